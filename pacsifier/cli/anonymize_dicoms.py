@@ -20,6 +20,10 @@ import warnings
 
 import numpy as np
 import pydicom
+from pydicom.filebase import DicomFileLike
+from pydicom.filereader import read_dataset
+from pydicom.filewriter import write_dataset
+from pydicom.valuerep import EXPLICIT_VR_LENGTH_32
 from datetime import datetime, timedelta
 from glob import glob
 import os
@@ -27,9 +31,28 @@ import warnings
 from progressbar import ProgressBar
 import random
 import json
-from typing import Dict, Tuple
+from typing import BinaryIO, Callable, Dict, List, Optional, Sequence, Tuple
 import argparse
-import hashlib
+import struct
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
+
+from pacsifier.core.deid_profile import (
+    PROFILES,
+    OPTIONS,
+    CompiledProfile,
+    DeidContext,
+    get_profile,
+)
+from pacsifier.core.manifest import AnonymizationManifest, describe_input
+from pacsifier.core.uid_mapper import UID_SECRET_ENV, UIDMapper
+
+# Size of the chunks in which the pixel data is copied from the original to the anonymized file
+PIXEL_DATA_CHUNK_SIZE = 1024 * 1024
+
+# Length of the elements of undefined length, e.g. encapsulated pixel data
+UNDEFINED_LENGTH = 0xFFFFFFFF
 
 
 def parse_date(date: str) -> Tuple[int, int, int]:
@@ -93,62 +116,121 @@ def fuzz_date(date: str, fuzz_parameter: int = 30) -> Tuple[str, int]:
     return fuzzed_date, fuzz
 
 
-def anonymize_dicom_file(
-    filename: str,
-    output_filename: str,
+def get_deid_context(
+    dataset: pydicom.Dataset,
+    PatientID: str,
+    new_StudyInstanceUID: Optional[str] = None,
+    new_SeriesInstanceUID: Optional[str] = None,
+    new_SOPInstanceUID: Optional[str] = None,
+    fuzz_acqdates: bool = False,
+    fuzz_days_shift: int = 0,
+    uid_mapper: Optional[Callable[[str], str]] = None,
+) -> DeidContext:
+    """Return the values used by the de-identification profile for a dicom dataset.
+
+    The context must be built before the dataset is anonymized, from its original UIDs.
+
+    Args:
+        dataset: dicom dataset, not anonymized yet
+        PatientID: the new patientID after anonymization
+        new_StudyInstanceUID: new study instance UID, None to use ``uid_mapper``
+        new_SeriesInstanceUID: new series instance UID, None to use ``uid_mapper``
+        new_SOPInstanceUID: new SOP instance UID, None to use ``uid_mapper``
+        fuzz_acqdates: if True, shift the acquisition-related dates
+        fuzz_days_shift: number of days to shift dates by (can be positive or negative)
+        uid_mapper: function returning the new UID of an original UID. Default is a
+            :class:`pacsifier.core.uid_mapper.UIDMapper` with the ``PACSIFIER_UID_SECRET``
+            secret, or a random one: the new UIDs of the datasets anonymized separately
+            are then not consistent.
+
+    Returns:
+        DeidContext: the values used by the actions of the profile.
+
+    """
+    # One of the components of the StudyInstanceUID sometimes contains the original patientID
+    # (e.g. on GE Revolution CT machines). Therefore, the original patientID should be replaced
+    # by the new anonymous one. But DICOM standard part 5 chapter 9.1 'UID encoding rules' says
+    # 'Each component of a UID is a number and shall consist of one or more digits', and
+    # 'Each component numeric value shall be encoded using the characters 0-9'.
+    # So we use a numeric equivalent instead of the new_id which has no restrictions.
+    # All the UIDs, including the references to this study, series and instance
+    # in the sequences, are replaced consistently by the profile.
+    if uid_mapper is None:
+        uid_mapper = UIDMapper()
+    new_uids = {}  # type: Dict[str, str]
+    for keyword, new_uid in [
+        ("StudyInstanceUID", new_StudyInstanceUID),
+        ("SeriesInstanceUID", new_SeriesInstanceUID),
+        ("SOPInstanceUID", new_SOPInstanceUID),
+    ]:
+        if new_uid is not None and keyword in dataset:
+            new_uids[str(dataset.data_element(keyword).value)] = new_uid
+
+    def map_uid(uid: str) -> str:
+        return new_uids.get(uid) or uid_mapper(uid)
+
+    return DeidContext(
+        fields={"patient_id": PatientID},
+        date_shift=fuzz_days_shift if fuzz_acqdates else None,
+        uid_mapper=map_uid,
+    )
+
+
+def anonymize_dataset(
+    dataset: pydicom.Dataset,
     PatientID: str,
-    new_StudyInstanceUID: str,
-    new_SeriesInstanceUID: str,
-    new_SOPInstanceUID: str,
+    new_StudyInstanceUID: Optional[str] = None,
+    new_SeriesInstanceUID: Optional[str] = None,
+    new_SOPInstanceUID: Optional[str] = None,
     fuzz_birthdate: bool = True,
     fuzz_acqdates: bool = False,
     fuzz_days_shift: int = 0,
     delete_identifiable_files: bool = False,
     remove_private_tags: bool = False,
-) -> None:
-    """Anonymize the dicom image located at filename by affecting  patient id, patient name and date.
+    source: str = "",
+    profile: Optional[CompiledProfile] = None,
+    uid_mapper: Optional[Callable[[str], str]] = None,
+    context: Optional[DeidContext] = None,
+) -> bool:
+    """Anonymize a dicom dataset in place by affecting patient id, patient name and date.
 
-    If identifiable data is present, deletes the file.
+    This is the anonymization applied by :func:`anonymize_dicom_file`, which can
+    also be applied to datasets received from the network without writing them.
 
     Args:
-        filename: path to dicom image
-        output_filename: output path of anonymized image
+        dataset: dicom dataset, modified in place
         PatientID: the new patientID after anonymization
-        new_StudyInstanceUID: study instance UID to be used for depersonalisation. This should be a DICOM VR UI
-        new_SeriesInstanceUID: series instance UID to be used for depersonalisation. This should be a DICOM VR UI
-        new_SOPInstanceUID: SOP instance UID to be used for depersonalisation. This should be a DICOM VR UI
+        new_StudyInstanceUID: new study instance UID (DICOM VR UI). If None, it is given
+            by ``uid_mapper`` like the other UIDs.
+        new_SeriesInstanceUID: new series instance UID (DICOM VR UI). If None, it is given
+            by ``uid_mapper`` like the other UIDs.
+        new_SOPInstanceUID: new SOP instance UID (DICOM VR UI). If None, it is given
+            by ``uid_mapper`` like the other UIDs.
         fuzz_birthdate: if True, to fuzz the birthdate or not
-        fuzz_acqdates: if True, fuzz  acquisition-related dates including study date, InstanceCreationDate,
-            SeriesDate, AcquisitionDate, ContentDate, PerformedProcedureStepStartDate, and
-            (07a3,101b) ST (e.g. 201703251500), (07a3,1020) DA
-        fuzz_days_shift: number of days to shift dates (birth and various acquisition dates) by (can be positive or negative)
-        delete_identifiable_files: if True, delete DICOM Series which have identifiable information in the image data itself
-            (in the case of SCREEN SAVE image type for dose reports coming from the GE Revolution CT machine, which have the patient name embedded, and
-            from Toshiba/Canon Aquilion Prime, although these don't have SCREEN SAVE label in ImageType tag)
+        fuzz_acqdates: if True, fuzz acquisition-related dates (see :func:`anonymize_dicom_file`)
+        fuzz_days_shift: number of days to shift dates (birth and various acquisition dates)
+            by (can be positive or negative)
+        delete_identifiable_files: if True, identifiable datasets (see
+            :func:`anonymize_dicom_file`) are not anonymized and must be discarded
         remove_private_tags: if True remove all private tags
+        source: path (or description) of the dataset, used in error messages
+        profile: compiled de-identification profile (see :mod:`pacsifier.core.deid_profile`)
+            applied to the dataset, the ``pacsifier`` profile by default
+        uid_mapper: function returning the new UID of an original UID, applied to all the
+            UIDs of the dataset (see :func:`get_deid_context`)
+        context: values used by the profile (see :func:`get_deid_context`), given by the
+            other arguments if None
 
-    Todo:
-        - Implement proper exception handling
-        - Check if resulting depersonalised StudyInstanceUID conforms to the proper VR (should be < 64 chars?)
-        - Fuzz acquisition times: InstanceCreationTime, StudyTime, Seriestime, AcquisitionTime, ContentTime,
-            TimeOfSecondaryCapture, PerformedProcedureStepStartTime (VR: TM)
-        - Replace datestring in ReferencedSOPInstanceUID and FrameOfReferenceUID too...
-        - Handle private date-containing tags? (07a3, 101b) ST(e.g. 201703251500) and  (07a3, 1020) DA
+    Returns:
+        bool: False if the dataset has identifiable information in the image data
+            itself and must be discarded, True otherwise.
 
     """
-    # Load the current dicom file to depersonalise
-    try:
-        dataset = pydicom.read_file(filename)
-    except pydicom.errors.InvalidDicomError:
-        print("Error at file at path:  " + filename)
-        pass
-
     ninety_plus = False
     delete_this_file = False
-    attributes = dataset.dir("")
 
     if delete_identifiable_files:
-        if "ImageType" in attributes:
+        if "ImageType" in dataset:
             if "SCREEN SAVE" in dataset.data_element("ImageType").value:
                 delete_this_file = True
             if (
@@ -156,61 +238,13 @@ def anonymize_dicom_file(
                 and "CT" in dataset.data_element("Modality").value
             ):
                 delete_this_file = True
-        if "Modality" in attributes:
+        if "Modality" in dataset:
             if "SR" in dataset.data_element("Modality").value:
                 delete_this_file = True
 
     if delete_this_file:
-        os.remove(filename)
+        return False
     else:
-        if "PatientID" in attributes:
-            old_id = dataset.PatientID
-            dataset.PatientID = PatientID
-
-        if "PatientName" in attributes:
-            # make it a valid PN VR
-            dataset.PatientName = PatientID + "^sub"
-
-        if "InstitutionAddress" in attributes:
-            dataset.InstitutionAddress = "Address"
-
-        elements_to_blank = [
-            "AccessionNumber",
-            "CurrentPatientLocation",
-            "CountryOfResidence",
-            "InstitutionalDepartmentName",
-            "InstitutionName",
-            "IssuerOfPatientID",
-            "NameOfPhysicianReadingStudy",
-            "OperatorsName",
-            "OrderCallbackPhoneNumber",
-            "OtherPatientNames",
-            "OtherPatientIDs",
-            "PatientAddress",
-            "PatientBirthName",
-            "PatientsBirthTime",
-            "PatientInstitutionResidence",
-            "PatientMotherBirthName",
-            "PatientTelephoneNumbers",
-            "PersonAddress",
-            "PersonName",
-            "PersonTelephoneNumbers",
-            "PerformingPhysicianIDSequence",
-            "PerformingPhysicianName",
-            "PhysiciansReadingStudyIdentificationSequence",
-            "PhysicianOfRecord",
-            "RegionOfResidence",
-            "ReferringPhysiciansAddress",
-            "ReferringPhysicianIDSequence",
-            "ReferringPhysiciansName",
-            "ReferringPhysicianTelephoneNumbers",
-            "RelatedSeriesSequenceAttribute",
-        ]
-        # note: OtherPatientIDs is a retired attribute
-        for el in elements_to_blank:
-            if el in attributes:
-                dataset.data_element(el).value = ""
-
         # now take care of age
         try:
             age = dataset.PatientAge
@@ -224,46 +258,7 @@ def anonymize_dicom_file(
         except AttributeError:
             pass
 
-        # One of the components of the StudyInstanceUID sometimes contains the original patientID (e.g. on GE Revolution CT machines).
-        # Therefore, the original patientID should be replaced by the new anonymous one.
-        # But DICOM standard part 5 chapter 9.1 'UID encoding rules' says 'Each component of a UID is a number and
-        # shall consist of one or more digits', and 'Each component numeric value shall be encoded using the characters 0-9'
-        # So we use a numeric equivalent instead of the new_id which has no restrictions
-
-        if "StudyInstanceUID" in attributes:
-            dataset.StudyInstanceUID = new_StudyInstanceUID
-        if "SeriesInstanceUID" in attributes:
-            dataset.SeriesInstanceUID = new_SeriesInstanceUID
-        if "SOPInstanceUID" in attributes:
-            dataset.SOPInstanceUID = new_SOPInstanceUID
-        # make Media Storage SOP Instance UID equal to  new SOPInstanceUID.
-        # See https://dicom.nema.org/dicom/2013/output/chtml/part10/chapter_7.html
-        if (0x02, 0x0) in dataset.file_meta:
-            dataset.file_meta[0x02, 0x03].value = new_SOPInstanceUID
-        if "ReferencedPerformedProcedureStepSequence" in attributes:
-            del dataset.ReferencedPerformedProcedureStepSequence
-
-        # we also have to fix the potentially referrring tags
-        # RequestAttributesSequence 0040,0275 is type 3, so optional, we should be able to delete it
-        # ReferencedStudySequence 0008,1110 is type 3 in GENERAL STUDY MODULE ATTRIBUTES (type 2 in other modules), so we could also delete it
-        # - RequestAttributesSequence > ReferencedStudySequence > ReferencedSOPInstanceUID
-        # or
-        # - RequestAttributesSequence >  StudyInstanceUID
-        # or
-        # - RequestAttributesSequence > Accession Number
-        # Also
-        # - ReferencedStudySequence > ReferencedSOPInstanceUID
-        # - ReferencedPerformedProcedureStepSequence > ReferencedSOPInstanceUID
-
-        if "RequestAttributesSequence" in attributes:
-            del dataset.RequestAttributesSequence
-
-        if "ReferencedStudySequence" in attributes:
-            del dataset.ReferencedStudySequence
-        # 	ReferencedStudySequence = dataset.ReferencedStudySequence
-        # 	dataset.ReferencedStudySequence = ReferencedStudySequence.replace(old_id, PatientID_numstr)
-
-        if "PatientBirthDate" in attributes:
+        if "PatientBirthDate" in dataset:
             # Assign a new fuzzed birth date, except if patient is 90+ in which case don't touch the fake birthdate.
             if fuzz_birthdate:
                 fuzzed_birthdate = shift_date_by_some_days(
@@ -289,32 +284,422 @@ def anonymize_dicom_file(
                 except AttributeError:
                     pass
 
-        if fuzz_acqdates:
-            if "StudyDate" not in attributes:
-                raise AssertionError(
-                    f"Cannot fuzz acquisition dates, StudyDate not in Dicom tags in file {filename}"
-                )
-            fuzzed_acqdate = shift_date_by_some_days(
-                dataset.data_element("StudyDate"), fuzz_days_shift
+        if fuzz_acqdates and "StudyDate" not in dataset:
+            raise AssertionError(
+                f"Cannot fuzz acquisition dates, StudyDate not in Dicom tags in file {source}"
             )
-            dates_to_fuzz = [
-                "StudyDate",
-                "InstanceCreationDate",
-                "SeriesDate",
-                "AcquisitionDate",
-                "ContentDate",
-                "PerformedProcedureStepStartDate",
-                "DateOfSecondaryCapture",
-            ]
-            for el in dates_to_fuzz:
-                if el in attributes:
-                    dataset.data_element(el).value = fuzzed_acqdate
 
-        if remove_private_tags:
-            dataset.remove_private_tags()
+        if context is None:
+            context = get_deid_context(
+                dataset,
+                PatientID,
+                new_StudyInstanceUID=new_StudyInstanceUID,
+                new_SeriesInstanceUID=new_SeriesInstanceUID,
+                new_SOPInstanceUID=new_SOPInstanceUID,
+                fuzz_acqdates=fuzz_acqdates,
+                fuzz_days_shift=fuzz_days_shift,
+                uid_mapper=uid_mapper,
+            )
+        if profile is None:
+            profile = get_profile(remove_private_tags=remove_private_tags)
+        profile.apply(dataset, context)
+
+        # make Media Storage SOP Instance UID equal to  new SOPInstanceUID.
+        # See https://dicom.nema.org/dicom/2013/output/chtml/part10/chapter_7.html
+        new_SOPInstanceUID = dataset.get("SOPInstanceUID", new_SOPInstanceUID)
+        if (0x02, 0x0) in dataset.file_meta and new_SOPInstanceUID is not None:
+            dataset.file_meta[0x02, 0x03].value = new_SOPInstanceUID
+
+        return True
+
+
+def anonymize_dicom_file(
+    filename: str,
+    output_filename: str,
+    PatientID: str,
+    new_StudyInstanceUID: Optional[str] = None,
+    new_SeriesInstanceUID: Optional[str] = None,
+    new_SOPInstanceUID: Optional[str] = None,
+    fuzz_birthdate: bool = True,
+    fuzz_acqdates: bool = False,
+    fuzz_days_shift: int = 0,
+    delete_identifiable_files: bool = False,
+    remove_private_tags: bool = False,
+    profile: str = "pacsifier",
+    profile_options: Sequence[str] = (),
+    uid_mapper: Optional[Callable[[str], str]] = None,
+) -> Optional[str]:
+    """Anonymize the dicom image located at filename by affecting  patient id, patient name and date.
+
+    If identifiable data is present, deletes the file.
+
+    Args:
+        filename: path to dicom image
+        output_filename: output path of anonymized image, or existing folder in which
+            it is written as ``<new SOPInstanceUID>.dcm``
+        PatientID: the new patientID after anonymization
+        new_StudyInstanceUID: new study instance UID (DICOM VR UI). If None, it is given
+            by ``uid_mapper``.
+        new_SeriesInstanceUID: new series instance UID (DICOM VR UI). If None, it is given
+            by ``uid_mapper``.
+        new_SOPInstanceUID: new SOP instance UID (DICOM VR UI). If None, it is given
+            by ``uid_mapper``.
+        fuzz_birthdate: if True, to fuzz the birthdate or not
+        fuzz_acqdates: if True, fuzz  acquisition-related dates including study date, InstanceCreationDate,
+            SeriesDate, AcquisitionDate, ContentDate, PerformedProcedureStepStartDate, and
+            (07a3,101b) ST (e.g. 201703251500), (07a3,1020) DA
+        fuzz_days_shift: number of days to shift dates (birth and various acquisition dates) by (can be positive or negative)
+        delete_identifiable_files: if True, delete DICOM Series which have identifiable information in the image data itself
+            (in the case of SCREEN SAVE image type for dose reports coming from the GE Revolution CT machine, which have the patient name embedded, and
+            from Toshiba/Canon Aquilion Prime, although these don't have SCREEN SAVE label in ImageType tag)
+        remove_private_tags: if True remove all private tags
+        profile: name of the de-identification profile (see :mod:`pacsifier.core.deid_profile`)
+        profile_options: names of the options applied on top of the profile
+        uid_mapper: function returning the new UID of an original UID
+            (see :func:`get_deid_context`)
+
+    Returns:
+        str: path of the anonymized image, None if the image was deleted.
+
+    Todo:
+        - Implement proper exception handling
+        - Check if resulting depersonalised StudyInstanceUID conforms to the proper VR (should be < 64 chars?)
+        - Fuzz acquisition times: InstanceCreationTime, StudyTime, Seriestime, AcquisitionTime, ContentTime,
+            TimeOfSecondaryCapture, PerformedProcedureStepStartTime (VR: TM)
+        - Handle private date-containing tags? (07a3, 101b) ST(e.g. 201703251500) and  (07a3, 1020) DA
+
+    """
+    # Load the header of the current dicom file to depersonalise, up to its pixel data
+    try:
+        with open(filename, "rb") as fp:
+            dataset = pydicom.read_file(fp, stop_before_pixels=True)
+            pixel_data_offset = fp.tell()
+    except pydicom.errors.InvalidDicomError:
+        print("Error at file at path:  " + filename)
+        pass
+
+    # A deflated dataset is compressed as a whole: its pixel data cannot be copied as is
+    deflated = (
+        dataset.file_meta.get("TransferSyntaxUID")
+        == pydicom.uid.DeflatedExplicitVRLittleEndian
+    )
+    if deflated:
+        dataset = pydicom.read_file(filename)
+
+    # The same profile and context are applied to the elements following the pixel data
+    compiled_profile = get_profile(profile, tuple(profile_options), remove_private_tags)
+    context = get_deid_context(
+        dataset,
+        PatientID,
+        new_StudyInstanceUID=new_StudyInstanceUID,
+        new_SeriesInstanceUID=new_SeriesInstanceUID,
+        new_SOPInstanceUID=new_SOPInstanceUID,
+        fuzz_acqdates=fuzz_acqdates,
+        fuzz_days_shift=fuzz_days_shift,
+        uid_mapper=uid_mapper,
+    )
+    keep = anonymize_dataset(
+        dataset,
+        PatientID=PatientID,
+        new_StudyInstanceUID=new_StudyInstanceUID,
+        new_SeriesInstanceUID=new_SeriesInstanceUID,
+        new_SOPInstanceUID=new_SOPInstanceUID,
+        fuzz_birthdate=fuzz_birthdate,
+        fuzz_acqdates=fuzz_acqdates,
+        fuzz_days_shift=fuzz_days_shift,
+        delete_identifiable_files=delete_identifiable_files,
+        remove_private_tags=remove_private_tags,
+        source=filename,
+        profile=compiled_profile,
+        context=context,
+    )
+
+    if not keep:
+        os.remove(filename)
+        return None
 
+    if os.path.isdir(output_filename):
+        new_SOPInstanceUID = dataset.get("SOPInstanceUID") or pydicom.uid.generate_uid(
+            pydicom.uid.PYDICOM_ROOT_UID
+        )
+        output_filename = os.path.join(output_filename, f"{new_SOPInstanceUID}.dcm")
+    if deflated:
         # write the 'anonymized' DICOM out under the new filename
         dataset.save_as(output_filename)
+    else:
+        # write the 'anonymized' header followed by the original pixel data under the new filename
+        write_with_original_pixel_data(
+            dataset,
+            filename,
+            pixel_data_offset,
+            output_filename,
+            compiled_profile,
+            context,
+        )
+    return output_filename
+
+
+def copy_bytes(src: BinaryIO, dst: BinaryIO, length: int) -> None:
+    """Copy ``length`` bytes from a file to another by chunks of ``PIXEL_DATA_CHUNK_SIZE``."""
+    while length > 0:
+        chunk = src.read(min(length, PIXEL_DATA_CHUNK_SIZE))
+        if not chunk:
+            raise EOFError("Unexpected end of file while copying the pixel data!")
+        dst.write(chunk)
+        length -= len(chunk)
+
+
+def copy_data_element(
+    src: BinaryIO, dst: BinaryIO, is_little_endian: bool, is_implicit_VR: bool
+) -> bool:
+    """Copy the encoded data element at the position of ``src`` without decoding its value.
+
+    Elements of undefined length (encapsulated pixel data) are copied item by
+    item up to their sequence delimitation item.
+
+    Args:
+        src: file positioned at the start of the element
+        dst: file to which the element is copied
+        is_little_endian: True if the dataset is encoded in little endian
+        is_implicit_VR: True if the dataset is encoded with implicit VR
+
+    Returns:
+        bool: False if ``src`` was at its end, True otherwise.
+
+    """
+    endian = "<" if is_little_endian else ">"
+    header = src.read(8)
+    if not header:
+        return False
+    dst.write(header)
+    if is_implicit_VR:
+        length = struct.unpack(endian + "L", header[4:8])[0]
+    elif header[4:6].decode("ascii") in EXPLICIT_VR_LENGTH_32:
+        extra = src.read(4)
+        dst.write(extra)
+        length = struct.unpack(endian + "L", extra)[0]
+    else:
+        length = struct.unpack(endian + "H", header[6:8])[0]
+
+    if length != UNDEFINED_LENGTH:
+        copy_bytes(src, dst, length)
+        return True
+
+    while True:
+        item = src.read(8)
+        dst.write(item)
+        group, element, length = struct.unpack(endian + "HHL", item)
+        if (group, element) == (0xFFFE, 0xE0DD):
+            return True
+        copy_bytes(src, dst, length)
+
+
+def write_with_original_pixel_data(
+    dataset: pydicom.Dataset,
+    filename: str,
+    pixel_data_offset: int,
+    output_filename: str,
+    profile: CompiledProfile,
+    context: DeidContext,
+) -> None:
+    """Write an anonymized header followed by the pixel data of the original file.
+
+    The pixel data is copied by chunks without being decoded, so that the
+    memory used does not depend on the size of the image. The elements
+    following the pixel data, if any (e.g. private tags of some vendors), are
+    decoded, de-identified like the header and written after it.
+
+    Args:
+        dataset: anonymized dataset read up to its pixel data (``stop_before_pixels``)
+        filename: path to the original dicom image
+        pixel_data_offset: position of the pixel data element in the original file
+        output_filename: output path of anonymized image, which can be ``filename``
+        profile: de-identification profile applied to the header
+        context: values used by the profile for the header (see :func:`get_deid_context`)
+
+    """
+    temp_filename = output_filename + ".part"
+    with open(filename, "rb") as src, open(temp_filename, "wb") as dst:
+        dataset.save_as(dst)
+        src.seek(pixel_data_offset)
+        if copy_data_element(
+            src, dst, dataset.is_little_endian, dataset.is_implicit_VR
+        ):
+            trailing = read_dataset(
+                src, dataset.is_implicit_VR, dataset.is_little_endian
+            )
+            profile.apply(trailing, context)
+            if len(trailing) > 0:
+                fp = DicomFileLike(dst)
+                fp.is_little_endian = dataset.is_little_endian
+                fp.is_implicit_VR = dataset.is_implicit_VR
+                write_dataset(fp, trailing)
+    os.replace(temp_filename, output_filename)
+
+
+class StreamAnonymizer:
+    """Anonymize datasets one by one, e.g. while they are received from a PACS server.
+
+    The anonymization is the one of :func:`anonymize_all_dicoms_within_root_folder`,
+    without reading or writing files: each patient gets a new id and a random
+    date offset, and the UIDs are replaced by ``uid_mapper``. The same
+    original patient or UID always gets the same new id or UID, so that the
+    datasets of a series stay consistent.
+
+    Args:
+        new_ids: new id of each original PatientID. Patients without new id get
+                 a sequential one (``000001``, ``000002``...).
+        fuzz_acq_dates: shift the acquisition-related dates by the date offset of the
+                        patient if True
+        delete_identifiable_files: discard identifiable datasets (see
+                                   :func:`anonymize_dicom_file`) if True
+        remove_private_tags: remove all private tags if True
+        profile: name of the de-identification profile (see :mod:`pacsifier.core.deid_profile`)
+        profile_options: names of the options applied on top of the profile
+        uid_mapper: function returning the new UID of an original UID. Default is a
+            :class:`pacsifier.core.uid_mapper.UIDMapper` with a random secret.
+
+    """
+
+    def __init__(
+        self,
+        new_ids: Dict[str, str] = None,
+        fuzz_acq_dates: bool = False,
+        delete_identifiable_files: bool = True,
+        remove_private_tags: bool = False,
+        profile: str = "pacsifier",
+        profile_options: Sequence[str] = (),
+        uid_mapper: Optional[Callable[[str], str]] = None,
+    ) -> None:
+        self.new_ids = dict(new_ids or {})
+        self.fuzz_acq_dates = fuzz_acq_dates
+        self.delete_identifiable_files = delete_identifiable_files
+        self.remove_private_tags = remove_private_tags
+        self.profile = get_profile(profile, tuple(profile_options), remove_private_tags)
+        # New id -> date offset in days
+        self.date_offsets = {}  # type: Dict[str, int]
+        self.uid_mapper = uid_mapper or UIDMapper()
+        self._lock = threading.Lock()
+
+    def _new_id(self, patient_id: str) -> str:
+        if patient_id not in self.new_ids:
+            self.new_ids[patient_id] = str(len(self.new_ids) + 1).zfill(6)
+        new_id = self.new_ids[patient_id]
+        if new_id not in self.date_offsets:
+            self.date_offsets[new_id] = random.randint(-30, 30)
+        return new_id
+
+    def __call__(self, dataset: pydicom.Dataset) -> Optional[pydicom.Dataset]:
+        """Anonymize a dataset in place.
+
+        Args:
+            dataset: dicom dataset
+
+        Returns:
+            the anonymized dataset, or None if it must be discarded
+
+        """
+        with self._lock:
+            new_id = self._new_id(str(dataset.get("PatientID", "")))
+
+        keep = anonymize_dataset(
+            dataset,
+            PatientID=new_id,
+            fuzz_birthdate=True,
+            fuzz_acqdates=self.fuzz_acq_dates,
+            fuzz_days_shift=self.date_offsets[new_id],
+            delete_identifiable_files=self.delete_identifiable_files,
+            remove_private_tags=self.remove_private_tags,
+            source=f"instance {dataset.get('SOPInstanceUID', '')}",
+            profile=self.profile,
+            uid_mapper=self.uid_mapper,
+        )
+        return dataset if keep else None
+
+    def mapper(self) -> Dict[str, str]:
+        """Return the mapping from the new ids to the original PatientIDs."""
+        return {new_id: patient_id for patient_id, new_id in self.new_ids.items()}
+
+
+def anonymize_series(
+    series_dir: str,
+    output_series_dir: str,
+    PatientID: str,
+    fuzz_days_shift: int,
+    fuzz_acq_dates: bool = False,
+    delete_identifiable_files: bool = True,
+    remove_private_tags: bool = False,
+    profile: str = "pacsifier",
+    profile_options: Sequence[str] = (),
+    uid_mapper: Optional[Callable[[str], str]] = None,
+    filenames: Optional[List[str]] = None,
+    describe_inputs: bool = False,
+) -> List[Dict[str, object]]:
+    """Anonymize all the dicom images of a series folder with :func:`anonymize_dicom_file`.
+
+    The UIDs of each image are replaced by ``uid_mapper``, and its new
+    SOPInstanceUID is also used as its file name.
+
+    Args:
+        series_dir: folder of the dicom images of the series
+        output_series_dir: folder where the anonymized images are written
+        PatientID: the new patientID after anonymization
+        fuzz_days_shift: number of days to shift dates by (date offset of the patient)
+        fuzz_acq_dates: fuzz acquisition-related dates if True
+        delete_identifiable_files: delete the identifiable images if True
+        remove_private_tags: remove all private tags if True
+        profile: name of the de-identification profile (see :mod:`pacsifier.core.deid_profile`)
+        profile_options: names of the options applied on top of the profile
+        uid_mapper: function returning the new UID of an original UID. Default is a
+            :class:`pacsifier.core.uid_mapper.UIDMapper` shared by the images of the series.
+        filenames: images of the series folder to anonymize, all of them if None
+        describe_inputs: add the size, modification time and digest of each image
+            to its record (see :func:`pacsifier.core.manifest.describe_input`) if True
+
+    Returns:
+        list: ``input`` and ``output`` path (None if deleted) of each image
+
+    """
+    if filenames is None:
+        filenames = glob(os.path.join(series_dir, "*"))
+    if uid_mapper is None:
+        uid_mapper = UIDMapper()
+
+    # Loop over all dicom files within the series directory and anonymize them.
+    records = []  # type: List[Dict[str, object]]
+    for filename in filenames:
+        # Described before the anonymization, which deletes the identifiable images
+        record = describe_input(filename) if describe_inputs else {}
+        record["input"] = filename
+        record["output"] = anonymize_dicom_file(
+            filename,
+            output_series_dir,
+            PatientID=PatientID,
+            fuzz_birthdate=True,
+            fuzz_acqdates=fuzz_acq_dates,
+            fuzz_days_shift=fuzz_days_shift,
+            delete_identifiable_files=delete_identifiable_files,
+            remove_private_tags=remove_private_tags,
+            profile=profile,
+            profile_options=profile_options,
+            uid_mapper=uid_mapper,
+        )
+        records.append(record)
+    return records
+
+
+def merge_folders(folder: str, new_folder: str) -> None:
+    """Rename a folder, or move its content into the new folder and its subfolders if it exists."""
+    if not os.path.isdir(new_folder):
+        os.replace(folder, new_folder)
+        return
+    for name in os.listdir(folder):
+        path, new_path = os.path.join(folder, name), os.path.join(new_folder, name)
+        if os.path.isdir(path) and os.path.isdir(new_path):
+            merge_folders(path, new_path)
+        else:
+            os.replace(path, new_path)
+    os.rmdir(folder)
 
 
 def anonymize_all_dicoms_within_root_folder(
@@ -326,9 +711,30 @@ def anonymize_all_dicoms_within_root_folder(
     delete_identifiable_files: bool = True,
     remove_private_tags: bool = False,
     fuzz_acq_dates: bool = False,
+    jobs: int = 1,
+    profile: str = "pacsifier",
+    profile_options: Sequence[str] = (),
+    uid_secret: Optional[str] = None,
+    uid_map: Optional[str] = None,
+    incremental: bool = True,
 ) -> Dict[str, str]:
     """Anonymizes all dicom images located at the datapath in the structure specified by pattern_dicom_files parameter.
 
+    With ``jobs`` greater than 1, the series are anonymized by a pool of
+    processes. The new ids and date offsets are still assigned by the calling
+    process, in the order of the folders, and the mapping and date offsets are
+    written once all the series are anonymized. The new UIDs are derived from
+    the original ones under ``uid_secret`` (see
+    :class:`pacsifier.core.uid_mapper.UIDMapper`), so they do not depend on the
+    process anonymizing an image, and the runs sharing the secret give the same UIDs.
+
+    The anonymized files are recorded in a manifest in the output folder (see
+    :class:`pacsifier.core.manifest.AnonymizationManifest`). A new run with the
+    same parameters, including the UID secret, only anonymizes the files which
+    are new or changed, with the new ids and date offsets of the previous runs,
+    and merges them into the folders of the previous runs. A random UID secret
+    is never written, so the runs without a secret anonymize all the files again.
+
     Args:
         output_folder: path where anonymized images will be located
         datapath: path to the dicom images
@@ -340,12 +746,48 @@ def anonymize_all_dicoms_within_root_folder(
             (in the case of screen savings coming from the GE Revolution CT machine, which have the patient name embedded for example)
         remove_private_tags: remove all private tags if True
         fuzz_acq_dates: shift the acquisition-related dates randomly by +- 30 days if True
+        jobs: number of processes anonymizing the series at the same time. Default is 1.
+        profile: name of the de-identification profile (see :mod:`pacsifier.core.deid_profile`).
+            Default is ``pacsifier``.
+        profile_options: names of the options applied on top of the profile
+        uid_secret: project secret from which the new UIDs are derived. If None, it is read
+            from the ``PACSIFIER_UID_SECRET`` environment variable, or drawn at random for
+            this run.
+        uid_map: path to a CSV file keeping the mapping from the original to the new UIDs
+        incremental: skip the files anonymized by the previous runs if True. Default is True.
 
     Returns:
         dict: dictionary keeping track of the new patientIDs and old patientIDs mappings
 
     """
     # TODO: fix required vs optional arguments
+    if jobs < 1:
+        raise ValueError("At least one job is needed to anonymize the files!")
+    # Fail before anonymizing anything if the profile is unknown
+    get_profile(profile, tuple(profile_options), remove_private_tags)
+
+    manifest = AnonymizationManifest(output_folder, datapath)
+    # Without a project secret, the UIDs are derived from a random one which is
+    # not kept: its fingerprint differs from the one of the previous runs
+    if uid_secret is None and not os.environ.get(UID_SECRET_ENV) and manifest.files:
+        warnings.warn(
+            "No UID secret given (--uid_secret or PACSIFIER_UID_SECRET): all the files "
+            "are anonymized again with new UIDs."
+        )
+    uid_mapper = UIDMapper(uid_secret, uid_map)
+    manifest.start(
+        {
+            "pattern_dicom_files": pattern_dicom_files,
+            "rename_patient_directories": rename_patient_directories,
+            "delete_identifiable_files": delete_identifiable_files,
+            "remove_private_tags": remove_private_tags,
+            "fuzz_acq_dates": fuzz_acq_dates,
+            "profile": profile,
+            "profile_options": sorted(profile_options),
+            "uid_secret": uid_mapper.fingerprint,
+        },
+        incremental=incremental,
+    )
 
     # List all  patient directories.
     patients_folders = next(os.walk(datapath))[1]
@@ -357,9 +799,18 @@ def anonymize_all_dicoms_within_root_folder(
         )
 
     if new_ids is None:
+        # The patients of the previous runs keep their new ids
         new_ids = {
-            patients_folders[i]: str(i+1).zfill(6) for i in range(len(patients_folders))
+            patient: record["new_id"] for patient, record in manifest.patients.items()
         }
+        used_ids = set(new_ids.values())
+        for i, patient in enumerate(patients_folders):
+            if patient not in new_ids:
+                number = i + 1
+                while str(number).zfill(6) in used_ids:
+                    number += 1
+                new_ids[patient] = str(number).zfill(6)
+                used_ids.add(new_ids[patient])
 
     all_date_offsets = np.zeros(len(patients_folders), dtype=np.int16)
 
@@ -378,9 +829,18 @@ def anonymize_all_dicoms_within_root_folder(
 
     old2set_idx = {}
 
+    # The new ids and date offsets are all assigned here, so that they do not
+    # depend on which worker anonymizes which series.
+    # Series to anonymize: (input folder, output folder, new id, date offset, files to anonymize)
+    series_tasks = []  # type: List[Tuple[str, str, str, int, List[str]]]
+    # Folders renamed once all their files are anonymized: (original path, new path)
+    study_renames = []  # type: List[Tuple[str, str]]
+    patient_renames = []  # type: List[Tuple[str, str]]
+    # Patients of the previous runs, whose anonymized folders are merged
+    known_patients = set(manifest.patients)
+
     # Loop over patients...
-    progress = ProgressBar()
-    for patient_index, patient in enumerate(progress(patients_folders)):
+    for patient_index, patient in enumerate(patients_folders):
         new_id = old2new_idx[patient]
         current_path = os.path.join(datapath, patient, pattern_dicom_files)
 
@@ -393,12 +853,6 @@ def anonymize_all_dicoms_within_root_folder(
             old2set_idx[new_id] = patient.split("-")[-1]
             os.remove(os.path.join(datapath, patient, "new_id.txt"))
 
-        # generate numeric string new ID - UI VR must have only digits
-        # use sha512 to be faster on 64 bits platforms and supported by python 3.5
-        new_id_numstr = str(
-            int(hashlib.sha512(new_id.encode("UTF-8")).hexdigest(), base=16)
-        )[0:16]
-
         # List all files within patient folder
         all_filenames = glob(current_path)
 
@@ -415,17 +869,26 @@ def anonymize_all_dicoms_within_root_folder(
                 "in pattern_dicom_files, currently " + pattern_dicom_files
             )
         else:
-            # grab real birth date
-            # TODO handle case where first file does not contain birthdate - look for any file that does?
-            first_file = pydicom.read_file(all_filenames[0])
-            if "PatientBirthDate" in first_file:
-                real_birthdate = first_file.data_element("PatientBirthDate").value
-                fuzzed_birthdate, birthdate_offset_days = fuzz_date(real_birthdate)
-            # print('Replacing real birthdate {} with {}'.format(real_birthdate, fuzzed_birthdate))
+            if patient in manifest.patients:
+                # keep the date offset of the previous runs
+                birthdate_offset_days = int(manifest.patients[patient]["date_offset"])
             else:
-                fuzzed_birthdate = ""
-                birthdate_offset_days = 0
+                # grab real birth date
+                # TODO handle case where first file does not contain birthdate
+                # - look for any file that does?
+                first_file = pydicom.read_file(
+                    all_filenames[0],
+                    stop_before_pixels=True,
+                    specific_tags=["PatientBirthDate"],
+                )
+                if "PatientBirthDate" in first_file:
+                    real_birthdate = first_file.data_element("PatientBirthDate").value
+                    fuzzed_birthdate, birthdate_offset_days = fuzz_date(real_birthdate)
+                else:
+                    fuzzed_birthdate = ""
+                    birthdate_offset_days = 0
             all_date_offsets[patient_index] = birthdate_offset_days
+            manifest.add_patient(patient, new_id, birthdate_offset_days)
 
             if not os.path.isdir(
                 os.path.join(output_folder, patient)
@@ -451,18 +914,18 @@ def anonymize_all_dicoms_within_root_folder(
                     fuzzed_study_date = shift_date_by_some_days(
                         original_study_date, int(all_date_offsets[patient_index])
                     )
-                    # rename dir
+                    # rename dir once its series are anonymized
                     fuzzed_study_dir = (
                         f"{study_dir_prefix}-{fuzzed_study_date}{original_study_time}"
                     )
                     # TODO edge case: what if fuzzed date maps to an already existing session? should be OK since
                     # not yet written to output
-                else:
-                    fuzzed_study_date = ""
-
-                new_StudyInstanceUID = pydicom.uid.generate_uid(
-                    pydicom.uid.PYDICOM_ROOT_UID
-                )
+                    study_renames.append(
+                        (
+                            os.path.join(output_folder, patient, study_dir),
+                            os.path.join(output_folder, patient, fuzzed_study_dir),
+                        )
+                    )
 
                 # List all series dirs for this patient.
                 series_dirs = next(os.walk(os.path.join(datapath, patient, study_dir)))[
@@ -470,6 +933,17 @@ def anonymize_all_dicoms_within_root_folder(
                 ]
 
                 for series_dir in series_dirs:
+                    # Only the files new or changed since the previous runs are anonymized
+                    series_filenames = []
+                    for filename in glob(
+                        os.path.join(datapath, patient, study_dir, series_dir, "*")
+                    ):
+                        if not manifest.is_current(filename):
+                            manifest.discard(filename)
+                            series_filenames.append(filename)
+                    if not series_filenames:
+                        continue
+
                     if not os.path.isdir(
                         os.path.join(output_folder, patient, study_dir, series_dir)
                     ):  # create series dir if needed
@@ -477,71 +951,116 @@ def anonymize_all_dicoms_within_root_folder(
                             os.path.join(output_folder, patient, study_dir, series_dir)
                         )
 
-                    new_SeriesInstanceUID = pydicom.uid.generate_uid(
-                        pydicom.uid.PYDICOM_ROOT_UID
-                    )
-
-                    all_filenames_series = glob(
-                        os.path.join(datapath, patient, study_dir, series_dir, "*")
-                    )
-
-                    # Loop over all dicom files within a patient directory and anonymize them.
-                    for filename in all_filenames_series:
-                        new_SOPInstanceUID = pydicom.uid.generate_uid(
-                            pydicom.uid.PYDICOM_ROOT_UID
-                        )
-
-                        anonymize_dicom_file(
-                            filename,
-                            os.path.join(
-                                output_folder,
-                                patient,
-                                study_dir,
-                                series_dir,
-                                f"{new_SOPInstanceUID}.dcm",
-                            ),
-                            PatientID=new_id,
-                            new_StudyInstanceUID=new_StudyInstanceUID,
-                            new_SeriesInstanceUID=new_SeriesInstanceUID,
-                            new_SOPInstanceUID=new_SOPInstanceUID,
-                            fuzz_birthdate=True,
-                            fuzz_acqdates=fuzz_acq_dates,
-                            fuzz_days_shift=int(all_date_offsets[patient_index]),
-                            delete_identifiable_files=delete_identifiable_files,
-                            remove_private_tags=remove_private_tags,
+                    series_tasks.append(
+                        (
+                            os.path.join(datapath, patient, study_dir, series_dir),
+                            os.path.join(output_folder, patient, study_dir, series_dir),
+                            new_id,
+                            int(all_date_offsets[patient_index]),
+                            series_filenames,
                         )
-                # actually rename dirs if needed
-                if fuzz_acq_dates:
-                    os.replace(
-                        os.path.join(output_folder, patient, study_dir),
-                        os.path.join(output_folder, patient, fuzzed_study_dir),
                     )
 
         # If the patient folders are to be renamed.
         if rename_patient_directories:
-            try:
-                os.replace(
+            patient_renames.append(
+                (
                     os.path.join(output_folder, patient),
                     os.path.join(output_folder, "sub-" + new_id),
                 )
-            except OSError:  # if destination dir already exists
-                os.replace(
-                    os.path.join(output_folder, patient),
-                    os.path.join(output_folder, "sub-" + new_id + "_2"),
-                )
+            )
 
-    # return a mapping from new ids to old ids as a dictionary.
-    new2old_idx = {new: old.replace("sub-", "") for old, new in old2new_idx.items()}
+    anonymize = partial(
+        anonymize_series,
+        fuzz_acq_dates=fuzz_acq_dates,
+        delete_identifiable_files=delete_identifiable_files,
+        remove_private_tags=remove_private_tags,
+        profile=profile,
+        profile_options=tuple(profile_options),
+        uid_mapper=uid_mapper,
+        describe_inputs=True,
+    )
+    # The files of each series are added to the manifest once it is anonymized,
+    # so that a run which stopped is resumed after its last anonymized series
+    progress = ProgressBar(max_value=len(series_tasks))
+    if jobs == 1:
+        for series_dir, output_series_dir, new_id, date_offset, filenames in progress(
+            series_tasks
+        ):
+            manifest.add_files(
+                anonymize(
+                    series_dir,
+                    output_series_dir,
+                    new_id,
+                    date_offset,
+                    filenames=filenames,
+                )
+            )
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [
+                executor.submit(
+                    anonymize,
+                    series_dir,
+                    output_series_dir,
+                    new_id,
+                    date_offset,
+                    filenames=filenames,
+                )
+                for series_dir, output_series_dir, new_id, date_offset, filenames in series_tasks
+            ]
+            # Raise the first error of a worker
+            for future in progress(as_completed(futures)):
+                manifest.add_files(future.result())
+
+    # actually rename dirs if needed, merging them with the folders of the previous runs
+    for study_path, fuzzed_study_path in study_renames:
+        merge_folders(study_path, fuzzed_study_path)
+        manifest.move_outputs(study_path, fuzzed_study_path)
+    for patient_path, new_patient_path in patient_renames:
+        patient = os.path.basename(patient_path)
+        if patient in known_patients and os.path.isdir(new_patient_path):
+            merge_folders(patient_path, new_patient_path)
+        else:
+            try:
+                os.replace(patient_path, new_patient_path)
+            except OSError:  # if destination dir already exists
+                new_patient_path += "_2"
+                os.replace(patient_path, new_patient_path)
+        manifest.move_outputs(patient_path, new_patient_path)
+    manifest.write()
+
+    # return a mapping from new ids to old ids as a dictionary, including
+    # the patients anonymized by the previous runs only
+    new2old_idx = {
+        record["new_id"]: patient.replace("sub-", "")
+        for patient, record in manifest.patients.items()
+        if patient not in old2new_idx
+    }
+    new2old_idx.update(
+        {new: old.replace("sub-", "") for old, new in old2new_idx.items()}
+    )
 
-    # dumping new ids to a json file.
-    with open(os.path.join(output_folder, "mapper.json"), "w") as fp:
+    # dumping new ids to a json file, replaced at once so that it is never left half written.
+    mapper_path = os.path.join(output_folder, "mapper.json")
+    with open(mapper_path + ".part", "w") as fp:
         if len(old2set_idx.keys()) == 0:
             json.dump(new2old_idx, fp)
         else:
             json.dump(old2set_idx, fp)
-
-    # dump date offsets to a csv
-    all_date_offsets.tofile(os.path.join(output_folder, "date_offsets.csv"), sep=",")
+    os.replace(mapper_path + ".part", mapper_path)
+
+    # dump date offsets to a csv, in the order of the patients of mapper.json,
+    # including the patients anonymized by the previous runs only
+    date_offsets = {
+        record["new_id"]: record["date_offset"] for record in manifest.patients.values()
+    }
+    mapped_ids = old2set_idx if old2set_idx else new2old_idx
+    date_offsets_path = os.path.join(output_folder, "date_offsets.csv")
+    np.array(
+        [date_offsets.get(new_id, 0) for new_id in mapped_ids], dtype=np.int16
+    ).tofile(date_offsets_path + ".part", sep=",")
+    os.replace(date_offsets_path + ".part", date_offsets_path)
 
     return new2old_idx
 
@@ -591,6 +1110,48 @@ def get_parser() -> argparse.ArgumentParser:
         action="store_true",
     )
     parser.add_argument("--new_ids", "-n", help="List of new ids.")
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        help="Number of processes anonymizing the series at the same time",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--profile",
+        help="De-identification profile applied to the files. Default is pacsifier.",
+        choices=sorted(PROFILES),
+        default="pacsifier",
+    )
+    parser.add_argument(
+        "--profile_option",
+        help="Option applied on top of the de-identification profile (can be repeated)",
+        choices=sorted(OPTIONS),
+        action="append",
+        default=[],
+    )
+    parser.add_argument(
+        "--uid_secret",
+        help="Project secret from which the new UIDs are derived, so that the runs sharing it "
+        "give the same UIDs. Default is the PACSIFIER_UID_SECRET environment variable, or a "
+        "random secret, in which case the files of the previous runs are anonymized again.",
+        default=None,
+    )
+    parser.add_argument(
+        "--uid_map",
+        help="CSV file keeping the mapping from the original to the new UIDs, reused by later "
+        "runs",
+        default=None,
+    )
+    parser.add_argument(
+        "--force",
+        "-f",
+        help="Anonymize all the files again, including those anonymized by the previous runs "
+        "into the output directory",
+        default=False,
+        required=False,
+        action="store_true",
+    )
     parser.add_argument(
         "--keep_patient_dir_names",
         "-k",
@@ -651,6 +1212,12 @@ def main():
         remove_private_tags=remove_private_tags,
         rename_patient_directories=rename_patient_directories,
         fuzz_acq_dates=fuzz_acq_dates,
+        jobs=args.jobs,
+        profile=args.profile,
+        profile_options=args.profile_option,
+        uid_secret=args.uid_secret,
+        uid_map=args.uid_map,
+        incremental=not args.force,
     )
 
 
@@ -15,24 +15,72 @@
 
 """Script to query, retrieve, and upload DICOM images from / to a PACS server."""
 
-import re
-import shutil
-import unicodedata
 import sys
 import os
 import warnings
 from pandas import read_csv, DataFrame
 from pandas.errors import ParserError
 import json
-from typing import Iterator, Dict, List
+from typing import Callable, Iterator, Dict, List, Optional, Tuple
 from cerberus import Validator
 from progressbar import ProgressBar
+from pydicom.dataset import Dataset
 import csv
-import time
 import argparse
+import threading
+import time
+from concurrent.futures import Future
+from functools import partial
 
 from pacsifier.info import __version__
-from pacsifier.core.dcmtk.commands import echo, find, get, move_remote, upload, write_file
+from pacsifier.cli.anonymize_dicoms import StreamAnonymizer
+from pacsifier.core.backend import (
+    DicomBackend,
+    create_backend,
+    get_backend,
+    get_max_concurrent_moves,
+)
+from pacsifier.core.cache import DEFAULT_CACHE_DIR, QueryCache, clear_query_cache
+from pacsifier.core.estimator import RetrievalEstimate, ThroughputHistory, format_estimate
+from pacsifier.core.journal import (
+    JOURNAL_FILENAME,
+    QUERIED,
+    RetrievalJournal,
+    count_instances,
+)
+from pacsifier.core.ledger import LEDGER_FILENAME, UploadLedger, read_sop_instance_uid
+from pacsifier.core.metrics import (
+    BYTES,
+    INSTANCES,
+    QUEUE_DEPTH,
+    MetricsExporters,
+    observe_request,
+)
+from pacsifier.core.pipeline import BackgroundStage, prefetch
+from pacsifier.core.planner import format_plan_summary, plan_queries
+from pacsifier.core.records import SeriesRecord
+from pacsifier.core.relay import Relay
+from pacsifier.core.retry import RetryPolicy
+from pacsifier.core.dcmtk.commands import replay_failures
+from pacsifier.core.dcmtk.parsers import (
+    TAG_TO_KEYWORD,
+    readLineByLine,
+    parse_findscu_dump_file,
+)
+from pacsifier.core.scheduler import RetrievalScheduler
+from pacsifier.core.stats import (
+    STATUS_DONE,
+    STATUS_FAILED,
+    STATUS_QUERIED,
+    STATUS_SKIPPED,
+    RetrievalTiming,
+    format_summary,
+    summarize_log,
+    timed,
+)
+from pacsifier.core.sorter import get_series_dirs
+from pacsifier.core.throttle import AdaptiveThrottle
+from pacsifier.core.uid_mapper import UIDMapper
 from pacsifier.core.sanity_checks import (
     check_date,
     check_date_range,
@@ -42,113 +90,24 @@ from pacsifier.core.sanity_checks import (
 
 warnings.filterwarnings("ignore")
 
-TAG_TO_KEYWORD = {  # type: Dict[str,str]
-    "(0008,0020)": "StudyDate",
-    "(0008,0030)": "StudyTime",
-    "(0008,103e)": "SeriesDescription",
-    "(0010,0020)": "PatientID",
-    "(0018,1030)": "ProtocolName",
-    "(0020,000d)": "StudyInstanceUID",
-    "(0020,000e)": "SeriesInstanceUID",
-    "(0010,0010)": "PatientName",
-    "(0010,0030)": "PatientBirthDate",
-    "(0018,1000)": "DeviceSerialNumber",
-    "(0008,0022)": "AcquisitionDate",
-    "(0008,0060)": "Modality",
-    "(0008,0008)": "ImageType",
-    "(0020,0011)": "SeriesNumber",
-    "(0008,1030)": "StudyDescription",
-    "(0008,0050)": "AccessionNumber",
-    "(0018,0024)": "SequenceName",
-}
-
 ALLOWED_FILTERS = list(TAG_TO_KEYWORD.values())
 ALLOWED_FILTERS.append("new_ids")
 
-
-def readLineByLine(filename: str) -> Iterator[str]:
-    """Return a list of lines of a text file located at the path filename.
-
-    Args:
-        filename: path to text file to be read
-
-    Yields:
-        Iterator: list of text lines of the file
-
-    """
-    with open(filename, "r", encoding="utf_8") as f:
-        for line in f:
-            line = line.encode("ascii", "ignore").decode("ascii")
-            yield line.strip("\n")
-
-
-def parse_findscu_dump_file(filename: str) -> List[Dict[str, str]]:
-    """Extract all useful information from the text file generated by dumping the output of the findscu command.
-
-    Args:
-        filename: path to textfile to be read
-
-    Returns:
-        list: list dictionaries each containing the attributes of a series
-
-    """
-    start = False
-
-    id_table = []  # type: List[str]
-    output_dict = {"": ""}  # type: Dict[str,str]
-
-    # Iterate over text lines
-    for line in readLineByLine(filename):
-        sample_dict = {  # type: Dict[str,str]
-            "StudyDate": "",
-            "StudyTime": "",
-            "SeriesDescription": "",
-            "PatientID": "",
-            "ProtocolName": "",
-            "StudyInstanceUID": "",
-            "PatientName": "",
-            "PatientBirthDate": "",
-            "SeriesInstanceUID": "",
-            "DeviceSerialNumber": "",
-            "Modality": "",
-            "ImageType": "",
-            "SeriesNumber": "",
-            "StudyDescription": "",
-            "AccessionNumber": "",
-            "SequenceName": "",
-        }
-
-        if "------------" in line or "Releasing Association" in line:
-            if start:
-                id_table.append(output_dict)
-
-            start = True
-            output_dict = sample_dict
-            continue
-
-        if not start:
-            continue
-        for tag in sorted(TAG_TO_KEYWORD.keys()):
-            # if current line contains a given tag then extract information from it.
-            if tag in line:
-                item = ""
-                try:
-                    item = (
-                        line.split("[")[1]
-                        .split("]")[0]
-                        .replace(" ", "")
-                        .replace("'", "_")
-                        .replace("/", "")
-                    )
-                # In case line.split gives a list of length less that 4 pass to next line.
-                except IndexError:
-                    pass
-
-                if item == "(no":
-                    continue
-                output_dict[TAG_TO_KEYWORD[tag]] = item
-
-    return id_table
+# Columns of the retrieval log added to the columns of the query table
+LOG_COLUMNS = [
+    "StudyInstanceUID",
+    "SeriesNumber",
+    "Modality",
+    "FilesFound",
+    "Status",
+    "Server",
+    "StartTime",
+    "FindSeconds",
+    "MoveSeconds",
+    "BytesReceived",
+    "InstancesPerSecond",
+    "Retries",
+]
 
 
 def check_query_table_allowed_filters(
@@ -220,6 +179,232 @@ def process_person_names(name: str) -> str:
     return new_name
 
 
+def get_move_ports(parameters: Dict[str, str]) -> List[int]:
+    """Return the list of local ports on which retrieved images can be received.
+
+    The ports are taken from the optional ``move_port_range`` config entry
+    (first and last port, both included). If it is not set, only ``move_port``
+    is used.
+
+    Args:
+        parameters: parameters from PACSIFIER configuration file
+
+    Returns:
+        list: list of port numbers
+
+    """
+    if "move_port_range" in parameters:
+        first_port, last_port = parameters["move_port_range"]
+        return list(range(int(first_port), int(last_port) + 1))
+    return [int(parameters["move_port"])]
+
+
+def query_series(
+    backend: DicomBackend,
+    query_retrieval_level: str,
+    query_attributes: Dict[str, str],
+    cache: Optional[QueryCache] = None,
+) -> List[SeriesRecord]:
+    """Query the series matching the attributes of a row of the query table.
+
+    Args:
+        backend: backend connected to the PACS server
+        query_retrieval_level: query retrieval level (SERIES or IMAGE)
+        query_attributes: attributes of the row of the query table
+        cache: cache of the C-FIND results. The PACS server is only queried
+               if the cache has no recent result for the same request.
+
+    Returns:
+        list: list of series records
+
+    """
+    find = backend.find if cache is None else partial(cache.find, backend)
+    return find(
+        query_retrieval_level=query_retrieval_level,
+        patient_id=query_attributes["PatientID"],
+        study_uid=query_attributes["StudyInstanceUID"],
+        series_instance_uid=query_attributes["SeriesInstanceUID"],
+        series_description=query_attributes["SeriesDescription"],
+        protocol_name=query_attributes["ProtocolName"],
+        acquisition_date=query_attributes["AcquisitionDate"],
+        study_date=query_attributes["StudyDate"],
+        patient_name=query_attributes["PatientName"],
+        patient_birthdate=query_attributes["PatientBirthDate"],
+        device_serial_number=query_attributes["DeviceSerialNumber"],
+        modality=query_attributes["Modality"],
+        image_type=query_attributes["ImageType"],
+        study_description=query_attributes["StudyDescription"],
+        accession_number=query_attributes["AccessionNumber"],
+        sequence_name=query_attributes["SequenceName"],
+    )
+
+
+def group_series(series: List[SeriesRecord], retrieve_level: str) -> Dict[str, List[int]]:
+    """Group the series retrieved with the same C-MOVE request.
+
+    Args:
+        series: list of series records
+        retrieve_level: level of the retrieval in {SERIES, STUDY, PATIENT}
+
+    Returns:
+        dict: indices of the series of each group, indexed by the SeriesInstanceUID,
+              StudyInstanceUID or PatientID identifying the retrieval of the group
+
+    """
+    groups = {}  # type: Dict[str, List[int]]
+    for index, serie in enumerate(series):
+        if retrieve_level == "STUDY":
+            key = serie["StudyInstanceUID"]
+        elif retrieve_level == "PATIENT":
+            key = serie["PatientID"]
+        else:
+            key = serie["SeriesInstanceUID"]
+        groups.setdefault(key, []).append(index)
+    return groups
+
+
+def join_retrieval(
+    journal: RetrievalJournal,
+    retrieval: Future,
+    destinations: Dict[str, str],
+    added: Dict[str, str],
+    count_files: bool = True,
+) -> None:
+    """Add the series found by another row to the pending retrieval of their study or patient.
+
+    The series are filed into their folders if the images of the retrieval
+    are not sorted yet, and into the folders built from their headers
+    otherwise. Their state is recorded in the journal once the retrieval is done.
+
+    Args:
+        journal: journal of the retrieved series
+        retrieval: pending retrieval of the study or patient
+        destinations: output directory (or move AET) of each series of the
+                      retrieval, indexed by SeriesInstanceUID
+        added: output directory (or move AET) of each added series
+        count_files: if True, the files of the added series are counted once retrieved
+
+    """
+    destinations.update(added)
+
+    def record(future: Future) -> None:
+        success = future.exception() is None and bool(future.result())
+        journal.record_retrieval(added, success, count_files)
+
+    retrieval.add_done_callback(record)
+
+
+def get_and_forward(
+    backend: DicomBackend,
+    relay: Relay,
+    study_date: str,
+    series_instance_uids: List[str],
+    **kwargs,
+) -> bool:
+    """Retrieve the images of a group of series in memory and forward them through a relay.
+
+    Args:
+        backend: backend connected to the PACS server
+        relay: relay anonymizing and forwarding the received datasets
+        study_date: study date
+        series_instance_uids: SeriesInstanceUID of the series of the group
+        kwargs: keyword arguments of :meth:`pacsifier.core.backend.DicomBackend.get_datasets`
+
+    Returns:
+        bool: True if the retrieval succeeded and all the datasets were forwarded
+
+    """
+    # Failures counted per key before the datasets of this retrieval are queued
+    failed = {uid: relay.failed.get(uid, 0) for uid in series_instance_uids}
+    lock = threading.Lock()
+
+    def handler(dataset: Dataset) -> None:
+        key = relay.key(dataset)
+        with lock:
+            failed.setdefault(key, relay.failed.get(key, 0))
+        relay.put(dataset)
+
+    try:
+        success = backend.get_datasets(study_date, handler=handler, **kwargs)
+    finally:
+        # Wait for the received datasets to be forwarded, not for those of other retrievals
+        relay.wait(failed)
+    return success and all(relay.failed.get(key, 0) == failed[key] for key in failed)
+
+
+def count_forwarded(relay: Relay, series_instance_uids: List[str]) -> int:
+    """Return the number of datasets of a group of series forwarded by a relay."""
+    return sum(relay.forwarded.get(uid, 0) for uid in series_instance_uids)
+
+
+def count_group_instances(series_dirs: Dict[str, str]) -> int:
+    """Return the number of files retrieved in the folders of a group of series."""
+    return sum(count_instances(series_dir) for series_dir in list(series_dirs.values()))
+
+
+def get_dir_size(directory: str) -> int:
+    """Return the total size in bytes of the files of a folder (0 if it does not exist)."""
+    if not os.path.isdir(directory):
+        return 0
+    return sum(entry.stat().st_size for entry in os.scandir(directory) if entry.is_file())
+
+
+def get_server_name(backend: DicomBackend) -> str:
+    """Return the name of the PACS server of a backend, e.g. ``AET@address:port``."""
+    return f"{backend.server_aet}@{backend.server_address}:{backend.port}"
+
+
+def measure_retrieval(
+    fn,
+    throttle: AdaptiveThrottle,
+    timing: RetrievalTiming,
+    instances=None,
+    operation: str = "C-MOVE",
+):
+    """Wrap a retrieval function so that it is throttled and its duration, outcome and retries are measured.
+
+    Args:
+        fn: retrieval function returning True on success
+        throttle: rate limiter of the retrievals
+        timing: measures of the retrieval, filled once it is done
+        instances: function returning the number of instances retrieved
+        operation: DIMSE service of the retrieval in the metrics (C-MOVE or C-GET)
+
+    Returns:
+        function: the wrapped retrieval function
+
+    """
+    measured = timed(fn, timing, instances)
+
+    def request(*args, **kwargs) -> bool:
+        try:
+            return measured(*args, **kwargs)
+        finally:
+            observe_request(operation, timing.seconds, bool(timing.success))
+
+    return throttle.wrap(request, lambda: timing.instances)
+
+
+def close_all(*functions: Optional[Callable[[], object]]) -> None:
+    """Call each cleanup function, even if a previous one raised, then raise the first error.
+
+    Args:
+        functions: cleanup functions, called in order. The None ones are skipped.
+
+    """
+    error = None  # type: Optional[BaseException]
+    for function in functions:
+        if function is None:
+            continue
+        try:
+            function()
+        except BaseException as e:
+            if error is None:
+                error = e
+    if error is not None:
+        raise error
+
+
 def retrieve_dicoms_using_table(
     table: DataFrame,
     parameters: Dict[str, str],
@@ -227,29 +412,86 @@ def retrieve_dicoms_using_table(
     save: bool,
     info: bool,
     move: bool,
+    resume: bool = True,
+    relay: bool = False,
 ) -> None:
     """Query and retrieve dicom images or / and  their info dumps using the input query table.
 
+    Retrievals are run by a bounded pool of at most ``max_concurrent_moves``
+    workers (1 by default, e.g. sequential retrieval). When saving images with
+    the DCMTK backend, each running retrieval listens on its own port taken
+    from ``move_port_range``. The pynetdicom backend receives the images of all
+    the running retrievals on ``move_port`` and files each image directly into
+    its series folder using its header.
+    If the config file lists additional PACS servers in ``sources``, the
+    retrievals are spread over all the servers, each one with its own
+    ``max_concurrent_moves``, and a failed retrieval is sent to the next server.
+
+    The retrievals are started at a rate which adapts to the latency and the
+    failures of the previous ones (see :class:`pacsifier.core.throttle.AdaptiveThrottle`).
+
+    Before querying, the redundant rows of the query table are removed or merged
+    (see :func:`pacsifier.core.planner.plan_queries`), and a series found by
+    several rows is only retrieved once.
+
+    With the ``retrieve_level`` STUDY (resp. PATIENT), all the series of a study
+    (resp. patient) are retrieved with one request and filed into their series
+    folders using their headers (see :meth:`pacsifier.core.backend.DicomBackend.get_sorted`).
+
+    When saving or moving images, the query results and the state of each
+    series are recorded in a journal (``logs/journal.sqlite``) so that running
+    the same retrieval again skips the series which were completely retrieved.
+
+    When relaying, the images are not written to disk: they are received in
+    memory, anonymized (see :class:`pacsifier.cli.anonymize_dicoms.StreamAnonymizer`)
+    and sent to the PACS server of the ``relay`` config entry by a
+    :class:`pacsifier.core.relay.Relay`. The new ids and date offsets of the
+    patients are written to ``mapper.json`` and ``date_offsets.json`` in the
+    output directory.
+
+    The retrieval runs as a pipeline: the series of the next rows of the query
+    table are queried while the previous ones are retrieved, and the info dumps
+    and log entries are written in the background as soon as each retrieval is
+    done. The stages are connected by bounded queues (twice
+    ``max_concurrent_moves`` items) so that large query tables are streamed.
+
+    Each series gets a row in ``logs/pacsifier_log.csv`` with, in addition to
+    the columns of the query table, its number of files, status (``done``,
+    ``failed``, ``skipped`` if retrieved by a previous run or ``queried`` if
+    only queried), the PACS server which sent it, the start time of its
+    retrieval, the latency of the C-FIND request of its row, the wall time of
+    the retrieval request, the bytes received, the instances per second and
+    the number of times the request was sent again. At the STUDY and PATIENT
+    retrieve levels, the time and throughput are the ones of the request
+    retrieving the whole study or patient. A summary of the run with the
+    percentiles of these measures is printed and written to
+    ``logs/run_summary.json``. The metrics of the requests and queues can also
+    be exported while the retrieval runs (see
+    :class:`pacsifier.core.metrics.MetricsExporters`).
+
     Args:
         table: query table
         parameters: query/retrieve parameters
         output_dir: path to the output directory
         save: option to save the images
         info: option to save info dumps
+        move: option to move the images to ``move_AET``
+        resume: option to resume from the journal of a previous run.
+                If False, the journal is reset.
+        relay: option to anonymize the images and forward them to the ``relay`` PACS server
 
     """
-    pacs_server = parameters["server_address"]
-    port = int(parameters["port"])
-    move_port = int(parameters["move_port"])
-    client_aet = parameters["AET"]
-    server_aet = parameters["server_AET"]
     move_aet = parameters["move_AET"]
-    batch_wait_time = float(parameters["batch_wait_time"])
-    batch_size = int(parameters["batch_size"])
+    max_concurrent_moves = get_max_concurrent_moves(parameters)
+    retrieve_level = parameters.get("retrieve_level", "SERIES")
 
     # Flexible parsing.
     attributes_list = parse_query_table(table, ALLOWED_FILTERS)
 
+    # Remove the redundant rows before any network call
+    attributes_list, plan_summary = plan_queries(attributes_list)
+    print(format_plan_summary(plan_summary))
+
     schema = {
         "PatientID": {"type": "string", "maxlength": 64},
         "StudyDate": {"type": "string", "maxlength": 17},
@@ -270,256 +512,515 @@ def retrieve_dicoms_using_table(
     }
 
     validator = Validator(schema)
-    counter = 0
-    log_entries = []
 
-    for i, query_attributes in enumerate(attributes_list):
-        # print("Retrieving images for element number ", i+1)
+    backend = get_backend(parameters, log_dir=os.path.join(output_dir, "logs"))
+    retrieve_operation = backend.retrieve_method
 
-        check_query_attributes(query_attributes)
+    # Recent results of identical C-FIND requests are reused across runs
+    cache = QueryCache.from_parameters(parameters)
 
-        query_attributes["PatientName"] = process_person_names(
-            query_attributes["PatientName"]
+    journal = None
+    if save or move or relay:
+        journal = RetrievalJournal(
+            os.path.join(output_dir, "logs", JOURNAL_FILENAME), reset=not resume
         )
 
-        if len(query_attributes["StudyDate"]) > 0:
-            print(
-                "Retrieving images for element number {0}: sub-{1}_ses-{2}".format(
-                    i + 1, query_attributes["PatientID"], query_attributes["StudyDate"]
-                )
-            )
-        else:
-            print(
-                "Retrieving images for element number {0}: sub-{1}".format(
-                    i + 1, query_attributes["PatientID"]
-                )
-            )
-
-        inputs = {k: query_attributes[k] for k in schema.keys()}
-
-        if not validator.validate(inputs):
-            raise ValueError(
-                "Invalid input file element at position  "
-                + str(i)
-                + " "
-                + str(validator.errors)
-            )
-
-        check_date_range(query_attributes["StudyDate"])
-        check_date_range(query_attributes["AcquisitionDate"])
-        check_date(query_attributes["PatientBirthDate"])
-
-        query_retrieval_level = "SERIES"
-        if query_attributes["ImageType"] != "":
-            query_retrieval_level = "IMAGE"
-
-        # check if we can ping the PACS
-        echo_res = echo(
-            server_address=pacs_server,
-            port=port,
-            server_aet=server_aet,
-            aet=client_aet,
-            log_dir=os.path.join(output_dir, "logs"),
+    # check once if we can ping the PACS, the backend then keeps its connections
+    if not backend.echo():
+        backend.close()
+        raise RuntimeError(
+            "Cannot associate with PACS server. Please check connectivity and firewall settings"
+            " with respect to ports configured in your config file."
         )
-        if not echo_res:
-            raise RuntimeError(
-                "Cannot associate with PACS server. Please check connectivity and firewall settings"
-                " with respect to ports configured in your config file."
-            )
 
-        # Look for series of current patient and current study.
-        find_series_res = find(
-            client_aet,
-            server_address=pacs_server,
-            server_aet=server_aet,
-            port=port,
-            query_retrieval_level=query_retrieval_level,
-            patient_id=query_attributes["PatientID"],
-            study_uid=query_attributes["StudyInstanceUID"],
-            series_instance_uid=query_attributes["SeriesInstanceUID"],
-            series_description=query_attributes["SeriesDescription"],
-            protocol_name=query_attributes["ProtocolName"],
-            acquisition_date=query_attributes["AcquisitionDate"],
-            study_date=query_attributes["StudyDate"],
-            patient_name=query_attributes["PatientName"],
-            patient_birthdate=query_attributes["PatientBirthDate"],
-            device_serial_number=query_attributes["DeviceSerialNumber"],
-            modality=query_attributes["Modality"],
-            image_type=query_attributes["ImageType"],
-            study_description=query_attributes["StudyDescription"],
-            accession_number=query_attributes["AccessionNumber"],
-            sequence_name=query_attributes["SequenceName"],
-            log_dir=os.path.join(output_dir, "logs"),
+    # The retrieved images are anonymized in memory and sent to another PACS server
+    forwarder = None
+    if relay:
+        relay_parameters = parameters["relay"]
+        relay_backend = create_backend(
+            "pynetdicom", relay_parameters, parameters["AET"], os.path.join(output_dir, "logs")
+        )
+        anonymizer = StreamAnonymizer(
+            fuzz_acq_dates=relay_parameters.get("fuzz_acq_dates", False),
+            delete_identifiable_files=relay_parameters.get("delete_identifiable", True),
+            remove_private_tags=relay_parameters.get("remove_private_tags", False),
+            uid_mapper=UIDMapper(relay_parameters.get("uid_secret"), relay_parameters.get("uid_map")),
+        )
+        forwarder = Relay(
+            anonymizer,
+            relay_backend.store_dataset,
+            queue_size=relay_parameters.get("queue_size", 64),
+            workers=relay_parameters.get("workers", 1),
         )
+        relay_destination = UploadLedger.destination_key(
+            relay_parameters["server_AET"], relay_parameters["server_address"], relay_parameters["port"]
+        )
+
+    # The rate of the retrievals adapts to the response of the PACS server
+    throttle = AdaptiveThrottle.from_parameters(parameters)
+
+    # Retrievals are run concurrently, each one with its own receive port,
+    # unless the backend receives the images of all the retrievals on move_port.
+    receive = {}  # type: Dict[str, object]
+    if (save or relay) and backend.shares_receive_port:
+        receive["move_port"] = int(parameters["move_port"])
+    elif save or relay:
+        receive["use_port"] = True
+    scheduler = RetrievalScheduler(
+        max_workers=max_concurrent_moves,
+        ports=get_move_ports(parameters) if "use_port" in receive else None,
+    )
 
-        current_findscu_dump_file = os.path.join(output_dir, "tmp", "current.txt")
-        if os.path.isfile(current_findscu_dump_file):
-            os.remove(current_findscu_dump_file)
+    # Path to save the CSV file
+    log_file_path = os.path.join(output_dir, "logs", "pacsifier_log.csv")
+    os.makedirs(os.path.dirname(log_file_path), exist_ok=True)
 
-        write_file(find_series_res, file=current_findscu_dump_file)
+    # Instances and bytes retrieved per modality, to estimate the next retrievals
+    transfers = {}  # type: Dict[str, List[int]]
+    # Log entry of each series, summarized at the end of the run
+    measured = set()  # type: set
+    summary_entries = []  # type: List[Dict[str, object]]
+    server_name = get_server_name(backend)
 
-        # Extract all series StudyInstanceUIDs etc.
-        series = parse_findscu_dump_file(current_findscu_dump_file)
+    def query_rows() -> Iterator[tuple]:
+        """Query the series of each row of the query table (first stage of the pipeline)."""
+        for i, query_attributes in enumerate(attributes_list):
+            # print("Retrieving images for element number ", i+1)
 
-        # Pre-compile sanitizing regex for folder renaming
-        my_re_clean = re.compile("[^0-9a-zA-Z]+")  # keep only alphanums
+            check_query_attributes(query_attributes)
 
-        # loop over series
-        progress = ProgressBar()
-        for serie in progress(series):
-            # replace illegal chars with underscores
-            patientID_sanitized = my_re_clean.sub(
-                "_",
-                unicodedata.normalize("NFD", serie["PatientID"])
-                .encode("ascii", "ignore")
-                .decode("ascii"),
+            query_attributes["PatientName"] = process_person_names(
+                query_attributes["PatientName"]
             )
 
-            # TODO handle empty patientID_sanitized
-            if patientID_sanitized == "":
-                patientID_sanitized = my_re_clean.sub(
-                    "_",
-                    unicodedata.normalize("NFD", query_attributes["PatientID"])
-                    .encode("ascii", "ignore")
-                    .decode("ascii"),
+            if len(query_attributes["StudyDate"]) > 0:
+                print(
+                    "Retrieving images for element number {0}: sub-{1}_ses-{2}".format(
+                        i + 1, query_attributes["PatientID"], query_attributes["StudyDate"]
+                    )
+                )
+            else:
+                print(
+                    "Retrieving images for element number {0}: sub-{1}".format(
+                        i + 1, query_attributes["PatientID"]
+                    )
                 )
 
-            counter += 1
-            if counter % batch_size == 0:
-                time.sleep(batch_wait_time)
+            inputs = {k: query_attributes[k] for k in schema.keys()}
 
-            patient_dir = os.path.join(output_dir, "sub-" + patientID_sanitized)
+            if not validator.validate(inputs):
+                raise ValueError(
+                    "Invalid input file element at position  "
+                    + str(i)
+                    + " "
+                    + str(validator.errors)
+                )
 
-            # Make the patient folder.
-            # if not os.path.isdir(patient_dir) and (save or info):
-            #     print("Creating directory " + patient_dir)
-            #     os.makedirs(patient_dir, exist_ok=True)
+            check_date_range(query_attributes["StudyDate"])
+            check_date_range(query_attributes["AcquisitionDate"])
+            check_date(query_attributes["PatientBirthDate"])
+
+            query_retrieval_level = "SERIES"
+            if query_attributes["ImageType"] != "":
+                query_retrieval_level = "IMAGE"
+
+            # Look for series of current patient and current study,
+            # unless they were already found by a previous run.
+            query_key = RetrievalJournal.query_key(query_attributes)
+            series = journal.get_query(query_key) if journal is not None else None
+            find_seconds = None
+            if series is None:
+                find_start = time.monotonic()
+                misses = cache.misses if cache is not None else 0
+                series = query_series(backend, query_retrieval_level, query_attributes, cache)
+                find_seconds = time.monotonic() - find_start
+                # Queries answered by the cache are not sent to the PACS server
+                if cache is None or cache.misses > misses:
+                    observe_request("C-FIND", find_seconds, True)
+                # Queries without match are run again as they may have failed
+                if journal is not None and series:
+                    journal.record_query(query_key, query_attributes, series)
+
+            # loop over series
+            progress = ProgressBar()
+            series_dirs = []
+            for serie in progress(series):
+                patient_dir, patient_study_output_dir, patient_serie_output_dir = get_series_dirs(
+                    output_dir, serie, default_patient_id=query_attributes["PatientID"]
+                )
 
-            if query_attributes["new_ids"] != "":
-                with open(os.path.join(patient_dir, "new_id.txt"), "w") as file:
-                    file.write(str(query_attributes["new_ids"]))
+                # The new ids of relayed images are written to mapper.json instead
+                if query_attributes["new_ids"] != "" and (save or info):
+                    os.makedirs(patient_dir, exist_ok=True)
+                    with open(os.path.join(patient_dir, "new_id.txt"), "w") as file:
+                        file.write(str(query_attributes["new_ids"]))
+
+                # Make the patient / session folders if they don't exist.
+                if save or info:
+                    os.makedirs(patient_study_output_dir, exist_ok=True)
+
+                # Store all later retrieved files of current patient within the serie_id directory.
+                if not os.path.isdir(patient_serie_output_dir) and (save or info):
+                    os.makedirs(patient_serie_output_dir, exist_ok=True)
+                series_dirs.append(patient_serie_output_dir)
+
+            yield i, query_attributes, series, series_dirs, find_seconds
+
+    def write_log_entry(item: tuple) -> None:
+        """Write the info dump and the log entry of a series once retrieved (last stage of the pipeline)."""
+        log_entry, serie, patient_serie_output_dir, retrieval, timing = item
+        success = retrieval.result() if retrieval is not None else None
+
+        if info:
+            # Writing series info to csv file.
+            with open(patient_serie_output_dir + ".csv", "w") as f:
+                w = csv.DictWriter(f, serie.keys())
+                w.writeheader()
+                w.writerow(serie)
+
+        if forwarder is not None:
+            log_entry["FilesFound"] = forwarder.forwarded.get(serie["SeriesInstanceUID"], 0)
+        else:
+            log_entry["FilesFound"] = (
+                len(os.listdir(patient_serie_output_dir))
+                if os.path.isdir(patient_serie_output_dir)
+                else 0
+            )
 
-            # Make a session folder for the study if the StudyDate and StudyTime are not empty
-            if len(serie["StudyDate"]) > 0 and len(serie["StudyTime"]) > 0:
-                patient_study_output_dir = os.path.join(
-                    patient_dir, f'ses-{serie["StudyDate"] + serie["StudyTime"]}'
-                )
-                # if not os.path.isdir(patient_study_output_dir) and (save or info):
-                #     os.makedirs(patient_study_output_dir, exist_ok=True)
-            elif len(serie["StudyDate"]) > 0:
-                patient_study_output_dir = os.path.join(
-                    patient_dir, f'ses-{serie["StudyDate"]}'
-                )
-            else:
-                patient_study_output_dir = os.path.join(patient_dir)
-
-            # Make the patient / session folders if they don't exist.
-            if save or info:
-                os.makedirs(patient_study_output_dir, exist_ok=True)
-
-            # Name the series folder after the SeriesDescription.
-            folder_name = serie["SeriesDescription"]
-
-            # Pre-emptively sanitize the folder name - decompose into separate combining chars, then remove them using asci encoding-decoding.
-            # finally replace illegal chars with underscores
-            folder_name = my_re_clean.sub(
-                "_",
-                unicodedata.normalize("NFD", folder_name)
-                .encode("ascii", "ignore")
-                .decode("ascii"),
+        if retrieval is not None:
+            log_entry["Status"] = STATUS_DONE if success else STATUS_FAILED
+        log_entry.setdefault("Status", STATUS_QUERIED)
+        if save and retrieval is not None:
+            log_entry["BytesReceived"] = get_dir_size(patient_serie_output_dir)
+        if timing is not None:
+            log_entry["Server"] = timing.server
+            log_entry["StartTime"] = time.strftime(
+                "%Y-%m-%dT%H:%M:%S", time.localtime(timing.started_at)
             )
+            log_entry["MoveSeconds"] = round(timing.seconds, 3)
+            if timing.instances_per_second is not None:
+                log_entry["InstancesPerSecond"] = round(timing.instances_per_second, 3)
+            log_entry["Retries"] = timing.retries
+
+        # The series found by several rows are measured once
+        if serie["SeriesInstanceUID"] not in measured:
+            measured.add(serie["SeriesInstanceUID"])
+            summary_entries.append({column: log_entry.get(column, "") for column in LOG_COLUMNS})
+            if retrieval is not None and not move:
+                INSTANCES.inc(log_entry["FilesFound"], direction="received")
+                BYTES.inc(log_entry.get("BytesReceived", 0), direction="received")
+            if save and retrieval is not None:
+                transfer = transfers.setdefault(serie["Modality"], [0, 0])
+                transfer[0] += log_entry["FilesFound"]
+                transfer[1] += log_entry["BytesReceived"]
+        writer.writerow(log_entry)
+        csvfile.flush()
+
+    # The queries of the next rows run while the series of the previous rows
+    # are retrieved, and the log entries are written as soon as the retrievals
+    # are done. The queues between the stages are bounded so that the memory
+    # stays flat on large query tables.
+    queue_size = 2 * max_concurrent_moves
+
+    # Write the log entries to a CSV file
+    with open(log_file_path, "w", newline="") as csvfile:
+        # Define the fieldnames for the CSV (dynamic from query file + additional fields)
+        fieldnames = list(table.columns) + [
+            column for column in LOG_COLUMNS if column not in table.columns
+        ]
+        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+
+        # Write the header
+        writer.writeheader()
 
-            # If the StudyDescription is an empty string name the folder No_series_description.
-            if folder_name == "":
-                folder_name = "No_series_description"
-            patient_serie_output_dir = os.path.join(
-                patient_study_output_dir,
-                serie["SeriesNumber"].zfill(5) + "-" + folder_name,
+        # Pending retrieval of each group, indexed by the SeriesInstanceUID,
+        # StudyInstanceUID or PatientID of the group (see group_series), so
+        # that a series, study or patient found by several rows is only retrieved once
+        submitted = {}  # type: Dict[str, Tuple[Future, RetrievalTiming, Dict[str, str]]]
+        started = time.monotonic()
+        rows = prefetch(query_rows(), maxsize=queue_size)
+        post_processing = BackgroundStage(write_log_entry, maxsize=queue_size)
+        exporters = MetricsExporters.from_parameters(parameters)
+        QUEUE_DEPTH.set_function(lambda: scheduler.pending, queue="retrievals")
+        QUEUE_DEPTH.set_function(post_processing.qsize, queue="log")
+        if forwarder is not None:
+            QUEUE_DEPTH.set_function(forwarder.qsize, queue="relay")
+        try:
+            for i, query_attributes, series, series_dirs, find_seconds in rows:
+                # Retrieving files of current patient, with one request per series, study or patient.
+                # TODO: handle and report error 'F: cannot listen on port 104, insufficient privileges' in movescu
+                retrievals = [None] * len(series)
+                timings = [None] * len(series)
+                skipped = set()  # type: set
+                if save or move or relay:
+                    for group_key, group in group_series(series, retrieve_level).items():
+                        first = series[group[0]]
+                        destinations = {
+                            series[j]["SeriesInstanceUID"]: series_dirs[j]
+                            if save
+                            else (relay_destination if relay else move_aet)
+                            for j in group
+                        }
+                        count_series_instances = partial(count_group_instances, destinations)
+
+                        # Add the series to the retrieval of their series, study
+                        # or patient already sent for a previous row
+                        if group_key in submitted:
+                            retrieval, timing, pending = submitted[group_key]
+                            added = {
+                                uid: dest
+                                for uid, dest in destinations.items()
+                                if uid not in pending
+                            }
+                            if added:
+                                join_retrieval(
+                                    journal, retrieval, pending, added, count_files=save
+                                )
+                            for j in group:
+                                retrievals[j], timings[j] = retrieval, timing
+                            continue
+
+                        # Skip the series completely retrieved by a previous run
+                        if all(
+                            journal.is_complete(uid, dest) for uid, dest in destinations.items()
+                        ):
+                            for uid in destinations:
+                                print(f"Series {uid} already retrieved, skipping")
+                            skipped.update(group)
+                            continue
+                        for uid, dest in destinations.items():
+                            journal.set_series(uid, dest, QUERIED)
+
+                        retrieve_keys = {
+                            "patient_id": query_attributes["PatientID"],  # serie["PatientID"],
+                            "study_instance_uid": first["StudyInstanceUID"],
+                            "series_instance_uid": first["SeriesInstanceUID"],
+                        }
+                        if retrieve_level != "SERIES":
+                            retrieve_keys["patient_id"] = (
+                                query_attributes["PatientID"] or first["PatientID"]
+                            )
+                            retrieve_keys["retrieve_level"] = retrieve_level
+
+                        timing = RetrievalTiming(server_name)
+                        if relay:
+                            # The anonymized patients get the new ids of the query table
+                            if query_attributes["new_ids"] != "":
+                                for j in group:
+                                    anonymizer.new_ids.setdefault(
+                                        series[j]["PatientID"] or query_attributes["PatientID"],
+                                        str(query_attributes["new_ids"]),
+                                    )
+                            retrieval = scheduler.submit(
+                                measure_retrieval(
+                                    journal.track(get_and_forward, destinations, count_files=False),
+                                    throttle,
+                                    timing,
+                                    partial(count_forwarded, forwarder, list(destinations)),
+                                    operation=retrieve_operation,
+                                ),
+                                backend,
+                                forwarder,
+                                query_attributes["StudyDate"],
+                                series_instance_uids=list(destinations),
+                                **receive,
+                                **retrieve_keys,
+                            )
+                        elif save:
+                            # File the images of the group into their series folders
+                            retrieval = scheduler.submit(
+                                measure_retrieval(
+                                    journal.track(backend.get_sorted, destinations),
+                                    throttle,
+                                    timing,
+                                    count_series_instances,
+                                    operation=retrieve_operation,
+                                ),
+                                query_attributes["StudyDate"],  # serie["StudyDate"],
+                                output_dir=output_dir,
+                                series_dirs=destinations,
+                                **receive,
+                                **retrieve_keys,
+                            )
+                        else:
+                            retrieval = scheduler.submit(
+                                measure_retrieval(
+                                    journal.track(backend.move_remote, destinations, count_files=False),
+                                    throttle,
+                                    timing,
+                                ),
+                                query_attributes["StudyDate"],  # serie["StudyDate"],
+                                move_aet=move_aet,
+                                **retrieve_keys,
+                            )
+                        for j in group:
+                            retrievals[j], timings[j] = retrieval, timing
+                        submitted[group_key] = (retrieval, timing, destinations)
+
+                # Log entry creation, the number of files is only known once the retrievals are done
+                for j, (serie, patient_serie_output_dir, retrieval) in enumerate(
+                    zip(series, series_dirs, retrievals)
+                ):
+                    log_entry = {col: query_attributes[col] for col in table.columns}  # Add original query attributes
+                    log_entry["StudyInstanceUID"] = serie["StudyInstanceUID"]
+                    log_entry["SeriesNumber"] = serie["SeriesNumber"]
+                    log_entry["Modality"] = serie["Modality"]
+                    if find_seconds is not None:
+                        log_entry["FindSeconds"] = round(find_seconds, 3)
+                    if j in skipped:
+                        log_entry["Status"] = STATUS_SKIPPED
+                    post_processing.put(
+                        (log_entry, serie, patient_serie_output_dir, retrieval, timings[j])
+                    )
+        finally:
+
+            def remove_staging_dir() -> None:
+                staging_dir = os.path.join(output_dir, "staging")
+                if os.path.isdir(staging_dir) and not os.listdir(staging_dir):
+                    os.rmdir(staging_dir)
+
+            def reset_queue_depths() -> None:
+                for name in ("retrievals", "log", "relay"):
+                    QUEUE_DEPTH.set_function(None, queue=name)
+
+            # Wait for all retrievals to be done and logged, then release the
+            # associations, listeners and files even if a step failed, e.g. the
+            # log stage raising the error of a retrieval
+            close_all(
+                rows.close,
+                partial(scheduler.shutdown, wait=True),
+                post_processing.close,
+                backend.close,
+                forwarder.close if forwarder is not None else None,
+                relay_backend.close if forwarder is not None else None,
+                journal.close if journal is not None else None,
+                cache.close if cache is not None else None,
+                remove_staging_dir,
+                reset_queue_depths,
+                exporters.close,
             )
 
-            # Store all later retrieved files of current patient within the serie_id directory.
-            if not os.path.isdir(patient_serie_output_dir) and (save or info):
-                os.makedirs(patient_serie_output_dir, exist_ok=True)
-
-            # Retrieving files of current patient, study and serie.
-            # TODO: handle and report error 'F: cannot listen on port 104, insufficient privileges' in movescu
-            if save:
-                get_res = get(
-                    client_aet,
-                    query_attributes["StudyDate"],  # serie["StudyDate"],
-                    server_address=pacs_server,
-                    server_aet=server_aet,
-                    port=port,
-                    patient_id=query_attributes["PatientID"],  # serie["PatientID"],
-                    study_instance_uid=serie["StudyInstanceUID"],
-                    series_instance_uid=serie["SeriesInstanceUID"],
-                    move_port=move_port,
-                    output_dir=patient_serie_output_dir,
-                    log_dir=os.path.join(output_dir, "logs"),
-                )
+    if forwarder is not None:
+        # Keep the new ids and date offsets to trace back the anonymized patients
+        os.makedirs(output_dir, exist_ok=True)
+        with open(os.path.join(output_dir, "mapper.json"), "w") as fp:
+            json.dump(anonymizer.mapper(), fp, indent=4)
+        with open(os.path.join(output_dir, "date_offsets.json"), "w") as fp:
+            json.dump(anonymizer.date_offsets, fp, indent=4)
+        print(
+            f"{sum(forwarder.forwarded.values())} images relayed, "
+            f"{sum(forwarder.failed.values())} failed, "
+            f"{sum(forwarder.discarded.values())} discarded as identifiable"
+        )
 
-            if move:
-                move_res = move_remote(
-                    client_aet,
-                    query_attributes["StudyDate"],  # serie["StudyDate"],
-                    server_address=pacs_server,
-                    server_aet=server_aet,
-                    port=port,
-                    patient_id=query_attributes["PatientID"],  # serie["PatientID"],
-                    study_instance_uid=serie["StudyInstanceUID"],
-                    series_instance_uid=serie["SeriesInstanceUID"],
-                    move_aet=move_aet,
-                    log_dir=os.path.join(output_dir, "logs"),
-                )
+    if cache is not None:
+        print(f"Query cache: {cache.hits} queries answered from {cache.path}, {cache.misses} sent")
 
-            if info:
-                # Writing series info to csv file.
-                with open(patient_serie_output_dir + ".csv", "w") as f:
-                    w = csv.DictWriter(f, serie.keys())
-                    w.writeheader()
-                    w.writerow(serie)
+    if save:
+        ThroughputHistory.from_parameters(parameters).record(
+            server_name,
+            time.monotonic() - started,
+            {modality: tuple(transfer) for modality, transfer in transfers.items()},
+        )
 
-            # Log entry creation
-            log_entry = {col: query_attributes[col] for col in table.columns}  # Add original query attributes
-            study_uid = serie["StudyInstanceUID"]
-            series_number = serie["SeriesNumber"]
-            num_files_found = len(os.listdir(patient_serie_output_dir)) if os.path.isdir(patient_serie_output_dir) else 0
+    summary = summarize_log(summary_entries)
+    summary["seconds"] = round(time.monotonic() - started, 3)
+    with open(os.path.join(output_dir, "logs", "run_summary.json"), "w") as fp:
+        json.dump(summary, fp, indent=4)
+    print(format_summary(summary))
 
-            log_entry["StudyInstanceUID"] = study_uid
-            log_entry["SeriesNumber"] = series_number
-            log_entry["FilesFound"] = num_files_found
+    print(f"Log written to {log_file_path}")
 
-            # Append the log entry for this series
-            log_entries.append(log_entry.copy())
 
-            if os.path.isfile(current_findscu_dump_file):
-                os.remove(current_findscu_dump_file)
+def plan_retrieval(table: DataFrame, parameters: Dict[str, str], output_dir: str) -> RetrievalEstimate:
+    """Estimate the size and duration of a retrieval without retrieving any image.
 
-    # Path to save the CSV file
-    log_file_path = os.path.join(output_dir, "logs","pacsifier_log.csv")
+    The series matching the query table are queried as for a retrieval, then
+    the number of instances of each series is queried (see
+    :meth:`pacsifier.core.backend.DicomBackend.count_instances`). The size and
+    duration are estimated per patient using the throughput measured in the
+    previous retrievals from the same PACS server (see
+    :class:`pacsifier.core.estimator.ThroughputHistory`). The estimation is
+    printed and written to ``logs/plan.csv`` in the output directory.
 
-    # Write the log entries to a CSV file
-    with open(log_file_path, "w", newline="") as csvfile:
-        # Define the fieldnames for the CSV (dynamic from query file + additional fields)
-        fieldnames = list(table.columns) + ["StudyInstanceUID", "SeriesNumber", "FilesFound"]
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+    Args:
+        table: query table
+        parameters: query/retrieve parameters
+        output_dir: path to the output directory
 
-        # Write the header
-        writer.writeheader()
+    Returns:
+        RetrievalEstimate: the estimation of the retrieval
 
-        # Write all log entries
-        for log_entry in log_entries:
-            writer.writerow(log_entry)
+    """
+    attributes_list = parse_query_table(table, ALLOWED_FILTERS)
+    attributes_list, plan_summary = plan_queries(attributes_list)
+    print(format_plan_summary(plan_summary))
 
-    print(f"Log written to {log_file_path}")
-    # Clean the tmp folder
-    if os.path.isdir(os.path.join(output_dir, "tmp")):
-        shutil.rmtree(os.path.join(output_dir, "tmp"), ignore_errors=True)
+    backend = get_backend(parameters, log_dir=os.path.join(output_dir, "logs"))
+    cache = QueryCache.from_parameters(parameters)
+    estimate = RetrievalEstimate(
+        ThroughputHistory.from_parameters(parameters), get_server_name(backend)
+    )
+    try:
+        if not backend.echo():
+            raise RuntimeError(
+                "Cannot associate with PACS server. Please check connectivity and firewall settings"
+                " with respect to ports configured in your config file."
+            )
+
+        # A series found by several rows is only counted once
+        counted = set()  # type: set
+        for query_attributes in attributes_list:
+            check_query_attributes(query_attributes)
+            check_date_range(query_attributes["StudyDate"])
+            check_date_range(query_attributes["AcquisitionDate"])
+            check_date(query_attributes["PatientBirthDate"])
+            query_attributes["PatientName"] = process_person_names(query_attributes["PatientName"])
+
+            query_retrieval_level = "SERIES"
+            if query_attributes["ImageType"] != "":
+                query_retrieval_level = "IMAGE"
+
+            for serie in query_series(backend, query_retrieval_level, query_attributes, cache):
+                if serie["SeriesInstanceUID"] in counted:
+                    continue
+                counted.add(serie["SeriesInstanceUID"])
+                patient_id = serie["PatientID"] or query_attributes["PatientID"]
+                instances = backend.count_instances(
+                    patient_id, serie["StudyInstanceUID"], serie["SeriesInstanceUID"]
+                )
+                estimate.add(patient_id, serie["Modality"], instances)
+    finally:
+        backend.close()
+        if cache is not None:
+            cache.close()
+
+    print(format_estimate(estimate))
+
+    plan_file_path = os.path.join(output_dir, "logs", "plan.csv")
+    os.makedirs(os.path.dirname(plan_file_path), exist_ok=True)
+    rows = estimate.rows()
+    with open(plan_file_path, "w", newline="") as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f"Plan written to {plan_file_path}")
 
+    return estimate
 
-def upload_dicoms(dicom_dir: str, parameters: Dict[str, str]) -> None:
+
+def upload_dicoms(dicom_dir: str, parameters: Dict[str, str], resume: bool = True) -> None:
     """Upload dicoms to a PACS server.
 
+    At most ``max_concurrent_uploads`` series (1 by default) are uploaded at
+    the same time, and the result of each file is written to
+    ``logs/upload/upload_results.csv`` in ``dicom_dir``.
+
+    The instances successfully stored on the PACS server are recorded in a
+    ledger (``logs/upload/ledger.sqlite`` in ``dicom_dir``) with the hash of
+    their content, so that running the same upload again only sends the
+    instances which are missing or changed.
+
     Args:
         dicom_dir: path to the directory containing the dicoms.
                    The directory should adopt the structure adopted by PACSIFIER output directory
@@ -545,49 +1046,43 @@ def upload_dicoms(dicom_dir: str, parameters: Dict[str, str]) -> None:
                         │   │   │   ├── image1.dcm
 
         parameters: parameters from PACSIFIER configuration file
+        resume: option to skip the instances already stored according to the
+                ledger of a previous run. If False, the ledger is reset.
 
     """
-    pacs_server = parameters["server_address"]
-    port = int(parameters["port"])
-    client_aet = parameters["AET"]
-    server_aet = parameters["server_AET"]
-    batch_wait_time = float(parameters["batch_wait_time"])
-    batch_size = int(parameters["batch_size"])
-
     log_dir = os.path.join(dicom_dir, "logs", "upload")
+    max_concurrent_uploads = int(parameters.get("max_concurrent_uploads", 1))
+    throttle = AdaptiveThrottle.from_parameters(parameters)
+
+    backend = get_backend(parameters, log_dir=log_dir)
 
     # check if we can ping the PACS
-    echo_res = echo(
-        server_address=pacs_server,
-        port=port,
-        server_aet=server_aet,
-        aet=client_aet,
-        log_dir=log_dir,
-    )
-    if not echo_res:
+    if not backend.echo():
+        backend.close()
         raise RuntimeError(
             "Cannot associate with PACS server. Please check connectivity and firewall settings"
             " with respect to ports configured in your config file."
         )
-    
-    counter = 0
-    # Loop over all patients
-    for patient in os.listdir(dicom_dir):
+
+    # Create a list of all series directories of all subjects
+    # depending on the structure of the patient directory
+    series_dirs = []
+    series_log_dirs = []
+    for patient in sorted(os.listdir(dicom_dir)):
         if not patient.startswith("sub-"):
             continue
         patient_dir = os.path.join(dicom_dir, patient)
 
-        # Create a list of all series directories of this subject
-        # depending on the structure of the patient directory
-        series_dirs = []
-        series_log_dirs = []
-        for sub_dir in os.listdir(patient_dir):
+        for sub_dir in sorted(os.listdir(patient_dir)):
             sub_dir_path = os.path.join(patient_dir, sub_dir)
             sub_dir_log_path = os.path.join(log_dir, patient, sub_dir)
             if os.path.isdir(sub_dir_path):
                 if sub_dir.startswith("ses-"):
-                    for series in os.listdir(sub_dir_path):
+                    for series in sorted(os.listdir(sub_dir_path)):
                         series_dir = os.path.join(sub_dir_path, series)
+                        # Skip the info dumps (.csv) stored next to the series
+                        if not os.path.isdir(series_dir):
+                            continue
                         series_log_dir = os.path.join(sub_dir_log_path, series)
                         series_dirs.append(series_dir)
                         series_log_dirs.append(series_log_dir)
@@ -595,29 +1090,101 @@ def upload_dicoms(dicom_dir: str, parameters: Dict[str, str]) -> None:
                     series_dirs.append(sub_dir_path)
                     series_log_dirs.append(sub_dir_log_path)
 
-        # Loop over all series
-        progress = ProgressBar()
-        for series_dir, series_log_dir in progress(zip(series_dirs, series_log_dirs)):
-            counter += 1
-            if counter % batch_size == 0:
-                time.sleep(batch_wait_time)
-
-            # Check if the series directory contains dicom files
-            dicom_files = [
-                f for f in os.listdir(series_dir) if os.path.isfile(os.path.join(series_dir, f))
-            ]
-            if not dicom_files:
-                continue
-
-            # Upload the series to the PACS server
-            upload_res = upload(
-                client_aet,
-                series_dir,
-                server_address=pacs_server,
-                server_aet=server_aet,
-                port=port,
-                log_dir=series_log_dir
+    ledger = UploadLedger(os.path.join(log_dir, LEDGER_FILENAME), reset=not resume)
+    destination = UploadLedger.destination_key(
+        parameters["server_AET"], parameters["server_address"], parameters["port"]
+    )
+
+    def upload_series(series_dir: str, series_log_dir: str) -> Dict[str, Optional[bool]]:
+        """Upload the missing instances of a series and return the result of each file.
+
+        The result of the files already stored by a previous run is None.
+        """
+        filenames = {}
+        for f in sorted(os.listdir(series_dir)):
+            filename = os.path.join(series_dir, f)
+            sop_instance_uid = read_sop_instance_uid(filename) if os.path.isfile(filename) else None
+            if sop_instance_uid is not None:
+                filenames[filename] = sop_instance_uid
+        pending = ledger.pending(destination, filenames)
+        results = {filename: None for filename in filenames if filename not in pending}
+        if not pending:
+            return results
+
+        sent = {}
+        # Nothing of the series was stored yet: the backend sends the whole directory
+        to_send = None if len(pending) == len(filenames) else list(pending)
+
+        def upload() -> bool:
+            start = time.monotonic()
+            sent.update(
+                backend.upload_results(series_dir, log_dir=series_log_dir, filenames=to_send)
             )
+            success = bool(sent) and all(sent.values())
+            observe_request("C-STORE", time.monotonic() - start, success)
+            return success
+
+        throttle.wrap(upload, lambda: len(sent))()
+        for filename, success in sent.items():
+            if success and filename in pending:
+                ledger.record(destination, pending[filename], filename)
+                INSTANCES.inc(direction="sent")
+                BYTES.inc(os.path.getsize(filename), direction="sent")
+        results.update(sent)
+        return results
+
+    # Path to save the result of each file
+    results_file_path = os.path.join(log_dir, "upload_results.csv")
+    os.makedirs(log_dir, exist_ok=True)
+    counts = {"uploaded": 0, "failed": 0, "skipped": 0}
+
+    def write_results(item: tuple) -> None:
+        """Write the result of each file of a series once uploaded."""
+        series_dir, upload_res = item
+        for filename, success in sorted(upload_res.result().items()):
+            status = "skipped" if success is None else ("uploaded" if success else "failed")
+            writer.writerow(
+                {"SeriesDirectory": series_dir, "File": filename, "Uploaded": status}
+            )
+            counts[status] += 1
+        csvfile.flush()
+
+    # Series are uploaded concurrently, each upload using its own association.
+    scheduler = RetrievalScheduler(max_workers=max_concurrent_uploads)
+    with open(results_file_path, "w", newline="") as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=["SeriesDirectory", "File", "Uploaded"])
+        writer.writeheader()
+
+        post_processing = BackgroundStage(write_results, maxsize=2 * max_concurrent_uploads)
+        exporters = MetricsExporters.from_parameters(parameters)
+        QUEUE_DEPTH.set_function(lambda: scheduler.pending, queue="uploads")
+        try:
+            # Loop over all series
+            progress = ProgressBar()
+            for series_dir, series_log_dir in progress(zip(series_dirs, series_log_dirs)):
+                # Check if the series directory contains dicom files
+                dicom_files = [
+                    f for f in os.listdir(series_dir) if os.path.isfile(os.path.join(series_dir, f))
+                ]
+                if not dicom_files:
+                    continue
+
+                # Upload the series to the PACS server
+                upload_res = scheduler.submit(upload_series, series_dir, series_log_dir)
+                post_processing.put((series_dir, upload_res))
+        finally:
+            # Wait for all uploads to be done and logged
+            scheduler.shutdown(wait=True)
+            post_processing.close()
+            backend.close()
+            ledger.close()
+            QUEUE_DEPTH.set_function(None, queue="uploads")
+            exporters.close()
+
+    print(
+        f"{counts['uploaded']} files uploaded, {counts['failed']} failed, "
+        f"{counts['skipped']} already uploaded. Results written to {results_file_path}"
+    )
 
 
 def get_parser() -> argparse.ArgumentParser:
@@ -650,10 +1217,23 @@ def get_parser() -> argparse.ArgumentParser:
         action="store_true",
         help="Move images resulting from query (cannot be used together with '--save')",
     )
+    parser.add_argument(
+        "--relay",
+        action="store_true",
+        help="Anonymize the images resulting from query in memory and send them to the "
+        "'relay' PACS server of the config file, without writing them to disk "
+        "(requires the pynetdicom backend)",
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="Estimate the number of series and instances, the size and the duration of the "
+        "retrieval of the query file without retrieving any image",
+    )
     parser.add_argument(
         "--queryfile",
         "-q",
-        help="Path to query file (mandatory if '--save' or '--move' is used)",
+        help="Path to query file (mandatory if '--save', '--move', '--relay' or '--plan' is used)",
     )
     parser.add_argument(
         "--out_directory",
@@ -661,6 +1241,23 @@ def get_parser() -> argparse.ArgumentParser:
         help="Output directory where images will be saved (used only with '--save' or '--move' options)",
         default=os.path.join(".", "data"),
     )
+    parser.add_argument(
+        "--no_resume",
+        action="store_true",
+        help="Retrieve (or upload) all the series again instead of resuming from the journal "
+        "(or upload ledger) of a previous run",
+    )
+    parser.add_argument(
+        "--clear_cache",
+        action="store_true",
+        help="Remove the cached query results (see 'query_cache_ttl' in the config file) before running",
+    )
+    parser.add_argument(
+        "--replay_failures",
+        action="store_true",
+        help="Run again the requests which failed for good in a previous run, recorded in the "
+        "failure queues (fails.jsonl) of the logs of the output directory",
+    )
     parser.add_argument(
         "--upload",
         "-u",
@@ -704,26 +1301,44 @@ def main():
 
     output_dir = args.out_directory
 
+    if args.clear_cache:
+        cleared = clear_query_cache(parameters.get("query_cache_dir", DEFAULT_CACHE_DIR))
+        print(f"{cleared} cached query results removed")
+
     # Check the case where save & move are specified (it should be only one of the two)
-    if (
-        (args.save and args.move)
-        or (args.save and args.upload)
-        or (args.move and args.upload)
-        or (args.save and args.move and args.upload)
-    ):
+    if sum([args.save, args.move, args.upload, args.relay, args.plan, args.replay_failures]) > 1:
         print(
             "You must select either '--save' to save locally "
             "or '--move' to define a remote destination "
-            "or '--upload' to upload, not all!"
+            "or '--upload' to upload "
+            "or '--relay' to anonymize and forward "
+            "or '--plan' to estimate a retrieval "
+            "or '--replay_failures' to run the failed requests again, not all!"
         )
         parser.print_help()
         sys.exit(1)
 
-    if args.save or args.move:
+    if args.relay and (
+        "relay" not in parameters or parameters.get("backend", "dcmtk") != "pynetdicom"
+    ):
+        print(
+            "The '--relay' option requires a 'relay' entry and the pynetdicom backend "
+            "in the config file!"
+        )
+        sys.exit(1)
+
+    if args.replay_failures:
+        replayed, failing = replay_failures(
+            os.path.join(output_dir, "logs"), RetryPolicy.from_parameters(parameters)
+        )
+        print(f"{replayed} failed requests replayed, {failing} still failing")
+
+    elif args.save or args.move or args.relay or args.plan:
         # Check the case where the queryfile option is missing. If it is the case print help.
         if args.queryfile is None:
             print(
-                "Missing mandatory parameter --queryfile for the '--save' or '--move' options!"
+                "Missing mandatory parameter --queryfile for the '--save', '--move', '--relay' "
+                "or '--plan' options!"
             )
             parser.print_help()
             sys.exit(1)
@@ -736,14 +1351,26 @@ def main():
             sys.exit(1)
 
         check_query_table_allowed_filters(table)
-        retrieve_dicoms_using_table(table, parameters, output_dir, save, info, move)
+        if args.plan:
+            plan_retrieval(table, parameters, output_dir)
+            return
+        retrieve_dicoms_using_table(
+            table,
+            parameters,
+            output_dir,
+            save,
+            info,
+            move,
+            resume=not args.no_resume,
+            relay=args.relay,
+        )
 
     elif args.upload:
         if not os.path.isdir(args.upload_directory):
             print("The specified upload directory does not exist. Please check!")
             sys.exit(1)
 
-        upload_dicoms(args.upload_directory, parameters)
+        upload_dicoms(args.upload_directory, parameters, resume=not args.no_resume)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,459 @@
+# Copyright 2018-2024 Lausanne University Hospital and University of Lausanne,
+# Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module defines the interface of the backends used to communicate with a PACS server."""
+
+import importlib
+import os
+import shutil
+import tempfile
+from typing import Callable, Dict, List, Optional
+
+from pydicom.dataset import Dataset
+
+from pacsifier.core.records import SeriesRecord
+from pacsifier.core.retry import RetryPolicy
+from pacsifier.core.sanity_checks import check_parameters_inputs, check_retrieve_method
+from pacsifier.core.sorter import sanitize_name, sort_instances
+
+
+# Backend name (``backend`` key of the config file) -> backend class
+BACKENDS = {
+    "dcmtk": "pacsifier.core.dcmtk.backend.DcmtkBackend",
+    "pynetdicom": "pacsifier.core.pynetdicom.backend.PynetdicomBackend",
+}
+
+
+class DicomBackend:
+    """Base class of the backends implementing the DIMSE services used by PACSIFIER.
+
+    A backend is bound to one PACS server. Subclasses implement :meth:`echo`,
+    :meth:`find`, :meth:`get`, :meth:`move_remote` and :meth:`upload_results`.
+
+    Args:
+        server_address: PACS server IP address.
+        port: PACS server port for incoming requests.
+        server_aet: PACS server AET.
+        aet: AET of the calling entity.
+        log_dir: Folder for the logs where the log file (log.txt) and
+                 the fails file (fails.txt) will be written.
+        retrieve_method: DIMSE service used to retrieve the images, "C-MOVE"
+                         (the PACS server opens an association to send the
+                         images to a local port) or "C-GET" (the images are sent
+                         back on the association of the request). Default is "C-MOVE".
+        retry_policy: number of retries and backoff delays after a transient
+                      failure of a request. Default is ``RetryPolicy()``.
+
+    """
+
+    name = ""
+    # True if all the retrievals running at the same time can receive their
+    # images on the same local port, False if each one needs its own port
+    shares_receive_port = False
+    # True to raise a ConnectionError when a C-FIND request fails, e.g. so
+    # that another PACS server is queried, instead of returning no match
+    raise_on_failure = False
+
+    def __init__(
+        self,
+        server_address: str,
+        port: int,
+        server_aet: str,
+        aet: str,
+        log_dir: str = os.path.join(".", "logs"),
+        retrieve_method: str = "C-MOVE",
+        retry_policy: Optional[RetryPolicy] = None,
+    ) -> None:
+        check_parameters_inputs(aet, server_address, server_aet, port)
+        check_retrieve_method(retrieve_method)
+        self.server_address = server_address
+        self.port = port
+        self.server_aet = server_aet
+        self.aet = aet
+        self.log_dir = log_dir
+        self.retrieve_method = retrieve_method
+        self.retry_policy = retry_policy or RetryPolicy()
+
+    def echo(self) -> bool:
+        """Check that the PACS server can be reached and accepts associations.
+
+        The C-ECHO request is not sent again if it fails.
+
+        Returns:
+            bool: True if the server answered the C-ECHO request.
+
+        """
+        raise NotImplementedError
+
+    def find(self, query_retrieval_level: str = "SERIES", **query_attributes: str) -> List[SeriesRecord]:
+        """Query the PACS server with a C-FIND request.
+
+        Args:
+            query_retrieval_level: query retrieval level which can only take values in
+                                   {SERIES, STUDY, PATIENT, IMAGE}.
+            query_attributes: query attributes, using the keyword arguments of
+                              :func:`pacsifier.core.dcmtk.commands.find`
+                              (``patient_id``, ``study_uid``, ``study_date``, ...).
+
+        Returns:
+            list: list of series records each containing the attributes of a series
+
+        Raises:
+            ConnectionError: if the request failed and ``raise_on_failure`` is
+                             set. Otherwise, no series is returned.
+
+        """
+        raise NotImplementedError
+
+    def count_instances(self, patient_id: str, study_instance_uid: str, series_instance_uid: str) -> int:
+        """Return the number of instances of a series on the PACS server, without retrieving them.
+
+        By default, the instances matching an IMAGE level C-FIND request are
+        counted. Backends which can request the NumberOfSeriesRelatedInstances
+        of the series use it first.
+
+        Args:
+            patient_id: patient id.
+            study_instance_uid: study instance unique identifier.
+            series_instance_uid: series instance unique identifier.
+
+        Returns:
+            int: number of instances of the series
+
+        """
+        return len(
+            self.find(
+                "IMAGE",
+                patient_id=patient_id,
+                study_uid=study_instance_uid,
+                series_instance_uid=series_instance_uid,
+            )
+        )
+
+    def get(
+        self,
+        study_date: str,
+        patient_id: str,
+        study_instance_uid: str,
+        series_instance_uid: str,
+        move_port: int,
+        output_dir: str,
+        retrieve_level: str = "SERIES",
+    ) -> bool:
+        """Retrieve a series with a C-MOVE request towards the calling AET.
+
+        Args:
+            study_date: study date.
+            patient_id: patient id.
+            study_instance_uid: study instance unique identifier.
+            series_instance_uid: series instance unique identifier.
+            move_port: local port on which the images are received.
+            output_dir: directory where the images are written.
+            retrieve_level: level of the retrieval in {SERIES, STUDY, PATIENT}. At the
+                            STUDY (resp. PATIENT) level, all the series of the study
+                            (resp. patient) are retrieved with one request.
+
+        Returns:
+            bool: True if the retrieval succeeded.
+
+        """
+        raise NotImplementedError
+
+    def get_sorted(
+        self,
+        study_date: str,
+        patient_id: str,
+        study_instance_uid: str,
+        series_instance_uid: str,
+        move_port: int,
+        output_dir: str,
+        series_dirs: Dict[str, str],
+        retrieve_level: str = "SERIES",
+    ) -> bool:
+        """Retrieve a series, study or patient and file the images into their series folders.
+
+        By default, a series is retrieved directly into its folder, while the
+        images of a study or patient are retrieved in a staging folder of
+        their own (in ``staging`` in ``output_dir``) and then sorted using their headers
+        (see :func:`pacsifier.core.sorter.sort_instances`).
+
+        Args:
+            study_date: study date.
+            patient_id: patient id.
+            study_instance_uid: study instance unique identifier.
+            series_instance_uid: series instance unique identifier.
+            move_port: local port on which the images are received.
+            output_dir: path to the output directory.
+            series_dirs: folder of each series, indexed by SeriesInstanceUID. The
+                         images of other series are filed into the folders built
+                         from their headers (see :func:`pacsifier.core.sorter.get_series_dirs`).
+            retrieve_level: level of the retrieval in {SERIES, STUDY, PATIENT}.
+
+        Returns:
+            bool: True if the retrieval succeeded.
+
+        """
+        keys = [patient_id, study_instance_uid, series_instance_uid]
+        if retrieve_level == "SERIES" and series_instance_uid in series_dirs:
+            os.makedirs(series_dirs[series_instance_uid], exist_ok=True)
+            return self.get(
+                study_date,
+                *keys,
+                move_port=move_port,
+                output_dir=series_dirs[series_instance_uid],
+            )
+
+        key = {"PATIENT": patient_id, "STUDY": study_instance_uid}.get(
+            retrieve_level, series_instance_uid
+        )
+        # Each retrieval gets its own staging folder, even for the same study or patient
+        staging_root = os.path.join(output_dir, "staging")
+        os.makedirs(staging_root, exist_ok=True)
+        staging_dir = tempfile.mkdtemp(
+            prefix=f"{retrieve_level}-{sanitize_name(key)}-", dir=staging_root
+        )
+        success = self.get(
+            study_date,
+            *keys,
+            move_port=move_port,
+            output_dir=staging_dir,
+            retrieve_level=retrieve_level,
+        )
+        sort_instances(staging_dir, output_dir, series_dirs)
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        return success
+
+    def get_datasets(
+        self,
+        study_date: str,
+        patient_id: str,
+        study_instance_uid: str,
+        series_instance_uid: str,
+        move_port: int,
+        handler: Callable[[Dataset], None],
+        retrieve_level: str = "SERIES",
+    ) -> bool:
+        """Retrieve a series with a C-MOVE request and hand each received dataset to ``handler``.
+
+        The datasets are not written to disk. ``handler`` is called by the
+        thread receiving the dataset, and can block to slow down the retrieval.
+
+        Args:
+            study_date: study date.
+            patient_id: patient id.
+            study_instance_uid: study instance unique identifier.
+            series_instance_uid: series instance unique identifier.
+            move_port: local port on which the images are received.
+            handler: function called with each received dataset.
+            retrieve_level: level of the retrieval in {SERIES, STUDY, PATIENT}.
+
+        Returns:
+            bool: True if the retrieval succeeded.
+
+        """
+        raise NotImplementedError(f"The {self.name} backend cannot retrieve datasets in memory.")
+
+    def move_remote(
+        self,
+        study_date: str,
+        patient_id: str,
+        study_instance_uid: str,
+        series_instance_uid: str,
+        move_aet: str,
+        retrieve_level: str = "SERIES",
+    ) -> bool:
+        """Move a series to a remote AET with a C-MOVE request.
+
+        Args:
+            study_date: study date.
+            patient_id: patient id.
+            study_instance_uid: study instance unique identifier.
+            series_instance_uid: series instance unique identifier.
+            move_aet: AET where to move the images.
+            retrieve_level: level of the retrieval in {SERIES, STUDY, PATIENT}.
+
+        Returns:
+            bool: True if the move succeeded.
+
+        """
+        raise NotImplementedError
+
+    def store_dataset(self, dataset: Dataset) -> bool:
+        """Store a dataset held in memory with a C-STORE request.
+
+        Args:
+            dataset: dataset to store, with its file meta information.
+
+        Returns:
+            bool: True if the dataset was stored.
+
+        """
+        raise NotImplementedError(f"The {self.name} backend cannot store datasets from memory.")
+
+    def upload(self, dicom_dir: str, log_dir: Optional[str] = None) -> bool:
+        """Upload the dicom files of a directory with C-STORE requests.
+
+        Args:
+            dicom_dir: directory of dicom files to upload.
+            log_dir: Folder for the logs of this upload. Default is the backend ``log_dir``.
+
+        Returns:
+            bool: True if all the files were uploaded.
+
+        """
+        results = self.upload_results(dicom_dir, log_dir=log_dir)
+        return bool(results) and all(results.values())
+
+    def upload_results(
+        self,
+        dicom_dir: str,
+        log_dir: Optional[str] = None,
+        filenames: Optional[List[str]] = None,
+    ) -> Dict[str, bool]:
+        """Upload the dicom files of a directory and return the result of each file.
+
+        Args:
+            dicom_dir: directory of dicom files to upload.
+            log_dir: Folder for the logs of this upload. Default is the backend ``log_dir``.
+            filenames: paths of the files of ``dicom_dir`` to upload. Default is all the files.
+
+        Returns:
+            dict: True for each file uploaded successfully, indexed by file path.
+
+        """
+        raise NotImplementedError
+
+    def share_receiver(self, other: "DicomBackend") -> None:
+        """Make ``other`` receive the images it retrieves with the listeners of this backend.
+
+        Used when several backends retrieve images on the same local ports
+        (see :class:`pacsifier.core.sources.MultiSourceBackend`). By default
+        the backends do not keep listeners between retrievals and nothing is shared.
+
+        Args:
+            other: backend retrieving images on the same ports.
+
+        """
+        return
+
+    def request_failed(self, message: str) -> None:
+        """Report a failed C-FIND request.
+
+        Raises:
+            ConnectionError: if ``raise_on_failure`` is set.
+
+        """
+        if self.raise_on_failure:
+            raise ConnectionError(
+                f"{message} failed on {self.server_aet}@{self.server_address}:{self.port}"
+            )
+
+    def close(self) -> None:
+        """Release the resources (associations, listening ports) held by the backend."""
+        return
+
+    def __enter__(self) -> "DicomBackend":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def create_backend(
+    name: str, server: Dict[str, str], aet: str, log_dir: str, **kwargs
+) -> DicomBackend:
+    """Create a backend connected to a PACS server.
+
+    Args:
+        name: backend name, one of the keys of ``BACKENDS``.
+        server: PACS server parameters (``server_address``, ``port`` and ``server_AET``).
+        aet: AET of the calling entity.
+        log_dir: Folder for the logs of the backend.
+        kwargs: additional keyword arguments passed to the backend constructor.
+
+    Returns:
+        DicomBackend: backend connected to the PACS server.
+
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown backend {name}! Use one of {list(BACKENDS)}.")
+
+    module_name, class_name = BACKENDS[name].rsplit(".", 1)
+    backend_class = getattr(importlib.import_module(module_name), class_name)
+
+    return backend_class(
+        server_address=server["server_address"],
+        port=int(server["port"]),
+        server_aet=server["server_AET"],
+        aet=aet,
+        log_dir=log_dir,
+        **kwargs,
+    )
+
+
+def get_backend(parameters: Dict[str, str], log_dir: str, **kwargs) -> DicomBackend:
+    """Create the backend selected by the ``backend`` key of the config file.
+
+    If the config file lists additional PACS servers in ``sources``, the
+    returned backend spreads the retrievals over all of them
+    (see :class:`pacsifier.core.sources.MultiSourceBackend`).
+
+    Args:
+        parameters: parameters from PACSIFIER configuration file
+        log_dir: Folder for the logs of the backend.
+        kwargs: additional keyword arguments passed to the backend constructor.
+
+    Returns:
+        DicomBackend: backend connected to the PACS server of the config file.
+            Default is the DCMTK backend.
+
+    """
+    name = parameters.get("backend", "dcmtk")
+    kwargs.setdefault("retrieve_method", parameters.get("retrieve_method", "C-MOVE"))
+    kwargs.setdefault("retry_policy", RetryPolicy.from_parameters(parameters))
+    backend = create_backend(name, parameters, parameters["AET"], log_dir, **kwargs)
+    if not parameters.get("sources"):
+        return backend
+
+    from pacsifier.core.sources import MultiSourceBackend, Source
+
+    max_concurrent_moves = int(parameters.get("max_concurrent_moves", 1))
+    sources = [Source(backend, max_concurrent_moves)]
+    for server in parameters["sources"]:
+        sources.append(
+            Source(
+                create_backend(name, server, parameters["AET"], log_dir, **kwargs),
+                int(server.get("max_concurrent_moves", max_concurrent_moves)),
+            )
+        )
+    return MultiSourceBackend(sources)
+
+
+def get_max_concurrent_moves(parameters: Dict[str, str]) -> int:
+    """Return the number of retrievals which can run at the same time over all the PACS servers.
+
+    Args:
+        parameters: parameters from PACSIFIER configuration file
+
+    Returns:
+        int: sum of the ``max_concurrent_moves`` of the PACS server and of the
+             additional ``sources`` (which default to the one of the PACS server).
+
+    """
+    max_concurrent_moves = int(parameters.get("max_concurrent_moves", 1))
+    return max_concurrent_moves + sum(
+        int(server.get("max_concurrent_moves", max_concurrent_moves))
+        for server in parameters.get("sources", [])
+    )
@@ -0,0 +1,189 @@
+# Copyright 2018-2024 Lausanne University Hospital and University of Lausanne,
+# Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module contains the on-disk cache of the C-FIND results."""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+
+from pacsifier.core.backend import DicomBackend
+from pacsifier.core.records import SeriesRecord
+
+CACHE_FILENAME = "query_cache.sqlite"
+
+# Default folder of the cache, shared by all the output directories
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "pacsifier")
+
+
+def normalize_query(
+    server: str, query_retrieval_level: str, query_attributes: Dict[str, str]
+) -> Dict[str, str]:
+    """Normalize a C-FIND request so that equivalent requests get the same key.
+
+    Values are converted to strings and stripped, empty attributes are
+    removed and date ranges with equal bounds (e.g. ``20171001-20171001``)
+    are replaced by the single date.
+
+    Args:
+        server: PACS server queried, e.g. ``AET@address:port``
+        query_retrieval_level: query retrieval level
+        query_attributes: query attributes (see :meth:`pacsifier.core.backend.DicomBackend.find`)
+
+    Returns:
+        dict: the normalized request
+
+    """
+    request = {"server": server, "query_retrieval_level": query_retrieval_level}
+    for key, value in query_attributes.items():
+        value = str(value).strip()
+        if key.endswith("date") and len(value) == 17 and value[:8] == value[9:]:
+            value = value[:8]
+        if value != "":
+            request[key] = value
+    return request
+
+
+class QueryCache:
+    """SQLite cache of the series found by the C-FIND requests, shared across runs.
+
+    The results are indexed by the hash of the normalized request (see
+    :func:`normalize_query`) and are reused for ``ttl`` seconds. Requests
+    without match are not cached, as they may have failed. As the results
+    hold identifying data (e.g. patient names and birth dates), the folder
+    of the cache is created readable by its owner only, and so is the database.
+
+    Args:
+        path: path to the SQLite database, created if it does not exist.
+        ttl: time in seconds during which a cached result is reused.
+
+    """
+
+    def __init__(self, path: str, ttl: float) -> None:
+        if ttl < 0:
+            raise ValueError("The time to live of the query cache cannot be negative!")
+        os.makedirs(os.path.dirname(os.path.abspath(path)), mode=0o700, exist_ok=True)
+        # SQLite creates its journal files with the permissions of the database
+        os.close(os.open(path, os.O_WRONLY | os.O_CREAT, 0o600))
+        self.path = path
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS queries ("
+                "query_key TEXT PRIMARY KEY, request TEXT, series TEXT, queried_at REAL)"
+            )
+
+    @classmethod
+    def from_parameters(cls, parameters: Dict[str, str]) -> Optional["QueryCache"]:
+        """Open the cache of the config file parameters (None if ``query_cache_ttl`` is not set)."""
+        ttl = float(parameters.get("query_cache_ttl", 0))
+        if ttl <= 0:
+            return None
+        cache_dir = parameters.get("query_cache_dir", DEFAULT_CACHE_DIR)
+        cache = cls(os.path.join(cache_dir, CACHE_FILENAME), ttl)
+        cache.purge()
+        return cache
+
+    @staticmethod
+    def query_key(request: Dict[str, str]) -> str:
+        """Return the key of a normalized request, e.g. the hash of its attributes."""
+        dump = json.dumps(request, sort_keys=True)
+        return hashlib.sha1(dump.encode("utf-8")).hexdigest()
+
+    def get(self, query_key: str) -> Optional[List[SeriesRecord]]:
+        """Return the cached series of a request (None if not cached or expired)."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT series FROM queries WHERE query_key = ? AND queried_at >= ?",
+                (query_key, time.time() - self.ttl),
+            ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def put(self, query_key: str, request: Dict[str, str], series: List[SeriesRecord]) -> None:
+        """Cache the series found by a request."""
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO queries VALUES (?, ?, ?, ?)",
+                (query_key, json.dumps(request), json.dumps(series), time.time()),
+            )
+
+    def find(
+        self, backend: DicomBackend, query_retrieval_level: str = "SERIES", **query_attributes: str
+    ) -> List[SeriesRecord]:
+        """Return the cached result of a C-FIND request, or send it and cache its result.
+
+        Args:
+            backend: backend connected to the PACS server
+            query_retrieval_level: query retrieval level
+            query_attributes: query attributes (see :meth:`pacsifier.core.backend.DicomBackend.find`)
+
+        Returns:
+            list: list of series records
+
+        """
+        server = f"{backend.server_aet}@{backend.server_address}:{backend.port}"
+        request = normalize_query(server, query_retrieval_level, query_attributes)
+        query_key = self.query_key(request)
+        series = self.get(query_key)
+        if series is not None:
+            self.hits += 1
+            return series
+
+        self.misses += 1
+        series = backend.find(query_retrieval_level, **query_attributes)
+        if series:
+            self.put(query_key, request, series)
+        return series
+
+    def clear(self) -> int:
+        """Remove all the cached results and return their number."""
+        with self._lock, self._connection:
+            return self._connection.execute("DELETE FROM queries").rowcount
+
+    def purge(self) -> int:
+        """Remove the expired results and return their number."""
+        with self._lock, self._connection:
+            return self._connection.execute(
+                "DELETE FROM queries WHERE queried_at < ?", (time.time() - self.ttl,)
+            ).rowcount
+
+    def close(self) -> None:
+        """Close the connection to the database."""
+        with self._lock:
+            self._connection.close()
+
+    def __enter__(self) -> "QueryCache":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def clear_query_cache(cache_dir: str = DEFAULT_CACHE_DIR) -> int:
+    """Remove all the cached results of the cache of a folder and return their number."""
+    path = os.path.join(cache_dir, CACHE_FILENAME)
+    if not os.path.isfile(path):
+        return 0
+    with QueryCache(path, ttl=0) as cache:
+        return cache.clear()
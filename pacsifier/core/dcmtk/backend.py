@@ -0,0 +1,197 @@
+# Copyright 2018-2024 Lausanne University Hospital and University of Lausanne,
+# Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module contains the backend running the DCMTK binaries."""
+
+import os
+from typing import Dict, List, Optional
+
+from pacsifier.core.backend import DicomBackend
+from pacsifier.core.dcmtk.commands import (
+    batch_filenames,
+    echo,
+    find,
+    get,
+    move_remote,
+    upload,
+)
+from pacsifier.core.dcmtk.parsers import parse_findscu_output, parse_storescu_output
+from pacsifier.core.records import SeriesRecord
+from pacsifier.core.retry import NO_RETRY
+
+# Tag of the number of instances of a series, returned by SERIES level C-FIND requests
+NUMBER_OF_SERIES_RELATED_INSTANCES_TAG = "(0020,1209)"
+
+
+class DcmtkBackend(DicomBackend):
+    """Backend spawning one DCMTK process per request.
+
+    The requests are sent by ``echoscu``, ``findscu``, ``movescu`` or
+    ``getscu``, and ``storescu``.
+    """
+
+    name = "dcmtk"
+
+    @property
+    def shares_receive_port(self) -> bool:
+        """Return True if the images are retrieved with C-GET, without listening port."""
+        return self.retrieve_method == "C-GET"
+
+    def echo(self) -> bool:
+        return bool(
+            echo(
+                server_address=self.server_address,
+                port=self.port,
+                server_aet=self.server_aet,
+                aet=self.aet,
+                log_dir=self.log_dir,
+                retry_policy=NO_RETRY,
+            )
+        )
+
+    def find(
+        self, query_retrieval_level: str = "SERIES", **query_attributes: str
+    ) -> List[SeriesRecord]:
+        find_res = find(
+            self.aet,
+            server_address=self.server_address,
+            server_aet=self.server_aet,
+            port=self.port,
+            query_retrieval_level=query_retrieval_level,
+            log_dir=self.log_dir,
+            retry_policy=self.retry_policy,
+            **query_attributes,
+        )
+
+        # The output is empty if findscu failed
+        if not find_res:
+            self.request_failed(f"C-FIND {query_retrieval_level}")
+
+        # Extract all series StudyInstanceUIDs etc. from the output of findscu
+        return parse_findscu_output(find_res)
+
+    def count_instances(
+        self, patient_id: str, study_instance_uid: str, series_instance_uid: str
+    ) -> int:
+        find_res = find(
+            self.aet,
+            server_address=self.server_address,
+            server_aet=self.server_aet,
+            port=self.port,
+            patient_id=patient_id,
+            study_uid=study_instance_uid,
+            series_instance_uid=series_instance_uid,
+            log_dir=self.log_dir,
+            retry_policy=self.retry_policy,
+            return_keys=["20,1209"],
+        )
+        if not find_res:
+            self.request_failed("C-FIND SERIES")
+        records = parse_findscu_output(
+            find_res, {NUMBER_OF_SERIES_RELATED_INSTANCES_TAG: "NumberOfSeriesRelatedInstances"}
+        )
+        if records and records[0].get("NumberOfSeriesRelatedInstances", "").isdigit():
+            return int(records[0]["NumberOfSeriesRelatedInstances"])
+        # Not returned by the PACS server: count the instances one by one
+        return super().count_instances(patient_id, study_instance_uid, series_instance_uid)
+
+    def get(
+        self,
+        study_date: str,
+        patient_id: str,
+        study_instance_uid: str,
+        series_instance_uid: str,
+        move_port: int,
+        output_dir: str,
+        retrieve_level: str = "SERIES",
+    ) -> bool:
+        return bool(
+            get(
+                self.aet,
+                study_date,
+                server_address=self.server_address,
+                server_aet=self.server_aet,
+                port=self.port,
+                patient_id=patient_id,
+                study_instance_uid=study_instance_uid,
+                series_instance_uid=series_instance_uid,
+                move_port=move_port,
+                output_dir=output_dir,
+                log_dir=self.log_dir,
+                retry_policy=self.retry_policy,
+                retrieve_level=retrieve_level,
+                retrieve_method=self.retrieve_method,
+            )
+        )
+
+    def move_remote(
+        self,
+        study_date: str,
+        patient_id: str,
+        study_instance_uid: str,
+        series_instance_uid: str,
+        move_aet: str,
+        retrieve_level: str = "SERIES",
+    ) -> bool:
+        return bool(
+            move_remote(
+                self.aet,
+                study_date,
+                server_address=self.server_address,
+                server_aet=self.server_aet,
+                port=self.port,
+                patient_id=patient_id,
+                study_instance_uid=study_instance_uid,
+                series_instance_uid=series_instance_uid,
+                move_aet=move_aet,
+                log_dir=self.log_dir,
+                retry_policy=self.retry_policy,
+                retrieve_level=retrieve_level,
+            )
+        )
+
+    def upload_results(
+        self,
+        dicom_dir: str,
+        log_dir: Optional[str] = None,
+        filenames: Optional[List[str]] = None,
+    ) -> Dict[str, bool]:
+        # Without a list of files, storescu scans the directory. Otherwise the files
+        # are sent in batches, so that the command lines stay short.
+        batches = [None] if filenames is None else batch_filenames(filenames)
+        results = {}  # type: Dict[str, bool]
+        for batch in batches:
+            upload_res = upload(
+                self.aet,
+                dicom_dir,
+                server_address=self.server_address,
+                server_aet=self.server_aet,
+                port=self.port,
+                log_dir=log_dir or self.log_dir,
+                retry_policy=self.retry_policy,
+                filenames=batch,
+            )
+            batch_results = parse_storescu_output(upload_res) if upload_res else {}
+            if not batch_results:
+                # The files sent are unknown: use the result of storescu for all of them
+                if batch is None:
+                    batch = [
+                        os.path.join(dicom_dir, f)
+                        for f in sorted(os.listdir(dicom_dir))
+                        if os.path.isfile(os.path.join(dicom_dir, f))
+                    ]
+                batch_results = {filename: bool(upload_res) for filename in batch}
+            results.update(batch_results)
+        return results
@@ -21,7 +21,19 @@ import warnings
 import shlex
 import subprocess
 import platform
-
+from typing import List, Optional, Sequence, Tuple
+
+from pacsifier.core.dcmtk.parsers import classify_dcmtk_output
+from pacsifier.core.metrics import observe_association, observe_failure
+from pacsifier.core.retry import (
+    FAILURES_FILENAME,
+    REPLAYING_SUFFIX,
+    FailureQueue,
+    RetryPolicy,
+    describe_failure,
+    find_failure_queues,
+)
+from pacsifier.core.stats import record_retry
 from pacsifier.core.sanity_checks import (
     check_parameters_inputs,
     check_ids,
@@ -29,6 +41,8 @@ from pacsifier.core.sanity_checks import (
     check_port,
     check_AET,
     check_query_retrieval_level,
+    check_retrieve_level,
+    check_retrieve_method,
 )
 
 warnings.filterwarnings("ignore")
@@ -43,6 +57,10 @@ STUDY_INSTANCE_UID, SERIES_INSTANCE_UID, OUTPUT_DIR = (
 )
 PARAMETERS = "88.202.185.144 104 -aec theServerAET -aet MY_AET"
 
+# Maximal length of the files listed on a storescu command line, well below the
+# limit of the Windows command lines (32767 characters)
+MAX_FILES_LENGTH = 8000
+
 ########################################################################################################################
 ########################################################FUNCTIONS#######################################################
 ########################################################################################################################
@@ -55,6 +73,7 @@ def echo(
     aet: str = "AET",
     log_dir: str = os.path.join(OUTPUT_DIR, "logs"),
     timeout: int = 10,
+    retry_policy: Optional[RetryPolicy] = None,
 ) -> str:
     """Checks that the PACS server can be reached and accepts associations.
 
@@ -67,6 +86,8 @@ def echo(
                     the fails file (fails.txt) produced by run() will be written.
                     Default is "./logs" e.g. the logs/ folder in the current working directory.
         timeout: time in seconds to wait for a response from the server. Default is 30.
+        retry_policy: number of retries and backoff delays after a transient failure.
+                      Default is ``RetryPolicy()``.
 
     Returns:
         string: The log lines.
@@ -82,6 +103,7 @@ def echo(
     return run(
         query=echo_command,
         log_dir=log_dir,
+        retry_policy=retry_policy,
     )
 
 
@@ -107,6 +129,8 @@ def find(
     accession_number: str = "",
     sequence_name: str = "",
     log_dir: str = os.path.join(OUTPUT_DIR, "logs"),
+    return_keys: Sequence[str] = (),
+    retry_policy: Optional[RetryPolicy] = None,
 ) -> str:
     """Builds a query for findscu of QueryRetrieveLevel of series using the parameters passed as arguments.
 
@@ -135,6 +159,10 @@ def find(
         log_dir: Folder for the logs where the log file (log.txt) and
                  the fails file (fails.txt) produced by run() will be written.
                  Default is "./logs" e.g. the logs/ folder in the current working directory.
+        return_keys: additional attributes to return, given by their tag
+                     (e.g. "20,1209" for NumberOfSeriesRelatedInstances). Default is ().
+        retry_policy: number of retries and backoff delays after a transient failure.
+                      Default is ``RetryPolicy()``.
 
     Returns:
         string: The log lines.
@@ -160,10 +188,13 @@ def find(
         f"--key 8,30 --key 18,1000={device_serial_number} --key 8,60={modality} --key 8,8={image_type} "
         f"--key 8,1030={study_description} --key 8,50={accession_number} --key 18,24={sequence_name}"
     )
+    for key in return_keys:
+        find_command += f" --key {key}"
 
     return run(
         query=find_command,
         log_dir=log_dir,
+        retry_policy=retry_policy,
     )
 
 
@@ -179,8 +210,11 @@ def get(
     move_port: int = 4006,
     output_dir: str = OUTPUT_DIR,
     log_dir: str = os.path.join(OUTPUT_DIR, "logs"),
+    retrieve_level: str = "SERIES",
+    retrieve_method: str = "C-MOVE",
+    retry_policy: Optional[RetryPolicy] = None,
 ) -> str:
-    """Builds a query for movescu.
+    """Builds a query for movescu (or getscu).
 
     Args:
         aet: called AET.
@@ -198,6 +232,15 @@ def get(
         log_dir: Folder for the logs where the log file (log.txt) and
                  the fails file (fails.txt) produced by run() will be written.
                  Default is "./logs" e.g. the logs/ folder in the current working directory.
+        retrieve_level: level of the retrieval in {SERIES, STUDY, PATIENT}. At the STUDY
+                        level, all the series of the study are retrieved at once, and at the
+                        PATIENT level all the studies of the patient. Default is "SERIES".
+        retrieve_method: "C-MOVE" to retrieve the images with movescu, which listens on
+                         ``move_port`` for the PACS server to send them, or "C-GET" to
+                         retrieve them with getscu on the association of the request,
+                         without listening port. Default is "C-MOVE".
+        retry_policy: number of retries and backoff delays after a transient failure.
+                      Default is ``RetryPolicy()``.
 
     Returns:
         string: The log lines.
@@ -208,21 +251,32 @@ def get(
     check_ids(study_instance_uid, attribute="Study instance UID")
     check_port(move_port)
     check_port(port)
+    check_retrieve_level(retrieve_level)
+    check_retrieve_method(retrieve_method)
 
     modified_params = replace_default_params(
         PARAMETERS, aet, server_address, server_aet, port
     )
 
-    move_command = (
-        f'movescu -ll debug {modified_params} -aem "{aet}" -k 0008,0052="PATIENT" --patient '
-        f"--key 0010,0020={patient_id} --key 0020,000d={study_instance_uid} "
-        f"--key 0020,000e={series_instance_uid} --key 0008,0020={study_date} "
-        f"--port {move_port} -od {output_dir}"
+    move_keys = get_move_keys(
+        study_date, patient_id, study_instance_uid, series_instance_uid, retrieve_level
     )
+    if retrieve_method == "C-GET":
+        # The images are sent back on the association of the C-GET request
+        move_command = (
+            f'getscu -ll debug {modified_params} -k 0008,0052="PATIENT" --patient '
+            f"{move_keys} -od {output_dir}"
+        )
+    else:
+        move_command = (
+            f'movescu -ll debug {modified_params} -aem "{aet}" -k 0008,0052="PATIENT" --patient '
+            f"{move_keys} --port {move_port} -od {output_dir}"
+        )
 
     return run(
         query=move_command,
         log_dir=log_dir,
+        retry_policy=retry_policy,
     )
 
 
@@ -237,6 +291,8 @@ def move_remote(
     series_instance_uid: str = SERIES_INSTANCE_UID,
     move_aet: str = "theMoveAET",
     log_dir: str = os.path.join(OUTPUT_DIR, "logs"),
+    retrieve_level: str = "SERIES",
+    retry_policy: Optional[RetryPolicy] = None,
 ) -> str:
     """Builds a query for movescu.
 
@@ -255,6 +311,9 @@ def move_remote(
         log_dir: Folder for the logs where the log file (log.txt) and
                  the fails file (fails.txt) produced by run() will be written.
                  Default is "./logs" e.g. the logs/ folder in the current working directory.
+        retrieve_level: level of the retrieval in {SERIES, STUDY, PATIENT}. Default is "SERIES".
+        retry_policy: number of retries and backoff delays after a transient failure.
+                      Default is ``RetryPolicy()``.
 
     Returns:
         string: The log lines.
@@ -265,20 +324,24 @@ def move_remote(
     check_ids(study_instance_uid, attribute="Study instance UID")
     check_port(port)
     check_AET(move_aet)
+    check_retrieve_level(retrieve_level)
 
     modified_params = replace_default_params(
         PARAMETERS, aet, server_address, server_aet, port
     )
 
+    move_keys = get_move_keys(
+        study_date, patient_id, study_instance_uid, series_instance_uid, retrieve_level
+    )
     move_remote_command = (
         f'movescu -ll debug {modified_params} -aem "{move_aet}" -k 0008,0052="PATIENT" --patient '
-        f"--key 0010,0020={patient_id} --key 0020,000d={study_instance_uid} "
-        f"--key 0020,000e={series_instance_uid} --key 0008,0020={study_date}"
+        f"{move_keys}"
     )
 
     return run(
         query=move_remote_command,
         log_dir=log_dir,
+        retry_policy=retry_policy,
     )
 
 
@@ -289,6 +352,8 @@ def upload(
     server_aet: str = "theServerAET",
     port: int = 4242,
     log_dir: str = os.path.join(OUTPUT_DIR, "logs"),
+    filenames: Optional[List[str]] = None,
+    retry_policy: Optional[RetryPolicy] = None,
 ):
     """Build a query for storescu to upload dicom files to a PACS server.
 
@@ -301,19 +366,55 @@ def upload(
         log_dir: Folder for the logs where the log file (log.txt) and
                  the fails file (fails.txt) produced by run() will be written.
                  Default is "./logs" e.g. the logs/ folder in the current working directory.
+        filenames: paths of the files to upload. Default is all the files of ``dicom_dir``,
+                   found by storescu. See :func:`batch_filenames` to keep the
+                   command line short.
+        retry_policy: number of retries and backoff delays after a transient failure.
+                      Default is ``RetryPolicy()``.
     """
     check_port(port)
     check_AET(aet)
     check_server_address(server_address)
     check_AET(server_aet, server=True)
 
+    if filenames is None:
+        files = f"--scan-directories {dicom_dir}"
+    else:
+        files = " ".join(f'"{filename}"' for filename in filenames)
     upload_command = (
         f"storescu -ll debug {server_address} {port} "
         f'-aet "{aet}" -aec "{server_aet}" '
-        f"--scan-directories {dicom_dir}"
+        f"{files}"
     )
 
-    return run(query=upload_command, log_dir=log_dir)
+    return run(query=upload_command, log_dir=log_dir, retry_policy=retry_policy)
+
+
+def batch_filenames(
+    filenames: Sequence[str], max_length: int = MAX_FILES_LENGTH
+) -> List[List[str]]:
+    """Split the files to upload into batches listed on storescu command lines of bounded length.
+
+    Args:
+        filenames: paths of the files to upload.
+        max_length: maximal length of the quoted file paths of a batch. A file
+                    whose path is longer is uploaded alone.
+
+    Returns:
+        list: paths of the files of each batch.
+
+    """
+    batches = []  # type: List[List[str]]
+    length = 0
+    for filename in filenames:
+        # Quotes and separating space
+        added = len(filename) + 3
+        if not batches or length + added > max_length:
+            batches.append([])
+            length = 0
+        batches[-1].append(filename)
+        length += added
+    return batches
 
 
 def write_file(results: str, file: str = "output.txt") -> None:
@@ -341,6 +442,38 @@ def write_file(results: str, file: str = "output.txt") -> None:
     f.close()
 
 
+def get_move_keys(
+    study_date: str,
+    patient_id: str,
+    study_instance_uid: str,
+    series_instance_uid: str,
+    retrieve_level: str = "SERIES",
+) -> str:
+    """Build the keys of a movescu command identifying the images to retrieve.
+
+    Args:
+        study_date: study date, ignored at the PATIENT level.
+        patient_id: patient id.
+        study_instance_uid: study instance unique identifier, ignored at the PATIENT level.
+        series_instance_uid: series instance unique identifier, ignored at the STUDY
+                             and PATIENT levels.
+        retrieve_level: level of the retrieval in {SERIES, STUDY, PATIENT}.
+
+    Returns:
+        string: the ``--key`` options of the movescu command.
+
+    """
+    keys = [f"--key 0010,0020={patient_id}"]
+    if retrieve_level in ["SERIES", "STUDY"]:
+        keys.append(f"--key 0020,000d={study_instance_uid}")
+    if retrieve_level == "SERIES":
+        keys.append(f"--key 0020,000e={series_instance_uid}")
+    # The study date would restrict a PATIENT level retrieval to some of the studies
+    if retrieve_level in ["SERIES", "STUDY"]:
+        keys.append(f"--key 0008,0020={study_date}")
+    return " ".join(keys)
+
+
 def replace_default_params(
     parameters: str, AET: str, server_address: str, server_aet: str, port: int
 ) -> str:
@@ -366,19 +499,45 @@ def replace_default_params(
     )
 
 
-def run(query: str, log_dir: str = ".") -> str:
+def record_associations(lines: List[str]) -> None:
+    """Record the associations requested by a DCMTK command in the metrics.
+
+    Args:
+        lines: output lines of the command
+
+    """
+    for line in lines:
+        if "Association Accepted" in line:
+            observe_association(True)
+        elif "Association Rejected" in line or "Association Request Failed" in line:
+            observe_association(False)
+
+
+def run(query: str, log_dir: str = ".", retry_policy: Optional[RetryPolicy] = None) -> str:
     """Runs the command passed as parameter.
 
+    The failures are classified from the return code and output of the command
+    (see :func:`pacsifier.core.dcmtk.parsers.classify_dcmtk_output`). The
+    command is run again after the transient failures (e.g. association
+    rejected transiently, timeout, partial retrieval), after a jittered
+    exponential backoff. The commands which failed for good are appended to
+    the fails file (fails.txt) and to the failure queue (fails.jsonl), from
+    which they can be replayed with :func:`replay_failures`.
+
     Args:
         query: Query command line to be executed.
         log_dir: Directory where the log file (log.txt) and
-                 the fails file (fails.txt) will be written.
+                 the fails files (fails.txt and fails.jsonl) will be written.
                  Default is "." e.g. the current working directory.
+        retry_policy: number of retries and backoff delays after a transient failure.
+                      Default is ``RetryPolicy()``.
 
     Returns:
-        string: The log lines.
+        string: The log lines, empty if the command failed.
 
     """
+    retry_policy = retry_policy or RetryPolicy()
+
     # Create output directory if it does not exist
     if not os.path.exists(log_dir):
         os.makedirs(log_dir, exist_ok=True)
@@ -389,32 +548,87 @@ def run(query: str, log_dir: str = ".") -> str:
         with open(os.path.join(log_dir, "log.txt"), "a") as f:
             f.write(query + "\n")
     except ValueError as e:
-        print("* Command parsing error: {}".format(" ".join(cmd)))
+        print("* Command parsing error: {}".format(query))
         exit()
 
-    try:
-        if "Windows" in platform.platform():
-            completed = subprocess.check_output(cmd, stderr=subprocess.PIPE)
-            lines = completed.decode("latin1").splitlines()
-        else:
-            completed = subprocess.run(
-                cmd, stderr=subprocess.PIPE, stdout=subprocess.PIPE, check=True
-            )
-            lines = completed.stderr.decode("latin1").splitlines()
-        lines = [line.replace("\x00", "") for line in lines]
-    except subprocess.CalledProcessError as e:
+    retries = 0
+    while True:
+        completed = subprocess.run(cmd, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
+        # DCMTK logs to stdout on Windows and to stderr elsewhere
+        output = completed.stdout if "Windows" in platform.platform() else completed.stderr
+        lines = [line.replace("\x00", "") for line in output.decode("latin1").splitlines()]
+        record_associations(lines)
+
+        failure = classify_dcmtk_output(completed.returncode, lines)
+        if failure is None:
+            return lines
+
+        retried = retry_policy.should_retry(failure, retries)
+        observe_failure(failure.kind, retried)
+        if not retried:
+            break
         print(
-            "* Command did not succeed: {}, return code {}".format(
-                " ".join(cmd), e.returncode
-            )
+            "* Command failed ({}), retrying: {}".format(describe_failure(failure), query)
         )
-        print("* Output: {}".format(e.stderr))
+        retry_policy.wait(retries)
+        retries += 1
+        record_retry()
 
-        with open(os.path.join(log_dir, "fails.txt"), "a") as f:
-            f.write(query + "\n")
+    print(
+        "* Command did not succeed: {}, return code {}, {}".format(
+            " ".join(cmd), completed.returncode, describe_failure(failure)
+        )
+    )
+    print("* Output: {}".format(failure.message))
+
+    with open(os.path.join(log_dir, "fails.txt"), "a") as f:
+        f.write(query + "\n")
+    FailureQueue(os.path.join(log_dir, FAILURES_FILENAME)).append(
+        {
+            "command": query,
+            "kind": failure.kind,
+            "transient": failure.transient,
+            "returncode": completed.returncode,
+            "attempts": retries + 1,
+            "message": failure.message,
+        }
+    )
+
+    return ""
+
+
+def replay_failures(log_dir: str, retry_policy: Optional[RetryPolicy] = None) -> Tuple[int, int]:
+    """Run again the commands of the failure queues (fails.jsonl) of a folder of logs and of its subfolders.
 
-        print(e.returncode)
-        print(e.output)
-        lines = ""
+    The records of a queue are moved aside (``fails.jsonl.replaying``) while
+    they are replayed, and deleted once they were all run again, so that an
+    interrupted replay loses none of them: the next replay runs them again.
+    The commands failing again are put back in their queue.
 
-    return lines
+    Args:
+        log_dir: folder of the logs, e.g. the logs/ folder of the output folder.
+        retry_policy: number of retries and backoff delays after a transient failure.
+                      Default is ``RetryPolicy()``.
+
+    Returns:
+        tuple: number of commands replayed and number of commands still failing.
+
+    """
+    replayed, failing = 0, 0
+    for path in find_failure_queues(log_dir):
+        queue = FailureQueue(path)
+        replaying = FailureQueue(path + REPLAYING_SUFFIX)
+        # The records of an interrupted replay are run again first, each command once
+        records = list(
+            {str(record["command"]): record for record in replaying.read() + queue.read()}.values()
+        )
+        replaying.rewrite(records)
+        # The commands failing again are appended to the emptied queue by run()
+        queue.rewrite([])
+        for record in records:
+            replayed += 1
+            command = str(record["command"])
+            if not run(command, log_dir=os.path.dirname(path), retry_policy=retry_policy):
+                failing += 1
+        replaying.rewrite([])
+    return replayed, failing
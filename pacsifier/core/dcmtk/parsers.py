@@ -0,0 +1,273 @@
+# Copyright 2018-2024 Lausanne University Hospital and University of Lausanne,
+# Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module contains functions to parse the output of DCMTK commands."""
+
+import re
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from pacsifier.core.records import (
+    TAG_TO_KEYWORD,
+    SeriesRecord,
+    new_series_record,
+    sanitize_value,
+)
+from pacsifier.core.retry import (
+    ASSOCIATION_FAILED,
+    ASSOCIATION_REJECTED,
+    LOCAL_ERROR,
+    OUT_OF_RESOURCES,
+    PARTIAL,
+    REQUEST_FAILED,
+    TIMEOUT,
+    UNKNOWN,
+    Failure,
+)
+
+# Matches the tag of a top-level element printed by findscu, e.g.
+# "I: (0008,0020) DA [20171001]   #   8, 1 StudyDate". Elements nested in
+# sequence items are indented and are therefore not matched.
+DUMP_ELEMENT_REGEX = re.compile(r"^\S+: (\([0-9a-fA-F]{4},[0-9a-fA-F]{4}\))")
+
+# Matches the lines printed by storescu for each file, e.g.
+# "I: Sending file: /data/MR.1" and "I: Received Store Response (Success)"
+STORESCU_SENDING_REGEX = re.compile(r"^\S+: Sending file: (.+)$")
+STORESCU_RESPONSE_REGEX = re.compile(r"^\S+: Received Store Response \(([^):]+)")
+
+# Matches the status of the last response to a request, e.g.
+# "I: Received Final Move Response (Warning)" and
+# "D: DIMSE Status                  : 0xa702: Refused: Out of Resources"
+FINAL_RESPONSE_REGEX = re.compile(r"Received Final (?:Find|Move|Get) Response \(([^)]*)\)")
+DIMSE_STATUS_REGEX = re.compile(r"DIMSE Status\s*: 0x([0-9a-fA-F]{4})")
+FAILED_SUBOPERATIONS_REGEX = re.compile(r"Number of Failed Suboperations\s*: ([0-9]+)")
+
+# Output of the network errors worth retrying
+TIMEOUT_MESSAGES = ("timeout", "timed out")
+ASSOCIATION_FAILED_MESSAGES = (
+    "Association Request Failed",
+    "Association Aborted",
+    "Peer aborted Association",
+    "Connection refused",
+    "TCP Initialization Error",
+)
+
+
+def readLineByLine(filename: str) -> Iterator[str]:
+    """Return a list of lines of a text file located at the path filename.
+
+    Args:
+        filename: path to text file to be read
+
+    Yields:
+        Iterator: list of text lines of the file
+
+    """
+    with open(filename, "r", encoding="utf_8") as f:
+        for line in f:
+            line = line.encode("ascii", "ignore").decode("ascii")
+            yield line.strip("\n")
+
+
+def parse_findscu_output(
+    lines: Iterable[str], tag_to_keyword: Dict[str, str] = TAG_TO_KEYWORD
+) -> List[SeriesRecord]:
+    """Extract the series records from the output of the findscu command.
+
+    The output is read in a single pass: the tag of each element line is
+    looked up in ``tag_to_keyword`` instead of searching every tag in every
+    line, so that the parsing time grows linearly with the number of matches.
+
+    Args:
+        lines: output lines of ``findscu -v``
+        tag_to_keyword: mapping from the lowercase tags (e.g. ``"(0008,103e)"``)
+                        to extract to the keywords used in the records
+
+    Returns:
+        list: list of series records, one per C-FIND response
+
+    """
+    records = []  # type: List[SeriesRecord]
+    record = None
+
+    for line in lines:
+        match = DUMP_ELEMENT_REGEX.match(line)
+        if match is None:
+            # Each response is delimited by a dashed line, the last one by the release
+            if "------------" in line or "Releasing Association" in line:
+                if record is not None:
+                    records.append(record)
+                record = new_series_record()
+            continue
+
+        # Skip the request identifiers printed before the first response
+        if record is None:
+            continue
+
+        keyword = tag_to_keyword.get(match.group(1).lower())
+        if keyword is None:
+            continue
+
+        # Elements without value are printed as "(no value available)"
+        start = line.find("[", match.end())
+        if start == -1:
+            record[keyword] = ""
+            continue
+        end = line.find("]", start + 1)
+        record[keyword] = sanitize_value(line[start + 1 : end if end != -1 else None])
+
+    return records
+
+
+def parse_findscu_dump_file(filename: str) -> List[SeriesRecord]:
+    """Extract all useful information from the text file generated by dumping the output of the findscu command.
+
+    Args:
+        filename: path to textfile to be read
+
+    Returns:
+        list: list dictionaries each containing the attributes of a series
+
+    """
+    return parse_findscu_output(readLineByLine(filename))
+
+
+def parse_storescu_output(lines: Iterable[str]) -> Dict[str, bool]:
+    """Extract the result of each file sent by the storescu command.
+
+    Args:
+        lines: output lines of ``storescu -ll debug``
+
+    Returns:
+        dict: True for each file stored successfully, False for each file
+              sent without a successful response, indexed by file path.
+
+    """
+    results = {}  # type: Dict[str, bool]
+    filename = None  # type: Optional[str]
+    for line in lines:
+        match = STORESCU_SENDING_REGEX.match(line)
+        if match:
+            filename = match.group(1).strip()
+            results[filename] = False
+            continue
+        match = STORESCU_RESPONSE_REGEX.match(line)
+        if match and filename is not None:
+            results[filename] = match.group(1).strip() == "Success"
+            filename = None
+    return results
+
+
+def classify_dimse_status(status: int, message: str = "") -> Optional[Failure]:
+    """Classify the DIMSE status of the last response to a request.
+
+    Args:
+        status: DIMSE status, e.g. 0xA702
+        message: line of the output holding the status
+
+    Returns:
+        Failure: the failure, None if the request succeeded or is still pending.
+
+    """
+    if status in (0x0000, 0xFF00, 0xFF01):
+        return None
+    if 0xB000 <= status <= 0xBFFF:
+        # Some sub-operations failed
+        return Failure(PARTIAL, True, message)
+    if 0xA700 <= status <= 0xA7FF:
+        return Failure(OUT_OF_RESOURCES, True, message)
+    return Failure(REQUEST_FAILED, False, message)
+
+
+def classify_dcmtk_output(returncode: int, lines: Iterable[str]) -> Optional[Failure]:
+    """Classify the failure of a DCMTK command from its return code and output.
+
+    Association rejections are transient or permanent as stated by the PACS
+    server, failed associations, timeouts, partial retrievals and refusals for
+    lack of resources are transient, the other failed DIMSE statuses and the
+    local errors (e.g. syntax error, missing binary, unwritable output folder)
+    are permanent.
+
+    Args:
+        returncode: return code of the command
+        lines: output lines of the command
+
+    Returns:
+        Failure: the failure, None if the command succeeded.
+
+    """
+    status_failure = None  # type: Optional[Failure]
+    final_response = None  # type: Optional[str]
+    lines = list(lines)
+
+    for i, line in enumerate(lines):
+        # The network errors are logged as errors ("E: ...") or fatal errors ("F: ...")
+        if line.startswith(("E:", "F:")):
+            failure = _classify_network_error(lines, i)
+            if failure is not None:
+                return failure
+
+        match = FINAL_RESPONSE_REGEX.search(line)
+        if match:
+            final_response = line.strip()
+            if not match.group(1).startswith(("Success", "Pending")):
+                status_failure = status_failure or _classify_status_text(match.group(1), final_response)
+            continue
+        match = DIMSE_STATUS_REGEX.search(line)
+        if match:
+            failure = classify_dimse_status(int(match.group(1), 16), line.strip())
+            if failure is not None:
+                status_failure = failure
+            continue
+        match = FAILED_SUBOPERATIONS_REGEX.search(line)
+        if match and int(match.group(1)) > 0 and status_failure is None:
+            status_failure = Failure(PARTIAL, True, line.strip())
+
+    if status_failure is not None:
+        return status_failure
+    if returncode == 0:
+        return None
+    message = final_response or (lines[-1].strip() if lines else "")
+    if returncode < 0:
+        # Killed by a signal
+        return Failure(UNKNOWN, True, message)
+    if returncode < 60 or returncode in (126, 127):
+        # Syntax errors, insufficient privileges, unreadable input files,
+        # unwritable output files and missing binaries
+        return Failure(LOCAL_ERROR, False, message)
+    if returncode < 80:
+        # Network errors, e.g. the association could not be negotiated
+        return Failure(ASSOCIATION_FAILED, True, message)
+    return Failure(UNKNOWN, True, message)
+
+
+def _classify_network_error(lines: List[str], i: int) -> Optional[Failure]:
+    line = lines[i]
+    if "Association Rejected" in line:
+        # The result ("Rejected Permanent" or "Rejected Transient") follows on the next lines
+        result = " ".join(lines[i : i + 3])
+        return Failure(ASSOCIATION_REJECTED, "Rejected Permanent" not in result, line.strip())
+    if any(message in line for message in ASSOCIATION_FAILED_MESSAGES):
+        return Failure(ASSOCIATION_FAILED, True, line.strip())
+    if any(message in line.lower() for message in TIMEOUT_MESSAGES):
+        return Failure(TIMEOUT, True, line.strip())
+    return None
+
+
+def _classify_status_text(status: str, message: str) -> Failure:
+    if status.startswith("Warning"):
+        return Failure(PARTIAL, True, message)
+    if "OutOfResources" in status.replace(" ", ""):
+        return Failure(OUT_OF_RESOURCES, True, message)
+    return Failure(REQUEST_FAILED, False, message)
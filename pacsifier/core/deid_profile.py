@@ -0,0 +1,519 @@
+# Copyright 2018-2024 Lausanne University Hospital and University of Lausanne,
+# Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module contains the de-identification profiles applied to the DICOM datasets by the anonymization.
+
+A profile declares the action applied to each attribute, given by its
+keyword. It is compiled once into a table of actions indexed by tag, which
+is applied in a single pass over the elements of a dataset, including the
+elements of its sequences.
+"""
+
+import functools
+from datetime import datetime, timedelta
+from typing import Callable, Dict, NamedTuple, Optional, Sequence, Tuple, Union
+
+import pydicom
+from pydicom.datadict import tag_for_keyword
+from pydicom.dataset import Dataset
+
+# Actions of the profiles
+KEEP = "keep"
+BLANK = "blank"
+REMOVE = "remove"
+REPLACE = "replace"
+SHIFT_DATE = "shift_date"
+HASH_UID = "hash_uid"
+ACTIONS = (KEEP, BLANK, REMOVE, REPLACE, SHIFT_DATE, HASH_UID)
+
+# Key of the rules giving the action applied to all the private tags
+PRIVATE_TAGS = "private"
+
+# Key of the rules giving the action applied to the other UI attributes without rule
+OTHER_UIDS = "uids"
+
+# Root of the UIDs defined by the DICOM standard (SOP classes, transfer
+# syntaxes, coding schemes...), never replaced
+DICOM_UID_ROOT = "1.2.840.10008."
+
+# Action of an attribute: an action, or REPLACE and the new value, which can
+# use the fields of the context (e.g. "{patient_id}^sub")
+Rule = Union[str, Tuple[str, str]]
+
+# UIDs identifying instances, replaced by other UIDs in all the profiles
+UID_RULES = {
+    keyword: HASH_UID
+    for keyword in [
+        "StudyInstanceUID",
+        "SeriesInstanceUID",
+        "SOPInstanceUID",
+        "ReferencedSOPInstanceUID",
+        "FrameOfReferenceUID",
+        "ReferencedFrameOfReferenceUID",
+        "RelatedFrameOfReferenceUID",
+        "SynchronizationFrameOfReferenceUID",
+        "IrradiationEventUID",
+        "ConcatenationUID",
+        "DimensionOrganizationUID",
+        "InstanceCreatorUID",
+        "StorageMediaFileSetUID",
+        "DeviceUID",
+        "FiducialUID",
+        "TargetUID",
+        "UID",
+    ]
+}  # type: Dict[str, Rule]
+
+# UIDs identifying classes or coding schemes rather than instances, kept by all the profiles
+CLASS_UID_RULES = {
+    keyword: KEEP
+    for keyword in [
+        "SOPClassUID",
+        "ReferencedSOPClassUID",
+        "ReferencedSOPClassUIDInFile",
+        "RelatedGeneralSOPClassUID",
+        "OriginalSpecializedSOPClassUID",
+        "SOPClassesInStudy",
+        "TransferSyntaxUID",
+        "ReferencedTransferSyntaxUIDInFile",
+        "ImplementationClassUID",
+        "CodingSchemeUID",
+        "ContextUID",
+        "ContextGroupExtensionCreatorUID",
+        "MappingResourceUID",
+    ]
+}  # type: Dict[str, Rule]
+
+# Pseudonym of the patient, set by all the profiles
+PSEUDONYM_RULES = {
+    "PatientID": (REPLACE, "{patient_id}"),
+    "PatientName": (REPLACE, "{patient_id}^sub"),
+}  # type: Dict[str, Rule]
+
+# Profile applied by PACSIFIER since its first versions: identifying
+# attributes are blanked, the UIDs, including those of the references to the
+# original study and procedure, are replaced and the acquisition dates are
+# shifted by the date offset of the patient
+PACSIFIER_PROFILE = {
+    **UID_RULES,
+    **CLASS_UID_RULES,
+    OTHER_UIDS: HASH_UID,
+    "InstitutionAddress": (REPLACE, "Address"),
+    **{
+        keyword: BLANK
+        for keyword in [
+            "AccessionNumber",
+            "CurrentPatientLocation",
+            "CountryOfResidence",
+            "InstitutionalDepartmentName",
+            "InstitutionName",
+            "IssuerOfPatientID",
+            "NameOfPhysiciansReadingStudy",
+            "OperatorsName",
+            "OrderCallbackPhoneNumber",
+            "OtherPatientNames",
+            "OtherPatientIDs",
+            "PatientAddress",
+            "PatientBirthName",
+            "PatientBirthTime",
+            "PatientInstitutionResidence",
+            "PatientMotherBirthName",
+            "PatientTelephoneNumbers",
+            "PersonAddress",
+            "PersonName",
+            "PersonTelephoneNumbers",
+            "PerformingPhysicianIdentificationSequence",
+            "PerformingPhysicianName",
+            "PhysiciansReadingStudyIdentificationSequence",
+            "PhysiciansOfRecord",
+            "RegionOfResidence",
+            "ReferringPhysicianAddress",
+            "ReferringPhysicianIdentificationSequence",
+            "ReferringPhysicianName",
+            "ReferringPhysicianTelephoneNumbers",
+            "RequestedProcedureID",
+            "ScheduledProcedureStepID",
+        ]
+    },
+    **{
+        keyword: SHIFT_DATE
+        for keyword in [
+            "StudyDate",
+            "InstanceCreationDate",
+            "SeriesDate",
+            "AcquisitionDate",
+            "ContentDate",
+            "PerformedProcedureStepStartDate",
+            "DateOfSecondaryCapture",
+        ]
+    },
+}  # type: Dict[str, Rule]
+
+# Basic Application Level Confidentiality Profile of DICOM PS3.15 (Table E.1-1),
+# for the attributes found in the images of the PACS servers: "Z" (zero length)
+# and "D" (dummy value) are blanked, "X" removed and "U" replaced by other UIDs
+BASIC_PROFILE = {
+    **UID_RULES,
+    **CLASS_UID_RULES,
+    OTHER_UIDS: HASH_UID,
+    PRIVATE_TAGS: REMOVE,
+    **{
+        keyword: BLANK
+        for keyword in [
+            "AccessionNumber",
+            "ContentCreatorName",
+            "ContentDate",
+            "ContentTime",
+            "ContrastBolusAgent",
+            "FillerOrderNumberImagingServiceRequest",
+            "OperatorsName",
+            "PatientBirthDate",
+            "PatientSex",
+            "PersonName",
+            "PlacerOrderNumberImagingServiceRequest",
+            "ReferringPhysicianName",
+            "StudyDate",
+            "StudyID",
+            "StudyTime",
+        ]
+    },
+    **{
+        keyword: REMOVE
+        for keyword in [
+            "AcquisitionComments",
+            "AcquisitionDate",
+            "AcquisitionDateTime",
+            "AcquisitionDeviceProcessingDescription",
+            "AcquisitionTime",
+            "AdditionalPatientHistory",
+            "AdmissionID",
+            "AdmittingDiagnosesDescription",
+            "Allergies",
+            "CountryOfResidence",
+            "CurrentPatientLocation",
+            "DateOfSecondaryCapture",
+            "DerivationDescription",
+            "DetectorID",
+            "DeviceSerialNumber",
+            "EthnicGroup",
+            "GantryID",
+            "ImageComments",
+            "InstanceCreationDate",
+            "InstanceCreationTime",
+            "InstitutionAddress",
+            "InstitutionalDepartmentName",
+            "InstitutionName",
+            "IssuerOfPatientID",
+            "MedicalAlerts",
+            "MedicalRecordLocator",
+            "MilitaryRank",
+            "NameOfPhysiciansReadingStudy",
+            "Occupation",
+            "OrderCallbackPhoneNumber",
+            "OtherPatientIDs",
+            "OtherPatientIDsSequence",
+            "OtherPatientNames",
+            "PatientAddress",
+            "PatientAge",
+            "PatientBirthName",
+            "PatientBirthTime",
+            "PatientComments",
+            "PatientInstitutionResidence",
+            "PatientInsurancePlanCodeSequence",
+            "PatientMotherBirthName",
+            "PatientReligiousPreference",
+            "PatientSexNeutered",
+            "PatientSize",
+            "PatientState",
+            "PatientTelephoneNumbers",
+            "PatientWeight",
+            "PerformedProcedureStepDescription",
+            "PerformedProcedureStepID",
+            "PerformedProcedureStepStartDate",
+            "PerformedProcedureStepStartTime",
+            "PerformingPhysicianIdentificationSequence",
+            "PerformingPhysicianName",
+            "PersonAddress",
+            "PersonTelephoneNumbers",
+            "PhysiciansOfRecord",
+            "PhysiciansReadingStudyIdentificationSequence",
+            "PregnancyStatus",
+            "ProtocolName",
+            "ReferencedPatientSequence",
+            "ReferencedPerformedProcedureStepSequence",
+            "ReferencedStudySequence",
+            "ReferringPhysicianAddress",
+            "ReferringPhysicianIdentificationSequence",
+            "ReferringPhysicianTelephoneNumbers",
+            "RegionOfResidence",
+            "RequestAttributesSequence",
+            "RequestingPhysician",
+            "RequestingService",
+            "ResponsibleOrganization",
+            "ResponsiblePerson",
+            "SeriesDate",
+            "SeriesDescription",
+            "SeriesTime",
+            "SmokingStatus",
+            "SpecialNeeds",
+            "StationName",
+            "StudyDescription",
+            "TimeOfSecondaryCapture",
+            "TimezoneOffsetFromUTC",
+            "VisitComments",
+        ]
+    },
+}  # type: Dict[str, Rule]
+
+# Options of the profiles of DICOM PS3.15 (Table E.1-1), applied on top of a profile
+OPTIONS = {
+    # Dates shifted by the date offset of the patient, times kept
+    "retain_longitudinal_modified_dates": {
+        **{
+            keyword: SHIFT_DATE
+            for keyword in [
+                "AcquisitionDate",
+                "AcquisitionDateTime",
+                "ContentDate",
+                "DateOfSecondaryCapture",
+                "InstanceCreationDate",
+                "PerformedProcedureStepStartDate",
+                "SeriesDate",
+                "StudyDate",
+            ]
+        },
+        **{
+            keyword: KEEP
+            for keyword in [
+                "AcquisitionTime",
+                "ContentTime",
+                "InstanceCreationTime",
+                "PerformedProcedureStepStartTime",
+                "SeriesTime",
+                "StudyTime",
+                "TimeOfSecondaryCapture",
+            ]
+        },
+    },
+    "retain_patient_characteristics": {
+        keyword: KEEP
+        for keyword in [
+            "EthnicGroup",
+            "PatientAge",
+            "PatientSex",
+            "PatientSexNeutered",
+            "PatientSize",
+            "PatientWeight",
+            "PregnancyStatus",
+            "SmokingStatus",
+        ]
+    },
+    "retain_device_identity": {
+        keyword: KEEP
+        for keyword in [
+            "AcquisitionDeviceProcessingDescription",
+            "DetectorID",
+            "DeviceSerialNumber",
+            "DeviceUID",
+            "GantryID",
+            "StationName",
+        ]
+    },
+    "retain_institution_identity": {
+        keyword: KEEP
+        for keyword in ["InstitutionAddress", "InstitutionalDepartmentName", "InstitutionName"]
+    },
+    # Descriptions kept, they must then be checked not to contain identifying information
+    "retain_descriptions": {
+        keyword: KEEP
+        for keyword in ["ProtocolName", "SeriesDescription", "StudyDescription"]
+    },
+    "retain_uids": {**{keyword: KEEP for keyword in UID_RULES}, OTHER_UIDS: KEEP},
+}  # type: Dict[str, Dict[str, Rule]]
+
+PROFILES = {
+    "pacsifier": PACSIFIER_PROFILE,
+    "basic": BASIC_PROFILE,
+}  # type: Dict[str, Dict[str, Rule]]
+
+
+def shift_date(value: str, days: int) -> str:
+    """Shift the date of a DA or DT value by a number of days.
+
+    Args:
+        value: date (``YYYYMMDD``) or date time (``YYYYMMDDhhmmss...``)
+        days: number of days by which the date is shifted (can be negative)
+
+    Returns:
+        str: the shifted value, empty if the date cannot be parsed.
+
+    """
+    if not value:
+        return value
+    try:
+        date = datetime.strptime(value[:8], "%Y%m%d")
+    except ValueError:
+        return ""
+    return (date + timedelta(days=days)).strftime("%Y%m%d") + value[8:]
+
+
+class DeidContext(NamedTuple):
+    """Values used by the actions of a profile for a dataset.
+
+    Attributes:
+        fields: values of the fields of the replacement values, e.g. ``patient_id``
+        uid_mapper: function returning the new UID of a UID (see
+                    :class:`pacsifier.core.uid_mapper.UIDMapper`)
+        date_shift: number of days by which the dates are shifted, None to keep them
+
+    """
+
+    fields: Dict[str, str]
+    uid_mapper: Callable[[str], str]
+    date_shift: Optional[int] = None
+
+
+class CompiledProfile:
+    """De-identification profile compiled into a table of actions indexed by tag.
+
+    Args:
+        rules: action of each attribute, given by its keyword, of the
+               private tags (``PRIVATE_TAGS`` key) and of the other UI
+               attributes (``OTHER_UIDS`` key). The other attributes are kept.
+
+    """
+
+    def __init__(self, rules: Dict[str, Rule]) -> None:
+        self.actions = {}  # type: Dict[int, Tuple[str, Optional[str]]]
+        self.private_action = None  # type: Optional[Tuple[str, Optional[str]]]
+        self.uid_action = None  # type: Optional[Tuple[str, Optional[str]]]
+        for keyword, rule in rules.items():
+            action, value = (rule, None) if isinstance(rule, str) else rule
+            if action not in ACTIONS:
+                raise ValueError(f"Unknown de-identification action {action} for {keyword}!")
+            if action == REPLACE and value is None:
+                raise ValueError(f"No replacement value for {keyword}!")
+            if keyword == PRIVATE_TAGS:
+                self.private_action = (action, value)
+                continue
+            if keyword == OTHER_UIDS:
+                self.uid_action = (action, value)
+                continue
+            tag = tag_for_keyword(keyword)
+            if tag is None:
+                raise ValueError(f"Unknown DICOM keyword {keyword}!")
+            self.actions[tag] = (action, value)
+
+    def apply(self, dataset: Dataset, context: DeidContext) -> None:
+        """De-identify a dataset in place, including the datasets of its sequences.
+
+        Args:
+            dataset: dicom dataset
+            context: values used by the actions for this dataset
+
+        """
+        for tag in list(dataset.keys()):
+            rule = self.actions.get(tag)
+            if rule is None and tag.is_private:
+                rule = self.private_action
+            if rule is not None and rule[0] != KEEP:
+                self._apply_action(dataset, tag, rule, context)
+                continue
+
+            # Values are only decoded for the sequences, the UIDs and the attributes with an action
+            element = dataset.get_item(tag)
+            if element.VR is None:
+                element = dataset[tag]
+            if element.VR == "SQ":
+                for item in dataset[tag].value:
+                    self.apply(item, context)
+            elif (
+                element.VR == "UI"
+                and rule is None
+                and not tag.is_private
+                and self.uid_action is not None
+                and self.uid_action[0] != KEEP
+            ):
+                self._apply_action(dataset, tag, self.uid_action, context)
+
+    @staticmethod
+    def _apply_action(
+        dataset: Dataset, tag: int, rule: Tuple[str, Optional[str]], context: DeidContext
+    ) -> None:
+        action, value = rule
+        if action == REMOVE:
+            del dataset[tag]
+            return
+
+        element = dataset[tag]
+        if action == BLANK:
+            element.value = element.empty_value
+        elif action == REPLACE:
+            element.value = value.format(**context.fields)
+        elif action == SHIFT_DATE:
+            if context.date_shift is not None:
+                element.value = _map_values(
+                    element.value, lambda date: shift_date(str(date), context.date_shift)
+                )
+        elif action == HASH_UID:
+            element.value = _map_values(element.value, lambda uid: _map_uid(str(uid), context))
+
+
+def _map_uid(uid: str, context: DeidContext) -> str:
+    # The UIDs defined by the standard do not identify anything
+    if not uid or uid.startswith(DICOM_UID_ROOT):
+        return uid
+    return context.uid_mapper(uid)
+
+
+def _map_values(value, function: Callable[[str], str]):
+    if value is None or value == "":
+        return value
+    if isinstance(value, pydicom.multival.MultiValue):
+        return [function(item) for item in value]
+    return function(value)
+
+
+@functools.lru_cache(maxsize=None)
+def get_profile(
+    name: str = "pacsifier", options: Sequence[str] = (), remove_private_tags: bool = False
+) -> CompiledProfile:
+    """Return a compiled profile, compiled once per process.
+
+    The pseudonym of the patient (``PatientID`` and ``PatientName``) is set
+    by all the profiles.
+
+    Args:
+        name: name of the profile, one of the keys of ``PROFILES``
+        options: names of the options applied on top of the profile, keys of ``OPTIONS``
+        remove_private_tags: remove all the private tags if True
+
+    Returns:
+        CompiledProfile: the compiled profile.
+
+    """
+    if name not in PROFILES:
+        raise ValueError(f"Unknown de-identification profile {name}! Use one of {list(PROFILES)}.")
+    rules = dict(PROFILES[name])
+    for option in options:
+        if option not in OPTIONS:
+            raise ValueError(
+                f"Unknown de-identification option {option}! Use one of {list(OPTIONS)}."
+            )
+        rules.update(OPTIONS[option])
+    rules.update(PSEUDONYM_RULES)
+    if remove_private_tags:
+        rules[PRIVATE_TAGS] = REMOVE
+    return CompiledProfile(rules)
@@ -0,0 +1,218 @@
+# Copyright 2018-2024 Lausanne University Hospital and University of Lausanne,
+# Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module contains the estimation of the size and duration of a retrieval before running it."""
+
+import json
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+from pacsifier.core.cache import DEFAULT_CACHE_DIR
+
+THROUGHPUT_FILENAME = "throughput.json"
+
+# Typical size in bytes of an instance of each modality, used until
+# retrievals of that modality were measured
+DEFAULT_INSTANCE_SIZES = {  # type: Dict[str,int]
+    "MR": 256 * 1024,
+    "CT": 512 * 1024,
+    "PT": 64 * 1024,
+    "NM": 256 * 1024,
+    "US": 1024 * 1024,
+    "CR": 8 * 1024 * 1024,
+    "DX": 8 * 1024 * 1024,
+    "MG": 24 * 1024 * 1024,
+    "SR": 16 * 1024,
+}
+DEFAULT_INSTANCE_SIZE = 512 * 1024
+
+# Instances retrieved per second until retrievals from the PACS server were measured
+DEFAULT_INSTANCES_PER_SECOND = 20.0
+
+
+class ThroughputHistory:
+    """Throughput of the last retrievals from each PACS server, kept in a JSON file.
+
+    Each run records the number of instances and bytes retrieved per modality
+    and its duration. The estimations are based on the ``max_runs`` last runs
+    from the same PACS server.
+
+    Args:
+        path: path to the JSON file, created when the first run is recorded.
+        max_runs: number of runs kept per PACS server.
+
+    """
+
+    def __init__(self, path: str, max_runs: int = 10) -> None:
+        if max_runs < 1:
+            raise ValueError("At least one run must be kept!")
+        self.path = path
+        self.max_runs = max_runs
+        self.runs = {}  # type: Dict[str, List[dict]]
+        if os.path.isfile(path):
+            with open(path, "r") as f:
+                self.runs = json.load(f)
+
+    @classmethod
+    def from_parameters(cls, parameters: Dict[str, str]) -> "ThroughputHistory":
+        """Open the history of the workstation, kept next to the query cache (``query_cache_dir``)."""
+        cache_dir = parameters.get("query_cache_dir", DEFAULT_CACHE_DIR)
+        return cls(os.path.join(cache_dir, THROUGHPUT_FILENAME))
+
+    def record(self, server: str, seconds: float, transfers: Dict[str, Tuple[int, int]]) -> None:
+        """Record a run and write the history to its file.
+
+        Args:
+            server: PACS server of the run, e.g. ``AET@address:port``
+            seconds: duration of the run in seconds
+            transfers: number of instances and bytes retrieved, indexed by modality
+
+        """
+        if seconds <= 0 or sum(instances for instances, _ in transfers.values()) == 0:
+            return
+        run = {
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "seconds": seconds,
+            "modalities": {
+                modality: {"instances": instances, "bytes": size}
+                for modality, (instances, size) in transfers.items()
+                if instances > 0
+            },
+        }
+        self.runs[server] = (self.runs.get(server, []) + [run])[-self.max_runs :]
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        temp_path = self.path + ".part"
+        with open(temp_path, "w") as f:
+            json.dump(self.runs, f, indent=4)
+        os.replace(temp_path, self.path)
+
+    def _totals(self, server: str, modality: Optional[str] = None) -> Tuple[int, int]:
+        instances, size = 0, 0
+        for run in self.runs.get(server, []):
+            for run_modality, transfer in run["modalities"].items():
+                if modality is None or run_modality == modality:
+                    instances += transfer["instances"]
+                    size += transfer["bytes"]
+        return instances, size
+
+    def instances_per_second(self, server: str) -> Optional[float]:
+        """Return the measured throughput of a PACS server (None if never measured)."""
+        seconds = sum(run["seconds"] for run in self.runs.get(server, []))
+        instances, _ = self._totals(server)
+        if seconds <= 0 or instances == 0:
+            return None
+        return instances / seconds
+
+    def instance_size(self, server: str, modality: str) -> float:
+        """Return the average size in bytes of the instances of a modality.
+
+        The size measured for the modality is used if any, then the typical
+        size of the modality (see ``DEFAULT_INSTANCE_SIZES``), then the size
+        measured for all the modalities.
+        """
+        instances, size = self._totals(server, modality)
+        if instances > 0:
+            return size / instances
+        if modality in DEFAULT_INSTANCE_SIZES:
+            return DEFAULT_INSTANCE_SIZES[modality]
+        instances, size = self._totals(server)
+        if instances > 0:
+            return size / instances
+        return DEFAULT_INSTANCE_SIZE
+
+
+class RetrievalEstimate:
+    """Estimation of the size and duration of the retrieval of a list of series.
+
+    Args:
+        history: throughput measured in the previous runs.
+        server: PACS server of the retrieval, e.g. ``AET@address:port``.
+
+    """
+
+    def __init__(self, history: ThroughputHistory, server: str) -> None:
+        self.history = history
+        self.server = server
+        measured = history.instances_per_second(server)
+        self.measured = measured is not None
+        self.instances_per_second = measured or DEFAULT_INSTANCES_PER_SECOND
+        # PatientID -> [series, instances, bytes]
+        self.patients = {}  # type: Dict[str, List[float]]
+
+    def add(self, patient_id: str, modality: str, instances: int) -> None:
+        """Add a series to the retrieval."""
+        patient = self.patients.setdefault(patient_id, [0, 0, 0.0])
+        patient[0] += 1
+        patient[1] += instances
+        patient[2] += instances * self.history.instance_size(self.server, modality)
+
+    def rows(self) -> List[Dict[str, object]]:
+        """Return the estimation of each patient, followed by the total."""
+        rows = []
+        for patient_id, (series, instances, size) in self.patients.items():
+            rows.append(self._row(patient_id, series, instances, size))
+        rows.append(
+            self._row(
+                "Total",
+                sum(patient[0] for patient in self.patients.values()),
+                sum(patient[1] for patient in self.patients.values()),
+                sum(patient[2] for patient in self.patients.values()),
+            )
+        )
+        return rows
+
+    def _row(self, patient_id: str, series: int, instances: int, size: float) -> Dict[str, object]:
+        return {
+            "PatientID": patient_id,
+            "Series": int(series),
+            "Instances": int(instances),
+            "EstimatedGB": round(size / 1e9, 3),
+            "EstimatedSeconds": round(instances / self.instances_per_second),
+        }
+
+
+def format_duration(seconds: float) -> str:
+    """Return a duration in a readable form, e.g. ``2h05m``."""
+    minutes = int(round(seconds / 60))
+    if minutes < 1:
+        return f"{int(round(seconds))}s"
+    if minutes < 60:
+        return f"{minutes}m"
+    return f"{minutes // 60}h{minutes % 60:02d}m"
+
+
+def format_estimate(estimate: RetrievalEstimate) -> str:
+    """Return a printable summary of an estimation (see :class:`RetrievalEstimate`)."""
+    lines = [
+        f"{'PatientID':<24} {'Series':>8} {'Instances':>10} {'GB':>9} {'Duration':>9}"
+    ]
+    for row in estimate.rows():
+        lines.append(
+            f"{row['PatientID']:<24} {row['Series']:>8} {row['Instances']:>10} "
+            f"{row['EstimatedGB']:>9.3f} {format_duration(row['EstimatedSeconds']):>9}"
+        )
+    if estimate.measured:
+        lines.append(
+            f"Duration estimated with {estimate.instances_per_second:.1f} instances/s "
+            f"measured in the previous runs from {estimate.server}"
+        )
+    else:
+        lines.append(
+            f"No previous run from {estimate.server}: duration estimated with "
+            f"{estimate.instances_per_second:.1f} instances/s"
+        )
+    return "\n".join(lines)
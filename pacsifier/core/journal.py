@@ -0,0 +1,221 @@
+# Copyright 2018-2024 Lausanne University Hospital and University of Lausanne,
+# Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module contains the journal used to resume an interrupted retrieval."""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from pacsifier.core.records import SeriesRecord
+
+# States of a series in the journal
+QUERIED = "queried"
+MOVING = "moving"
+COMPLETE = "complete"
+FAILED = "failed"
+
+JOURNAL_FILENAME = "journal.sqlite"
+
+
+def count_instances(series_dir: str) -> int:
+    """Return the number of files in the directory of a retrieved series (0 if it does not exist)."""
+    if not os.path.isdir(series_dir):
+        return 0
+    return sum(1 for entry in os.scandir(series_dir) if entry.is_file())
+
+
+class RetrievalJournal:
+    """SQLite journal of the query rows and series handled by a retrieval.
+
+    The journal records the series found for each query row and the state of
+    each series (``queried``, ``moving``, ``complete`` or ``failed``) with the
+    number of instances retrieved. Running the same retrieval again reuses the
+    recorded query results and skips the series which are complete, so that an
+    interrupted run resumes where it stopped. The journal can be shared by the
+    threads of a :class:`pacsifier.core.scheduler.RetrievalScheduler`.
+
+    Args:
+        path: path to the SQLite database, created if it does not exist.
+        reset: if True, the content of an existing journal is discarded.
+
+    """
+
+    def __init__(self, path: str, reset: bool = False) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            if reset:
+                self._connection.execute("DROP TABLE IF EXISTS queries")
+                self._connection.execute("DROP TABLE IF EXISTS series")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS queries ("
+                "query_key TEXT PRIMARY KEY, attributes TEXT, series TEXT, queried_at REAL)"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS series ("
+                "series_instance_uid TEXT, destination TEXT, state TEXT, "
+                "instances INTEGER, updated_at REAL, "
+                "PRIMARY KEY (series_instance_uid, destination))"
+            )
+
+    @staticmethod
+    def query_key(query_attributes: Dict[str, str]) -> str:
+        """Return the key identifying a query row, e.g. the hash of its attributes."""
+        dump = json.dumps(query_attributes, sort_keys=True, default=str)
+        return hashlib.sha1(dump.encode("utf-8")).hexdigest()
+
+    def get_query(self, query_key: str) -> Optional[List[SeriesRecord]]:
+        """Return the series recorded for a query row, or None if the row was not queried yet."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT series FROM queries WHERE query_key = ?", (query_key,)
+            ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def record_query(
+        self, query_key: str, query_attributes: Dict[str, str], series: List[SeriesRecord]
+    ) -> None:
+        """Record the series found for a query row."""
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO queries VALUES (?, ?, ?, ?)",
+                (
+                    query_key,
+                    json.dumps(query_attributes, default=str),
+                    json.dumps(series),
+                    time.time(),
+                ),
+            )
+
+    def get_series(self, series_instance_uid: str, destination: str) -> Tuple[Optional[str], Optional[int]]:
+        """Return the state and number of instances of a series (None if it is not in the journal)."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT state, instances FROM series "
+                "WHERE series_instance_uid = ? AND destination = ?",
+                (series_instance_uid, destination),
+            ).fetchone()
+        return (None, None) if row is None else (row[0], row[1])
+
+    def set_series(
+        self,
+        series_instance_uid: str,
+        destination: str,
+        state: str,
+        instances: Optional[int] = None,
+    ) -> None:
+        """Record the state of a series.
+
+        Args:
+            series_instance_uid: series instance unique identifier.
+            destination: output directory (or move AET) of the series.
+            state: one of ``queried``, ``moving``, ``complete`` or ``failed``.
+            instances: number of instances retrieved, if known.
+
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO series VALUES (?, ?, ?, ?, ?)",
+                (series_instance_uid, destination, state, instances, time.time()),
+            )
+
+    def is_complete(self, series_instance_uid: str, destination: str) -> bool:
+        """Check whether a series was completely retrieved.
+
+        A series retrieved to a directory is only complete if the directory
+        still holds the number of instances recorded when it was retrieved.
+
+        Args:
+            series_instance_uid: series instance unique identifier.
+            destination: output directory (or move AET) of the series.
+
+        Returns:
+            bool: True if the series does not need to be retrieved again.
+
+        """
+        state, instances = self.get_series(series_instance_uid, destination)
+        if state != COMPLETE:
+            return False
+        return instances is None or count_instances(destination) == instances
+
+    def track(
+        self,
+        fn: Callable[..., bool],
+        destinations: Dict[str, str],
+        count_files: bool = True,
+    ) -> Callable[..., bool]:
+        """Wrap a retrieval function so that it records the state of the series it retrieves.
+
+        Args:
+            fn: retrieval function returning True on success
+                (e.g. :meth:`pacsifier.core.backend.DicomBackend.get`).
+            destinations: output directory (or move AET) of each retrieved
+                          series, indexed by SeriesInstanceUID.
+            count_files: if True, the files of the destinations are counted
+                         once the retrieval is done.
+
+        Returns:
+            function: the wrapped retrieval function.
+
+        """
+
+        def retrieve(*args, **kwargs) -> bool:
+            # Series can be added to the destinations while the retrieval runs
+            for series_instance_uid, destination in list(destinations.items()):
+                self.set_series(series_instance_uid, destination, MOVING)
+            success = fn(*args, **kwargs)
+            self.record_retrieval(destinations, success, count_files)
+            return success
+
+        return retrieve
+
+    def record_retrieval(
+        self, destinations: Dict[str, str], success: bool, count_files: bool = True
+    ) -> None:
+        """Record the state of the series of a finished retrieval.
+
+        Args:
+            destinations: output directory (or move AET) of each retrieved
+                          series, indexed by SeriesInstanceUID.
+            success: True if the retrieval succeeded.
+            count_files: if True, the files of the destinations are counted.
+
+        """
+        for series_instance_uid, destination in list(destinations.items()):
+            self.set_series(
+                series_instance_uid,
+                destination,
+                COMPLETE if success else FAILED,
+                count_instances(destination) if count_files else None,
+            )
+
+    def close(self) -> None:
+        """Close the connection to the database."""
+        with self._lock:
+            self._connection.close()
+
+    def __enter__(self) -> "RetrievalJournal":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
@@ -0,0 +1,182 @@
+# Copyright 2018-2024 Lausanne University Hospital and University of Lausanne,
+# Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module contains the ledger of the instances already uploaded to a PACS server."""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from pydicom import dcmread
+
+LEDGER_FILENAME = "ledger.sqlite"
+
+# Size of the chunks read to hash a file
+CHUNK_SIZE = 1024 * 1024
+
+
+def file_digest(filename: str, algorithm: str = "sha1") -> str:
+    """Return the hash of the content of a file.
+
+    Args:
+        filename: path to the file
+        algorithm: name of the hash algorithm (see :func:`hashlib.new`), SHA-1 by default
+
+    Returns:
+        str: the hexadecimal digest of the file.
+
+    """
+    digest = hashlib.new(algorithm)
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_sop_instance_uid(filename: str) -> Optional[str]:
+    """Return the SOPInstanceUID of a dicom file (None if it is not a dicom file)."""
+    try:
+        header = dcmread(filename, stop_before_pixels=True, specific_tags=["SOPInstanceUID"])
+    except Exception:
+        return None
+    return str(header.get("SOPInstanceUID", "")) or None
+
+
+class UploadLedger:
+    """SQLite ledger of the instances successfully stored on each destination.
+
+    For each destination (e.g. ``AET@address:port``) and SOPInstanceUID, the
+    ledger records the hash of the content of the file which was stored, with
+    its size and modification time. Running the same upload again only sends
+    the instances which are not in the ledger or whose content changed. The
+    content of a file is only hashed again if its size or modification time
+    changed. The ledger can be shared by the threads of a
+    :class:`pacsifier.core.scheduler.RetrievalScheduler`.
+
+    Args:
+        path: path to the SQLite database, created if it does not exist.
+        reset: if True, the content of an existing ledger is discarded.
+
+    """
+
+    def __init__(self, path: str, reset: bool = False) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            if reset:
+                self._connection.execute("DROP TABLE IF EXISTS instances")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS instances ("
+                "destination TEXT, sop_instance_uid TEXT, digest TEXT, "
+                "size INTEGER, mtime INTEGER, stored_at REAL, "
+                "PRIMARY KEY (destination, sop_instance_uid))"
+            )
+
+    @staticmethod
+    def destination_key(server_aet: str, server_address: str, port: int) -> str:
+        """Return the key identifying a destination, e.g. ``AET@address:port``."""
+        return f"{server_aet}@{server_address}:{port}"
+
+    def get(self, destination: str, sop_instance_uid: str) -> Optional[Tuple[str, int, int]]:
+        """Return the hash, size and modification time of a stored instance (None if it is not in the ledger)."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT digest, size, mtime FROM instances "
+                "WHERE destination = ? AND sop_instance_uid = ?",
+                (destination, sop_instance_uid),
+            ).fetchone()
+        return None if row is None else (row[0], row[1], row[2])
+
+    def record(self, destination: str, sop_instance_uid: str, filename: str, digest: Optional[str] = None) -> None:
+        """Record an instance successfully stored on a destination.
+
+        Args:
+            destination: key of the destination.
+            sop_instance_uid: SOP instance unique identifier.
+            filename: path to the file which was stored.
+            digest: hash of the file content. Computed if not given.
+
+        """
+        stat = os.stat(filename)
+        digest = digest or file_digest(filename)
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO instances VALUES (?, ?, ?, ?, ?, ?)",
+                (destination, sop_instance_uid, digest, stat.st_size, stat.st_mtime_ns, time.time()),
+            )
+
+    def is_sent(self, destination: str, sop_instance_uid: str, filename: str) -> bool:
+        """Check whether the content of a file was already stored on a destination.
+
+        Args:
+            destination: key of the destination.
+            sop_instance_uid: SOP instance unique identifier of the file.
+            filename: path to the file.
+
+        Returns:
+            bool: True if the file does not need to be sent again.
+
+        """
+        entry = self.get(destination, sop_instance_uid)
+        if entry is None:
+            return False
+        digest, size, mtime = entry
+        stat = os.stat(filename)
+        if stat.st_size != size:
+            return False
+        if stat.st_mtime_ns != mtime:
+            if file_digest(filename) != digest:
+                return False
+            # Only touched: the file is not read again by the next checks
+            with self._lock, self._connection:
+                self._connection.execute(
+                    "UPDATE instances SET mtime = ? WHERE destination = ? AND sop_instance_uid = ?",
+                    (stat.st_mtime_ns, destination, sop_instance_uid),
+                )
+        return True
+
+    def pending(self, destination: str, filenames: Dict[str, str]) -> Dict[str, str]:
+        """Return the files which were not stored on a destination yet.
+
+        Args:
+            destination: key of the destination.
+            filenames: SOPInstanceUID of each file, indexed by file path.
+
+        Returns:
+            dict: SOPInstanceUID of each file to send, indexed by file path.
+
+        """
+        return {
+            filename: sop_instance_uid
+            for filename, sop_instance_uid in filenames.items()
+            if not self.is_sent(destination, sop_instance_uid, filename)
+        }
+
+    def close(self) -> None:
+        """Close the connection to the database."""
+        with self._lock:
+            self._connection.close()
+
+    def __enter__(self) -> "UploadLedger":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
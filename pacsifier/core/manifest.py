@@ -0,0 +1,195 @@
+# Copyright 2018-2024 Lausanne University Hospital and University of Lausanne,
+# Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module contains the manifest of the files anonymized into an output folder, used to skip them when anonymizing again."""
+
+import json
+import os
+from typing import Dict, List, Optional
+
+from pacsifier.core.ledger import file_digest
+
+MANIFEST_FILENAME = "anonymization_manifest.jsonl"
+
+
+def describe_input(path: str) -> Dict[str, object]:
+    """Return the size, modification time and digest of an input file, as recorded in the manifest."""
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": file_digest(path, "sha256")}
+
+
+class AnonymizationManifest:
+    """Manifest of the files anonymized into an output folder, one JSON object per line.
+
+    The manifest records the parameters of the anonymization, the new id and
+    date offset of each patient folder, and the size, modification time and
+    SHA-256 digest of each input file with the path of its anonymized file.
+    A new run with the same parameters skips the input files which did not
+    change, and gives the patients of the previous runs the same new ids and
+    date offsets, so that an output folder can be topped up with new series.
+
+    The records are appended as the series are anonymized, so that a run
+    which stopped can be resumed, and the manifest is rewritten at once
+    (see :meth:`write`) at the end of each run. Like ``mapper.json``, it
+    links the anonymized files to the original ones.
+
+    Args:
+        output_folder: folder of the anonymized files, where the manifest is written
+        datapath: folder of the input files
+
+    """
+
+    def __init__(self, output_folder: str, datapath: str) -> None:
+        self.path = os.path.join(output_folder, MANIFEST_FILENAME)
+        self.output_folder = output_folder
+        self.datapath = datapath
+        self.parameters = None  # type: Optional[Dict[str, object]]
+        # Patient folder -> new id and date offset
+        self.patients = {}  # type: Dict[str, Dict[str, object]]
+        # Input file, relative to the input folder -> description and output file
+        self.files = {}  # type: Dict[str, Dict[str, object]]
+        if os.path.isfile(self.path):
+            with open(self.path, "r") as f:
+                for line in f:
+                    if line.strip():
+                        self._load(json.loads(line))
+
+    def _load(self, record: Dict[str, object]) -> None:
+        kind = record.pop("type")
+        if kind == "parameters":
+            self.parameters = record["parameters"]
+        elif kind == "patient":
+            self.patients[record.pop("patient")] = record
+        elif kind == "file":
+            self.files[record.pop("input")] = record
+
+    def _append(self, records: List[Dict[str, object]]) -> None:
+        with open(self.path, "a") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+
+    def _input_key(self, filename: str) -> str:
+        return os.path.relpath(filename, self.datapath)
+
+    def _remove_output(self, record: Dict[str, object]) -> None:
+        if record["output"] is not None:
+            output_path = os.path.join(self.output_folder, str(record["output"]))
+            if os.path.isfile(output_path):
+                os.remove(output_path)
+
+    def start(self, parameters: Dict[str, object], incremental: bool = True) -> None:
+        """Start a new run, rewriting the manifest.
+
+        The files of the previous runs are anonymized again, and their
+        previous anonymized files deleted, if the parameters changed or if the
+        run is not incremental. The patients keep their new ids and date offsets.
+
+        Args:
+            parameters: parameters of the anonymization of this run
+            incremental: skip the files anonymized by the previous runs if True
+
+        """
+        if not incremental or parameters != self.parameters:
+            for record in self.files.values():
+                self._remove_output(record)
+            self.files = {}
+        self.parameters = parameters
+        self.write()
+
+    def add_patient(self, patient: str, new_id: str, date_offset: int) -> None:
+        """Record the new id and date offset of a patient folder.
+
+        The files of the patient are anonymized again if they changed, and
+        their previous anonymized files deleted.
+        """
+        record = {"new_id": new_id, "date_offset": int(date_offset)}
+        if self.patients.get(patient) == record:
+            return
+        if patient in self.patients:
+            prefix = patient + os.sep
+            for key in [key for key in self.files if key.startswith(prefix)]:
+                self._remove_output(self.files.pop(key))
+        self.patients[patient] = record
+        self._append([{"type": "patient", "patient": patient, **record}])
+
+    def is_current(self, filename: str) -> bool:
+        """Check whether an input file was anonymized by a previous run and did not change since.
+
+        The content of the file is only read if its modification time changed.
+        """
+        record = self.files.get(self._input_key(filename))
+        if record is None:
+            return False
+        # The anonymized file was deleted since
+        if record["output"] is not None and not os.path.isfile(
+            os.path.join(self.output_folder, str(record["output"]))
+        ):
+            return False
+        stat = os.stat(filename)
+        if stat.st_size != record["size"]:
+            return False
+        if stat.st_mtime_ns != record["mtime_ns"]:
+            if file_digest(filename, "sha256") != record["sha256"]:
+                return False
+            record["mtime_ns"] = stat.st_mtime_ns
+        return True
+
+    def discard(self, filename: str) -> None:
+        """Forget an input file which changed, and delete the file anonymized from it by a previous run."""
+        record = self.files.pop(self._input_key(filename), None)
+        if record is not None:
+            self._remove_output(record)
+
+    def add_files(self, records: List[Dict[str, object]]) -> None:
+        """Record anonymized files.
+
+        Args:
+            records: ``input`` path, ``output`` path (None for the discarded
+                     files), ``size``, ``mtime_ns`` and ``sha256`` of each file
+
+        """
+        lines = []
+        for record in records:
+            record = dict(record)
+            key = self._input_key(str(record.pop("input")))
+            if record["output"] is not None:
+                record["output"] = os.path.relpath(str(record["output"]), self.output_folder)
+            self.files[key] = record
+            lines.append({"type": "file", "input": key, **record})
+        self._append(lines)
+
+    def move_outputs(self, folder: str, new_folder: str) -> None:
+        """Update the paths of the anonymized files of a folder which is renamed."""
+        prefix = os.path.relpath(folder, self.output_folder) + os.sep
+        new_prefix = os.path.relpath(new_folder, self.output_folder) + os.sep
+        for record in self.files.values():
+            output = record["output"]
+            if output is not None and str(output).startswith(prefix):
+                record["output"] = new_prefix + str(output)[len(prefix) :]
+
+    def write(self) -> None:
+        """Rewrite the manifest at once, with one record per patient and input file."""
+        records = [
+            {"type": "parameters", "parameters": self.parameters}
+        ]  # type: List[Dict[str, object]]
+        records += [
+            {"type": "patient", "patient": patient, **record}
+            for patient, record in self.patients.items()
+        ]
+        records += [{"type": "file", "input": key, **record} for key, record in self.files.items()]
+        with open(self.path + ".part", "w") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+        os.replace(self.path + ".part", self.path)
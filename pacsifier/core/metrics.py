@@ -0,0 +1,463 @@
+# Copyright 2018-2024 Lausanne University Hospital and University of Lausanne,
+# Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module contains the metrics of the retrievals and uploads, and their exporters."""
+
+import math
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# Content types of the Prometheus (0.0.4) and OpenMetrics (1.0.0) text formats
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+OPENMETRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+# Upper bounds in seconds of the buckets of the latency histograms
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    pairs = []
+    for name, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class _Metric:
+    """Metric family with one value (or histogram) per combination of label values."""
+
+    type = ""
+    # Suffix of the samples, part of the name of the family in the Prometheus text format
+    suffix = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}  # type: Dict[Tuple[str, ...], object]
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"The labels of {self.name} are {list(self.labelnames)}!")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self) -> List[Tuple[str, Dict[str, str], float]]:
+        raise NotImplementedError
+
+    def render(self, openmetrics: bool = False) -> List[str]:
+        """Return the lines of the metric family in the Prometheus or OpenMetrics text format."""
+        if openmetrics:
+            lines = [
+                f"# TYPE {self.name} {self.type}",
+                f"# HELP {self.name} {self.documentation}",
+            ]
+        else:
+            lines = [
+                f"# HELP {self.name}{self.suffix} {self.documentation}",
+                f"# TYPE {self.name}{self.suffix} {self.type}",
+            ]
+        for suffix, labels, value in self._samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    """Counter, e.g. number of requests or bytes received, only increasing during a run."""
+
+    type = "counter"
+    suffix = "_total"
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        """Increase the counter of the label values by ``amount``."""
+        if amount < 0:
+            raise ValueError("A counter can only increase!")
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels: str) -> float:
+        """Return the value of the counter of the label values."""
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _samples(self) -> List[Tuple[str, Dict[str, str], float]]:
+        with self._lock:
+            return [
+                (self.suffix, dict(zip(self.labelnames, key)), value)
+                for key, value in sorted(self._values.items())
+            ]
+
+
+class Gauge(_Metric):
+    """Gauge, e.g. depth of a queue, set to its current value or read from a function."""
+
+    type = "gauge"
+
+    def set(self, value: float, **labels: str) -> None:
+        """Set the gauge of the label values."""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function: Optional[Callable[[], float]], **labels: str) -> None:
+        """Read the gauge of the label values from a function when rendered (removed if None)."""
+        key = self._key(labels)
+        with self._lock:
+            if function is None:
+                self._values.pop(key, None)
+            else:
+                self._values[key] = function
+
+    def get(self, **labels: str) -> Optional[float]:
+        """Return the value of the gauge of the label values (None if not set)."""
+        with self._lock:
+            value = self._values.get(self._key(labels))
+        return value() if callable(value) else value
+
+    def _samples(self) -> List[Tuple[str, Dict[str, str], float]]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [
+            ("", dict(zip(self.labelnames, key)), value() if callable(value) else value)
+            for key, value in values
+        ]
+
+
+class Histogram(_Metric):
+    """Histogram of observed values, e.g. latencies in seconds.
+
+    Args:
+        name: name of the metric family.
+        documentation: description of the metric family.
+        labelnames: names of the labels.
+        buckets: upper bounds of the buckets, in increasing order.
+
+    """
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        if list(buckets) != sorted(buckets):
+            raise ValueError("The buckets of a histogram must be sorted!")
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, value: float, **labels: str) -> None:
+        """Add a value to the histogram of the label values."""
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    def count(self, **labels: str) -> int:
+        """Return the number of values observed for the label values."""
+        with self._lock:
+            counts, _ = self._values.get(self._key(labels), ([0], 0.0))
+        return sum(counts)
+
+    def _samples(self) -> List[Tuple[str, Dict[str, str], float]]:
+        samples = []
+        with self._lock:
+            values = [
+                (key, list(counts), total) for key, (counts, total) in sorted(self._values.items())
+            ]
+        for key, counts, total in values:
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append(("_bucket", {**labels, "le": _format_value(bound)}, cumulative))
+            samples.append(("_count", labels, cumulative))
+            samples.append(("_sum", labels, total))
+        return samples
+
+
+class MetricsRegistry:
+    """Collection of metric families rendered together."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._metrics = {}  # type: Dict[str, _Metric]
+
+    def _register(self, cls, name: str, *args, **kwargs) -> _Metric:
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(self._metrics[name], cls):
+                raise ValueError(f"The metric {name} is already registered with another type!")
+            return self._metrics[name]
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        """Return the counter of a name, registered if needed."""
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        """Return the gauge of a name, registered if needed."""
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        """Return the histogram of a name, registered if needed."""
+        return self._register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def render(self, openmetrics: bool = False) -> str:
+        """Return all the metrics in the Prometheus (default) or OpenMetrics text format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines += metric.render(openmetrics)
+        if openmetrics:
+            lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+# Registry of the metrics of PACSIFIER
+REGISTRY = MetricsRegistry()
+
+ASSOCIATIONS = REGISTRY.counter(
+    "pacsifier_associations", "Associations requested to the PACS servers.", ["result"]
+)
+REQUESTS = REGISTRY.counter(
+    "pacsifier_requests", "DIMSE requests sent to the PACS servers.", ["operation", "result"]
+)
+REQUEST_SECONDS = REGISTRY.histogram(
+    "pacsifier_request_duration_seconds",
+    "Duration of the DIMSE requests sent to the PACS servers.",
+    ["operation"],
+)
+INSTANCES = REGISTRY.counter(
+    "pacsifier_instances",
+    "DICOM instances received from or sent to the PACS servers.",
+    ["direction"],
+)
+BYTES = REGISTRY.counter(
+    "pacsifier_bytes",
+    "Bytes of the DICOM instances received from or sent to the PACS servers.",
+    ["direction"],
+)
+QUEUE_DEPTH = REGISTRY.gauge(
+    "pacsifier_queue_depth", "Number of items waiting or running in a queue.", ["queue"]
+)
+FAILURES = REGISTRY.counter(
+    "pacsifier_failures",
+    "Failed requests, retried or not, per kind of failure.",
+    ["kind", "retried"],
+)
+LAST_REQUEST = REGISTRY.gauge(
+    "pacsifier_last_request_timestamp_seconds",
+    "Time of the last DIMSE request done, to detect a stalled PACS server.",
+    ["operation"],
+)
+
+
+def observe_request(operation: str, seconds: Optional[float], success: bool) -> None:
+    """Record the outcome and duration of a DIMSE request.
+
+    Args:
+        operation: DIMSE service, e.g. ``C-FIND``, ``C-MOVE``, ``C-GET`` or ``C-STORE``
+        seconds: duration of the request in seconds, if known
+        success: True if the request succeeded
+
+    """
+    REQUESTS.inc(operation=operation, result="success" if success else "failure")
+    if seconds is not None:
+        REQUEST_SECONDS.observe(seconds, operation=operation)
+    LAST_REQUEST.set(time.time(), operation=operation)
+
+
+def observe_association(established: bool) -> None:
+    """Record whether an association was established or rejected."""
+    ASSOCIATIONS.inc(result="established" if established else "failed")
+
+
+def observe_failure(kind: str, retried: bool) -> None:
+    """Record a failed request and whether it is sent again."""
+    FAILURES.inc(kind=kind, retried="true" if retried else "false")
+
+
+class TextfileExporter:
+    """Write the metrics to a file at a regular interval, e.g. for the node exporter.
+
+    The metrics are written in the Prometheus text format read by the node
+    exporter textfile collector. The file is written to a temporary file
+    which is then renamed, so that it is never read partially written. It is
+    written a last time when the exporter is closed.
+
+    Args:
+        path: path to the metrics file (e.g. ``pacsifier.prom``).
+        interval: time in seconds between two writes.
+        registry: registry of the metrics.
+
+    """
+
+    def __init__(
+        self, path: str, interval: float = 15.0, registry: MetricsRegistry = REGISTRY
+    ) -> None:
+        if interval <= 0:
+            raise ValueError("The interval between two writes must be positive!")
+        self.path = path
+        self.interval = interval
+        self.registry = registry
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self) -> None:
+        """Write the current metrics to the file."""
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        temp_path = self.path + ".part"
+        with open(temp_path, "w") as f:
+            f.write(self.registry.render())
+        os.replace(temp_path, self.path)
+
+    def _run(self) -> None:
+        while True:
+            try:
+                self.write()
+            except OSError as e:
+                print(f"* Cannot write the metrics to {self.path}: {e}")
+            if self._stop.wait(self.interval):
+                return
+
+    def close(self) -> None:
+        """Stop writing the metrics periodically and write them a last time."""
+        self._stop.set()
+        self._thread.join()
+        self.write()
+
+
+class HttpExporter:
+    """Serve the metrics over HTTP on ``/metrics`` in a background thread.
+
+    The metrics are served in the OpenMetrics text format to the clients
+    accepting it (e.g. Prometheus scrapers), and in the Prometheus text format otherwise.
+
+    Args:
+        port: local port to listen on (0 to pick a free port).
+        address: local address to listen on. Default is all interfaces.
+        registry: registry of the metrics.
+
+    """
+
+    def __init__(self, port: int, address: str = "", registry: MetricsRegistry = REGISTRY) -> None:
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                openmetrics = "application/openmetrics-text" in self.headers.get("Accept", "")
+                body = registry.render(openmetrics).encode("utf-8")
+                self.send_response(200)
+                self.send_header(
+                    "Content-Type", OPENMETRICS_CONTENT_TYPE if openmetrics else CONTENT_TYPE
+                )
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args) -> None:
+                # Scrapes are not written to the standard output
+                pass
+
+        self._server = ThreadingHTTPServer((address, port), Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        """Stop serving the metrics."""
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+
+class MetricsExporters:
+    """Exporters configured in the config file, closed together at the end of a run.
+
+    Args:
+        exporters: list of exporters.
+
+    """
+
+    def __init__(self, exporters: Optional[List[object]] = None) -> None:
+        self.exporters = exporters or []
+
+    @classmethod
+    def from_parameters(cls, parameters: Dict[str, str]) -> "MetricsExporters":
+        """Start the exporters of the config file.
+
+        The metrics are written every ``metrics_interval`` seconds (15 by
+        default) to ``metrics_textfile`` if given, and served on
+        ``metrics_port`` if given.
+
+        Args:
+            parameters: parameters from PACSIFIER configuration file
+
+        Returns:
+            MetricsExporters: the running exporters (none if not configured)
+
+        """
+        exporters = []  # type: List[object]
+        if "metrics_textfile" in parameters:
+            exporters.append(
+                TextfileExporter(
+                    parameters["metrics_textfile"], float(parameters.get("metrics_interval", 15))
+                )
+            )
+        if "metrics_port" in parameters:
+            exporters.append(HttpExporter(int(parameters["metrics_port"])))
+        return cls(exporters)
+
+    def close(self) -> None:
+        """Stop all the exporters."""
+        for exporter in self.exporters:
+            exporter.close()
+
+    def __enter__(self) -> "MetricsExporters":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
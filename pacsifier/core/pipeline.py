@@ -0,0 +1,142 @@
+# Copyright 2018-2024 Lausanne University Hospital and University of Lausanne,
+# Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module contains the stages used to overlap the queries, retrievals and post-processing."""
+
+import queue
+import threading
+from typing import Any, Callable, Iterable, Iterator
+
+# Marks the end of the items of a stage
+_DONE = object()
+
+
+class _Error:
+    """Exception raised by a stage, re-raised in the calling thread."""
+
+    def __init__(self, exception: BaseException) -> None:
+        self.exception = exception
+
+
+def prefetch(iterable: Iterable, maxsize: int = 1) -> Iterator:
+    """Iterate over ``iterable`` in a background thread, at most ``maxsize`` items ahead.
+
+    The items are produced by the background thread while the caller
+    processes the previous ones. Exceptions raised while producing an item
+    are re-raised by the caller when it reaches that item.
+
+    Args:
+        iterable: iterable to consume in the background, e.g. a generator
+                  running the C-FIND requests of the query table.
+        maxsize: maximal number of items produced ahead of the caller.
+
+    Yields:
+        the items of ``iterable``, in order.
+
+    """
+    items = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+
+    def put(item: Any) -> bool:
+        # Give up if the caller stopped iterating
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce() -> None:
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except BaseException as e:
+            put(_Error(e))
+            return
+        put(_DONE)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is _DONE:
+                break
+            if isinstance(item, _Error):
+                raise item.exception
+            yield item
+    finally:
+        # Unblock the producer if the caller stops early
+        stop.set()
+        thread.join()
+
+
+class BackgroundStage:
+    """Apply a function to items, in order, in a background thread fed by a bounded queue.
+
+    :meth:`put` blocks once ``maxsize`` items are waiting, so that the memory
+    used by the pending items stays bounded. The first exception raised by the
+    function stops the stage and is re-raised by :meth:`put` or :meth:`close`.
+
+    Args:
+        fn: function applied to each item.
+        maxsize: maximal number of items waiting to be processed.
+
+    """
+
+    def __init__(self, fn: Callable[[Any], None], maxsize: int = 1) -> None:
+        self.fn = fn
+        self._items = queue.Queue(maxsize=maxsize)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            item = self._items.get()
+            if item is _DONE:
+                return
+            if self._error is not None:
+                # Drain the queue so that put() never blocks
+                continue
+            try:
+                self.fn(item)
+            except BaseException as e:
+                self._error = e
+
+    def qsize(self) -> int:
+        """Return the approximate number of items waiting to be processed."""
+        return self._items.qsize()
+
+    def put(self, item: Any) -> None:
+        """Queue an item, blocking while the queue is full."""
+        if self._error is not None:
+            raise self._error
+        self._items.put(item)
+
+    def close(self) -> None:
+        """Wait for all the queued items to be processed."""
+        self._items.put(_DONE)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self) -> "BackgroundStage":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
@@ -0,0 +1,215 @@
+# Copyright 2018-2024 Lausanne University Hospital and University of Lausanne,
+# Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module contains the planner removing the redundant rows of a query table before querying the PACS."""
+
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+# Attributes which must be equal for two rows to be merged
+IDENTITY_ATTRIBUTES = ["new_ids"]
+
+
+def normalize_row(query_attributes: Dict[str, str]) -> Dict[str, str]:
+    """Normalize the attributes of a query row.
+
+    Values are converted to strings and stripped, and date ranges with equal
+    bounds (e.g. ``20171001-20171001``) are replaced by the single date.
+
+    Args:
+        query_attributes: dictionary containing the attributes of a query row
+
+    Returns:
+        dict: the normalized attributes
+
+    """
+    row = {key: str(value).strip() for key, value in query_attributes.items()}
+    date = row.get("StudyDate", "")
+    if len(date) == 17 and date[:8] == date[9:]:
+        row["StudyDate"] = date[:8]
+    return row
+
+
+def parse_date_range(date: str) -> Optional[Tuple[datetime, datetime]]:
+    """Return the first and last day of a date or date range (None if it cannot be parsed).
+
+    Args:
+        date: date (``YYYYMMDD``) or date range (``YYYYMMDD-YYYYMMDD``)
+
+    Returns:
+        tuple: first and last day, both included
+
+    """
+    bounds = date.split("-") if len(date) == 17 else [date, date]
+    try:
+        first, last = [datetime.strptime(bound, "%Y%m%d") for bound in bounds]
+    except ValueError:
+        return None
+    if first > last:
+        return None
+    return first, last
+
+
+def format_date_range(first: datetime, last: datetime) -> str:
+    """Return the DICOM date (range) from its first and last day."""
+    if first == last:
+        return first.strftime("%Y%m%d")
+    return first.strftime("%Y%m%d") + "-" + last.strftime("%Y%m%d")
+
+
+def merge_date_ranges(dates: List[str]) -> List[str]:
+    """Merge the overlapping or contiguous dates and date ranges.
+
+    Args:
+        dates: list of dates (``YYYYMMDD``) or date ranges (``YYYYMMDD-YYYYMMDD``)
+
+    Returns:
+        list: the merged date ranges, sorted by first day
+
+    """
+    ranges = sorted(parse_date_range(date) for date in dates)
+    merged = []  # type: List[List[datetime]]
+    for first, last in ranges:
+        if merged and first <= merged[-1][1] + timedelta(days=1):
+            merged[-1][1] = max(merged[-1][1], last)
+        else:
+            merged.append([first, last])
+    return [format_date_range(first, last) for first, last in merged]
+
+
+def covers(row: Dict[str, str], other: Dict[str, str]) -> bool:
+    """Check whether the series matched by a query row include the ones matched by another row.
+
+    It is the case if each non-empty attribute of ``row`` is equal in
+    ``other``, and the date range of ``other`` is included in the one of ``row``.
+
+    Args:
+        row: attributes of the (broader) query row
+        other: attributes of the other query row
+
+    Returns:
+        bool: True if ``other`` is redundant with ``row``
+
+    """
+    for key, value in row.items():
+        if key in IDENTITY_ATTRIBUTES:
+            if other.get(key, "") != value:
+                return False
+        elif key == "StudyDate":
+            if value == "":
+                continue
+            dates = parse_date_range(value)
+            other_dates = parse_date_range(other.get(key, ""))
+            if dates is None or other_dates is None:
+                if other.get(key, "") != value:
+                    return False
+            elif other_dates[0] < dates[0] or other_dates[1] > dates[1]:
+                return False
+        elif value != "" and other.get(key, "") != value:
+            return False
+    return True
+
+
+def plan_queries(
+    attributes_list: List[Dict[str, str]]
+) -> Tuple[List[Dict[str, str]], Dict[str, int]]:
+    """Remove the redundant rows of a query table.
+
+    The rows are normalized (see :func:`normalize_row`), then:
+
+    * duplicated rows are removed,
+    * rows which only differ by their ``StudyDate`` are merged into one row
+      per set of overlapping or contiguous date ranges,
+    * rows covered by a broader row (see :func:`covers`), e.g. a row
+      with the StudyInstanceUID of a study already queried, are removed.
+
+    The remaining rows keep the order of the query table.
+
+    Args:
+        attributes_list: list of dictionaries containing the attributes of each
+                         query row (see :func:`pacsifier.cli.pacsifier.parse_query_table`)
+
+    Returns:
+        tuple: the planned query rows, and a summary of the plan with the number of
+               ``rows``, ``duplicates``, ``merged`` and ``covered`` rows, ``queries``
+               and ``known_moves`` (series or studies whose UID is given in the rows).
+
+    """
+    summary = {"rows": len(attributes_list), "duplicates": 0, "merged": 0, "covered": 0}
+
+    # Remove the duplicated rows
+    unique = OrderedDict()  # type: Dict[tuple, Dict[str, str]]
+    for query_attributes in attributes_list:
+        row = normalize_row(query_attributes)
+        unique.setdefault(tuple(sorted(row.items())), row)
+    summary["duplicates"] = len(attributes_list) - len(unique)
+
+    # Merge the date ranges of the rows which only differ by their date
+    groups = OrderedDict()  # type: Dict[tuple, List[Dict[str, str]]]
+    for row in unique.values():
+        key = tuple(sorted((k, v) for k, v in row.items() if k != "StudyDate"))
+        groups.setdefault(key, []).append(row)
+    rows = []
+    for group in groups.values():
+        dates = [row.get("StudyDate", "") for row in group]
+        if len(group) == 1 or any(parse_date_range(date) is None for date in dates):
+            rows.extend(group)
+            continue
+        merged_dates = merge_date_ranges(dates)
+        summary["merged"] += len(group) - len(merged_dates)
+        rows.extend(dict(group[0], StudyDate=date) for date in merged_dates)
+
+    # Remove the rows covered by a broader row. Rows can only be covered by a
+    # row with the same PatientID or without PatientID.
+    by_patient = {}  # type: Dict[str, List[int]]
+    for index, row in enumerate(rows):
+        by_patient.setdefault(row.get("PatientID", ""), []).append(index)
+    covered = set()
+    for index, row in enumerate(rows):
+        candidates = by_patient.get(row.get("PatientID", ""), [])
+        if row.get("PatientID", ""):
+            candidates = candidates + by_patient.get("", [])
+        for other_index in candidates:
+            if other_index == index or other_index in covered:
+                continue
+            # Two rows covering each other are equal, the first one is kept
+            if covers(rows[other_index], row) and (
+                other_index < index or not covers(row, rows[other_index])
+            ):
+                covered.add(index)
+                break
+    planned = [row for index, row in enumerate(rows) if index not in covered]
+    summary["covered"] = len(covered)
+
+    summary["queries"] = len(planned)
+    summary["known_moves"] = len(
+        {
+            row.get("SeriesInstanceUID") or row.get("StudyInstanceUID")
+            for row in planned
+            if row.get("SeriesInstanceUID") or row.get("StudyInstanceUID")
+        }
+    )
+    return planned, summary
+
+
+def format_plan_summary(summary: Dict[str, int]) -> str:
+    """Return a printable summary of a query plan (see :func:`plan_queries`)."""
+    return (
+        "Query plan: {queries} queries for {rows} rows "
+        "({duplicates} duplicated, {merged} merged date ranges, {covered} covered by another row), "
+        "at least {known_moves} moves known in advance, "
+        "the other moves depend on the query results".format(**summary)
+    )
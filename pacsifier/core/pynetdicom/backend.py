@@ -0,0 +1,620 @@
+# Copyright 2018-2024 Lausanne University Hospital and University of Lausanne,
+# Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module contains the backend implementing the DIMSE services in Python with pynetdicom."""
+
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Sequence, Set
+
+from pydicom import dcmread
+from pydicom.dataset import Dataset
+
+try:
+    from pynetdicom import AE, StoragePresentationContexts, build_role, evt
+    from pynetdicom.sop_class import (
+        PatientRootQueryRetrieveInformationModelGet,
+        PatientRootQueryRetrieveInformationModelMove,
+        StudyRootQueryRetrieveInformationModelFind,
+        Verification,
+    )
+except ImportError:  # pragma: no cover
+    raise ImportError(
+        "The pynetdicom backend requires the pynetdicom package. "
+        "Install it with `pip install pacsifier[native]`."
+    )
+
+from pacsifier.core.backend import DicomBackend
+from pacsifier.core.metrics import observe_failure
+from pacsifier.core.pynetdicom.pool import AssociationPool
+from pacsifier.core.pynetdicom.receiver import StorageReceiver
+from pacsifier.core.records import SeriesRecord, dataset_to_series_record
+from pacsifier.core.retry import ASSOCIATION_FAILED, NO_RETRY, Failure, RetryPolicy
+from pacsifier.core.sanity_checks import (
+    check_AET,
+    check_ids,
+    check_port,
+    check_query_retrieval_level,
+    check_retrieve_level,
+)
+from pacsifier.core.sorter import get_series_dirs
+from pacsifier.core.stats import record_retry
+
+
+# Keyword arguments of find() -> DICOM keyword of the matching key
+FIND_ARGUMENT_TO_KEYWORD = {  # type: Dict[str,str]
+    "patient_id": "PatientID",
+    "study_uid": "StudyInstanceUID",
+    "series_instance_uid": "SeriesInstanceUID",
+    "series_description": "SeriesDescription",
+    "protocol_name": "ProtocolName",
+    "acquisition_date": "AcquisitionDate",
+    "patient_name": "PatientName",
+    "patient_birthdate": "PatientBirthDate",
+    "study_date": "StudyDate",
+    "device_serial_number": "DeviceSerialNumber",
+    "modality": "Modality",
+    "image_type": "ImageType",
+    "study_description": "StudyDescription",
+    "accession_number": "AccessionNumber",
+    "sequence_name": "SequenceName",
+}
+
+# Return keys requested in addition to the query keys, as done by findscu
+FIND_RETURN_KEYWORDS = ["SeriesNumber", "StudyTime", "PatientAge"]
+
+# Maximal number of upload pools kept open, the least recently used one is closed first
+MAX_STORE_POOLS = 4
+
+# Status of a C-FIND / C-MOVE response
+STATUS_SUCCESS = 0x0000
+STATUS_PENDING = (0xFF00, 0xFF01)
+
+
+class PynetdicomBackend(DicomBackend):
+    """Backend implementing the DIMSE services in Python with pynetdicom.
+
+    Unlike the DCMTK backend, no process is started per request: associations
+    with the PACS server are kept open in an :class:`AssociationPool` and reused
+    by the following requests, and the Storage SCP receiving the retrieved
+    images keeps listening on its port between retrievals. The Storage SCP
+    routes each image with its header, so that all the retrievals running at
+    the same time share one port (see :class:`StorageReceiver`). With the
+    ``retrieve_method`` C-GET, the images are received on the (pooled)
+    association of the request instead, and no port is listened on. Uploads
+    reuse pooled associations as well, one pool per set of presentation contexts
+    and at most :data:`MAX_STORE_POOLS` of them.
+
+    Args:
+        timeout: time in seconds to wait for the association and network
+                 responses of the PACS server. Default is 10.
+        keepalive: idle time in seconds after which a pooled association is
+                   health-checked before being reused. Default is 30.
+
+    """
+
+    name = "pynetdicom"
+    shares_receive_port = True
+
+    def __init__(self, *args, timeout: int = 10, keepalive: float = 30, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+
+        self._ae = AE(ae_title=self.aet)
+        self._ae.acse_timeout = timeout
+        self._ae.network_timeout = timeout
+        self._ae.dimse_timeout = None
+        for context in [
+            Verification,
+            StudyRootQueryRetrieveInformationModelFind,
+            PatientRootQueryRetrieveInformationModelMove,
+        ]:
+            self._ae.add_requested_context(context)
+
+        self._pool = AssociationPool(
+            self._ae, self.server_address, self.port, self.server_aet, keepalive=keepalive
+        )
+
+        self._receiver = StorageReceiver(self.aet)
+
+        self._lock = threading.Lock()
+        # Pools of associations used by the uploads, per set of presentation contexts,
+        # from the least to the most recently used
+        self._store_pools = OrderedDict()  # type: Dict[frozenset, AssociationPool]
+        # Pool of associations used by the C-GET requests, created on first use
+        self._get_pool = None  # type: Optional[AssociationPool]
+
+    def _log(self, message: str, failed: bool = False, log_dir: Optional[str] = None) -> None:
+        log_dir = log_dir or self.log_dir
+        os.makedirs(log_dir, exist_ok=True)
+        with open(os.path.join(log_dir, "log.txt"), "a") as f:
+            f.write(message + "\n")
+        if failed:
+            print(f"* Request did not succeed: {message}")
+            with open(os.path.join(log_dir, "fails.txt"), "a") as f:
+                f.write(message + "\n")
+
+    def _associate(self, ae: AE, contexts=None):
+        assoc = ae.associate(
+            self.server_address, self.port, contexts=contexts, ae_title=self.server_aet
+        )
+        if not assoc.is_established:
+            return None
+        return assoc
+
+    def _request(
+        self,
+        send: Callable,
+        default,
+        pool: Optional[AssociationPool] = None,
+        retry_policy: Optional[RetryPolicy] = None,
+    ):
+        """Run ``send(assoc)`` on a pooled association.
+
+        If no association could be established, or if the association is lost
+        during the request (e.g. it was closed by the server), the request is
+        sent again on a new association after the backoff delay of the retry policy.
+
+        Args:
+            send: function sending the request on the association and returning its result.
+            default: result returned if no association could be established.
+            pool: pool of associations to use. Default is the pool of the
+                  query / retrieve associations.
+            retry_policy: number of retries and backoff delays. Default is the
+                          retry policy of the backend.
+
+        Returns:
+            the result of ``send``.
+
+        """
+        pool = pool or self._pool
+        retry_policy = retry_policy or self.retry_policy
+        retries = 0
+        while True:
+            with pool.acquire() as assoc:
+                if assoc is None:
+                    result = default
+                    failure = Failure(ASSOCIATION_FAILED, True, "Association request failed")
+                else:
+                    result = send(assoc)
+                    if assoc.is_established:
+                        return result
+                    failure = Failure(ASSOCIATION_FAILED, True, "Association lost")
+
+            retried = retry_policy.should_retry(failure, retries)
+            observe_failure(failure.kind, retried)
+            if not retried:
+                return result
+            retry_policy.wait(retries)
+            retries += 1
+            record_retry()
+
+    def echo(self) -> bool:
+        def send(assoc) -> bool:
+            status = assoc.send_c_echo()
+            return bool(status) and status.Status == STATUS_SUCCESS
+
+        success = self._request(send, False, retry_policy=NO_RETRY)
+        self._log(
+            f"C-ECHO {self.server_aet}@{self.server_address}:{self.port}", failed=not success
+        )
+        return success
+
+    def find_datasets(
+        self,
+        query_retrieval_level: str = "SERIES",
+        return_keywords: Sequence[str] = (),
+        **query_attributes: str,
+    ) -> List[Dataset]:
+        """Query the PACS server and return the C-FIND response identifiers.
+
+        Args:
+            query_retrieval_level: query retrieval level which can only take values in
+                                   {SERIES, STUDY, PATIENT, IMAGE}.
+            return_keywords: attributes to return in addition to ``FIND_RETURN_KEYWORDS``.
+            query_attributes: query attributes (see :meth:`DicomBackend.find`).
+
+        Returns:
+            list: list of pydicom datasets, one per match
+
+        """
+        check_ids(query_attributes.get("patient_id", ""))
+        check_ids(query_attributes.get("study_uid", ""), attribute="Study instance UID")
+        check_ids(
+            query_attributes.get("series_instance_uid", ""),
+            attribute="Series instance UID",
+        )
+        check_query_retrieval_level(query_retrieval_level)
+
+        identifier = Dataset()
+        identifier.QueryRetrieveLevel = query_retrieval_level
+        for keyword in list(FIND_RETURN_KEYWORDS) + list(return_keywords):
+            setattr(identifier, keyword, "")
+        for argument, keyword in FIND_ARGUMENT_TO_KEYWORD.items():
+            setattr(identifier, keyword, query_attributes.get(argument, ""))
+
+        def send(assoc):
+            datasets = []
+            failed = False
+            for status, response in assoc.send_c_find(
+                identifier, StudyRootQueryRetrieveInformationModelFind
+            ):
+                if not status:
+                    failed = True
+                    break
+                if status.Status in STATUS_PENDING and response is not None:
+                    datasets.append(response)
+                elif status.Status != STATUS_SUCCESS:
+                    failed = True
+            return datasets, failed
+
+        datasets, failed = self._request(send, ([], True))
+        self._log(f"C-FIND {query_retrieval_level} {query_attributes}", failed=failed)
+        if failed:
+            self.request_failed(f"C-FIND {query_retrieval_level}")
+
+        return datasets
+
+    def find(
+        self, query_retrieval_level: str = "SERIES", **query_attributes: str
+    ) -> List[SeriesRecord]:
+        return [
+            dataset_to_series_record(dataset)
+            for dataset in self.find_datasets(query_retrieval_level, **query_attributes)
+        ]
+
+    def count_instances(
+        self, patient_id: str, study_instance_uid: str, series_instance_uid: str
+    ) -> int:
+        datasets = self.find_datasets(
+            "SERIES",
+            patient_id=patient_id,
+            study_uid=study_instance_uid,
+            series_instance_uid=series_instance_uid,
+            return_keywords=["NumberOfSeriesRelatedInstances"],
+        )
+        if datasets and datasets[0].get("NumberOfSeriesRelatedInstances") not in (None, ""):
+            return int(datasets[0].NumberOfSeriesRelatedInstances)
+        # Not returned by the PACS server: count the instances one by one
+        return super().count_instances(patient_id, study_instance_uid, series_instance_uid)
+
+    def _move(self, identifier: Dataset, move_aet: str) -> bool:
+        message = (
+            f"C-MOVE {identifier.QueryRetrieveLevel} {identifier.PatientID}/"
+            f"{identifier.get('StudyInstanceUID', '')}/"
+            f"{identifier.get('SeriesInstanceUID', '')} -> {move_aet}"
+        )
+
+        def send(assoc) -> bool:
+            success = False
+            for status, _ in assoc.send_c_move(
+                identifier, move_aet, PatientRootQueryRetrieveInformationModelMove
+            ):
+                if not status:
+                    return False
+                success = status.Status == STATUS_SUCCESS or status.Status in STATUS_PENDING
+            return success
+
+        success = self._request(send, False)
+        self._log(message, failed=not success)
+
+        return success
+
+    def _get(self, identifier: Dataset) -> bool:
+        message = (
+            f"C-GET {identifier.QueryRetrieveLevel} {identifier.PatientID}/"
+            f"{identifier.get('StudyInstanceUID', '')}/"
+            f"{identifier.get('SeriesInstanceUID', '')}"
+        )
+
+        def send(assoc) -> bool:
+            success = False
+            for status, _ in assoc.send_c_get(
+                identifier, PatientRootQueryRetrieveInformationModelGet
+            ):
+                if not status:
+                    return False
+                success = status.Status == STATUS_SUCCESS or status.Status in STATUS_PENDING
+            return success
+
+        success = self._request(send, False, pool=self._get_association_pool())
+        self._log(message, failed=not success)
+
+        return success
+
+    def _get_association_pool(self) -> AssociationPool:
+        """Return the pool of associations used by the C-GET requests.
+
+        The associations request the storage presentation contexts with the
+        SCP role, and the images received on them are handled by the receiver.
+        """
+        with self._lock:
+            if self._get_pool is None:
+                ae = AE(ae_title=self.aet)
+                ae.acse_timeout = self._ae.acse_timeout
+                ae.network_timeout = self._ae.network_timeout
+                ae.dimse_timeout = self._ae.dimse_timeout
+                ae.add_requested_context(Verification)
+                ae.add_requested_context(PatientRootQueryRetrieveInformationModelGet)
+                # At most 128 presentation contexts can be requested
+                roles = []
+                for context in StoragePresentationContexts[:126]:
+                    ae.add_requested_context(context.abstract_syntax)
+                    roles.append(build_role(context.abstract_syntax, scp_role=True))
+                self._get_pool = AssociationPool(
+                    ae,
+                    self.server_address,
+                    self.port,
+                    self.server_aet,
+                    keepalive=self._pool.keepalive,
+                    ext_neg=roles,
+                    evt_handlers=[(evt.EVT_C_STORE, self._receiver.handle_store)],
+                )
+        return self._get_pool
+
+    def _receive(self, identifier: Dataset, move_port: int, **route) -> bool:
+        """Retrieve the images matching an identifier, routed by the receiver.
+
+        Args:
+            identifier: C-MOVE (or C-GET) identifier.
+            move_port: local port on which the images are received with C-MOVE.
+            route: ``directory`` or ``handler`` of the received images
+                   (see :meth:`StorageReceiver.route`).
+
+        Returns:
+            bool: True if the retrieval succeeded.
+
+        """
+        with self._receiver.route(identifier, **route):
+            if self.retrieve_method == "C-GET":
+                return self._get(identifier)
+            self._receiver.listen(move_port)
+            return self._move(identifier, self.aet)
+
+    def get(
+        self,
+        study_date: str,
+        patient_id: str,
+        study_instance_uid: str,
+        series_instance_uid: str,
+        move_port: int,
+        output_dir: str,
+        retrieve_level: str = "SERIES",
+    ) -> bool:
+        check_ids(patient_id)
+        check_ids(series_instance_uid, attribute="Series instance UID")
+        check_ids(study_instance_uid, attribute="Study instance UID")
+        check_port(move_port)
+        check_retrieve_level(retrieve_level)
+
+        identifier = self._move_identifier(
+            patient_id, study_instance_uid, series_instance_uid, retrieve_level
+        )
+        return self._receive(identifier, move_port, directory=lambda header: output_dir)
+
+    def get_sorted(
+        self,
+        study_date: str,
+        patient_id: str,
+        study_instance_uid: str,
+        series_instance_uid: str,
+        move_port: int,
+        output_dir: str,
+        series_dirs: Dict[str, str],
+        retrieve_level: str = "SERIES",
+    ) -> bool:
+        check_ids(patient_id)
+        check_ids(series_instance_uid, attribute="Series instance UID")
+        check_ids(study_instance_uid, attribute="Study instance UID")
+        check_port(move_port)
+        check_retrieve_level(retrieve_level)
+
+        def directory(header: Dataset) -> str:
+            # Images are filed directly into their series folder, without staging
+            series_dir = series_dirs.get(str(header.get("SeriesInstanceUID", "")))
+            if series_dir is None:
+                _, _, series_dir = get_series_dirs(output_dir, dataset_to_series_record(header))
+            return series_dir
+
+        identifier = self._move_identifier(
+            patient_id, study_instance_uid, series_instance_uid, retrieve_level
+        )
+        return self._receive(identifier, move_port, directory=directory)
+
+    def get_datasets(
+        self,
+        study_date: str,
+        patient_id: str,
+        study_instance_uid: str,
+        series_instance_uid: str,
+        move_port: int,
+        handler: Callable[[Dataset], None],
+        retrieve_level: str = "SERIES",
+    ) -> bool:
+        check_ids(patient_id)
+        check_ids(series_instance_uid, attribute="Series instance UID")
+        check_ids(study_instance_uid, attribute="Study instance UID")
+        check_port(move_port)
+        check_retrieve_level(retrieve_level)
+
+        identifier = self._move_identifier(
+            patient_id, study_instance_uid, series_instance_uid, retrieve_level
+        )
+        return self._receive(identifier, move_port, handler=handler)
+
+    def store_dataset(self, dataset: Dataset) -> bool:
+        contexts = {
+            dataset.file_meta.MediaStorageSOPClassUID: {dataset.file_meta.TransferSyntaxUID}
+        }
+
+        def send(assoc) -> bool:
+            status = assoc.send_c_store(dataset)
+            return bool(status) and status.Status == STATUS_SUCCESS
+
+        success = self._request(send, False, pool=self._store_pool(contexts))
+        if not success:
+            self._log(f"C-STORE {dataset.get('SOPInstanceUID', '')}", failed=True)
+        return success
+
+    def move_remote(
+        self,
+        study_date: str,
+        patient_id: str,
+        study_instance_uid: str,
+        series_instance_uid: str,
+        move_aet: str,
+        retrieve_level: str = "SERIES",
+    ) -> bool:
+        check_ids(patient_id)
+        check_ids(series_instance_uid, attribute="Series instance UID")
+        check_ids(study_instance_uid, attribute="Study instance UID")
+        check_AET(move_aet)
+        check_retrieve_level(retrieve_level)
+
+        return self._move(
+            self._move_identifier(
+                patient_id, study_instance_uid, series_instance_uid, retrieve_level
+            ),
+            move_aet,
+        )
+
+    @staticmethod
+    def _move_identifier(
+        patient_id: str,
+        study_instance_uid: str,
+        series_instance_uid: str,
+        retrieve_level: str = "SERIES",
+    ) -> Dataset:
+        # Only the unique keys down to the retrieve level are allowed
+        identifier = Dataset()
+        identifier.QueryRetrieveLevel = retrieve_level
+        identifier.PatientID = patient_id
+        if retrieve_level in ["SERIES", "STUDY"]:
+            identifier.StudyInstanceUID = study_instance_uid
+        if retrieve_level == "SERIES":
+            identifier.SeriesInstanceUID = series_instance_uid
+        return identifier
+
+    def _store_pool(self, contexts: Dict[str, Set[str]]) -> AssociationPool:
+        """Return the pool of associations negotiating the given presentation contexts.
+
+        Associations are shared by all the uploads of files with the same set
+        of SOP classes and transfer syntaxes, so that the presentation contexts
+        are only negotiated once per set. A pool negotiating more presentation
+        contexts than needed is reused as well. Once :data:`MAX_STORE_POOLS`
+        pools are open, the least recently used one is closed, so that idle
+        associations do not pile up against the limits of the PACS server.
+
+        Args:
+            contexts: transfer syntaxes of each SOP class to upload.
+
+        Returns:
+            AssociationPool: pool of associations for the uploads.
+
+        """
+        key = frozenset(
+            (sop_class_uid, transfer_syntax)
+            for sop_class_uid, transfer_syntaxes in contexts.items()
+            for transfer_syntax in transfer_syntaxes
+        )
+        evicted = None
+        with self._lock:
+            # Most recently used first
+            pool_key = next((other for other in reversed(self._store_pools) if key <= other), None)
+            if pool_key is not None:
+                self._store_pools.move_to_end(pool_key)
+                pool = self._store_pools[pool_key]
+            else:
+                ae = AE(ae_title=self.aet)
+                ae.acse_timeout = self._ae.acse_timeout
+                ae.network_timeout = self._ae.network_timeout
+                ae.dimse_timeout = self._ae.dimse_timeout
+                # Used to health-check idle associations
+                ae.add_requested_context(Verification)
+                for sop_class_uid, transfer_syntaxes in sorted(contexts.items()):
+                    ae.add_requested_context(sop_class_uid, sorted(transfer_syntaxes))
+                pool = AssociationPool(
+                    ae,
+                    self.server_address,
+                    self.port,
+                    self.server_aet,
+                    keepalive=self._pool.keepalive,
+                )
+                self._store_pools[key] = pool
+                if len(self._store_pools) > MAX_STORE_POOLS:
+                    _, evicted = self._store_pools.popitem(last=False)
+        if evicted is not None:
+            evicted.close()
+        return pool
+
+    def upload_results(
+        self,
+        dicom_dir: str,
+        log_dir: Optional[str] = None,
+        filenames: Optional[List[str]] = None,
+    ) -> Dict[str, bool]:
+        if filenames is None:
+            filenames = [
+                os.path.join(dicom_dir, f)
+                for f in sorted(os.listdir(dicom_dir))
+                if os.path.isfile(os.path.join(dicom_dir, f))
+            ]
+
+        # Request one presentation context per SOP class / transfer syntax pair
+        datasets = []
+        contexts = {}  # type: Dict[str, Set[str]]
+        for filename in filenames:
+            try:
+                header = dcmread(filename, stop_before_pixels=True)
+            except Exception:
+                continue
+            datasets.append(filename)
+            sop_class_uid = header.file_meta.MediaStorageSOPClassUID
+            transfer_syntax = header.file_meta.TransferSyntaxUID
+            contexts.setdefault(sop_class_uid, set()).add(transfer_syntax)
+        results = {filename: False for filename in datasets}
+        if not datasets:
+            return results
+
+        def send(assoc) -> Dict[str, bool]:
+            for filename in datasets:
+                # Files already stored before the association was lost are skipped
+                if results[filename]:
+                    continue
+                status = assoc.send_c_store(filename)
+                results[filename] = bool(status) and status.Status == STATUS_SUCCESS
+                if not assoc.is_established:
+                    break
+            return results
+
+        self._request(send, results, pool=self._store_pool(contexts))
+        for filename, success in results.items():
+            if not success:
+                self._log(f"C-STORE {filename}", failed=True, log_dir=log_dir)
+        self._log(f"C-STORE {dicom_dir}", failed=not all(results.values()), log_dir=log_dir)
+
+        return results
+
+    def share_receiver(self, other: DicomBackend) -> None:
+        if isinstance(other, PynetdicomBackend):
+            other._receiver = self._receiver
+
+    def close(self) -> None:
+        self._pool.close()
+        for pool in self._store_pools.values():
+            pool.close()
+        if self._get_pool is not None:
+            self._get_pool.close()
+        self._receiver.close()
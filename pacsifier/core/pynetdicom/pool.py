@@ -0,0 +1,146 @@
+# Copyright 2018-2024 Lausanne University Hospital and University of Lausanne,
+# Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module contains a pool of associations kept open with a PACS server."""
+
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, Tuple
+
+from pynetdicom import AE
+from pynetdicom.association import Association
+
+from pacsifier.core.metrics import observe_association
+
+
+class AssociationPool:
+    """Thread-safe pool of associations with one PACS server.
+
+    Associations are opened on demand and handed back to the pool once a
+    request is done, so that the following requests (of any thread) reuse them
+    instead of negotiating a new association. The pool thus holds at most as
+    many associations as there were concurrent requests. An association that
+    stayed idle for more than ``keepalive`` seconds is health-checked with a
+    C-ECHO before being handed out again, and associations that were aborted or
+    released by the server are dropped and replaced by new ones.
+
+    Args:
+        ae: application entity requesting the presentation contexts.
+        server_address: PACS server IP address.
+        port: PACS server port for incoming requests.
+        server_aet: PACS server AET.
+        keepalive: idle time in seconds after which an association is
+                   health-checked before being reused. Default is 30.
+        kwargs: additional keyword arguments of ``AE.associate`` used to open the
+                associations (e.g. ``ext_neg`` and ``evt_handlers``).
+
+    """
+
+    def __init__(
+        self,
+        ae: AE,
+        server_address: str,
+        port: int,
+        server_aet: str,
+        keepalive: float = 30,
+        **kwargs,
+    ) -> None:
+        self.ae = ae
+        self.server_address = server_address
+        self.port = port
+        self.server_aet = server_aet
+        self.keepalive = keepalive
+        self.associate_kwargs = kwargs
+
+        self._lock = threading.Lock()
+        # Idle associations with the time they were handed back
+        self._idle = []  # type: List[Tuple[Association, float]]
+        self._closed = False
+        self.opened = 0
+
+    def _open(self) -> Optional[Association]:
+        assoc = self.ae.associate(
+            self.server_address, self.port, ae_title=self.server_aet, **self.associate_kwargs
+        )
+        observe_association(assoc.is_established)
+        if not assoc.is_established:
+            return None
+        with self._lock:
+            self.opened += 1
+        return assoc
+
+    @staticmethod
+    def _is_alive(assoc: Association) -> bool:
+        if not assoc.is_established:
+            return False
+        status = assoc.send_c_echo()
+        return bool(status) and status.Status == 0x0000
+
+    def _take(self) -> Optional[Association]:
+        """Return an idle association which is still established, if any."""
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+                # Most recently used first, so that the oldest ones expire
+                assoc, released_at = self._idle.pop()
+
+            if time.monotonic() - released_at > self.keepalive:
+                alive = self._is_alive(assoc)
+            else:
+                alive = assoc.is_established
+            if alive:
+                return assoc
+            assoc.abort()
+
+    def _give_back(self, assoc: Association) -> None:
+        if not assoc.is_established:
+            return
+        with self._lock:
+            if not self._closed:
+                self._idle.append((assoc, time.monotonic()))
+                return
+        # The pool was closed during the request
+        assoc.release()
+
+    @contextmanager
+    def acquire(self) -> Iterator[Optional[Association]]:
+        """Hand out an established association for the duration of the context.
+
+        Yields:
+            Association: an association with the PACS server, or None if no
+                association could be established.
+
+        """
+        assoc = self._take() or self._open()
+        try:
+            yield assoc
+        except BaseException:
+            # The state of the association is unknown: do not reuse it
+            if assoc is not None:
+                assoc.abort()
+            raise
+        if assoc is not None:
+            self._give_back(assoc)
+
+    def close(self) -> None:
+        """Release all the idle associations, and the others once their request is done."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+            self._closed = True
+        for assoc, _ in idle:
+            if assoc.is_established:
+                assoc.release()
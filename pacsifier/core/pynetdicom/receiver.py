@@ -0,0 +1,195 @@
+# Copyright 2018-2024 Lausanne University Hospital and University of Lausanne,
+# Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module contains the Storage SCP receiving the images retrieved by the pynetdicom backend."""
+
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+from pydicom.dataset import Dataset
+from pydicom.filewriter import write_file_meta_info
+from pynetdicom import AE, AllStoragePresentationContexts, evt
+
+# SOP Class UID -> file name prefix used by DCMTK storage SCPs
+SOP_CLASS_TO_PREFIX = {  # type: Dict[str,str]
+    "1.2.840.10008.5.1.4.1.1.1": "CR",
+    "1.2.840.10008.5.1.4.1.1.1.1": "DX",
+    "1.2.840.10008.5.1.4.1.1.1.1.1": "DX",
+    "1.2.840.10008.5.1.4.1.1.1.2": "MG",
+    "1.2.840.10008.5.1.4.1.1.1.2.1": "MG",
+    "1.2.840.10008.5.1.4.1.1.2": "CT",
+    "1.2.840.10008.5.1.4.1.1.2.1": "CTe",
+    "1.2.840.10008.5.1.4.1.1.3.1": "US",
+    "1.2.840.10008.5.1.4.1.1.4": "MR",
+    "1.2.840.10008.5.1.4.1.1.4.1": "MRe",
+    "1.2.840.10008.5.1.4.1.1.4.2": "MRs",
+    "1.2.840.10008.5.1.4.1.1.6.1": "US",
+    "1.2.840.10008.5.1.4.1.1.7": "SC",
+    "1.2.840.10008.5.1.4.1.1.20": "NM",
+    "1.2.840.10008.5.1.4.1.1.128": "PT",
+    "1.2.840.10008.5.1.4.1.1.481.1": "RI",
+    "1.2.840.10008.5.1.4.1.1.481.2": "RD",
+    "1.2.840.10008.5.1.4.1.1.481.3": "RS",
+    "1.2.840.10008.5.1.4.1.1.481.5": "RP",
+}
+
+# Retrieve level -> unique key of the C-MOVE identifier at that level,
+# in the order used to route a received image
+RETRIEVE_LEVEL_TO_KEYWORD = {  # type: Dict[str,str]
+    "SERIES": "SeriesInstanceUID",
+    "STUDY": "StudyInstanceUID",
+    "PATIENT": "PatientID",
+}
+
+# Status of a C-STORE response
+STATUS_SUCCESS = 0x0000
+STATUS_OUT_OF_RESOURCES = 0xA700
+STATUS_CANNOT_UNDERSTAND = 0xC000
+
+
+class StorageReceiver:
+    """Storage SCP receiving the images of concurrent retrievals on shared ports.
+
+    The SCP keeps listening in the background and handles each association in
+    its own thread, so that several retrievals can run at the same time on the
+    same port. Each retrieval registers the unique key of its C-MOVE (or
+    C-GET) identifier (see :meth:`route`), and each received image is routed
+    with its header to the retrieval of its series, study or patient. The
+    C-STORE requests received on the association of a C-GET request are
+    handled the same way (see :meth:`handle_store`).
+
+    Images are filed directly into the folder returned by the ``directory``
+    function of their retrieval, e.g. their ``sub-/ses-/NNNNN-Description``
+    series folder built from their header. Each image is written to a
+    temporary file renamed once complete, so that an interrupted transfer
+    never leaves a truncated image. Alternatively, a retrieval can hand the
+    received datasets to a ``handler`` instead of writing them.
+
+    Args:
+        aet: AET of the Storage SCP.
+
+    """
+
+    def __init__(self, aet: str) -> None:
+        self._ae = AE(ae_title=aet)
+        self._ae.supported_contexts = AllStoragePresentationContexts
+        self._lock = threading.Lock()
+        self._servers = {}
+        # (keyword, value) -> (directory function, handler)
+        self._routes = {}  # type: Dict[Tuple[str, str], tuple]
+
+    def listen(self, port: int) -> None:
+        """Start listening on a port, if not done yet."""
+        with self._lock:
+            if port not in self._servers:
+                self._servers[port] = self._ae.start_server(
+                    ("", port),
+                    block=False,
+                    evt_handlers=[(evt.EVT_C_STORE, self.handle_store)],
+                )
+
+    @contextmanager
+    def route(
+        self,
+        identifier: Dataset,
+        directory: Optional[Callable[[Dataset], str]] = None,
+        handler: Optional[Callable[[Dataset], None]] = None,
+    ) -> Iterator[None]:
+        """Route the images matching a C-MOVE identifier while the retrieval runs.
+
+        Args:
+            identifier: C-MOVE identifier of the retrieval.
+            directory: function returning the folder of a received image from its header.
+            handler: function called with each received dataset, instead of writing it.
+
+        """
+        keyword = RETRIEVE_LEVEL_TO_KEYWORD[identifier.QueryRetrieveLevel]
+        key = (keyword, str(identifier.get(keyword, "")))
+        with self._lock:
+            if key in self._routes:
+                raise ValueError(f"{keyword} {key[1]} is already being retrieved!")
+            self._routes[key] = (directory, handler)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._routes.pop(key, None)
+
+    def _find_route(self, dataset: Dataset) -> Optional[tuple]:
+        with self._lock:
+            for keyword in RETRIEVE_LEVEL_TO_KEYWORD.values():
+                route = self._routes.get((keyword, str(dataset.get(keyword, ""))))
+                if route is not None:
+                    return route
+        return None
+
+    def handle_store(self, event) -> int:
+        """Write a received image into its folder, or hand it to its handler.
+
+        Handler of the C-STORE requests received by the Storage SCP, or on the
+        association of a C-GET request.
+        """
+        try:
+            dataset = event.dataset
+        except Exception:
+            return STATUS_CANNOT_UNDERSTAND
+
+        route = self._find_route(dataset)
+        if route is None:
+            # No retrieval running for this image: out of resources
+            return STATUS_OUT_OF_RESOURCES
+        directory, handler = route
+
+        if handler is not None:
+            dataset.file_meta = event.file_meta
+            try:
+                handler(dataset)
+            except Exception:
+                return STATUS_CANNOT_UNDERSTAND
+            return STATUS_SUCCESS
+
+        output_dir = directory(dataset)
+        os.makedirs(output_dir, exist_ok=True)
+        sop_class_uid = event.request.AffectedSOPClassUID
+        sop_instance_uid = event.request.AffectedSOPInstanceUID
+        prefix = SOP_CLASS_TO_PREFIX.get(sop_class_uid, "UNKNOWN")
+        filename = os.path.join(output_dir, f"{prefix}.{sop_instance_uid}")
+
+        # Write the encoded dataset as received, without encoding it again,
+        # then rename it so that the image only appears once complete
+        fd, temp_filename = tempfile.mkstemp(dir=output_dir, prefix=".", suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(b"\x00" * 128)
+                f.write(b"DICM")
+                write_file_meta_info(f, event.file_meta)
+                f.write(event.request.DataSet.getvalue())
+            os.replace(temp_filename, filename)
+        except BaseException:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+            raise
+
+        return STATUS_SUCCESS
+
+    def close(self) -> None:
+        """Stop listening on all the ports."""
+        with self._lock:
+            for server in self._servers.values():
+                server.shutdown()
+            self._servers.clear()
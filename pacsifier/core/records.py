@@ -0,0 +1,145 @@
+# Copyright 2018-2024 Lausanne University Hospital and University of Lausanne,
+# Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module defines the series records returned by the C-FIND requests of the backends."""
+
+from typing import Dict, List, TypedDict
+
+from pydicom.dataset import Dataset
+from pydicom.multival import MultiValue
+
+
+TAG_TO_KEYWORD = {  # type: Dict[str,str]
+    "(0008,0020)": "StudyDate",
+    "(0008,0030)": "StudyTime",
+    "(0008,103e)": "SeriesDescription",
+    "(0010,0020)": "PatientID",
+    "(0018,1030)": "ProtocolName",
+    "(0020,000d)": "StudyInstanceUID",
+    "(0020,000e)": "SeriesInstanceUID",
+    "(0010,0010)": "PatientName",
+    "(0010,0030)": "PatientBirthDate",
+    "(0018,1000)": "DeviceSerialNumber",
+    "(0008,0022)": "AcquisitionDate",
+    "(0008,0060)": "Modality",
+    "(0008,0008)": "ImageType",
+    "(0020,0011)": "SeriesNumber",
+    "(0008,1030)": "StudyDescription",
+    "(0008,0050)": "AccessionNumber",
+    "(0018,0024)": "SequenceName",
+}
+
+# Attributes present in every series record. AcquisitionDate is only
+# present if it was returned by the PACS server.
+SERIES_RECORD_KEYWORDS = [
+    "StudyDate",
+    "StudyTime",
+    "SeriesDescription",
+    "PatientID",
+    "ProtocolName",
+    "StudyInstanceUID",
+    "PatientName",
+    "PatientBirthDate",
+    "SeriesInstanceUID",
+    "DeviceSerialNumber",
+    "Modality",
+    "ImageType",
+    "SeriesNumber",
+    "StudyDescription",
+    "AccessionNumber",
+    "SequenceName",
+]  # type: List[str]
+
+
+class SeriesRecord(TypedDict, total=False):
+    """Attributes of a series matching a C-FIND request.
+
+    All values are strings, cleaned with :func:`sanitize_value`.
+    """
+
+    StudyDate: str
+    StudyTime: str
+    SeriesDescription: str
+    PatientID: str
+    ProtocolName: str
+    StudyInstanceUID: str
+    PatientName: str
+    PatientBirthDate: str
+    SeriesInstanceUID: str
+    DeviceSerialNumber: str
+    AcquisitionDate: str
+    Modality: str
+    ImageType: str
+    SeriesNumber: str
+    StudyDescription: str
+    AccessionNumber: str
+    SequenceName: str
+
+
+_EMPTY_SERIES_RECORD = {keyword: "" for keyword in SERIES_RECORD_KEYWORDS}
+
+
+def new_series_record() -> SeriesRecord:
+    """Return a series record with all the attributes of ``SERIES_RECORD_KEYWORDS`` set to empty strings."""
+    return SeriesRecord(_EMPTY_SERIES_RECORD)
+
+
+def sanitize_value(value: str) -> str:
+    """Clean an attribute value before storing it in a series record.
+
+    Non-ASCII characters, spaces and slashes are removed, and quotes are
+    replaced by underscores.
+
+    Args:
+        value: attribute value as printed by DCMTK
+
+    Returns:
+        string: cleaned value
+
+    """
+    return (
+        value.encode("ascii", "ignore")
+        .decode("ascii")
+        .replace(" ", "")
+        .replace("'", "_")
+        .replace("/", "")
+    )
+
+
+def dataset_to_series_record(dataset: Dataset) -> SeriesRecord:
+    """Convert a C-FIND response identifier or a DICOM header into a series record.
+
+    The values are cleaned with :func:`sanitize_value` as in
+    :func:`pacsifier.core.dcmtk.parsers.parse_findscu_output` so that both
+    backends produce the same records.
+
+    Args:
+        dataset: C-FIND response identifier or DICOM header
+
+    Returns:
+        SeriesRecord: attributes of the series
+
+    """
+    record = new_series_record()
+    for keyword in TAG_TO_KEYWORD.values():
+        if keyword not in dataset:
+            continue
+        value = dataset.data_element(keyword).value
+        if value is None:
+            value = ""
+        elif isinstance(value, MultiValue):
+            value = "\\".join(str(v) for v in value)
+        record[keyword] = sanitize_value(str(value))
+    return record
@@ -0,0 +1,163 @@
+# Copyright 2018-2024 Lausanne University Hospital and University of Lausanne,
+# Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module contains the relay forwarding the retrieved datasets to another PACS server."""
+
+import queue
+import threading
+from typing import Callable, Dict, Iterable, Optional
+
+from pydicom.dataset import Dataset
+
+# Marks the end of the datasets for a forwarding thread
+_DONE = object()
+
+
+class Relay:
+    """Transform the datasets received by a retrieval and forward them, through a bounded queue.
+
+    Datasets are handed to :meth:`put` (e.g. by the Storage SCP receiving the
+    retrieved images), which blocks while ``queue_size`` datasets are waiting,
+    so that the memory used stays bounded and a slow destination slows down
+    the retrieval instead of filling the memory. ``workers`` threads apply
+    ``transform`` to each dataset (e.g. anonymize it) and send it with ``store``.
+
+    The number of datasets forwarded and the failures are counted per key of
+    the dataset before its transformation, e.g. per original SeriesInstanceUID.
+    The datasets waiting to be forwarded are counted per key as well, so that
+    a retrieval can :meth:`wait` for its own datasets only.
+
+    Args:
+        transform: function returning the dataset to forward, or None if the
+                   dataset must be discarded.
+        store: function sending a dataset to the destination and returning
+               True on success (e.g. :meth:`PynetdicomBackend.store_dataset`).
+        queue_size: maximal number of datasets waiting to be forwarded.
+        workers: number of threads forwarding the datasets.
+        key: function returning the key of a dataset used to count the
+             forwarded datasets. Default is its SeriesInstanceUID.
+
+    """
+
+    def __init__(
+        self,
+        transform: Callable[[Dataset], Optional[Dataset]],
+        store: Callable[[Dataset], bool],
+        queue_size: int = 64,
+        workers: int = 1,
+        key: Optional[Callable[[Dataset], str]] = None,
+    ) -> None:
+        if queue_size < 1 or workers < 1:
+            raise ValueError("The relay needs a queue and at least one worker!")
+        self.transform = transform
+        self.store = store
+        self.key = key or (lambda dataset: str(dataset.get("SeriesInstanceUID", "")))
+        self.forwarded = {}  # type: Dict[str, int]
+        self.discarded = {}  # type: Dict[str, int]
+        self.failed = {}  # type: Dict[str, int]
+        self._pending = {}  # type: Dict[str, int]
+        self._lock = threading.Lock()
+        self._forwarded = threading.Condition(self._lock)
+        self._datasets = queue.Queue(maxsize=queue_size)
+        self._threads = [
+            threading.Thread(target=self._run, daemon=True) for _ in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def _count(self, counts: Dict[str, int], key: str) -> None:
+        with self._lock:
+            counts[key] = counts.get(key, 0) + 1
+
+    def _forward(self, key: str, dataset: Dataset) -> None:
+        try:
+            dataset = self.transform(dataset)
+            if dataset is None:
+                self._count(self.discarded, key)
+                return
+            success = self.store(dataset)
+        except Exception as e:
+            print(f"* Cannot forward dataset of {key}: {e}")
+            success = False
+        self._count(self.forwarded if success else self.failed, key)
+
+    def _done(self, key: str) -> None:
+        with self._forwarded:
+            self._pending[key] -= 1
+            if not self._pending[key]:
+                del self._pending[key]
+            self._forwarded.notify_all()
+
+    def _run(self) -> None:
+        while True:
+            item = self._datasets.get()
+            try:
+                if item is _DONE:
+                    return
+                key, dataset = item
+                try:
+                    self._forward(key, dataset)
+                finally:
+                    self._done(key)
+            finally:
+                self._datasets.task_done()
+
+    def put(self, dataset: Dataset) -> str:
+        """Queue a dataset to be forwarded, blocking while the queue is full.
+
+        Returns:
+            str: key of the dataset, to :meth:`wait` for it to be forwarded
+
+        """
+        key = self.key(dataset)
+        with self._lock:
+            self._pending[key] = self._pending.get(key, 0) + 1
+        try:
+            self._datasets.put((key, dataset))
+        except BaseException:
+            self._done(key)
+            raise
+        return key
+
+    def qsize(self) -> int:
+        """Return the approximate number of datasets waiting to be forwarded."""
+        return self._datasets.qsize()
+
+    def wait(self, keys: Iterable[str]) -> None:
+        """Wait for the queued datasets of some keys to be forwarded.
+
+        Unlike :meth:`join`, the datasets queued with other keys, e.g. by
+        concurrent retrievals, are not waited for.
+        """
+        keys = set(keys)
+        with self._forwarded:
+            self._forwarded.wait_for(lambda: keys.isdisjoint(self._pending))
+
+    def join(self) -> None:
+        """Wait for all the queued datasets to be forwarded."""
+        self._datasets.join()
+
+    def close(self) -> None:
+        """Forward the queued datasets and stop the forwarding threads."""
+        for _ in self._threads:
+            self._datasets.put(_DONE)
+        for thread in self._threads:
+            thread.join()
+
+    def __enter__(self) -> "Relay":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
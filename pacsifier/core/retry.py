@@ -0,0 +1,172 @@
+# Copyright 2018-2024 Lausanne University Hospital and University of Lausanne,
+# Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module contains the retry policy of the failed requests and the queue of the requests which failed for good."""
+
+import json
+import os
+import random
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional
+
+FAILURES_FILENAME = "fails.jsonl"
+
+# Suffix of the failure queue moved aside while its requests are replayed
+REPLAYING_SUFFIX = ".replaying"
+
+# Kinds of failures
+ASSOCIATION_REJECTED = "association_rejected"
+ASSOCIATION_FAILED = "association_failed"
+TIMEOUT = "timeout"
+PARTIAL = "partial"
+OUT_OF_RESOURCES = "out_of_resources"
+REQUEST_FAILED = "request_failed"
+LOCAL_ERROR = "local_error"
+UNKNOWN = "unknown"
+
+
+class Failure(NamedTuple):
+    """Classified failure of a request.
+
+    Attributes:
+        kind: kind of failure, e.g. ``association_rejected`` or ``timeout``
+        transient: True if sending the request again may succeed
+        message: line of the output explaining the failure
+
+    """
+
+    kind: str
+    transient: bool
+    message: str = ""
+
+
+class RetryPolicy:
+    """Retry policy with jittered exponential backoff.
+
+    The n-th retry (n starting at 0) waits for a random delay between 0 and
+    ``min(max_backoff, backoff * 2 ** n)`` seconds ("full jitter"), so that
+    the requests of concurrent workers failing together do not hit the PACS
+    server again at the same time.
+
+    Args:
+        max_retries: maximal number of times a request is sent again after a
+                     transient failure. Default is 3.
+        backoff: base delay in seconds. Default is 2.
+        max_backoff: maximal delay in seconds. Default is 60.
+
+    """
+
+    def __init__(self, max_retries: int = 3, backoff: float = 2.0, max_backoff: float = 60.0) -> None:
+        if max_retries < 0:
+            raise ValueError("The number of retries cannot be negative!")
+        if backoff < 0 or max_backoff < 0:
+            raise ValueError("The backoff delays cannot be negative!")
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    @classmethod
+    def from_parameters(cls, parameters: Dict[str, str]) -> "RetryPolicy":
+        """Create the policy from the ``max_retries``, ``retry_backoff`` and ``retry_max_backoff`` config entries."""
+        return cls(
+            max_retries=int(parameters.get("max_retries", 3)),
+            backoff=float(parameters.get("retry_backoff", 2.0)),
+            max_backoff=float(parameters.get("retry_max_backoff", 60.0)),
+        )
+
+    def should_retry(self, failure: Failure, retries: int) -> bool:
+        """Check whether a request is sent again after a failure and ``retries`` previous retries."""
+        return failure.transient and retries < self.max_retries
+
+    def delay(self, retries: int) -> float:
+        """Return the delay in seconds before the retry following ``retries`` previous retries."""
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** retries))
+
+    def wait(self, retries: int) -> None:
+        """Wait before the retry following ``retries`` previous retries."""
+        time.sleep(self.delay(retries))
+
+
+# No retry, for the C-ECHO requests checking that the PACS server can be reached
+NO_RETRY = RetryPolicy(max_retries=0)
+
+
+class FailureQueue:
+    """Machine-readable queue of the requests which failed for good, one JSON object per line.
+
+    Each record holds the failed command, the kind of failure, the return code,
+    the number of attempts and the time of the failure, so that the failed
+    requests can be sent again later (see
+    :func:`pacsifier.core.dcmtk.commands.replay_failures`).
+
+    Args:
+        path: path to the JSON Lines file (``fails.jsonl``).
+
+    """
+
+    # The records of the queues of all threads are appended under the same lock
+    _lock = threading.Lock()
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def append(self, record: Dict[str, object]) -> None:
+        """Append a failed request to the queue."""
+        record = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), **record}
+        with self._lock:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(self.path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+    def read(self) -> List[Dict[str, object]]:
+        """Return the failed requests of the queue, oldest first."""
+        if not os.path.isfile(self.path):
+            return []
+        with self._lock, open(self.path, "r") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def rewrite(self, records: List[Dict[str, object]]) -> None:
+        """Replace the content of the queue, e.g. by the requests still failing after a replay."""
+        with self._lock:
+            if not records:
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+                return
+            temp_path = self.path + ".part"
+            with open(temp_path, "w") as f:
+                for record in records:
+                    f.write(json.dumps(record) + "\n")
+            os.replace(temp_path, self.path)
+
+
+def find_failure_queues(log_dir: str) -> List[str]:
+    """Return the paths to the failure queues of a folder of logs and of its subfolders.
+
+    The queues whose replay was interrupted are included, even if only their
+    records moved aside (``fails.jsonl.replaying``) are left.
+    """
+    paths = []
+    for root, _, filenames in os.walk(log_dir):
+        if FAILURES_FILENAME in filenames or FAILURES_FILENAME + REPLAYING_SUFFIX in filenames:
+            paths.append(os.path.join(root, FAILURES_FILENAME))
+    return sorted(paths)
+
+
+def describe_failure(failure: Optional[Failure]) -> str:
+    """Return a short description of a failure, e.g. ``timeout (transient)``."""
+    if failure is None:
+        return "success"
+    return f"{failure.kind} ({'transient' if failure.transient else 'permanent'})"
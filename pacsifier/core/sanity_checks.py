@@ -19,6 +19,10 @@ import jsonschema
 from datetime import datetime
 from typing import Dict
 
+# Levels at which the images can be retrieved with one C-MOVE request
+RETRIEVE_LEVELS = ["SERIES", "STUDY", "PATIENT"]
+RETRIEVE_METHODS = ["C-MOVE", "C-GET"]
+
 
 def check_ip(ip_address: str) -> None:
     """Check if an ip adress is valid.
@@ -240,18 +244,19 @@ def check_config_parameters(config_parameters: Dict[str, str]) -> None:
     Raises:
         ValueError if the config file is not valid or if the parameters are not valid
     """
+    server_address_schema = {
+        'anyOf': [ # Can be either an IP address, a hostname, or a URL (http/https or starting with www.)
+            {"format": 'ipv4'},
+            {"format": 'ipv6'},
+            {"format": 'hostname'},
+            {"format": 'uri', "pattern": '^(https?|http?)://|^www.'}
+        ]
+    }
     schema = {
         "$schema": "https://json-schema.org/draft/2020-12/schema",
         "type": "object",
         "properties": {
-            "server_address": {
-                'anyOf': [ # Can be either an IP address, a hostname, or a URL (http/https or starting with www.)
-                    {"format": 'ipv4'},
-                    {"format": 'ipv6'},
-                    {"format": 'hostname'},
-                    {"format": 'uri', "pattern": '^(https?|http?)://|^www.'}
-                ]
-            },
+            "server_address": server_address_schema,
             "port": {"type": "integer", "minimum": 1, "maximum": 65535},
             "server_AET": {"type": "string", "maxLength": 16},
             "AET": {"type": "string", "maxLength": 16},
@@ -259,6 +264,57 @@ def check_config_parameters(config_parameters: Dict[str, str]) -> None:
             "move_port": {"type": "integer", "minimum": 1, "maximum": 65535},
             "batch_size": {"type": "integer", "minimum": 1},
             "batch_wait_time": {"type": "number", "minimum": 0.0},
+            "backend": {"enum": ["dcmtk", "pynetdicom"]},
+            "retrieve_level": {"enum": RETRIEVE_LEVELS},
+            "retrieve_method": {"enum": RETRIEVE_METHODS},
+            "query_cache_ttl": {"type": "number", "minimum": 0},
+            "query_cache_dir": {"type": "string", "minLength": 1},
+            "metrics_textfile": {"type": "string", "minLength": 1},
+            "metrics_port": {"type": "integer", "minimum": 1, "maximum": 65535},
+            "metrics_interval": {"type": "number", "exclusiveMinimum": 0},
+            "max_concurrent_moves": {"type": "integer", "minimum": 1},
+            "max_retries": {"type": "integer", "minimum": 0},
+            "retry_backoff": {"type": "number", "minimum": 0},
+            "retry_max_backoff": {"type": "number", "minimum": 0},
+            "max_moves_per_minute": {"type": "number", "exclusiveMinimum": 0},
+            "max_concurrent_uploads": {"type": "integer", "minimum": 1},
+            "move_port_range": {
+                "type": "array",
+                "items": {"type": "integer", "minimum": 1, "maximum": 65535},
+                "minItems": 2,
+                "maxItems": 2,
+            },
+            "sources": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "server_address": server_address_schema,
+                        "port": {"type": "integer", "minimum": 1, "maximum": 65535},
+                        "server_AET": {"type": "string", "maxLength": 16},
+                        "max_concurrent_moves": {"type": "integer", "minimum": 1},
+                    },
+                    "required": ["server_address", "port", "server_AET"],
+                    "additionalProperties": False,
+                },
+            },
+            "relay": {
+                "type": "object",
+                "properties": {
+                    "server_address": server_address_schema,
+                    "port": {"type": "integer", "minimum": 1, "maximum": 65535},
+                    "server_AET": {"type": "string", "maxLength": 16},
+                    "queue_size": {"type": "integer", "minimum": 1},
+                    "workers": {"type": "integer", "minimum": 1},
+                    "fuzz_acq_dates": {"type": "boolean"},
+                    "remove_private_tags": {"type": "boolean"},
+                    "delete_identifiable": {"type": "boolean"},
+                    "uid_secret": {"type": "string", "minLength": 1},
+                    "uid_map": {"type": "string"},
+                },
+                "required": ["server_address", "port", "server_AET"],
+                "additionalProperties": False,
+            },
         },
         "required": [
             "server_address",
@@ -277,6 +333,40 @@ def check_config_parameters(config_parameters: Dict[str, str]) -> None:
     except jsonschema.exceptions.ValidationError as e:
         raise ValueError(f"Invalid config file: {e}")
 
+    if "move_port_range" in config_parameters:
+        first_port, last_port = config_parameters["move_port_range"]
+        if first_port > last_port:
+            raise ValueError(
+                "Invalid config file: the first port of move_port_range "
+                "must be smaller or equal to the last one"
+            )
+
+
+def check_retrieve_level(retrieve_level: str) -> None:
+    """Check that the retrieve level is one of ``RETRIEVE_LEVELS``.
+
+    Args:
+        retrieve_level: level of the C-MOVE requests
+
+    Raises:
+        ValueError if it is not valid
+    """
+    if retrieve_level not in RETRIEVE_LEVELS:
+        raise ValueError(f"Invalid retrieve level ! Use one of {RETRIEVE_LEVELS}.")
+
+
+def check_retrieve_method(retrieve_method: str) -> None:
+    """Check that the retrieve method is one of ``RETRIEVE_METHODS``.
+
+    Args:
+        retrieve_method: DIMSE service used to retrieve the images
+
+    Raises:
+        ValueError if it is not valid
+    """
+    if retrieve_method not in RETRIEVE_METHODS:
+        raise ValueError(f"Invalid retrieve method ! Use one of {RETRIEVE_METHODS}.")
+
 
 def check_query_retrieval_level(query_retrieval_level: str) -> None:
     valid_levels = ["SERIES", "PATIENT", "IMAGE", "STUDY"]
@@ -0,0 +1,127 @@
+# Copyright 2018-2024 Lausanne University Hospital and University of Lausanne,
+# Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module contains helpers to run several C-MOVE retrievals concurrently."""
+
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Iterator, List, Optional
+
+
+class PortPool:
+    """Thread-safe pool of local ports on which a C-MOVE destination can listen.
+
+    Each port is handed out to at most one caller at a time, so that two
+    concurrent ``movescu`` processes never try to listen on the same port.
+
+    Args:
+        ports: list of local port numbers available for incoming C-STORE
+               sub-operations.
+
+    """
+
+    def __init__(self, ports: List[int]) -> None:
+        if not ports:
+            raise ValueError("The port pool needs at least one port!")
+        self._ports = queue.Queue()
+        for port in ports:
+            self._ports.put(port)
+        self.size = len(ports)
+
+    @contextmanager
+    def acquire(self) -> Iterator[int]:
+        """Block until a port is free and hand it out for the duration of the context."""
+        port = self._ports.get()
+        try:
+            yield port
+        finally:
+            self._ports.put(port)
+
+
+class RetrievalScheduler:
+    """Bounded worker pool running retrieval jobs concurrently.
+
+    The number of jobs running at the same time is capped by ``max_workers``
+    (the per-PACS concurrency cap), and the number of jobs waiting to be run is
+    capped as well, so that :meth:`submit` blocks instead of queueing an
+    unbounded number of jobs in memory.
+
+    Args:
+        max_workers: maximal number of jobs running at the same time.
+        ports: optional list of local ports. If given, each job is run with
+               its own port from the list, passed as the ``move_port`` keyword
+               argument, and the number of concurrent jobs is further capped by
+               the number of ports.
+
+    """
+
+    def __init__(self, max_workers: int = 1, ports: Optional[List[int]] = None) -> None:
+        if max_workers < 1:
+            raise ValueError("The number of concurrent retrievals must be at least 1!")
+        self.port_pool = PortPool(ports) if ports else None
+        if self.port_pool is not None:
+            max_workers = min(max_workers, self.port_pool.size)
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        # Allow as many queued jobs as running ones
+        self._slots = threading.BoundedSemaphore(2 * max_workers)
+        self._lock = threading.Lock()
+        self.pending = 0
+
+    def submit(self, fn: Callable, *args, use_port: bool = False, **kwargs) -> Future:
+        """Schedule ``fn(*args, **kwargs)`` and return its future.
+
+        Args:
+            fn: function to run (e.g. :func:`pacsifier.core.dcmtk.commands.get`).
+            use_port: if True, a port from the pool is reserved for the job and
+                      passed to ``fn`` as the ``move_port`` keyword argument.
+
+        Returns:
+            Future: future holding the return value of ``fn``.
+
+        """
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self._run, fn, args, kwargs, use_port)
+        except BaseException:
+            self._slots.release()
+            raise
+        with self._lock:
+            self.pending += 1
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future: Future) -> None:
+        with self._lock:
+            self.pending -= 1
+        self._slots.release()
+
+    def _run(self, fn: Callable, args: tuple, kwargs: dict, use_port: bool):
+        if use_port and self.port_pool is not None:
+            with self.port_pool.acquire() as port:
+                return fn(*args, move_port=port, **kwargs)
+        return fn(*args, **kwargs)
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Release the worker threads once all submitted jobs are done."""
+        self._executor.shutdown(wait=wait)
+
+    def __enter__(self) -> "RetrievalScheduler":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.shutdown(wait=True)
@@ -0,0 +1,143 @@
+# Copyright 2018-2024 Lausanne University Hospital and University of Lausanne,
+# Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module contains functions to file retrieved images into the ``sub-/ses-/NNNNN-Description`` layout."""
+
+import os
+import re
+import unicodedata
+from typing import Dict, Tuple
+
+from pydicom import dcmread
+from pydicom.errors import InvalidDicomError
+
+from pacsifier.core.records import SeriesRecord, dataset_to_series_record
+
+# Keep only alphanums in folder names
+CLEAN_NAME_REGEX = re.compile("[^0-9a-zA-Z]+")
+
+# Attributes read from the headers of the images to sort
+SORT_KEYWORDS = [
+    "PatientID",
+    "StudyDate",
+    "StudyTime",
+    "SeriesInstanceUID",
+    "SeriesNumber",
+    "SeriesDescription",
+]
+
+
+def sanitize_name(name: str) -> str:
+    """Make a string usable as a folder name.
+
+    The string is decomposed into separate combining chars, which are then
+    removed by the ascii encoding, and the illegal chars are replaced with
+    underscores.
+
+    Args:
+        name: string to sanitize
+
+    Returns:
+        string: sanitized string
+
+    """
+    return CLEAN_NAME_REGEX.sub(
+        "_",
+        unicodedata.normalize("NFD", name).encode("ascii", "ignore").decode("ascii"),
+    )
+
+
+def get_series_dirs(
+    output_dir: str, serie: SeriesRecord, default_patient_id: str = ""
+) -> Tuple[str, str, str]:
+    """Return the folders where the images of a series are stored.
+
+    Args:
+        output_dir: path to the output directory
+        serie: series record
+        default_patient_id: patient id used if the series record has no PatientID
+
+    Returns:
+        tuple: the patient (``sub-``), session (``ses-``) and series
+            (``NNNNN-Description``) folders
+
+    """
+    patient_id = sanitize_name(serie["PatientID"])
+    # TODO handle empty patientID_sanitized
+    if patient_id == "":
+        patient_id = sanitize_name(default_patient_id)
+    patient_dir = os.path.join(output_dir, "sub-" + patient_id)
+
+    # Make a session folder for the study if the StudyDate and StudyTime are not empty
+    if len(serie["StudyDate"]) > 0 and len(serie["StudyTime"]) > 0:
+        study_dir = os.path.join(
+            patient_dir, f'ses-{serie["StudyDate"] + serie["StudyTime"]}'
+        )
+    elif len(serie["StudyDate"]) > 0:
+        study_dir = os.path.join(patient_dir, f'ses-{serie["StudyDate"]}')
+    else:
+        study_dir = os.path.join(patient_dir)
+
+    # Name the series folder after the SeriesDescription.
+    # If it is an empty string name the folder No_series_description.
+    folder_name = sanitize_name(serie["SeriesDescription"])
+    if folder_name == "":
+        folder_name = "No_series_description"
+    series_dir = os.path.join(
+        study_dir, serie["SeriesNumber"].zfill(5) + "-" + folder_name
+    )
+
+    return patient_dir, study_dir, series_dir
+
+
+def sort_instances(
+    staging_dir: str, output_dir: str, series_dirs: Dict[str, str]
+) -> Dict[str, int]:
+    """Move the images retrieved in a staging folder to the folders of their series.
+
+    The headers are read without the pixel data. Images of the series in
+    ``series_dirs`` are moved to the given folders, the others to the folders
+    built from their headers by :func:`get_series_dirs`. Files which are not
+    DICOM files are left in the staging folder.
+
+    Args:
+        staging_dir: folder where the images were retrieved
+        output_dir: path to the output directory
+        series_dirs: folder of each series, indexed by SeriesInstanceUID
+
+    Returns:
+        dict: number of images moved for each SeriesInstanceUID
+
+    """
+    counts = {}  # type: Dict[str, int]
+    for root, _, filenames in os.walk(staging_dir):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            try:
+                header = dcmread(path, stop_before_pixels=True, specific_tags=SORT_KEYWORDS)
+            except (InvalidDicomError, OSError):
+                continue
+
+            series_instance_uid = str(header.get("SeriesInstanceUID", ""))
+            series_dir = series_dirs.get(series_instance_uid)
+            if series_dir is None:
+                _, _, series_dir = get_series_dirs(
+                    output_dir, dataset_to_series_record(header)
+                )
+            os.makedirs(series_dir, exist_ok=True)
+            os.replace(path, os.path.join(series_dir, filename))
+            counts[series_instance_uid] = counts.get(series_instance_uid, 0) + 1
+
+    return counts
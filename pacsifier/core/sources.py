@@ -0,0 +1,222 @@
+# Copyright 2018-2024 Lausanne University Hospital and University of Lausanne,
+# Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module contains the backend spreading the retrievals over several PACS servers holding the same data."""
+
+import threading
+import time
+from typing import Dict, List, Optional
+
+from pacsifier.core.backend import DicomBackend
+from pacsifier.core.records import SeriesRecord
+from pacsifier.core.stats import record_retry, record_server
+
+
+class Source:
+    """PACS server (backend) used by a :class:`MultiSourceBackend`, with its own concurrency cap.
+
+    Args:
+        backend: backend connected to the PACS server.
+        max_concurrent_moves: maximal number of retrievals running at the same
+                              time on this server.
+
+    """
+
+    def __init__(self, backend: DicomBackend, max_concurrent_moves: int = 1) -> None:
+        if max_concurrent_moves < 1:
+            raise ValueError("The number of concurrent retrievals must be at least 1!")
+        self.backend = backend
+        self.max_concurrent_moves = max_concurrent_moves
+        self.active = 0
+        self.failures = 0
+        # The source is not used until then after a failure
+        self.down_until = 0.0
+
+    @property
+    def name(self) -> str:
+        """Return the name of the source, e.g. ``AET@address:port``."""
+        return f"{self.backend.server_aet}@{self.backend.server_address}:{self.backend.port}"
+
+    def is_up(self) -> bool:
+        """Check whether the source did not fail recently."""
+        return time.monotonic() >= self.down_until
+
+
+class MultiSourceBackend(DicomBackend):
+    """Backend spreading the retrievals over several PACS servers holding the same data.
+
+    Each retrieval is sent to the source with the lowest load (running
+    retrievals over its ``max_concurrent_moves``) among the ones which did not
+    fail recently, waiting for a free slot if all of them are busy. When a
+    retrieval fails on a source, the source is put aside for a delay growing
+    with its consecutive failures, and the retrieval is sent again to the next
+    source. Queries and uploads are sent to the first source which is up, and
+    the failed queries to the next sources.
+
+    Args:
+        sources: list of sources, the first one being the primary PACS server.
+        backoff: delay in seconds during which a source is not used after a
+                 failure, doubled after each consecutive failure.
+        max_backoff: maximal delay in seconds during which a source is not used.
+
+    """
+
+    name = "multi"
+
+    def __init__(self, sources: List[Source], backoff: float = 5.0, max_backoff: float = 300.0) -> None:
+        if not sources:
+            raise ValueError("At least one source is needed!")
+        primary = sources[0].backend
+        super().__init__(
+            primary.server_address,
+            primary.port,
+            primary.server_aet,
+            primary.aet,
+            log_dir=primary.log_dir,
+            retrieve_method=primary.retrieve_method,
+        )
+        self.sources = sources
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._condition = threading.Condition()
+
+        # Images retrieved from any source are received by the same listeners
+        for source in sources[1:]:
+            primary.share_receiver(source.backend)
+        # The failed queries are sent to the next source
+        for source in sources:
+            source.backend.raise_on_failure = True
+
+    @property
+    def max_concurrent_moves(self) -> int:
+        """Return the total number of retrievals which can run at the same time."""
+        return sum(source.max_concurrent_moves for source in self.sources)
+
+    @property
+    def shares_receive_port(self) -> bool:
+        """Return True if the retrievals of all the sources can share one receive port."""
+        return all(source.backend.shares_receive_port for source in self.sources)
+
+    def _failed(self, source: Source) -> None:
+        source.failures += 1
+        delay = min(self.backoff * 2 ** (source.failures - 1), self.max_backoff)
+        source.down_until = time.monotonic() + delay
+        print(f"* Source {source.name} failed, not used for {delay:.0f} s")
+
+    def _acquire(self, tried: List[Source]) -> Optional[Source]:
+        """Block until a source which was not tried yet has a free slot, and reserve it."""
+        with self._condition:
+            while True:
+                candidates = [source for source in self.sources if source not in tried]
+                if not candidates:
+                    return None
+                # Sources which failed recently are only used as a last resort
+                up = [source for source in candidates if source.is_up()]
+                free = [
+                    source
+                    for source in (up or candidates)
+                    if source.active < source.max_concurrent_moves
+                ]
+                if free:
+                    source = min(free, key=lambda s: s.active / s.max_concurrent_moves)
+                    source.active += 1
+                    return source
+                self._condition.wait(timeout=1.0)
+
+    def _release(self, source: Source, success: bool) -> None:
+        with self._condition:
+            source.active -= 1
+            if success:
+                source.failures = 0
+            else:
+                self._failed(source)
+            self._condition.notify_all()
+
+    def _retrieve(self, method: str, *args, **kwargs) -> bool:
+        """Run a retrieval on the least loaded source, and on the next ones if it fails."""
+        tried = []  # type: List[Source]
+        while True:
+            source = self._acquire(tried)
+            if source is None:
+                return False
+            if tried:
+                record_retry(source.name)
+            else:
+                record_server(source.name)
+            success = False
+            try:
+                success = getattr(source.backend, method)(*args, **kwargs)
+            finally:
+                self._release(source, bool(success))
+            if success:
+                return True
+            tried.append(source)
+
+    def _ordered_sources(self) -> List[Source]:
+        """Return the sources which are up first, in the config order."""
+        return sorted(self.sources, key=lambda source: not source.is_up())
+
+    def echo(self) -> bool:
+        reachable = False
+        for source in self.sources:
+            if source.backend.echo():
+                reachable = True
+            else:
+                with self._condition:
+                    self._failed(source)
+        return reachable
+
+    def _query(self, method: str, default, *args, **kwargs):
+        """Send a query to the first source which is up, and to the next ones if it fails."""
+        for source in self._ordered_sources():
+            try:
+                return getattr(source.backend, method)(*args, **kwargs)
+            except (ConnectionError, OSError, RuntimeError):
+                with self._condition:
+                    self._failed(source)
+        self.request_failed(method)
+        return default
+
+    def find(self, query_retrieval_level: str = "SERIES", **query_attributes: str) -> List[SeriesRecord]:
+        return self._query("find", [], query_retrieval_level, **query_attributes)
+
+    def count_instances(self, *args, **kwargs) -> int:
+        return self._query("count_instances", 0, *args, **kwargs)
+
+    def get(self, *args, **kwargs) -> bool:
+        return self._retrieve("get", *args, **kwargs)
+
+    def get_sorted(self, *args, **kwargs) -> bool:
+        return self._retrieve("get_sorted", *args, **kwargs)
+
+    def get_datasets(self, *args, **kwargs) -> bool:
+        return self._retrieve("get_datasets", *args, **kwargs)
+
+    def move_remote(self, *args, **kwargs) -> bool:
+        return self._retrieve("move_remote", *args, **kwargs)
+
+    def upload_results(
+        self,
+        dicom_dir: str,
+        log_dir: Optional[str] = None,
+        filenames: Optional[List[str]] = None,
+    ) -> Dict[str, bool]:
+        return self._ordered_sources()[0].backend.upload_results(
+            dicom_dir, log_dir=log_dir, filenames=filenames
+        )
+
+    def close(self) -> None:
+        for source in self.sources:
+            source.backend.close()
@@ -0,0 +1,213 @@
+# Copyright 2018-2024 Lausanne University Hospital and University of Lausanne,
+# Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module contains the measures of the retrievals written to the retrieval log and summarized after a run."""
+
+import math
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional
+
+# Status of a series in the retrieval log
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+STATUS_SKIPPED = "skipped"
+STATUS_QUERIED = "queried"
+
+# Percentiles reported in the run summary
+SUMMARY_PERCENTILES = (50, 90, 99)
+
+# Measures of the retrieval running in the current thread
+_local = threading.local()
+
+
+class RetrievalTiming:
+    """Measures of one retrieval request (of a series, study or patient).
+
+    Args:
+        server: PACS server the request is sent to, e.g. ``AET@address:port``.
+
+    """
+
+    def __init__(self, server: str = "") -> None:
+        self.server = server
+        # Wall clock time at which the request started
+        self.started_at = None  # type: Optional[float]
+        self.seconds = None  # type: Optional[float]
+        self.success = None  # type: Optional[bool]
+        self.retries = 0
+        self.instances = None  # type: Optional[int]
+
+    @property
+    def instances_per_second(self) -> Optional[float]:
+        """Return the number of instances retrieved per second (None if unknown)."""
+        if self.instances is None or not self.seconds:
+            return None
+        return self.instances / self.seconds
+
+
+def current_timing() -> Optional[RetrievalTiming]:
+    """Return the measures of the retrieval running in the current thread (None outside :func:`timed`)."""
+    return getattr(_local, "timing", None)
+
+
+def record_retry(server: Optional[str] = None) -> None:
+    """Record that the retrieval running in the current thread is sent again.
+
+    Args:
+        server: PACS server the request is sent to next, if it changes.
+
+    """
+    timing = current_timing()
+    if timing is None:
+        return
+    timing.retries += 1
+    if server is not None:
+        timing.server = server
+
+
+def record_server(server: str) -> None:
+    """Record the PACS server handling the retrieval running in the current thread."""
+    timing = current_timing()
+    if timing is not None:
+        timing.server = server
+
+
+def timed(
+    fn: Callable[..., bool],
+    timing: RetrievalTiming,
+    instances: Optional[Callable[[], int]] = None,
+) -> Callable[..., bool]:
+    """Wrap a retrieval function so that its duration, outcome and retries are measured.
+
+    Args:
+        fn: retrieval function returning True on success.
+        timing: measures of the retrieval, filled once it is done.
+        instances: function returning the number of instances retrieved,
+                   called once the retrieval is done.
+
+    Returns:
+        function: the wrapped retrieval function.
+
+    """
+
+    def request(*args, **kwargs) -> bool:
+        _local.timing = timing
+        timing.started_at = time.time()
+        start = time.monotonic()
+        success = False
+        try:
+            success = fn(*args, **kwargs)
+        finally:
+            timing.seconds = time.monotonic() - start
+            timing.success = bool(success)
+            _local.timing = None
+            if instances is not None:
+                timing.instances = instances()
+        return success
+
+    return request
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Return the q-th percentile of a list of values, interpolated linearly between the closest ranks."""
+    if not values:
+        raise ValueError("Cannot compute the percentile of an empty list!")
+    values = sorted(values)
+    rank = (len(values) - 1) * q / 100
+    low, high = math.floor(rank), math.ceil(rank)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def describe(values: Iterable[Optional[float]]) -> Dict[str, float]:
+    """Return the number, percentiles (see ``SUMMARY_PERCENTILES``) and maximum of the known values."""
+    values = [value for value in values if value is not None]
+    if not values:
+        return {"count": 0}
+    description = {"count": len(values)}  # type: Dict[str, float]
+    for q in SUMMARY_PERCENTILES:
+        description[f"p{q}"] = round(percentile(values, q), 3)
+    description["max"] = round(max(values), 3)
+    return description
+
+
+def _to_float(value: object) -> Optional[float]:
+    return None if value in (None, "") else float(value)
+
+
+def summarize_log(entries: List[Dict[str, object]]) -> Dict[str, object]:
+    """Summarize the log entries of the series of a run.
+
+    Args:
+        entries: log entries, with the ``Status``, ``Modality``, ``Server``,
+                 ``FilesFound``, ``BytesReceived``, ``FindSeconds``,
+                 ``MoveSeconds`` and ``InstancesPerSecond`` of each series
+
+    Returns:
+        dict: number of series per status, instances and bytes retrieved, and
+              percentiles of the latencies and throughputs, overall and per
+              PACS server and modality
+
+    """
+    statuses = {}  # type: Dict[str, int]
+    for entry in entries:
+        statuses[str(entry["Status"])] = statuses.get(str(entry["Status"]), 0) + 1
+    done = [entry for entry in entries if entry["Status"] == STATUS_DONE]
+
+    def throughput(selected: List[Dict[str, object]]) -> Dict[str, float]:
+        return describe(_to_float(entry["InstancesPerSecond"]) for entry in selected)
+
+    return {
+        "series": statuses,
+        "instances": sum(int(entry["FilesFound"] or 0) for entry in done),
+        "bytes": sum(int(entry["BytesReceived"] or 0) for entry in done),
+        "retries": sum(int(entry["Retries"] or 0) for entry in entries),
+        "find_seconds": describe(_to_float(entry["FindSeconds"]) for entry in entries),
+        "move_seconds": describe(_to_float(entry["MoveSeconds"]) for entry in done),
+        "instances_per_second": throughput(done),
+        "instances_per_second_by_server": {
+            server: throughput([entry for entry in done if entry["Server"] == server])
+            for server in sorted({str(entry["Server"]) for entry in done})
+        },
+        "instances_per_second_by_modality": {
+            modality: throughput([entry for entry in done if entry["Modality"] == modality])
+            for modality in sorted({str(entry["Modality"]) for entry in done})
+        },
+    }
+
+
+def format_summary(summary: Dict[str, object]) -> str:
+    """Return a printable version of a run summary (see :func:`summarize_log`)."""
+
+    def percentiles(description: Dict[str, float], unit: str) -> str:
+        if not description["count"]:
+            return "n/a"
+        return ", ".join(
+            f"{key} {value:.2f}{unit}" for key, value in description.items() if key != "count"
+        )
+
+    series = ", ".join(f"{count} {status}" for status, count in sorted(summary["series"].items()))
+    lines = [
+        f"Run summary: {series or 'no'} series, {summary['instances']} instances, "
+        f"{summary['bytes'] / 1e9:.3f} GB, {summary['retries']} retries",
+        f"  C-FIND latency: {percentiles(summary['find_seconds'], 's')}",
+        f"  Retrieval time: {percentiles(summary['move_seconds'], 's')}",
+        f"  Instances per second: {percentiles(summary['instances_per_second'], '')}",
+    ]
+    for server, description in summary["instances_per_second_by_server"].items():
+        lines.append(f"    {server}: {percentiles(description, '')}")
+    for modality, description in summary["instances_per_second_by_modality"].items():
+        lines.append(f"    {modality or 'unknown modality'}: {percentiles(description, '')}")
+    return "\n".join(lines)
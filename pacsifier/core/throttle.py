@@ -0,0 +1,186 @@
+# Copyright 2018-2024 Lausanne University Hospital and University of Lausanne,
+# Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module contains the rate limiter adapting the request rate to the load of the PACS server."""
+
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+
+class AdaptiveThrottle:
+    """Token bucket rate limiter with an additive increase / multiplicative decrease (AIMD) rate.
+
+    Each request takes a token from the bucket, which is refilled at ``rate``
+    tokens per second. Once a request is done, its outcome adapts the rate:
+
+    * if it failed, or if its time per instance (sub-operation) got slower than
+      ``slowdown`` times the fastest time per instance measured so far, the
+      PACS server is considered overloaded and the rate is multiplied by
+      ``decrease``;
+    * otherwise the rate is increased by ``increase`` times the initial rate.
+
+    The rate always stays between ``min_rate`` and ``max_rate``.
+
+    Args:
+        rate: initial rate in requests per second. If None, the requests are not
+              throttled.
+        max_rate: upper bound of the rate in requests per second. Default is no bound.
+        min_rate: lower bound of the rate in requests per second. Default is a
+                  tenth of the initial rate.
+        burst: number of requests which can be started at once. Default is 1.
+        increase: additive increase of the rate, as a fraction of the initial rate.
+                  Default is 0.1.
+        decrease: multiplicative decrease of the rate. Default is 0.5.
+        slowdown: ratio to the fastest time per instance above which a request is
+                  considered slow. Default is 2.
+
+    """
+
+    def __init__(
+        self,
+        rate: Optional[float],
+        max_rate: Optional[float] = None,
+        min_rate: Optional[float] = None,
+        burst: int = 1,
+        increase: float = 0.1,
+        decrease: float = 0.5,
+        slowdown: float = 2.0,
+    ) -> None:
+        if rate is not None and rate <= 0:
+            raise ValueError("The request rate must be positive!")
+        if rate is not None and max_rate is not None:
+            rate = min(rate, max_rate)
+        self.rate = rate
+        self.max_rate = max_rate
+        self.min_rate = min_rate if min_rate is not None else (rate or 0) / 10
+        self.burst = burst
+        self.step = (rate or 0) * increase
+        self.decrease = decrease
+        self.slowdown = slowdown
+
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._last_refill = time.monotonic()
+        # Fastest smoothed time per instance
+        self._baseline = None  # type: Optional[float]
+        self._smoothed = None  # type: Optional[float]
+
+    @classmethod
+    def from_parameters(cls, parameters: Dict[str, str]) -> "AdaptiveThrottle":
+        """Create the throttle from the config file.
+
+        The initial rate is ``batch_size`` requests every ``batch_wait_time``
+        seconds, with bursts of ``batch_size`` requests, and is bounded by
+        ``max_moves_per_minute`` if given. If ``batch_wait_time`` is 0 and no
+        bound is given, the requests are not throttled. These limits apply to
+        each PACS server, so they are multiplied by the number of servers when
+        additional ``sources`` are configured.
+
+        Args:
+            parameters: parameters from PACSIFIER configuration file
+
+        Returns:
+            AdaptiveThrottle: the throttle
+
+        """
+        servers = 1 + len(parameters.get("sources", []))
+        batch_wait_time = float(parameters["batch_wait_time"])
+        batch_size = int(parameters["batch_size"]) * servers
+        max_rate = None
+        if "max_moves_per_minute" in parameters:
+            max_rate = float(parameters["max_moves_per_minute"]) * servers / 60
+        rate = batch_size / batch_wait_time if batch_wait_time > 0 else max_rate
+        return cls(rate, max_rate=max_rate, burst=batch_size)
+
+    def acquire(self) -> None:
+        """Block until a request can be started."""
+        if self.rate is None:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._last_refill) * self.rate
+                )
+                self._last_refill = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def record(self, latency: float, success: bool, instances: Optional[int] = None) -> None:
+        """Adapt the rate to the outcome of a request.
+
+        Args:
+            latency: duration of the request in seconds.
+            success: True if the request succeeded.
+            instances: number of instances transferred by the request, if known.
+
+        """
+        if self.rate is None:
+            return
+        with self._lock:
+            slow = False
+            if success:
+                per_instance = latency / max(instances or 1, 1)
+                self._smoothed = (
+                    per_instance
+                    if self._smoothed is None
+                    else 0.7 * self._smoothed + 0.3 * per_instance
+                )
+                # The baseline slowly drifts up to forget an old minimum
+                if self._baseline is None or self._smoothed < self._baseline:
+                    self._baseline = self._smoothed
+                else:
+                    self._baseline *= 1.01
+                slow = self._smoothed > self.slowdown * self._baseline
+
+            if success and not slow:
+                rate = self.rate + self.step
+            else:
+                rate = self.rate * self.decrease
+            if self.max_rate is not None:
+                rate = min(rate, self.max_rate)
+            self.rate = max(rate, self.min_rate)
+
+    def wrap(
+        self, fn: Callable[..., bool], instances: Optional[Callable[[], int]] = None
+    ) -> Callable[..., bool]:
+        """Wrap a request function so that it is throttled and its outcome adapts the rate.
+
+        Args:
+            fn: request function returning True on success.
+            instances: function returning the number of instances transferred,
+                       called once the request is done.
+
+        Returns:
+            function: the wrapped request function.
+
+        """
+
+        def request(*args, **kwargs) -> bool:
+            self.acquire()
+            start = time.monotonic()
+            success = fn(*args, **kwargs)
+            self.record(
+                time.monotonic() - start,
+                bool(success),
+                instances() if instances is not None else None,
+            )
+            return success
+
+        return request
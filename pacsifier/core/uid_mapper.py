@@ -0,0 +1,131 @@
+# Copyright 2018-2024 Lausanne University Hospital and University of Lausanne,
+# Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module contains the keyed mapping of the original UIDs to the UIDs of the anonymized images."""
+
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+from typing import Dict, Optional, Union
+
+import pydicom
+
+# Maximal length of a UID (DICOM PS3.5 9.1)
+MAX_UID_LENGTH = 64
+
+# Environment variable holding the project secret, used when none is given
+UID_SECRET_ENV = "PACSIFIER_UID_SECRET"
+
+# Mappings read from the UID map files by the current process, per absolute path
+_loaded_maps = {}  # type: Dict[str, Dict[str, str]]
+_lock = threading.Lock()
+
+
+def derive_uid(uid: str, secret: bytes, prefix: str = pydicom.uid.PYDICOM_ROOT_UID) -> str:
+    """Derive a new UID from the HMAC-SHA256 of a UID under a secret.
+
+    Args:
+        uid: original UID
+        secret: project secret
+        prefix: root of the new UID, ending with a dot
+
+    Returns:
+        str: the new UID, at most 64 characters long.
+
+    """
+    digest = hmac.new(secret, uid.encode("utf-8"), hashlib.sha256).digest()
+    return prefix + str(int.from_bytes(digest, "big"))[: MAX_UID_LENGTH - len(prefix)]
+
+
+class UIDMapper:
+    """Keyed, deterministic mapping of the original UIDs to new UIDs.
+
+    The new UID of a UID is derived from the HMAC of the original UID under
+    a project secret (see :func:`derive_uid`): the runs and the processes
+    sharing the secret give the same new UIDs without coordination, and the
+    references between images (e.g. of a RT structure set to its CT series)
+    stay consistent. Without the secret, the new UIDs cannot be linked back
+    to the original ones.
+
+    The mapping can also be kept in a CSV file (one ``original,new`` line
+    per UID). The UIDs of the file keep the new UID it gives, e.g. one
+    assigned by an earlier run with another secret, and the UIDs mapped
+    for the first time are appended to it. The file is read once per process.
+
+    Args:
+        secret: project secret. If None, the secret is read from the
+                ``PACSIFIER_UID_SECRET`` environment variable, or drawn at
+                random, in which case the new UIDs only stay consistent
+                within this mapper.
+        map_path: path to the UID map file, None to not keep the mapping.
+        prefix: root of the new UIDs. Default is the pydicom root.
+
+    """
+
+    def __init__(
+        self,
+        secret: Optional[Union[str, bytes]] = None,
+        map_path: Optional[str] = None,
+        prefix: str = pydicom.uid.PYDICOM_ROOT_UID,
+    ) -> None:
+        if secret is None:
+            secret = os.environ.get(UID_SECRET_ENV) or secrets.token_bytes(32)
+        if isinstance(secret, str):
+            secret = secret.encode("utf-8")
+        if not secret:
+            raise ValueError("The UID secret cannot be empty!")
+        if len(prefix) > MAX_UID_LENGTH - 20:
+            raise ValueError(f"The UID prefix {prefix} is too long!")
+        self.secret = secret
+        self.prefix = prefix
+        self.map_path = os.path.abspath(map_path) if map_path else None
+        if self.map_path is not None:
+            os.makedirs(os.path.dirname(self.map_path), exist_ok=True)
+            # A new mapper reads the file again, e.g. for a new run
+            with _lock:
+                _loaded_maps.pop(self.map_path, None)
+
+    @property
+    def fingerprint(self) -> str:
+        """Return a short fingerprint of the secret, telling whether two mappers give the same UIDs."""
+        return hmac.new(self.secret, self.prefix.encode("utf-8"), hashlib.sha256).hexdigest()[:16]
+
+    def _load_map(self) -> Dict[str, str]:
+        if self.map_path not in _loaded_maps:
+            mapping = {}  # type: Dict[str, str]
+            if os.path.isfile(self.map_path):
+                with open(self.map_path, "r") as f:
+                    for line in f:
+                        if line.strip():
+                            original, new = line.strip().split(",")
+                            mapping[original] = new
+            _loaded_maps[self.map_path] = mapping
+        return _loaded_maps[self.map_path]
+
+    def __call__(self, uid: str) -> str:
+        """Return the new UID of a UID."""
+        if self.map_path is None:
+            return derive_uid(uid, self.secret, self.prefix)
+
+        with _lock:
+            mapping = self._load_map()
+            if uid not in mapping:
+                mapping[uid] = derive_uid(uid, self.secret, self.prefix)
+                # Single short appends, so that the lines of concurrent processes do not mix
+                with open(self.map_path, "a") as f:
+                    f.write(f"{uid},{mapping[uid]}\n")
+            return mapping[uid]
@@ -15,6 +15,7 @@
 
 """Tests for the functions of the `pacsifier.cli.anonymize_dicoms` script.""" ""
 
+import json
 import os
 import random
 import shutil
@@ -22,12 +23,18 @@ import sys
 import pytest
 
 import pydicom
+import pydicom.data
 
+from pacsifier.cli import anonymize_dicoms
 from pacsifier.cli.anonymize_dicoms import (
     fuzz_date,
+    anonymize_dataset,
+    shift_date_by_some_days,
     anonymize_dicom_file,
     anonymize_all_dicoms_within_root_folder,
+    StreamAnonymizer,
 )
+from pacsifier.core.uid_mapper import UID_SECRET_ENV, UIDMapper
 
 
 def test_fuzz_date():
@@ -185,6 +192,106 @@ def test_anonymize(test_dir):
     assert dataset.PatientAge == "90+Y"
 
 
+@pytest.mark.parametrize(
+    "name",
+    ["MR_small.dcm", "MR_small_implicit.dcm", "MR_small_bigendian.dcm", "JPEG2000.dcm"],
+)
+def test_anonymize_copies_pixel_data(test_dir, monkeypatch, name):
+    out_dir = os.path.join(test_dir, "tmp", "test_data", "pixel_data_anon")
+    os.makedirs(out_dir, exist_ok=True)
+    in_file = os.path.join(out_dir, name)
+
+    # Original file with a private element following the pixel data
+    dataset = pydicom.dcmread(pydicom.data.get_testdata_file(name))
+    dataset.PatientBirthDate = "19700101"
+    dataset.StudyDate = "20200101"
+    block = dataset.private_block(0x7FE1, "SIEMENS CSA NON-IMAGE", create=True)
+    block.add_new(0x10, "OB", b"CSA DATA")
+    dataset.save_as(in_file, write_like_original=True)
+
+    # Copy the pixel data by chunks of 7 bytes
+    monkeypatch.setattr(anonymize_dicoms, "PIXEL_DATA_CHUNK_SIZE", 7)
+    # The other UIDs are derived under the same secret by both anonymizations
+    uids = dict(
+        new_StudyInstanceUID="1.2.3",
+        new_SeriesInstanceUID="1.2.3.4",
+        new_SOPInstanceUID="1.2.3.4.5",
+        uid_mapper=UIDMapper("secret"),
+    )
+    for remove_private_tags in [False, True]:
+        out_file = os.path.join(out_dir, f"anon_{remove_private_tags}_{name}")
+        anonymize_dicom_file(
+            in_file,
+            out_file,
+            PatientID="PACSIFIER2",
+            fuzz_days_shift=10,
+            remove_private_tags=remove_private_tags,
+            **uids,
+        )
+
+        # Same result as the anonymization of the whole dataset
+        expected = pydicom.dcmread(in_file)
+        anonymize_dataset(
+            expected,
+            PatientID="PACSIFIER2",
+            fuzz_days_shift=10,
+            remove_private_tags=remove_private_tags,
+            **uids,
+        )
+        anonymized = pydicom.dcmread(out_file)
+        assert anonymized == expected
+        assert anonymized.PixelData == dataset.PixelData
+        assert anonymized.file_meta.MediaStorageSOPInstanceUID == "1.2.3.4.5"
+        assert ((0x7FE1, 0x1010) in anonymized) != remove_private_tags
+
+    # The profile is also applied to the elements following the pixel data
+    block[0x10].value = b"Doe^John SECRETID"
+    dataset.save_as(in_file, write_like_original=True)
+    out_file = os.path.join(out_dir, f"anon_basic_{name}")
+    anonymize_dicom_file(
+        in_file, out_file, PatientID="PACSIFIER2", profile="basic", **uids
+    )
+    with open(out_file, "rb") as f:
+        assert b"SECRETID" not in f.read()
+    assert (0x7FE1, 0x1010) not in pydicom.dcmread(out_file)
+
+    # The original file can be replaced by the anonymized one
+    anonymize_dicom_file(in_file, in_file, PatientID="PACSIFIER2", **uids)
+    anonymized = pydicom.dcmread(in_file)
+    assert anonymized.PatientID == "PACSIFIER2"
+    assert anonymized.PixelData == dataset.PixelData
+
+
+def test_stream_anonymizer(test_dir):
+    in_file = os.path.join(test_dir, "test_data", "dicomseries", "slice0.dcm")
+    anonymizer = StreamAnonymizer(new_ids={"PACSIFIER2": "sub42"})
+
+    first = pydicom.dcmread(in_file)
+    second = pydicom.dcmread(in_file)
+    second.SOPInstanceUID = pydicom.uid.generate_uid()
+    other_patient = pydicom.dcmread(in_file)
+    original_patient_id = str(other_patient.PatientID)
+    other_patient.PatientID = "PACSIFIER2"
+
+    first = anonymizer(first)
+    second = anonymizer(second)
+    other_patient = anonymizer(other_patient)
+
+    # The datasets of a series keep the same new UIDs, but not their instances
+    assert first.PatientID == second.PatientID == "000002"
+    assert (
+        first.SeriesInstanceUID
+        == second.SeriesInstanceUID
+        == other_patient.SeriesInstanceUID
+    )
+    assert first.SOPInstanceUID != second.SOPInstanceUID
+    assert first.file_meta.MediaStorageSOPInstanceUID == first.SOPInstanceUID
+    assert other_patient.PatientID == "sub42"
+    assert anonymizer.mapper() == {"sub42": "PACSIFIER2", "000002": original_patient_id}
+    assert set(anonymizer.date_offsets) == {"000002", "sub42"}
+    assert all(abs(offset) <= 30 for offset in anonymizer.date_offsets.values())
+
+
 def test_anonymize_all_dicoms_within_folder(test_dir):
     # Create a folder with a few files following the expected structure
     dicom_dir = os.path.join(test_dir, "test_data", "dicomseries")
@@ -215,3 +322,198 @@ def test_anonymize_all_dicoms_within_folder(test_dir):
         rename_patient_directories=False,
     )
     assert dict_ == {"000001": "PACSIFIER1"}
+
+
+@pytest.fixture
+def anonymize_folder():
+    """Return a function anonymizing a folder with fuzzed dates.
+
+    The function returns the mapper, the date offsets and the paths of the
+    output files relative to the output folder.
+    """
+
+    def anonymize(datapath, output_folder, **kwargs):
+        os.makedirs(output_folder, exist_ok=True)
+        mapper = anonymize_all_dicoms_within_root_folder(
+            output_folder=output_folder,
+            datapath=datapath,
+            fuzz_acq_dates=True,
+            **kwargs,
+        )
+        with open(os.path.join(output_folder, "mapper.json")) as f:
+            assert json.load(f) == mapper
+        with open(os.path.join(output_folder, "date_offsets.csv")) as f:
+            offsets = [int(offset) for offset in f.read().split(",")]
+        outputs = {
+            os.path.relpath(os.path.join(root, f), output_folder)
+            for root, _, files in os.walk(output_folder)
+            for f in files
+        }
+        return mapper, offsets, outputs
+
+    return anonymize
+
+
+def test_anonymize_all_dicoms_within_folder_jobs(test_dir, anonymize_folder):
+    # Two patients with two series each, anonymized by a pool of processes
+    dicom_dir = os.path.join(test_dir, "test_data", "dicomseries")
+    pacsifier_dir = os.path.join(test_dir, "tmp", "test_data", "dicomseries_jobs")
+    anonymization_dir = os.path.join(
+        test_dir, "tmp", "test_data", "dicomseries_jobs_anon"
+    )
+    for dir in [pacsifier_dir, anonymization_dir, anonymization_dir + "_sequential"]:
+        shutil.rmtree(dir, ignore_errors=True)
+
+    filenames = sorted(f for f in os.listdir(dicom_dir) if f.endswith(".dcm"))[:8]
+    original_study_date = pydicom.dcmread(
+        os.path.join(dicom_dir, filenames[0])
+    ).StudyDate
+    for j, patient in enumerate(["sub-PAT1", "sub-PAT2"]):
+        for i, series in enumerate(["00001-T1", "00002-T2"]):
+            series_dir = os.path.join(pacsifier_dir, patient, "ses-20170115", series)
+            os.makedirs(series_dir)
+            for f in filenames[i * 4 : (i + 1) * 4]:
+                dataset = pydicom.dcmread(os.path.join(dicom_dir, f))
+                dataset.PatientBirthDate = "19800101"
+                # Each study and series has its own UIDs
+                dataset.StudyInstanceUID = f"1.2.3.{j}"
+                dataset.SeriesInstanceUID = f"1.2.3.{j}.{i}"
+                dataset.SOPInstanceUID = f"1.2.3.{j}.{i}.{f[5:-4]}"
+                dataset.save_as(os.path.join(series_dir, f))
+
+    kwargs = dict(new_ids={"sub-PAT1": "P1", "sub-PAT2": "P2"}, uid_secret="secret")
+    random.seed(42)
+    mapper, offsets, outputs = anonymize_folder(
+        pacsifier_dir, anonymization_dir, jobs=2, **kwargs
+    )
+    assert mapper == {"P1": "PAT1", "P2": "PAT2"}
+    assert all(offset != 0 for offset in offsets)
+
+    # The date offsets, UIDs and output files do not depend on the number of jobs
+    random.seed(42)
+    assert anonymize_folder(
+        pacsifier_dir, anonymization_dir + "_sequential", jobs=1, **kwargs
+    ) == (mapper, offsets, outputs)
+
+    # The offsets are written in the order of the patients of mapper.json
+    offsets = dict(zip(mapper, offsets))
+    study_uids = set()
+    for patient in ["sub-P1", "sub-P2"]:
+        offset = offsets[patient[4:]]
+        patient_dir = os.path.join(anonymization_dir, patient)
+        fuzzed_study_date = shift_date_by_some_days("20170115", offset)
+        assert os.listdir(patient_dir) == [f"ses-{fuzzed_study_date}"]
+        study_dir = os.path.join(patient_dir, f"ses-{fuzzed_study_date}")
+        series_uids = set()
+        for series in ["00001-T1", "00002-T2"]:
+            datasets = [
+                pydicom.dcmread(os.path.join(study_dir, series, f))
+                for f in os.listdir(os.path.join(study_dir, series))
+            ]
+            assert len(datasets) == 4
+            # All the images of a series share the same new UIDs
+            assert len({dataset.SeriesInstanceUID for dataset in datasets}) == 1
+            series_uids.add(datasets[0].SeriesInstanceUID)
+            study_uids.update(dataset.StudyInstanceUID for dataset in datasets)
+            assert {dataset.PatientID for dataset in datasets} == {patient[4:]}
+            assert {dataset.StudyDate for dataset in datasets} == {
+                shift_date_by_some_days(original_study_date, offset)
+            }
+        assert len(series_uids) == 2
+    assert len(study_uids) == 2
+
+    with pytest.raises(ValueError):
+        anonymize_all_dicoms_within_root_folder(
+            output_folder=anonymization_dir, datapath=pacsifier_dir, jobs=0
+        )
+
+
+def test_anonymize_all_dicoms_within_folder_incremental(
+    test_dir, monkeypatch, anonymize_folder
+):
+    dicom_dir = os.path.join(test_dir, "test_data", "dicomseries")
+    pacsifier_dir = os.path.join(
+        test_dir, "tmp", "test_data", "dicomseries_incremental"
+    )
+    anonymization_dir = os.path.join(
+        test_dir, "tmp", "test_data", "dicomseries_incremental_anon"
+    )
+    for dir in [pacsifier_dir, anonymization_dir]:
+        shutil.rmtree(dir, ignore_errors=True)
+    filenames = sorted(f for f in os.listdir(dicom_dir) if f.endswith(".dcm"))[:5]
+
+    def add_series(patient, series, files):
+        series_dir = os.path.join(pacsifier_dir, patient, "ses-20170115", series)
+        os.makedirs(series_dir)
+        for f in files:
+            dataset = pydicom.dcmread(os.path.join(dicom_dir, f))
+            dataset.PatientBirthDate = "19800101"
+            dataset.SeriesInstanceUID = f"1.2.3.{patient[-1]}.{series}"
+            dataset.SOPInstanceUID = f"1.2.3.{patient[-1]}.{series}.{f[5:-4]}"
+            dataset.save_as(os.path.join(series_dir, f))
+        return [os.path.join(series_dir, f) for f in files]
+
+    anonymized = []
+    monkeypatch.setattr(
+        anonymize_dicoms,
+        "anonymize_dicom_file",
+        lambda filename, *args, **kwargs: anonymized.append(filename)
+        or anonymize_dicom_file(filename, *args, **kwargs),
+    )
+
+    def anonymize(uid_secret="secret", **kwargs):
+        anonymized.clear()
+        return anonymize_folder(
+            pacsifier_dir, anonymization_dir, uid_secret=uid_secret, **kwargs
+        )
+
+    first_series = add_series("sub-PAT1", "1", filenames[:3])
+    mapper, offsets, outputs = anonymize()
+    assert mapper == {"000001": "PAT1"}
+    assert len(anonymized) == 3
+
+    # Nothing changed
+    assert anonymize() == (mapper, offsets, outputs)
+    assert anonymized == []
+
+    # A new series of the same patient, a new patient and a changed file
+    new_series = add_series("sub-PAT1", "2", filenames[3:])
+    new_patient = add_series("sub-PAT2", "1", filenames[:1])
+    dataset = pydicom.dcmread(first_series[0])
+    dataset.SeriesDescription = "changed"
+    dataset.save_as(first_series[0])
+    first_offset = offsets[0]
+    mapper, offsets, outputs = anonymize()
+    assert mapper == {"000001": "PAT1", "000002": "PAT2"}
+    assert sorted(anonymized) == sorted([first_series[0]] + new_series + new_patient)
+
+    # The new series are merged into the folders of the first run, with the same date offset
+    assert dict(zip(mapper, offsets))["000001"] == first_offset
+    patient_dirs = {output.split(os.sep)[0] for output in outputs if os.sep in output}
+    assert patient_dirs == {"sub-000001", "sub-000002"}
+    study_dirs = {
+        output.split(os.sep)[1] for output in outputs if output.startswith("sub-000001")
+    }
+    assert len(study_dirs) == 1
+    # 6 images, the manifest, mapper.json and date_offsets.csv
+    assert len(outputs) == 6 + 3
+
+    # The UIDs of the unchanged files are the same when anonymizing them again
+    assert anonymize(incremental=False) == (mapper, offsets, outputs)
+    assert len(anonymized) == 6
+
+    # Without a secret, the UIDs are derived from a random one which is not kept
+    monkeypatch.delenv(UID_SECRET_ENV, raising=False)
+    with pytest.warns(UserWarning):
+        new_mapper, new_offsets, new_outputs = anonymize(uid_secret=None)
+    assert (new_mapper, new_offsets) == (mapper, offsets)
+    assert len(anonymized) == 6
+    assert len(new_outputs) == len(outputs)
+    assert len(new_outputs & outputs) == 3
+
+    # The date offsets follow the order of mapper.json, including the patients
+    # anonymized by the previous runs only
+    shutil.rmtree(os.path.join(pacsifier_dir, "sub-PAT1"))
+    new_mapper, new_offsets, _ = anonymize()
+    assert list(new_mapper) == ["000001", "000002"]
+    assert dict(zip(new_mapper, new_offsets)) == dict(zip(mapper, offsets))
@@ -15,6 +15,7 @@
 
 """Tests for the functions of the `pacsifier.cli.pacsifier` script."""
 
+from concurrent.futures import Future
 from glob import glob
 import json
 import os
@@ -23,8 +24,10 @@ import pytest
 from functools import reduce
 import string
 import shutil
+import threading
 from hypothesis import given, example
 from hypothesis.strategies import text
+from pydicom.dataset import Dataset
 
 from pacsifier.cli import (
     readLineByLine,
@@ -36,7 +39,13 @@ from pacsifier.cli import (
     add_or_retrieve_name,
     retrieve_dicoms_using_table,
     upload_dicoms,
+    group_series,
+    join_retrieval,
+    close_all,
+    get_and_forward,
 )
+from pacsifier.core.journal import COMPLETE, RetrievalJournal
+from pacsifier.core.relay import Relay
 
 
 def test_process_findscu_dump_file(test_dir):
@@ -250,6 +259,84 @@ def test_retrieve_dicoms_using_table(test_dir):
     assert os.path.exists(log_csv_path), f"CSV log file {log_csv_path} was not created."
 
 
+def test_group_series():
+    series = [
+        {"PatientID": "01", "StudyInstanceUID": "1.1", "SeriesInstanceUID": "1.1.1"},
+        {"PatientID": "01", "StudyInstanceUID": "1.1", "SeriesInstanceUID": "1.1.2"},
+        {"PatientID": "01", "StudyInstanceUID": "1.2", "SeriesInstanceUID": "1.2.1"},
+    ]
+    assert group_series(series, "SERIES") == {"1.1.1": [0], "1.1.2": [1], "1.2.1": [2]}
+    assert group_series(series, "STUDY") == {"1.1": [0, 1], "1.2": [2]}
+    assert group_series(series, "PATIENT") == {"01": [0, 1, 2]}
+
+
+def test_join_retrieval(test_dir):
+    log_dir = os.path.join(test_dir, "tmp", "join_retrieval")
+    shutil.rmtree(log_dir, ignore_errors=True)
+    os.makedirs(log_dir)
+    with RetrievalJournal(os.path.join(log_dir, "journal.sqlite")) as journal:
+        retrieval = Future()
+        destinations = {"1.1.1": os.path.join(log_dir, "1")}
+        added = {"1.1.2": os.path.join(log_dir, "2")}
+        join_retrieval(journal, retrieval, destinations, added)
+        # The series of another row are filed by the pending retrieval
+        assert destinations == {"1.1.1": os.path.join(log_dir, "1"), "1.1.2": added["1.1.2"]}
+
+        os.makedirs(added["1.1.2"])
+        open(os.path.join(added["1.1.2"], "MR.1"), "w").close()
+        retrieval.set_result(True)
+        assert journal.get_series("1.1.2", added["1.1.2"]) == (COMPLETE, 1)
+
+
+def test_close_all():
+    closed = []
+
+    def fail(name):
+        closed.append(name)
+        raise RuntimeError(name)
+
+    # All the functions are called, and the first error is raised
+    with pytest.raises(RuntimeError, match="log"):
+        close_all(
+            lambda: fail("log"), None, lambda: closed.append("backend"), lambda: fail("cache")
+        )
+    assert closed == ["log", "backend", "cache"]
+    close_all(None)
+
+
+def test_get_and_forward():
+    release = threading.Event()
+
+    def store(dataset):
+        # The datasets of series 2.2 are blocked, those of series 3.3 fail
+        if dataset.SeriesInstanceUID == "2.2":
+            release.wait()
+        return dataset.SeriesInstanceUID != "3.3"
+
+    class Backend:
+        def get_datasets(self, study_date, handler, series_instance_uid):
+            for _ in range(3):
+                handler(make_series_dataset(series_instance_uid))
+            return True
+
+    relay = Relay(lambda dataset: dataset, store, workers=2)
+    relay.put(make_series_dataset("2.2"))
+    relay.put(make_series_dataset("3.3"))
+
+    # The retrieval does not wait for the other series nor count their failures
+    assert get_and_forward(Backend(), relay, "20240101", ["1.1"], series_instance_uid="1.1")
+    assert relay.forwarded == {"1.1": 3}
+    assert not get_and_forward(Backend(), relay, "20240101", ["3.3"], series_instance_uid="3.3")
+    release.set()
+    relay.close()
+
+
+def make_series_dataset(series_instance_uid):
+    dataset = Dataset()
+    dataset.SeriesInstanceUID = series_instance_uid
+    return dataset
+
+
 def test_upload_dicoms(test_dir):
     dicomseries_karnak_tags_dir = os.path.join(
         test_dir, "tmp", "test_data", "dicomseries_tagged_all"
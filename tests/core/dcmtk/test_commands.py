@@ -18,9 +18,12 @@
 import os
 import pytest
 
+from pacsifier.core.dcmtk import commands
 from pacsifier.core.dcmtk.commands import (
-    echo, find, get, upload, replace_default_params, run
+    batch_filenames, echo, find, get, get_move_keys, upload, replace_default_params,
+    replay_failures, run,
 )
+from pacsifier.core.retry import FAILURES_FILENAME, REPLAYING_SUFFIX, FailureQueue, RetryPolicy
 
 
 def test_echo_invalid_inputs(dummy_long_string):
@@ -100,6 +103,12 @@ def test_get_invalid_inputs(dummy_long_string):
     with pytest.raises(ValueError):
         get("", "19930911")
 
+    with pytest.raises(ValueError):
+        get("AET", "19930911", retrieve_level="IMAGE")
+
+    with pytest.raises(ValueError):
+        get("AET", "19930911", retrieve_method="C-PUT")
+
     with pytest.raises(ValueError):
         get("AET", "19930911", port=0)
 
@@ -170,6 +179,13 @@ def test_upload_invalid_inputs(test_dir):
         upload("AET", os.path.join(test_dir, "test_data", "dicomseries"), server_aet="")
 
 
+def test_batch_filenames():
+    assert batch_filenames([]) == []
+    assert batch_filenames(["a", "bb", "c"], max_length=9) == [["a", "bb"], ["c"]]
+    # A file with a longer path is sent alone
+    assert batch_filenames(["a", "b" * 20, "c"], max_length=9) == [["a"], ["b" * 20], ["c"]]
+
+
 def test_replace_default_parameters():
     dummy_long_string = "aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa"
     parameters = "88.202.185.144 104 -aec theServerAET -aet MY_AET"
@@ -211,3 +227,106 @@ def test_run():
     log_dir = "./logs"
     os.makedirs(log_dir, exist_ok=True)
     assert [] == run("echo California Dreaming.", log_dir=log_dir)
+
+
+def test_run_retries_transient_failures(tmp_path, monkeypatch):
+    log_dir = str(tmp_path / "logs")
+    policy = RetryPolicy(max_retries=2, backoff=0)
+
+    # Fails transiently twice, then succeeds
+    state = tmp_path / "attempts"
+    script = tmp_path / "flaky.sh"
+    script.write_text(
+        f'echo x >> "{state}"\n'
+        f'if [ $(wc -l < "{state}") -le 2 ]; then echo "F: Association Request Failed" >&2; exit 70; fi\n'
+        'echo "I: Received Final Move Response (Success)" >&2\n'
+    )
+    assert run(f"sh {script}", log_dir=log_dir, retry_policy=policy) == [
+        "I: Received Final Move Response (Success)"
+    ]
+    assert len(state.read_text().splitlines()) == 3
+    assert not os.path.exists(os.path.join(log_dir, "fails.txt"))
+
+    # Gives up after the retries and records the failure
+    state.unlink()
+    assert run(f"sh {script}", log_dir=log_dir, retry_policy=RetryPolicy(1, backoff=0)) == ""
+    assert len(state.read_text().splitlines()) == 2
+    records = FailureQueue(os.path.join(log_dir, FAILURES_FILENAME)).read()
+    assert len(records) == 1
+    assert records[0]["command"] == f"sh {script}"
+    assert records[0]["kind"] == "association_failed"
+    assert records[0]["returncode"] == 70
+    assert records[0]["attempts"] == 2
+
+    # Permanent failures are not retried
+    state.unlink()
+    assert run(f"sh -c 'echo x >> {state}; exit 1'", log_dir=log_dir, retry_policy=policy) == ""
+    assert len(state.read_text().splitlines()) == 1
+    assert len(FailureQueue(os.path.join(log_dir, FAILURES_FILENAME)).read()) == 2
+
+    # The failed commands are replayed from the queue, the first one now succeeds
+    state.unlink()
+    assert replay_failures(str(tmp_path), policy) == (2, 1)
+    records = FailureQueue(os.path.join(log_dir, FAILURES_FILENAME)).read()
+    assert [record["kind"] for record in records] == ["local_error"]
+
+
+def test_replay_failures_interrupted(tmp_path, monkeypatch):
+    log_dir = str(tmp_path / "logs")
+    path = os.path.join(log_dir, FAILURES_FILENAME)
+    for i in range(3):
+        FailureQueue(path).append({"command": f"movescu {i}", "kind": "timeout"})
+
+    # Interrupted while replaying the second command
+    replayed = []
+
+    def interrupted(query, log_dir, retry_policy):
+        if query == "movescu 1":
+            raise KeyboardInterrupt
+        replayed.append(query)
+        return ["I: Received Final Move Response (Success)"]
+
+    monkeypatch.setattr(commands, "run", interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        replay_failures(str(tmp_path))
+    assert replayed == ["movescu 0"]
+    assert len(FailureQueue(path + REPLAYING_SUFFIX).read()) == 3
+
+    # The next replay runs all the records again, once each
+    replayed.clear()
+    FailureQueue(path).append({"command": "movescu 0", "kind": "timeout"})
+    monkeypatch.setattr(
+        commands, "run", lambda query, log_dir, retry_policy: replayed.append(query)
+    )
+    assert replay_failures(str(tmp_path)) == (3, 3)
+    assert replayed == ["movescu 0", "movescu 1", "movescu 2"]
+    assert not os.path.exists(path + REPLAYING_SUFFIX)
+
+
+def test_get_move_keys():
+    assert get_move_keys("20171001", "PAT004", "1.2", "1.2.3") == (
+        "--key 0010,0020=PAT004 --key 0020,000d=1.2 "
+        "--key 0020,000e=1.2.3 --key 0008,0020=20171001"
+    )
+    assert get_move_keys("20171001", "PAT004", "1.2", "1.2.3", "STUDY") == (
+        "--key 0010,0020=PAT004 --key 0020,000d=1.2 --key 0008,0020=20171001"
+    )
+    assert get_move_keys("20171001", "PAT004", "1.2", "1.2.3", "PATIENT") == (
+        "--key 0010,0020=PAT004"
+    )
+
+
+def test_get_retrieve_method(monkeypatch):
+    queries = []
+    monkeypatch.setattr(commands, "run", lambda query, log_dir, retry_policy: queries.append(query))
+
+    get("AET", "20171001", server_address="127.0.0.1", move_port=11112, output_dir="out")
+    get(
+        "AET", "20171001", server_address="127.0.0.1", move_port=11112, output_dir="out",
+        retrieve_method="C-GET",
+    )
+    assert queries[0].startswith("movescu ") and "--port 11112" in queries[0]
+    # C-GET receives the images on the association of the request
+    assert queries[1].startswith("getscu ")
+    assert "--port" not in queries[1] and "-aem" not in queries[1]
+    assert queries[1].endswith("-od out")
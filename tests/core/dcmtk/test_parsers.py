@@ -0,0 +1,155 @@
+# Copyright 2018-2024 Lausanne University Hospital and University of Lausanne,
+# Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the functions of the `pacsifier.core.dcmtk.parsers` module."""
+
+import os
+
+from pacsifier.core.dcmtk.parsers import (
+    classify_dcmtk_output,
+    classify_dimse_status,
+    parse_findscu_dump_file,
+    parse_findscu_output,
+    parse_storescu_output,
+    readLineByLine,
+)
+from pacsifier.core.records import SERIES_RECORD_KEYWORDS
+
+
+FINDSCU_RESPONSE = [
+    "I: ---------------------------",
+    "I: Find Response: {} (Pending)",
+    "I: ",
+    "I: # Dicom-Data-Set",
+    "I: (0008,0020) DA [20171001]                              #   8, 1 StudyDate",
+    "I: (0008,0060) CS [MR]                                    #   2, 1 Modality",
+    "I: (0008,103e) LO [t1 mprage/sag]                         #  14, 1 SeriesDescription",
+    "I: (0008,1110) SQ (Sequence with explicit length #=1)     #  20, 1 ReferencedStudySequence",
+    "I:   (fffe,e000) na (Item with explicit length #=1)       #  12, 1 Item",
+    "I:     (0020,000e) UI [1.2.3.4.5.6]                       #  12, 1 SeriesInstanceUID",
+    "I:   (fffe,e00d) na (ItemDelimitationItem for re-encoding) #   0, 0 ItemDelimitationItem",
+    "I: (0010,0010) PN (no value available)                    #   0, 0 PatientName",
+    "I: (0010,0020) LO [sub'01]                                #   6, 1 PatientID",
+    "I: (0020,000e) UI [1.2.3.4]                               #   8, 1 SeriesInstanceUID",
+]
+
+
+def test_parse_findscu_output(test_dir):
+    filename = os.path.join(
+        test_dir, "test_data", "dump", "findscu_dump_file_example.txt"
+    )
+    records = parse_findscu_output(readLineByLine(filename))
+    assert records == parse_findscu_dump_file(filename)
+    assert len(records) == 2
+
+    request = [
+        "I: Request Identifiers:",
+        "I: (0020,000e) UI [this.is.the.request]",
+    ]
+    records = parse_findscu_output(
+        request + FINDSCU_RESPONSE * 2 + ["I: Releasing Association"]
+    )
+    assert len(records) == 2
+    for record in records:
+        assert set(SERIES_RECORD_KEYWORDS) <= set(record)
+        assert record["StudyDate"] == "20171001"
+        assert record["SeriesDescription"] == "t1mpragesag"
+        assert record["PatientName"] == ""
+        assert record["PatientID"] == "sub_01"
+        # The identifier nested in the sequence item is ignored
+        assert record["SeriesInstanceUID"] == "1.2.3.4"
+
+    records = parse_findscu_output(
+        FINDSCU_RESPONSE * 5000 + ["I: Releasing Association"]
+    )
+    assert len(records) == 5000
+
+    assert parse_findscu_output([]) == []
+
+
+def test_parse_storescu_output():
+    lines = [
+        "I: checking input files ...",
+        "I: Requesting Association",
+        "I: Sending file: /data/MR.1",
+        "D: Converting transfer syntax: Little Endian Explicit -> Little Endian Explicit",
+        "I: Received Store Response (Success)",
+        "I: Sending file: /data/MR.2",
+        "I: Received Store Response (Error: Out of Resources)",
+        "I: Sending file: /data/MR.3",
+        "E: Store Failed, file: /data/MR.3:",
+        "I: Releasing Association",
+    ]
+    assert parse_storescu_output(lines) == {
+        "/data/MR.1": True,
+        "/data/MR.2": False,
+        "/data/MR.3": False,
+    }
+    assert parse_storescu_output([]) == {}
+
+
+def test_classify_dimse_status():
+    assert classify_dimse_status(0x0000) is None
+    assert classify_dimse_status(0xFF00) is None
+    assert classify_dimse_status(0xB000) == ("partial", True, "")
+    assert classify_dimse_status(0xA702) == ("out_of_resources", True, "")
+    assert classify_dimse_status(0xA900) == ("request_failed", False, "")
+    assert classify_dimse_status(0xC001) == ("request_failed", False, "")
+
+
+def test_classify_dcmtk_output():
+    assert classify_dcmtk_output(0, ["I: Received Final Move Response (Success)"]) is None
+    assert classify_dcmtk_output(0, []) is None
+
+    def classify(returncode, lines):
+        failure = classify_dcmtk_output(returncode, lines)
+        return failure.kind, failure.transient
+
+    rejected = [
+        "F: Association Rejected:",
+        "F: Result: Rejected Transient, Source: Service Provider (Presentation Function)",
+        "F: Reason: Local Limit Exceeded",
+    ]
+    assert classify(1, rejected) == ("association_rejected", True)
+    rejected[1] = "F: Result: Rejected Permanent, Source: Service User"
+    assert classify(1, rejected) == ("association_rejected", False)
+    assert classify(70, [
+        "F: Association Request Failed: 0006:031b Failed to establish association",
+        "F: 0006:0317 Peer aborted Association (or never connected)",
+    ]) == ("association_failed", True)
+    assert classify(1, ["E: DIMSE Failed to receive message: 0006:0207 DIMSE No data available (timeout in non-blocking mode)"]) == ("timeout", True)
+    # Informational lines mentioning a timeout are ignored
+    assert classify_dcmtk_output(0, ["D: ACSE timeout: 30"]) is None
+
+    # Status of the last response
+    assert classify(0, [
+        "I: Received Final Move Response (Warning)",
+        "D: DIMSE Status                  : 0xb000: Warning",
+        "D: Number of Failed Suboperations : 3",
+    ]) == ("partial", True)
+    assert classify(0, ["I: Received Final Move Response (Refused: OutOfResourcesSubOperations)"]) == (
+        "out_of_resources", True
+    )
+    assert classify(0, ["I: Received Final Find Response (Failed: IdentifierDoesNotMatchSOPClass)"]) == (
+        "request_failed", False
+    )
+    assert classify(0, ["D: Number of Failed Suboperations : 2"]) == ("partial", True)
+    assert classify_dcmtk_output(0, ["D: Number of Failed Suboperations : 0"]) is None
+
+    # Return code only
+    assert classify(1, ["E: unknown option"]) == ("local_error", False)
+    assert classify(127, []) == ("local_error", False)
+    assert classify(60, []) == ("association_failed", True)
+    assert classify(-9, []) == ("unknown", True)
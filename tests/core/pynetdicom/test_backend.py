@@ -0,0 +1,181 @@
+# Copyright 2018-2024 Lausanne University Hospital and University of Lausanne,
+# Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the functions of the `pacsifier.core.pynetdicom.backend` module."""
+
+import json
+import os
+import shutil
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("pynetdicom")
+
+from pacsifier.core.backend import get_backend
+from pacsifier.core.pynetdicom.backend import MAX_STORE_POOLS, PynetdicomBackend
+from pacsifier.core.retry import NO_RETRY, RetryPolicy
+
+
+@pytest.fixture
+def backend(test_dir):
+    config_path = os.path.join(test_dir, "config", "config.json")
+    with open(config_path) as f:
+        parameters = json.load(f)
+    parameters["backend"] = "pynetdicom"
+    with get_backend(parameters, log_dir=os.path.join(test_dir, "tmp", "logs")) as backend:
+        yield backend
+
+
+def test_invalid_inputs(backend, dummy_long_string):
+    with pytest.raises(ValueError):
+        backend.find(patient_id=dummy_long_string)
+
+    with pytest.raises(ValueError):
+        backend.find(query_retrieval_level="California")
+
+    with pytest.raises(ValueError):
+        backend.get("", "PAT004", dummy_long_string, "", 11112, ".")
+
+    with pytest.raises(ValueError):
+        backend.move_remote("", "PAT004", "", "", dummy_long_string)
+
+
+def test_echo_find_get(backend, test_dir):
+    assert backend.echo()
+
+    series = backend.find(patient_id="PACSMAN1", study_date="20231016")
+    assert len(series) == 1
+    assert series[0]["PatientID"] == "PACSMAN1"
+    assert (
+        backend.count_instances(
+            "PACSMAN1", series[0]["StudyInstanceUID"], series[0]["SeriesInstanceUID"]
+        )
+        == 128
+    )
+
+    output_dir = os.path.join(test_dir, "tmp", "pynetdicom", "series")
+    os.makedirs(output_dir, exist_ok=True)
+    assert backend.get(
+        "20231016",
+        "PACSMAN1",
+        series[0]["StudyInstanceUID"],
+        series[0]["SeriesInstanceUID"],
+        move_port=11112,
+        output_dir=output_dir,
+    )
+    filenames = os.listdir(output_dir)
+    assert len(filenames) == 128
+    assert all(filename.startswith("MR.") for filename in filenames)
+
+
+def test_upload_results(backend, test_dir):
+    dicom_dir = os.path.join(test_dir, "test_data", "dicomseries")
+    results = backend.upload_results(dicom_dir)
+    assert len(results) == 128
+    assert all(results.values())
+
+    # The association negotiated for the first upload is reused
+    assert backend.upload(dicom_dir)
+    assert [pool.opened for pool in backend._store_pools.values()] == [1]
+
+
+def test_store_pools(backend):
+    mr, ct = "1.2.840.10008.5.1.4.1.1.4", "1.2.840.10008.5.1.4.1.1.2"
+    explicit, implicit = "1.2.840.10008.1.2.1", "1.2.840.10008.1.2"
+
+    # A pool negotiating more presentation contexts is reused
+    pool = backend._store_pool({mr: {explicit, implicit}, ct: {explicit}})
+    assert backend._store_pool({mr: {implicit}}) is pool
+    assert backend._store_pool({ct: {explicit}}) is pool
+    other = backend._store_pool({ct: {implicit}})
+    assert other is not pool
+
+    # The least recently used pool is closed once too many are open
+    for i in range(MAX_STORE_POOLS - 2):
+        backend._store_pool({f"1.2.3.{i}": {explicit}})
+    assert backend._store_pool({mr: {explicit}}) is pool
+    backend._store_pool({"1.2.3.4.5": {explicit}})
+    assert len(backend._store_pools) == MAX_STORE_POOLS
+    assert pool in backend._store_pools.values()
+    assert other not in backend._store_pools.values()
+
+
+def test_get_c_get(test_dir):
+    config_path = os.path.join(test_dir, "config", "config.json")
+    with open(config_path) as f:
+        parameters = json.load(f)
+    parameters["backend"] = "pynetdicom"
+    parameters["retrieve_method"] = "C-GET"
+    log_dir = os.path.join(test_dir, "tmp", "logs")
+    with get_backend(parameters, log_dir=log_dir) as backend:
+        assert backend.shares_receive_port
+        series = backend.find(patient_id="PACSMAN1", study_date="20231016")
+
+        output_dir = os.path.join(test_dir, "tmp", "pynetdicom", "series_c_get")
+        shutil.rmtree(output_dir, ignore_errors=True)
+        assert backend.get_sorted(
+            "20231016",
+            "PACSMAN1",
+            series[0]["StudyInstanceUID"],
+            series[0]["SeriesInstanceUID"],
+            move_port=11112,
+            output_dir=output_dir,
+            series_dirs={series[0]["SeriesInstanceUID"]: output_dir},
+        )
+        assert len(os.listdir(output_dir)) == 128
+        # The images are received on the association of the request
+        assert not backend._receiver._servers
+
+
+class LostAssociationPool:
+    """Pool handing out associations lost during the request, or none if ``refuse`` is set."""
+
+    def __init__(self, refuse=False):
+        self.refuse = refuse
+        self.acquired = 0
+
+    @contextmanager
+    def acquire(self):
+        self.acquired += 1
+        yield None if self.refuse else SimpleNamespace(is_established=True)
+
+    def close(self):
+        pass
+
+
+def test_request_retries(test_dir):
+    def send(assoc):
+        assoc.is_established = False
+        return "partial"
+
+    log_dir = os.path.join(test_dir, "tmp", "logs")
+    backend = PynetdicomBackend(
+        "127.0.0.1", 4242, "SERVER", "PACSIFIER", log_dir=log_dir, retry_policy=RetryPolicy(2, 0)
+    )
+    pool = LostAssociationPool()
+    assert backend._request(send, "default", pool=pool) == "partial"
+    assert pool.acquired == 3
+
+    pool = LostAssociationPool(refuse=True)
+    assert backend._request(send, "default", pool=pool, retry_policy=NO_RETRY) == "default"
+    assert pool.acquired == 1
+
+    # The connectivity checks are not sent again
+    backend._pool = LostAssociationPool(refuse=True)
+    assert not backend.echo()
+    assert backend._pool.acquired == 1
+    backend.close()
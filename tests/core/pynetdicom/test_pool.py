@@ -0,0 +1,95 @@
+# Copyright 2018-2024 Lausanne University Hospital and University of Lausanne,
+# Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the functions of the `pacsifier.core.pynetdicom.pool` module."""
+
+import pytest
+from pydicom.dataset import Dataset
+
+pytest.importorskip("pynetdicom")
+
+from pacsifier.core.pynetdicom.pool import AssociationPool
+
+
+class DummyAssociation:
+    def __init__(self):
+        self.is_established = True
+        self.echoes = 0
+
+    def send_c_echo(self):
+        self.echoes += 1
+        status = Dataset()
+        status.Status = 0x0000
+        return status
+
+    def abort(self):
+        self.is_established = False
+
+    def release(self):
+        self.is_established = False
+
+
+class DummyAE:
+    def __init__(self):
+        self.associations = []
+
+    def associate(self, *args, **kwargs):
+        self.associations.append(DummyAssociation())
+        return self.associations[-1]
+
+
+def test_association_pool():
+    ae = DummyAE()
+    pool = AssociationPool(ae, "127.0.0.1", 4242, "SERVER", keepalive=30)
+
+    # Associations are reused across requests
+    with pool.acquire() as assoc:
+        first = assoc
+    with pool.acquire() as assoc:
+        assert assoc is first
+        # Concurrent requests get their own association
+        with pool.acquire() as other:
+            assert other is not first
+    assert pool.opened == 2
+
+    # Associations closed by the server are replaced
+    for assoc in ae.associations:
+        assoc.is_established = False
+    with pool.acquire() as assoc:
+        assert assoc.is_established
+    assert pool.opened == 3
+
+    # Idle associations are health-checked before being reused
+    pool.keepalive = 0
+    with pool.acquire() as assoc:
+        assert assoc.echoes == 1
+
+    # Associations used by a failed request are not reused
+    with pytest.raises(RuntimeError):
+        with pool.acquire() as assoc:
+            raise RuntimeError
+    assert not assoc.is_established
+
+    pool.close()
+    assert not any(assoc.is_established for assoc in ae.associations)
+
+
+def test_association_pool_close_during_request():
+    pool = AssociationPool(DummyAE(), "127.0.0.1", 4242, "SERVER")
+    with pool.acquire() as assoc:
+        pool.close()
+        assert assoc.is_established
+    # The association is released when handed back to the closed pool
+    assert not assoc.is_established
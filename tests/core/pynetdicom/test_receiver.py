@@ -0,0 +1,91 @@
+# Copyright 2018-2024 Lausanne University Hospital and University of Lausanne,
+# Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the functions of the `pacsifier.core.pynetdicom.receiver` module."""
+
+import os
+import shutil
+
+import pytest
+from pydicom import dcmread
+from pydicom.dataset import Dataset
+
+pytest.importorskip("pynetdicom")
+
+from pynetdicom import AE
+
+from pacsifier.core.pynetdicom.receiver import StorageReceiver
+
+RECEIVE_PORT = 11130
+
+
+def store(filenames, port=RECEIVE_PORT):
+    """Send files to the receiver and return the status of each C-STORE request."""
+    datasets = [dcmread(filename) for filename in filenames]
+    ae = AE(ae_title="PACS")
+    for dataset in datasets:
+        ae.add_requested_context(dataset.SOPClassUID, dataset.file_meta.TransferSyntaxUID)
+    assoc = ae.associate("127.0.0.1", port, ae_title="PACSIFIER_SCU")
+    assert assoc.is_established
+    statuses = [assoc.send_c_store(dataset).Status for dataset in datasets]
+    assoc.release()
+    return statuses
+
+
+def identifier(series_instance_uid):
+    identifier = Dataset()
+    identifier.QueryRetrieveLevel = "SERIES"
+    identifier.SeriesInstanceUID = series_instance_uid
+    return identifier
+
+
+def test_storage_receiver(test_dir):
+    filenames = [
+        os.path.join(test_dir, "test_data", "dicomseries", f"slice{i}.dcm") for i in range(3)
+    ]
+    series_instance_uid = dcmread(filenames[0]).SeriesInstanceUID
+    output_dir = os.path.join(test_dir, "tmp", "pynetdicom", "receiver")
+    shutil.rmtree(output_dir, ignore_errors=True)
+
+    receiver = StorageReceiver("PACSIFIER_SCU")
+    try:
+        receiver.listen(RECEIVE_PORT)
+        receiver.listen(RECEIVE_PORT)
+
+        # Images of a series which is not being retrieved are refused
+        assert store(filenames[:1]) == [0xA700]
+
+        # Images are filed into the folder of their retrieval, without temporary files
+        with receiver.route(identifier(series_instance_uid), directory=lambda header: output_dir):
+            with receiver.route(identifier("1.2.3"), directory=lambda header: "unused"):
+                assert store(filenames) == [0x0000] * 3
+            with pytest.raises(ValueError):
+                with receiver.route(identifier(series_instance_uid), handler=print):
+                    pass
+        filed = sorted(os.listdir(output_dir))
+        assert len(filed) == 3
+        assert all(filename.startswith("MR.") for filename in filed)
+        assert dcmread(os.path.join(output_dir, filed[0])).SeriesInstanceUID == series_instance_uid
+
+        # Datasets can be handed to a handler instead of being written
+        received = []
+        with receiver.route(identifier(series_instance_uid), handler=received.append):
+            assert store(filenames) == [0x0000] * 3
+        assert [dataset.SOPInstanceUID for dataset in received] == [
+            dcmread(filename).SOPInstanceUID for filename in filenames
+        ]
+        assert all(dataset.file_meta.TransferSyntaxUID for dataset in received)
+    finally:
+        receiver.close()
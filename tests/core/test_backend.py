@@ -0,0 +1,202 @@
+# Copyright 2018-2024 Lausanne University Hospital and University of Lausanne,
+# Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the functions of the `pacsifier.core.backend` module."""
+
+import json
+import os
+import shutil
+import pytest
+
+from pacsifier.core.backend import DicomBackend, get_backend, get_max_concurrent_moves
+from pacsifier.core.dcmtk import commands
+from pacsifier.core.dcmtk.backend import DcmtkBackend
+from pacsifier.core.retry import NO_RETRY
+from pacsifier.core.sources import MultiSourceBackend
+
+
+def test_get_backend(test_dir):
+    config_path = os.path.join(test_dir, "config", "config.json")
+    with open(config_path) as f:
+        parameters = json.load(f)
+    log_dir = os.path.join(test_dir, "tmp", "logs")
+
+    backend = get_backend(parameters, log_dir=log_dir)
+    assert isinstance(backend, DcmtkBackend)
+
+    with pytest.raises(ValueError):
+        get_backend({**parameters, "backend": "California Dreaming"}, log_dir=log_dir)
+
+    with pytest.raises(ValueError):
+        get_backend({**parameters, "AET": ""}, log_dir=log_dir)
+
+    backend = get_backend({**parameters, "retrieve_method": "C-GET"}, log_dir=log_dir)
+    assert backend.retrieve_method == "C-GET"
+    assert backend.shares_receive_port
+    with pytest.raises(ValueError):
+        get_backend({**parameters, "retrieve_method": "C-PUT"}, log_dir=log_dir)
+
+
+def test_get_backend_sources(test_dir):
+    config_path = os.path.join(test_dir, "config", "config.json")
+    with open(config_path) as f:
+        parameters = json.load(f)
+    log_dir = os.path.join(test_dir, "tmp", "logs")
+    parameters["max_concurrent_moves"] = 2
+    parameters["sources"] = [
+        {"server_address": "localhost", "port": 4445, "server_AET": "REPLICA1"},
+        {"server_address": "localhost", "port": 4446, "server_AET": "REPLICA2", "max_concurrent_moves": 3},
+    ]
+
+    backend = get_backend(parameters, log_dir=log_dir)
+    assert isinstance(backend, MultiSourceBackend)
+    assert [source.backend.port for source in backend.sources] == [4444, 4445, 4446]
+    assert backend.max_concurrent_moves == get_max_concurrent_moves(parameters) == 7
+
+
+def findscu_output(*responses):
+    """Return the output of findscu for responses given as lists of element lines."""
+    lines = ["I: Requesting Association"]
+    for response in responses:
+        lines += ["I: ---------------------------", "I: Find Response: 1 (Pending)"] + response
+    return lines + ["I: Releasing Association"]
+
+
+def test_count_instances(monkeypatch):
+    backend = DcmtkBackend("localhost", 4444, "SERVER", "PACSIFIER_SCU")
+    queries = []
+
+    def run(query, log_dir, retry_policy=None):
+        queries.append(query)
+        if "QueryRetrieveLevel=SERIES" in query:
+            return findscu_output(["I: (0020,1209) IS [12]    #   2, 1 NumberOfSeriesRelatedInstances"])
+        return findscu_output(*[["I: (0020,000e) UI [1.2.3]"]] * 3)
+
+    monkeypatch.setattr(commands, "run", run)
+    assert backend.count_instances("PAT004", "1.2", "1.2.3") == 12
+    assert "--key 20,1209" in queries[0]
+
+    # Without NumberOfSeriesRelatedInstances, the instances are counted one by one
+    monkeypatch.setattr(
+        commands,
+        "run",
+        lambda query, log_dir, retry_policy: run(query.replace("QueryRetrieveLevel=SERIES", ""), log_dir),
+    )
+    assert backend.count_instances("PAT004", "1.2", "1.2.3") == 3
+
+
+def test_echo_not_retried(monkeypatch):
+    backend = DcmtkBackend("localhost", 4444, "SERVER", "PACSIFIER_SCU")
+    policies = []
+
+    def run(query, log_dir, retry_policy=None):
+        policies.append(retry_policy)
+        return ""
+
+    monkeypatch.setattr(commands, "run", run)
+    assert not backend.echo()
+    assert policies == [NO_RETRY]
+
+
+def test_find_failed(monkeypatch):
+    backend = DcmtkBackend("localhost", 4444, "SERVER", "PACSIFIER_SCU")
+    # The output of a failed command is empty
+    monkeypatch.setattr(commands, "run", lambda query, log_dir, retry_policy: "")
+    assert backend.find(patient_id="PAT004") == []
+    assert backend.count_instances("PAT004", "1.2", "1.2.3") == 0
+
+    backend.raise_on_failure = True
+    with pytest.raises(ConnectionError):
+        backend.find(patient_id="PAT004")
+    with pytest.raises(ConnectionError):
+        backend.count_instances("PAT004", "1.2", "1.2.3")
+
+
+def test_upload_results_batches(monkeypatch):
+    backend = DcmtkBackend("localhost", 4444, "SERVER", "PACSIFIER_SCU")
+    queries = []
+
+    def run(query, log_dir, retry_policy=None):
+        queries.append(query)
+        # The second batch fails
+        if len(queries) == 2:
+            return ""
+        filenames = query.split('"')[5::2] or ["/data/series/MR.000"]
+        return [
+            line
+            for filename in filenames
+            for line in [f"D: Sending file: {filename}", "I: Received Store Response (Success)"]
+        ]
+
+    monkeypatch.setattr(commands, "run", run)
+    filenames = [f"/data/series/{'MR' * 1000}.{i:03}" for i in range(10)]
+    results = backend.upload_results("/data/series", filenames=filenames)
+
+    # The files are listed on several command lines of bounded length
+    assert [query.count(" \"/data/series/") for query in queries] == [3, 3, 3, 1]
+    assert all(len(query) < 10000 for query in queries)
+    assert results == {filename: not 3 <= i < 6 for i, filename in enumerate(filenames)}
+
+    # Without a list of files, storescu scans the directory
+    queries.clear()
+    assert backend.upload_results("/data/series") == {"/data/series/MR.000": True}
+    assert "--scan-directories /data/series" in queries[0]
+
+
+class CopyBackend(DicomBackend):
+    """Backend "retrieving" the files of a folder by copying them."""
+
+    def __init__(self, dicom_dir):
+        super().__init__("localhost", 4444, "SERVER", "PACSIFIER_SCU")
+        self.dicom_dir = dicom_dir
+        self.output_dirs = []
+
+    def get(self, study_date, patient_id, study_instance_uid, series_instance_uid,
+            move_port, output_dir, retrieve_level="SERIES"):
+        self.output_dirs.append(output_dir)
+        for filename in os.listdir(self.dicom_dir)[:3]:
+            shutil.copy(os.path.join(self.dicom_dir, filename), output_dir)
+        return True
+
+
+def test_get_sorted(test_dir):
+    backend = CopyBackend(os.path.join(test_dir, "test_data", "dicomseries"))
+    output_dir = os.path.join(test_dir, "tmp", "get_sorted")
+    shutil.rmtree(output_dir, ignore_errors=True)
+    series_dir = os.path.join(output_dir, "series")
+
+    # A series is retrieved directly into its folder
+    assert backend.get_sorted("", "PAT", "1.2", "1.2.3", 11112, output_dir, {"1.2.3": series_dir})
+    assert backend.output_dirs == [series_dir]
+    assert len(os.listdir(series_dir)) == 3
+
+    # A study is retrieved in a staging folder, then sorted using the headers
+    shutil.rmtree(output_dir)
+    assert backend.get_sorted(
+        "", "PAT", "1.2", "", 11112, output_dir, {}, retrieve_level="STUDY"
+    )
+    staging_dir = backend.output_dirs[-1]
+    assert os.path.dirname(staging_dir) == os.path.join(output_dir, "staging")
+    assert os.path.basename(staging_dir).startswith("STUDY-1_2-")
+    assert not os.listdir(os.path.join(output_dir, "staging"))
+    sub_dirs = [name for name in os.listdir(output_dir) if name.startswith("sub-")]
+    assert len(sub_dirs) == 1
+
+    # Retrievals of the same study do not share their staging folder
+    assert backend.get_sorted(
+        "", "PAT", "1.2", "", 11112, output_dir, {}, retrieve_level="STUDY"
+    )
+    assert backend.output_dirs[-1] != staging_dir
+    assert os.path.basename(backend.output_dirs[-1]).startswith("STUDY-1_2-")
@@ -0,0 +1,102 @@
+# Copyright 2018-2024 Lausanne University Hospital and University of Lausanne,
+# Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the functions of the `pacsifier.core.cache` module."""
+
+import os
+import shutil
+import time
+
+import pytest
+
+from pacsifier.core.backend import DicomBackend
+from pacsifier.core.cache import (
+    CACHE_FILENAME,
+    QueryCache,
+    clear_query_cache,
+    normalize_query,
+)
+
+
+class CountingBackend(DicomBackend):
+    """Backend counting its C-FIND requests."""
+
+    def __init__(self, port=4444):
+        super().__init__("localhost", port, "SERVER", "PACSIFIER_SCU")
+        self.finds = 0
+
+    def find(self, query_retrieval_level="SERIES", **query_attributes):
+        self.finds += 1
+        if query_attributes.get("patient_id") == "UNKNOWN":
+            return []
+        return [{"PatientID": query_attributes.get("patient_id", ""), "SeriesNumber": "1"}]
+
+
+def test_normalize_query():
+    assert normalize_query(
+        "SERVER@localhost:4444",
+        "SERIES",
+        {"patient_id": " 01 ", "study_date": "20171001-20171001", "modality": ""},
+    ) == {
+        "server": "SERVER@localhost:4444",
+        "query_retrieval_level": "SERIES",
+        "patient_id": "01",
+        "study_date": "20171001",
+    }
+
+
+def test_query_cache(test_dir):
+    cache_dir = os.path.join(test_dir, "tmp", "query_cache")
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    backend = CountingBackend()
+
+    assert QueryCache.from_parameters({}) is None
+    with QueryCache.from_parameters({"query_cache_ttl": 60, "query_cache_dir": cache_dir}) as cache:
+        # The cached results are only readable by their owner
+        if os.name == "posix":
+            assert os.stat(cache_dir).st_mode & 0o777 == 0o700
+            assert os.stat(cache.path).st_mode & 0o777 == 0o600
+
+        series = cache.find(backend, patient_id="01", study_date="20171001")
+        assert series == [{"PatientID": "01", "SeriesNumber": "1"}]
+
+        # Equivalent requests are answered from the cache
+        assert cache.find(backend, patient_id="01 ", study_date="20171001-20171001", modality="") == series
+        assert backend.finds == 1
+        assert (cache.hits, cache.misses) == (1, 1)
+
+        # Other levels, servers and requests without match are not
+        cache.find(backend, "IMAGE", patient_id="01", study_date="20171001")
+        cache.find(CountingBackend(4445), patient_id="01", study_date="20171001")
+        cache.find(backend, patient_id="UNKNOWN")
+        cache.find(backend, patient_id="UNKNOWN")
+        assert backend.finds == 4
+
+    # The cache is kept between runs until its results expire
+    with QueryCache(os.path.join(cache_dir, CACHE_FILENAME), ttl=60) as cache:
+        cache.find(backend, patient_id="01", study_date="20171001")
+        assert backend.finds == 4
+    with QueryCache(os.path.join(cache_dir, CACHE_FILENAME), ttl=0.1) as cache:
+        time.sleep(0.2)
+        cache.find(backend, patient_id="01", study_date="20171001")
+        assert backend.finds == 5
+        # The other results expired and are removed
+        assert cache.purge() == 2
+
+    assert clear_query_cache(cache_dir) == 1
+    assert clear_query_cache(os.path.join(cache_dir, "missing")) == 0
+
+    with pytest.raises(ValueError):
+        QueryCache(os.path.join(cache_dir, CACHE_FILENAME), ttl=-1)
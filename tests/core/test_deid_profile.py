@@ -0,0 +1,188 @@
+# Copyright 2018-2024 Lausanne University Hospital and University of Lausanne,
+# Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the functions of the `pacsifier.core.deid_profile` module."""
+
+import pytest
+from pydicom.dataset import Dataset
+from pydicom.sequence import Sequence
+
+from pacsifier.core.deid_profile import (
+    BLANK,
+    HASH_UID,
+    OPTIONS,
+    PROFILES,
+    REMOVE,
+    REPLACE,
+    SHIFT_DATE,
+    CompiledProfile,
+    DeidContext,
+    get_profile,
+    shift_date,
+)
+from pacsifier.core.uid_mapper import UIDMapper
+
+# New UID of a UID, for the tests not checking the UIDs
+uid_mapper = UIDMapper("secret")
+
+
+def make_dataset() -> Dataset:
+    dataset = Dataset()
+    dataset.PatientID = "1234"
+    dataset.PatientName = "Doe^John"
+    dataset.InstitutionName = "Hospital"
+    dataset.StudyDate = "20200101"
+    dataset.AcquisitionDateTime = "20200102120000"
+    dataset.StudyInstanceUID = "1.2.3"
+    dataset.ReferringPhysicianName = "Doe^Jane"
+    item = Dataset()
+    item.ReferencedSOPInstanceUID = "1.2.3.4"
+    item.ReferringPhysicianName = "Doe^Jane"
+    dataset.ReferencedImageSequence = Sequence([item])
+    request = Dataset()
+    request.StudyInstanceUID = "1.2.3"
+    request.RequestedProcedureID = "REQ1"
+    reference = Dataset()
+    reference.ReferencedSOPClassUID = "1.2.840.10008.3.1.2.3.1"
+    reference.ReferencedSOPInstanceUID = "1.2.3.5"
+    request.ReferencedStudySequence = Sequence([reference])
+    dataset.RequestAttributesSequence = Sequence([request])
+    dataset.SOPClassUID = "1.2.840.10008.5.1.4.1.1.4"
+    # UI attribute without rule, replaced as any other UID
+    dataset.FailedSOPInstanceUIDList = ["1.2.3.6", "1.2.3.7"]
+    dataset.add_new(0x00091010, "LO", "private")
+    return dataset
+
+
+def test_shift_date():
+    assert shift_date("20200101", -1) == "20191231"
+    assert shift_date("20200101120000.5", 31) == "20200201120000.5"
+    assert shift_date("", 10) == ""
+    assert shift_date("2020", 10) == ""
+
+
+@pytest.mark.parametrize("name", sorted(PROFILES))
+def test_profiles_compile(name):
+    assert get_profile(name, tuple(sorted(OPTIONS))).actions
+    assert get_profile(name) is get_profile(name)
+
+
+def test_compile_errors():
+    with pytest.raises(ValueError):
+        CompiledProfile({"NotAKeyword": BLANK})
+    with pytest.raises(ValueError):
+        CompiledProfile({"PatientName": "scramble"})
+    with pytest.raises(ValueError):
+        CompiledProfile({"PatientName": REPLACE})
+    with pytest.raises(ValueError):
+        get_profile("unknown")
+    with pytest.raises(ValueError):
+        get_profile("pacsifier", ("unknown",))
+
+
+def test_apply_actions():
+    profile = CompiledProfile(
+        {
+            "PatientID": (REPLACE, "{patient_id}"),
+            "InstitutionName": REMOVE,
+            "StudyDate": SHIFT_DATE,
+            "AcquisitionDateTime": SHIFT_DATE,
+            "StudyInstanceUID": HASH_UID,
+            "ReferencedSOPInstanceUID": HASH_UID,
+            "ReferringPhysicianName": BLANK,
+            "private": REMOVE,
+        }
+    )
+    dataset = make_dataset()
+    profile.apply(
+        dataset,
+        DeidContext(fields={"patient_id": "000001"}, uid_mapper=uid_mapper, date_shift=-1),
+    )
+
+    assert dataset.PatientID == "000001"
+    assert dataset.PatientName == "Doe^John"
+    assert "InstitutionName" not in dataset
+    assert dataset.StudyDate == "20191231"
+    assert dataset.AcquisitionDateTime == "20200101120000"
+    assert dataset.StudyInstanceUID == uid_mapper("1.2.3")
+    assert dataset.ReferringPhysicianName == ""
+    assert 0x00091010 not in dataset
+    # The attributes of the sequences are de-identified too
+    item = dataset.ReferencedImageSequence[0]
+    assert item.ReferencedSOPInstanceUID == uid_mapper("1.2.3.4")
+    assert item.ReferringPhysicianName == ""
+
+
+def test_apply_keeps_dates_without_shift():
+    profile = CompiledProfile({"StudyDate": SHIFT_DATE})
+    dataset = make_dataset()
+    profile.apply(dataset, DeidContext(fields={}, uid_mapper=uid_mapper))
+    assert dataset.StudyDate == "20200101"
+
+
+def test_pacsifier_profile():
+    dataset = make_dataset()
+    get_profile().apply(
+        dataset,
+        DeidContext(fields={"patient_id": "000001"}, uid_mapper=lambda uid: uid + ".1"),
+    )
+    assert dataset.PatientID == "000001"
+    assert dataset.PatientName == "000001^sub"
+    assert dataset.InstitutionName == ""
+    assert dataset.StudyInstanceUID == "1.2.3.1"
+    assert dataset.ReferencedImageSequence[0].ReferencedSOPInstanceUID == "1.2.3.4.1"
+    assert dataset.ReferencedImageSequence[0].ReferringPhysicianName == ""
+    # The references are kept, with their UIDs replaced
+    item = dataset.RequestAttributesSequence[0]
+    assert item.StudyInstanceUID == "1.2.3.1"
+    assert item.ReferencedStudySequence[0].ReferencedSOPClassUID == "1.2.840.10008.3.1.2.3.1"
+    assert item.ReferencedStudySequence[0].ReferencedSOPInstanceUID == "1.2.3.5.1"
+    assert item.RequestedProcedureID == ""
+    assert dataset.SOPClassUID == "1.2.840.10008.5.1.4.1.1.4"
+    assert dataset.FailedSOPInstanceUIDList == ["1.2.3.6.1", "1.2.3.7.1"]
+    assert 0x00091010 in dataset
+
+    dataset = make_dataset()
+    get_profile(remove_private_tags=True).apply(
+        dataset, DeidContext(fields={"patient_id": "1"}, uid_mapper=uid_mapper)
+    )
+    assert 0x00091010 not in dataset
+
+
+def test_basic_profile_options():
+    dataset = make_dataset()
+    get_profile("basic").apply(
+        dataset, DeidContext(fields={"patient_id": "1"}, uid_mapper=uid_mapper, date_shift=2)
+    )
+    assert "InstitutionName" not in dataset
+    assert dataset.StudyDate == ""
+    assert 0x00091010 not in dataset
+
+    dataset = make_dataset()
+    profile = get_profile(
+        "basic", ("retain_longitudinal_modified_dates", "retain_institution_identity")
+    )
+    profile.apply(
+        dataset, DeidContext(fields={"patient_id": "1"}, uid_mapper=uid_mapper, date_shift=2)
+    )
+    assert dataset.InstitutionName == "Hospital"
+    assert dataset.StudyDate == "20200103"
+
+    dataset = make_dataset()
+    get_profile("basic", ("retain_uids",)).apply(
+        dataset, DeidContext(fields={"patient_id": "1"}, uid_mapper=uid_mapper)
+    )
+    assert dataset.StudyInstanceUID == "1.2.3"
+    assert dataset.FailedSOPInstanceUIDList == ["1.2.3.6", "1.2.3.7"]
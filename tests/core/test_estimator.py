@@ -0,0 +1,83 @@
+# Copyright 2018-2024 Lausanne University Hospital and University of Lausanne,
+# Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the functions of the `pacsifier.core.estimator` module."""
+
+import os
+
+import pytest
+
+from pacsifier.core.estimator import (
+    DEFAULT_INSTANCE_SIZES,
+    DEFAULT_INSTANCES_PER_SECOND,
+    RetrievalEstimate,
+    ThroughputHistory,
+    format_duration,
+    format_estimate,
+)
+
+SERVER = "SERVER@localhost:4444"
+
+
+def test_throughput_history(test_dir):
+    path = os.path.join(test_dir, "tmp", "estimator", "throughput.json")
+    if os.path.exists(path):
+        os.remove(path)
+
+    history = ThroughputHistory(path, max_runs=2)
+    assert history.instances_per_second(SERVER) is None
+    assert history.instance_size(SERVER, "CT") == DEFAULT_INSTANCE_SIZES["CT"]
+
+    # Runs without retrieved instance are not recorded
+    history.record(SERVER, 10.0, {})
+    assert not os.path.exists(path)
+
+    history.record(SERVER, 10.0, {"MR": (100, 1000)})
+    history.record(SERVER, 10.0, {"MR": (200, 4000), "OT": (100, 500)})
+    history = ThroughputHistory(path, max_runs=2)
+    assert history.instances_per_second(SERVER) == 20.0
+    assert history.instance_size(SERVER, "MR") == 5000 / 300
+    # Unknown modalities without measure use the size of all the modalities
+    assert history.instance_size(SERVER, "XA") == 5500 / 400
+    assert history.instances_per_second("OTHER@localhost:104") is None
+
+    # Only the last runs are kept
+    history.record(SERVER, 20.0, {"MR": (100, 1000)})
+    assert history.instances_per_second(SERVER) == 400 / 30
+
+    with pytest.raises(ValueError):
+        ThroughputHistory(path, max_runs=0)
+
+
+def test_retrieval_estimate(test_dir):
+    path = os.path.join(test_dir, "tmp", "estimator", "missing.json")
+    estimate = RetrievalEstimate(ThroughputHistory(path), SERVER)
+    estimate.add("PAT001", "CT", 100)
+    estimate.add("PAT001", "CT", 100)
+    estimate.add("PAT002", "CT", 200)
+
+    rows = estimate.rows()
+    assert [row["PatientID"] for row in rows] == ["PAT001", "PAT002", "Total"]
+    assert rows[-1]["Series"] == 3
+    assert rows[-1]["Instances"] == 400
+    assert rows[-1]["EstimatedGB"] == round(400 * DEFAULT_INSTANCE_SIZES["CT"] / 1e9, 3)
+    assert rows[-1]["EstimatedSeconds"] == round(400 / DEFAULT_INSTANCES_PER_SECOND)
+    assert "No previous run" in format_estimate(estimate)
+
+
+def test_format_duration():
+    assert format_duration(12) == "12s"
+    assert format_duration(600) == "10m"
+    assert format_duration(7500) == "2h05m"
@@ -0,0 +1,72 @@
+# Copyright 2018-2024 Lausanne University Hospital and University of Lausanne,
+# Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the functions of the `pacsifier.core.journal` module."""
+
+import os
+import shutil
+
+from pacsifier.core.journal import (
+    COMPLETE,
+    FAILED,
+    QUERIED,
+    RetrievalJournal,
+)
+
+
+def test_retrieval_journal(test_dir):
+    journal_dir = os.path.join(test_dir, "tmp", "journal")
+    shutil.rmtree(journal_dir, ignore_errors=True)
+    journal_path = os.path.join(journal_dir, "logs", "journal.sqlite")
+    series_dir = os.path.join(journal_dir, "sub-01", "ses-01", "00001-T1")
+
+    query = {"PatientID": "01", "StudyDate": "20171001"}
+    key = RetrievalJournal.query_key(query)
+    assert key == RetrievalJournal.query_key(dict(reversed(list(query.items()))))
+
+    with RetrievalJournal(journal_path) as journal:
+        assert journal.get_query(key) is None
+        journal.record_query(key, query, [{"SeriesInstanceUID": "1.2.3"}])
+        assert journal.get_query(key) == [{"SeriesInstanceUID": "1.2.3"}]
+
+        journal.set_series("1.2.3", series_dir, QUERIED)
+        assert journal.get_series("1.2.3", series_dir) == (QUERIED, None)
+        assert not journal.is_complete("1.2.3", series_dir)
+
+        def get(output_dir):
+            os.makedirs(output_dir, exist_ok=True)
+            for i in range(3):
+                open(os.path.join(output_dir, f"MR.{i}"), "w").close()
+            return True
+
+        assert journal.track(get, {"1.2.3": series_dir})(output_dir=series_dir)
+        assert journal.get_series("1.2.3", series_dir) == (COMPLETE, 3)
+
+        assert not journal.track(lambda: False, {"1.2.4": "REMOTE_AET"}, count_files=False)()
+        assert journal.get_series("1.2.4", "REMOTE_AET") == (FAILED, None)
+
+    # The journal is persistent
+    with RetrievalJournal(journal_path) as journal:
+        assert journal.get_query(key) is not None
+        assert journal.is_complete("1.2.3", series_dir)
+        assert not journal.is_complete("1.2.4", "REMOTE_AET")
+
+        # Partially deleted series must be retrieved again
+        os.remove(os.path.join(series_dir, "MR.0"))
+        assert not journal.is_complete("1.2.3", series_dir)
+
+    with RetrievalJournal(journal_path, reset=True) as journal:
+        assert journal.get_query(key) is None
+        assert journal.get_series("1.2.3", series_dir) == (None, None)
@@ -0,0 +1,78 @@
+# Copyright 2018-2024 Lausanne University Hospital and University of Lausanne,
+# Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the functions of the `pacsifier.core.ledger` module."""
+
+import hashlib
+import os
+import shutil
+
+from pacsifier.core.ledger import (
+    LEDGER_FILENAME,
+    UploadLedger,
+    file_digest,
+    read_sop_instance_uid,
+)
+
+
+def test_file_digest(test_dir):
+    tmp_dir = os.path.join(test_dir, "tmp", "ledger")
+    os.makedirs(tmp_dir, exist_ok=True)
+    filename = os.path.join(tmp_dir, "content.txt")
+    with open(filename, "wb") as f:
+        f.write(b"content")
+    assert file_digest(filename) == hashlib.sha1(b"content").hexdigest()
+    assert file_digest(filename, "sha256") == hashlib.sha256(b"content").hexdigest()
+
+
+def test_upload_ledger(test_dir):
+    tmp_dir = os.path.join(test_dir, "tmp", "ledger")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    filename = os.path.join(tmp_dir, "slice0.dcm")
+    shutil.copy(os.path.join(test_dir, "test_data", "dicomseries", "slice0.dcm"), filename)
+    with open(os.path.join(tmp_dir, "notes.txt"), "w") as f:
+        f.write("not a DICOM file")
+
+    sop_instance_uid = read_sop_instance_uid(filename)
+    assert sop_instance_uid
+    assert read_sop_instance_uid(os.path.join(tmp_dir, "notes.txt")) is None
+
+    path = os.path.join(tmp_dir, LEDGER_FILENAME)
+    destination = UploadLedger.destination_key("SCU_STORE", "localhost", 4444)
+    assert destination == "SCU_STORE@localhost:4444"
+    with UploadLedger(path) as ledger:
+        assert ledger.pending(destination, {filename: sop_instance_uid}) == {
+            filename: sop_instance_uid
+        }
+        ledger.record(destination, sop_instance_uid, filename)
+        assert ledger.get(destination, sop_instance_uid)[0] == file_digest(filename)
+        assert ledger.pending(destination, {filename: sop_instance_uid}) == {}
+        # Other destinations do not know the instance
+        assert not ledger.is_sent("OTHER@localhost:104", sop_instance_uid, filename)
+
+    # The ledger is kept between runs, changed files are sent again
+    with UploadLedger(path) as ledger:
+        assert ledger.is_sent(destination, sop_instance_uid, filename)
+        os.utime(filename, ns=(0, 0))
+        assert ledger.is_sent(destination, sop_instance_uid, filename)
+        # The new modification time of the unchanged file is recorded
+        assert ledger.get(destination, sop_instance_uid)[2] == 0
+        with open(filename, "ab") as f:
+            f.write(b"\x00\x00")
+        assert not ledger.is_sent(destination, sop_instance_uid, filename)
+
+    with UploadLedger(path, reset=True) as ledger:
+        assert ledger.get(destination, sop_instance_uid) is None
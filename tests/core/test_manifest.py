@@ -0,0 +1,89 @@
+# Copyright 2018-2024 Lausanne University Hospital and University of Lausanne,
+# Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the functions of the `pacsifier.core.manifest` module."""
+
+import hashlib
+import os
+import shutil
+
+from pacsifier.core.manifest import AnonymizationManifest, describe_input
+
+
+def write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(content)
+
+
+def test_describe_input(test_dir):
+    path = os.path.join(test_dir, "tmp", "manifest", "file")
+    write(path, b"content")
+    description = describe_input(path)
+    assert description["sha256"] == hashlib.sha256(b"content").hexdigest()
+    assert description["size"] == 7
+    assert description["mtime_ns"] == os.stat(path).st_mtime_ns
+
+
+def test_manifest(test_dir):
+    base_dir = os.path.join(test_dir, "tmp", "manifest")
+    shutil.rmtree(base_dir, ignore_errors=True)
+    datapath, output_folder = os.path.join(base_dir, "in"), os.path.join(base_dir, "out")
+    inputs = [os.path.join(datapath, "sub-1", "ses-1", "series", f"{i}.dcm") for i in range(3)]
+    outputs = [os.path.join(output_folder, "sub-1", "ses-1", "series", f"{i}.dcm") for i in range(3)]
+    for input_path, output_path in zip(inputs, outputs):
+        write(input_path, input_path.encode())
+        write(output_path, b"anonymized")
+
+    parameters = {"profile": "pacsifier"}
+    manifest = AnonymizationManifest(output_folder, datapath)
+    manifest.start(parameters)
+    manifest.add_patient("sub-1", "000001", 3)
+    assert not manifest.is_current(inputs[0])
+    manifest.add_files(
+        [{"input": path, "output": output, **describe_input(path)} for path, output in zip(inputs, outputs)]
+    )
+    manifest.move_outputs(
+        os.path.join(output_folder, "sub-1"), os.path.join(output_folder, "sub-000001")
+    )
+    os.rename(os.path.join(output_folder, "sub-1"), os.path.join(output_folder, "sub-000001"))
+    manifest.write()
+
+    # A new run reads the records of the previous ones
+    manifest = AnonymizationManifest(output_folder, datapath)
+    assert manifest.patients == {"sub-1": {"new_id": "000001", "date_offset": 3}}
+    assert manifest.files[os.path.join("sub-1", "ses-1", "series", "0.dcm")]["output"] == os.path.join(
+        "sub-000001", "ses-1", "series", "0.dcm"
+    )
+    manifest.start(parameters)
+    assert all(manifest.is_current(path) for path in inputs)
+
+    # Touched but not modified
+    os.utime(inputs[0], ns=(0, 0))
+    assert manifest.is_current(inputs[0])
+    # Modified
+    write(inputs[1], b"modified")
+    assert not manifest.is_current(inputs[1])
+    manifest.discard(inputs[1])
+    assert not os.path.exists(os.path.join(output_folder, "sub-000001", "ses-1", "series", "1.dcm"))
+    # Anonymized file deleted
+    os.remove(os.path.join(output_folder, "sub-000001", "ses-1", "series", "2.dcm"))
+    assert not manifest.is_current(inputs[2])
+
+    # Other parameters: all the files are anonymized again
+    manifest.start({"profile": "basic"})
+    assert not manifest.is_current(inputs[0])
+    assert not os.path.exists(os.path.join(output_folder, "sub-000001", "ses-1", "series", "0.dcm"))
+    assert manifest.patients == {"sub-1": {"new_id": "000001", "date_offset": 3}}
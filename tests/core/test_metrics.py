@@ -0,0 +1,125 @@
+# Copyright 2018-2024 Lausanne University Hospital and University of Lausanne,
+# Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the functions of the `pacsifier.core.metrics` module."""
+
+import os
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+import pytest
+
+from pacsifier.core.metrics import (
+    CONTENT_TYPE,
+    OPENMETRICS_CONTENT_TYPE,
+    REGISTRY,
+    REQUESTS,
+    HttpExporter,
+    MetricsExporters,
+    MetricsRegistry,
+    TextfileExporter,
+    observe_request,
+)
+
+
+def test_metrics_registry():
+    registry = MetricsRegistry()
+    requests = registry.counter("test_requests", "Requests.", ["operation"])
+    assert registry.counter("test_requests", "Requests.", ["operation"]) is requests
+    with pytest.raises(ValueError):
+        registry.gauge("test_requests", "Requests.")
+
+    requests.inc(operation="C-FIND")
+    requests.inc(2, operation="C-FIND")
+    assert requests.get(operation="C-FIND") == 3
+    with pytest.raises(ValueError):
+        requests.inc(-1, operation="C-FIND")
+    with pytest.raises(ValueError):
+        requests.inc(server="PACS")
+
+    depth = registry.gauge("test_queue_depth", "Queue depth.", ["queue"])
+    depth.set(4, queue="log")
+    depth.set_function(lambda: 7, queue="retrievals")
+    assert depth.get(queue="retrievals") == 7
+    depth.set_function(None, queue="retrievals")
+    assert depth.get(queue="retrievals") is None
+
+    latency = registry.histogram("test_seconds", "Latency.", ["operation"], buckets=[1.0, 10.0])
+    latency.observe(0.5, operation="C-MOVE")
+    latency.observe(5.0, operation="C-MOVE")
+    latency.observe(50.0, operation="C-MOVE")
+    assert latency.count(operation="C-MOVE") == 3
+    with pytest.raises(ValueError):
+        registry.histogram("test_unsorted", "Unsorted.", buckets=[10.0, 1.0])
+
+    lines = registry.render().splitlines()
+    assert lines[:3] == [
+        "# HELP test_requests_total Requests.",
+        "# TYPE test_requests_total counter",
+        'test_requests_total{operation="C-FIND"} 3',
+    ]
+    assert 'test_queue_depth{queue="log"} 4' in lines
+    assert 'test_seconds_bucket{operation="C-MOVE",le="1"} 1' in lines
+    assert 'test_seconds_bucket{operation="C-MOVE",le="10"} 2' in lines
+    assert 'test_seconds_bucket{operation="C-MOVE",le="+Inf"} 3' in lines
+    assert 'test_seconds_count{operation="C-MOVE"} 3' in lines
+    assert 'test_seconds_sum{operation="C-MOVE"} 55.5' in lines
+    assert "# EOF" not in lines
+
+    lines = registry.render(openmetrics=True).splitlines()
+    assert lines[:3] == [
+        "# TYPE test_requests counter",
+        "# HELP test_requests Requests.",
+        'test_requests_total{operation="C-FIND"} 3',
+    ]
+    assert lines[-1] == "# EOF"
+
+
+def test_exporters(test_dir):
+    observe_request("C-STORE", 0.2, False)
+    path = os.path.join(test_dir, "tmp", "metrics", "pacsifier.prom")
+
+    exporters = MetricsExporters.from_parameters(
+        {"metrics_textfile": path, "metrics_interval": 60}
+    )
+    assert isinstance(exporters.exporters[0], TextfileExporter)
+    REQUESTS.inc(operation="C-STORE", result="success")
+    exporters.close()
+    with open(path) as f:
+        metrics = f.read()
+    # The metrics are written a last time once closed
+    assert metrics == REGISTRY.render()
+    assert 'pacsifier_requests_total{operation="C-STORE",result="success"}' in metrics
+    assert not MetricsExporters.from_parameters({}).exporters
+
+    with pytest.raises(ValueError):
+        TextfileExporter(path, interval=0)
+
+    exporter = HttpExporter(0, address="127.0.0.1")
+    try:
+        with urlopen(f"http://127.0.0.1:{exporter.port}/metrics") as response:
+            assert response.headers["Content-Type"] == CONTENT_TYPE
+            assert 'operation="C-STORE",result="failure"' in response.read().decode("utf-8")
+        request = Request(
+            f"http://127.0.0.1:{exporter.port}/metrics",
+            headers={"Accept": "application/openmetrics-text; version=1.0.0,text/plain;q=0.5"},
+        )
+        with urlopen(request) as response:
+            assert response.headers["Content-Type"] == OPENMETRICS_CONTENT_TYPE
+            assert response.read().decode("utf-8").endswith("# EOF\n")
+        with pytest.raises(HTTPError):
+            urlopen(f"http://127.0.0.1:{exporter.port}/other")
+    finally:
+        exporter.close()
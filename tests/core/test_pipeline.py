@@ -0,0 +1,90 @@
+# Copyright 2018-2024 Lausanne University Hospital and University of Lausanne,
+# Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the functions of the `pacsifier.core.pipeline` module."""
+
+import threading
+import time
+
+import pytest
+
+from pacsifier.core.pipeline import BackgroundStage, prefetch
+
+
+def test_prefetch():
+    assert list(prefetch(range(5), maxsize=2)) == [0, 1, 2, 3, 4]
+
+    # The next item is produced while the caller processes the current one
+    def slow_items():
+        for i in range(3):
+            time.sleep(0.1)
+            yield i
+
+    start = time.monotonic()
+    for _ in prefetch(slow_items()):
+        time.sleep(0.1)
+    assert time.monotonic() - start < 0.55
+
+    # At most maxsize items are produced ahead of the caller
+    produced = []
+
+    def counted_items():
+        for i in range(10):
+            produced.append(i)
+            yield i
+
+    items = prefetch(counted_items(), maxsize=2)
+    next(items)
+    time.sleep(0.1)
+    assert len(produced) <= 4
+    items.close()
+
+    def failing_items():
+        yield 0
+        raise ValueError("Invalid row")
+
+    items = prefetch(failing_items())
+    assert next(items) == 0
+    with pytest.raises(ValueError):
+        next(items)
+
+
+def test_background_stage():
+    results = []
+    with BackgroundStage(results.append, maxsize=2) as stage:
+        for i in range(5):
+            stage.put(i)
+    assert results == [0, 1, 2, 3, 4]
+
+    # put() blocks while the queue is full
+    release = threading.Event()
+    stage = BackgroundStage(lambda item: release.wait(), maxsize=1)
+    stage.put(0)
+    stage.put(1)
+    blocked = threading.Thread(target=stage.put, args=(2,))
+    blocked.start()
+    blocked.join(timeout=0.1)
+    assert blocked.is_alive()
+    release.set()
+    blocked.join()
+    stage.close()
+
+    def fail(item):
+        raise RuntimeError("Cannot write log entry")
+
+    stage = BackgroundStage(fail)
+    stage.put(0)
+    with pytest.raises(RuntimeError):
+        stage.close()
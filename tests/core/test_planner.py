@@ -0,0 +1,95 @@
+# Copyright 2018-2024 Lausanne University Hospital and University of Lausanne,
+# Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the functions of the `pacsifier.core.planner` module."""
+
+from pacsifier.core.planner import (
+    covers,
+    format_plan_summary,
+    merge_date_ranges,
+    normalize_row,
+    plan_queries,
+)
+
+
+def make_row(**attributes):
+    row = {
+        "PatientID": "",
+        "StudyDate": "",
+        "StudyInstanceUID": "",
+        "SeriesInstanceUID": "",
+        "new_ids": "",
+    }
+    row.update(attributes)
+    return row
+
+
+def test_normalize_row():
+    row = normalize_row(make_row(PatientID=" 01 ", StudyDate="20171001-20171001"))
+    assert row["PatientID"] == "01"
+    assert row["StudyDate"] == "20171001"
+
+
+def test_merge_date_ranges():
+    assert merge_date_ranges(["20170105-20170110", "20170101-20170106"]) == [
+        "20170101-20170110"
+    ]
+    # Contiguous ranges are merged, disjoint ones are kept
+    assert merge_date_ranges(["20170101", "20170102", "20170201"]) == [
+        "20170101-20170102",
+        "20170201",
+    ]
+
+
+def test_covers():
+    study = make_row(PatientID="01", StudyInstanceUID="1.2.3")
+    series = make_row(PatientID="01", StudyInstanceUID="1.2.3", SeriesInstanceUID="1.2.3.4")
+    assert covers(study, series)
+    assert not covers(series, study)
+
+    assert covers(make_row(StudyDate="20170101-20171231"), make_row(StudyDate="20170601"))
+    assert not covers(make_row(StudyDate="20170101"), make_row(StudyDate="20170101-20170102"))
+
+    # Rows with different new ids are never redundant
+    assert not covers(study, dict(series, new_ids="sub-02"))
+
+
+def test_plan_queries():
+    rows = [
+        make_row(PatientID="01", StudyDate="20170101-20170110"),
+        make_row(PatientID="01", StudyDate="20170105-20170120"),
+        make_row(PatientID="01 ", StudyDate="20170101-20170110"),
+        make_row(PatientID="01", StudyDate="20170115", StudyInstanceUID="1.2.3"),
+        make_row(PatientID="02", StudyInstanceUID="1.2.4"),
+        make_row(PatientID="02", StudyInstanceUID="1.2.4", SeriesInstanceUID="1.2.4.5"),
+        make_row(PatientID="03", StudyDate="20170101"),
+        make_row(PatientID="03", StudyDate="20180101"),
+    ]
+    planned, summary = plan_queries(rows)
+    assert planned == [
+        make_row(PatientID="01", StudyDate="20170101-20170120"),
+        make_row(PatientID="02", StudyInstanceUID="1.2.4"),
+        make_row(PatientID="03", StudyDate="20170101"),
+        make_row(PatientID="03", StudyDate="20180101"),
+    ]
+    assert summary == {
+        "rows": 8,
+        "duplicates": 1,
+        "merged": 1,
+        "covered": 2,
+        "queries": 4,
+        "known_moves": 1,
+    }
+    assert format_plan_summary(summary).startswith("Query plan: 4 queries for 8 rows")
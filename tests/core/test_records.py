@@ -0,0 +1,39 @@
+# Copyright 2018-2024 Lausanne University Hospital and University of Lausanne,
+# Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the functions of the `pacsifier.core.records` module."""
+
+from pydicom.dataset import Dataset
+
+from pacsifier.core.records import dataset_to_series_record
+
+
+def test_dataset_to_series_record():
+    dataset = Dataset()
+    dataset.PatientID = "dummy id"
+    dataset.StudyDate = "20171001"
+    dataset.SeriesDescription = "4metas24Gy_PTV18Gy_68min - RTDOSE "
+    dataset.ImageType = ["ORIGINAL", "PRIMARY"]
+    dataset.SeriesNumber = None
+    dataset.AcquisitionDate = "20171001"
+
+    record = dataset_to_series_record(dataset)
+    assert record["PatientID"] == "dummyid"
+    assert record["StudyDate"] == "20171001"
+    assert record["SeriesDescription"] == "4metas24Gy_PTV18Gy_68min-RTDOSE"
+    assert record["ImageType"] == "ORIGINAL\\PRIMARY"
+    assert record["SeriesNumber"] == ""
+    assert record["AcquisitionDate"] == "20171001"
+    assert record["StudyInstanceUID"] == ""
@@ -0,0 +1,114 @@
+# Copyright 2018-2024 Lausanne University Hospital and University of Lausanne,
+# Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the functions of the `pacsifier.core.relay` module."""
+
+import threading
+import time
+
+import pytest
+from pydicom.dataset import Dataset
+
+from pacsifier.core.relay import Relay
+
+
+def make_dataset(series_instance_uid: str, number: int) -> Dataset:
+    dataset = Dataset()
+    dataset.SeriesInstanceUID = series_instance_uid
+    dataset.InstanceNumber = number
+    return dataset
+
+
+def test_relay():
+    stored = []
+
+    def transform(dataset):
+        # Identifiable datasets are discarded
+        if dataset.InstanceNumber == 3:
+            return None
+        dataset.SeriesInstanceUID = "2.2"
+        return dataset
+
+    def store(dataset):
+        if dataset.InstanceNumber == 4:
+            raise ConnectionError("Association aborted")
+        stored.append(dataset.InstanceNumber)
+        return dataset.InstanceNumber != 5
+
+    with Relay(transform, store) as relay:
+        for number in range(8):
+            relay.put(make_dataset("1.1", number))
+        relay.join()
+        assert stored == [0, 1, 2, 5, 6, 7]
+
+    # The datasets are counted with their key before the transformation
+    assert relay.forwarded == {"1.1": 5}
+    assert relay.discarded == {"1.1": 1}
+    assert relay.failed == {"1.1": 2}
+
+    with pytest.raises(ValueError):
+        Relay(transform, store, workers=0)
+
+
+def test_relay_bounded_queue():
+    release = threading.Event()
+
+    def store(dataset):
+        release.wait()
+        return True
+
+    relay = Relay(lambda dataset: dataset, store, queue_size=2)
+
+    # One dataset is being stored and two are waiting, the next put blocks
+    for number in range(3):
+        relay.put(make_dataset("1.1", number))
+    blocked = threading.Thread(target=relay.put, args=(make_dataset("1.1", 3),))
+    blocked.start()
+    time.sleep(0.1)
+    assert blocked.is_alive()
+
+    release.set()
+    blocked.join(timeout=1)
+    assert not blocked.is_alive()
+    relay.close()
+    assert relay.forwarded == {"1.1": 4}
+
+
+def test_relay_wait():
+    release = threading.Event()
+
+    def store(dataset):
+        # The datasets of series 1.1 are blocked
+        if dataset.SeriesInstanceUID == "1.1":
+            release.wait()
+        return True
+
+    relay = Relay(lambda dataset: dataset, store, workers=2)
+    assert relay.put(make_dataset("1.1", 0)) == "1.1"
+    relay.put(make_dataset("2.2", 0))
+
+    # Waiting for series 2.2 does not wait for the datasets of series 1.1
+    relay.wait(["2.2", "3.3"])
+    assert relay.forwarded == {"2.2": 1}
+    waiting = threading.Thread(target=relay.wait, args=(["1.1"],))
+    waiting.start()
+    time.sleep(0.1)
+    assert waiting.is_alive()
+
+    release.set()
+    waiting.join(timeout=1)
+    assert not waiting.is_alive()
+    assert relay.forwarded == {"1.1": 1, "2.2": 1}
+    relay.close()
@@ -0,0 +1,86 @@
+# Copyright 2018-2024 Lausanne University Hospital and University of Lausanne,
+# Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the functions of the `pacsifier.core.retry` module."""
+
+import os
+
+import pytest
+
+from pacsifier.core.retry import (
+    FAILURES_FILENAME,
+    REPLAYING_SUFFIX,
+    Failure,
+    FailureQueue,
+    RetryPolicy,
+    describe_failure,
+    find_failure_queues,
+)
+
+
+def test_retry_policy():
+    policy = RetryPolicy(max_retries=2, backoff=1, max_backoff=3)
+    transient, permanent = Failure("timeout", True), Failure("request_failed", False)
+    assert policy.should_retry(transient, 0)
+    assert policy.should_retry(transient, 1)
+    assert not policy.should_retry(transient, 2)
+    assert not policy.should_retry(permanent, 0)
+
+    for _ in range(100):
+        assert 0 <= policy.delay(0) <= 1
+        assert 0 <= policy.delay(1) <= 2
+        assert 0 <= policy.delay(5) <= 3
+
+    with pytest.raises(ValueError):
+        RetryPolicy(max_retries=-1)
+    with pytest.raises(ValueError):
+        RetryPolicy(backoff=-1)
+
+
+def test_retry_policy_from_parameters():
+    policy = RetryPolicy.from_parameters({"max_retries": 5, "retry_backoff": 0.5})
+    assert (policy.max_retries, policy.backoff, policy.max_backoff) == (5, 0.5, 60.0)
+    policy = RetryPolicy.from_parameters({})
+    assert (policy.max_retries, policy.backoff, policy.max_backoff) == (3, 2.0, 60.0)
+
+
+def test_failure_queue(tmp_path):
+    path = str(tmp_path / "logs" / FAILURES_FILENAME)
+    queue = FailureQueue(path)
+    assert queue.read() == []
+
+    queue.append({"command": "movescu 1", "kind": "timeout"})
+    queue.append({"command": "movescu 2", "kind": "partial"})
+    records = queue.read()
+    assert [record["command"] for record in records] == ["movescu 1", "movescu 2"]
+    assert "time" in records[0]
+
+    queue.rewrite(records[1:])
+    assert [record["command"] for record in queue.read()] == ["movescu 2"]
+    assert find_failure_queues(str(tmp_path)) == [path]
+
+    queue.rewrite([])
+    assert not os.path.exists(path)
+    assert find_failure_queues(str(tmp_path)) == []
+
+    # A queue whose replay was interrupted
+    FailureQueue(path + REPLAYING_SUFFIX).append({"command": "movescu 1", "kind": "timeout"})
+    assert find_failure_queues(str(tmp_path)) == [path]
+
+
+def test_describe_failure():
+    assert describe_failure(None) == "success"
+    assert describe_failure(Failure("timeout", True)) == "timeout (transient)"
+    assert describe_failure(Failure("local_error", False)) == "local_error (permanent)"
@@ -20,6 +20,7 @@ import pytest
 from pacsifier.core.sanity_checks import (
     check_config_parameters,
     check_query_retrieval_level,
+    check_retrieve_level,
     check_server_address,
     check_port,
     check_AET,
@@ -86,11 +87,79 @@ def test_check_config_parameters_invalid_values():
         })
 
 
+def test_check_config_parameters_concurrent_moves():
+    parameters = {
+        "server_address": "localhost",
+        "port": 4444,
+        "server_AET": "SCU_STORE",
+        "AET": "PACSIFIER_SCU",
+        "move_port": 11112,
+        "move_AET": "PACSIFIER_SCU",
+        "batch_size": 30,
+        "batch_wait_time": 10,
+        "max_concurrent_moves": 4,
+        "move_port_range": [11112, 11115],
+    }
+    check_config_parameters(parameters)
+
+    with pytest.raises(ValueError):
+        check_config_parameters({**parameters, "max_concurrent_moves": 0})
+
+    with pytest.raises(ValueError):
+        check_config_parameters({**parameters, "move_port_range": [11115, 11112]})
+
+    with pytest.raises(ValueError):
+        check_config_parameters({**parameters, "move_port_range": [11112]})
+
+    check_config_parameters({**parameters, "retrieve_level": "STUDY"})
+    check_config_parameters({**parameters, "retrieve_method": "C-GET"})
+    with pytest.raises(ValueError):
+        check_config_parameters({**parameters, "retrieve_method": "C-PUT"})
+    check_config_parameters({**parameters, "query_cache_ttl": 3600, "query_cache_dir": "/tmp/cache"})
+    with pytest.raises(ValueError):
+        check_config_parameters({**parameters, "query_cache_ttl": -1})
+    check_config_parameters(
+        {**parameters, "metrics_textfile": "/var/lib/node_exporter/pacsifier.prom", "metrics_port": 9477}
+    )
+    with pytest.raises(ValueError):
+        check_config_parameters({**parameters, "metrics_interval": 0})
+    check_config_parameters({**parameters, "max_moves_per_minute": 120})
+    check_config_parameters({**parameters, "max_concurrent_uploads": 4})
+    with pytest.raises(ValueError):
+        check_config_parameters({**parameters, "max_concurrent_uploads": 0})
+    with pytest.raises(ValueError):
+        check_config_parameters({**parameters, "max_moves_per_minute": 0})
+    with pytest.raises(ValueError):
+        check_config_parameters({**parameters, "retrieve_level": "IMAGE"})
+
+    source = {"server_address": "192.168.1.2", "port": 104, "server_AET": "REPLICA"}
+    check_config_parameters({**parameters, "sources": [source]})
+    check_config_parameters({**parameters, "sources": [{**source, "max_concurrent_moves": 2}]})
+    with pytest.raises(ValueError):
+        check_config_parameters({**parameters, "sources": [{**source, "port": 0}]})
+    with pytest.raises(ValueError):
+        check_config_parameters({**parameters, "sources": [{"server_address": "192.168.1.2"}]})
+
+    relay = {"server_address": "192.168.1.3", "port": 104, "server_AET": "RESEARCH"}
+    check_config_parameters({**parameters, "relay": relay})
+    check_config_parameters({**parameters, "relay": {**relay, "queue_size": 16, "workers": 2}})
+    with pytest.raises(ValueError):
+        check_config_parameters({**parameters, "relay": {**relay, "workers": 0}})
+    with pytest.raises(ValueError):
+        check_config_parameters({**parameters, "relay": {"server_address": "192.168.1.3"}})
+
+
 def test_check_query_retrieval_level():
     with pytest.raises(ValueError):
         check_query_retrieval_level({"Hello"})
 
 
+def test_check_retrieve_level():
+    check_retrieve_level("PATIENT")
+    with pytest.raises(ValueError):
+        check_retrieve_level("IMAGE")
+
+
 def test_sanity_checks():
     dummy_long_string = "aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa"
     with pytest.raises(ValueError):
@@ -0,0 +1,61 @@
+# Copyright 2018-2024 Lausanne University Hospital and University of Lausanne,
+# Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the functions of the `pacsifier.core.scheduler` module."""
+
+import threading
+import time
+import pytest
+
+from pacsifier.core.scheduler import PortPool, RetrievalScheduler
+
+
+def test_port_pool():
+    with pytest.raises(ValueError):
+        PortPool([])
+
+    pool = PortPool([11112, 11113])
+    with pool.acquire() as first_port:
+        with pool.acquire() as second_port:
+            assert {first_port, second_port} == {11112, 11113}
+
+
+def test_retrieval_scheduler_invalid_inputs():
+    with pytest.raises(ValueError):
+        RetrievalScheduler(max_workers=0)
+
+
+def test_retrieval_scheduler_ports_are_exclusive():
+    lock = threading.Lock()
+    ports_in_use = set()
+    running = []
+
+    def job(index, move_port=None):
+        with lock:
+            assert move_port not in ports_in_use
+            ports_in_use.add(move_port)
+            running.append(len(ports_in_use))
+        time.sleep(0.01)
+        with lock:
+            ports_in_use.remove(move_port)
+        return index
+
+    # The concurrency is capped by the number of ports
+    with RetrievalScheduler(max_workers=8, ports=[11112, 11113, 11114]) as scheduler:
+        assert scheduler.max_workers == 3
+        futures = [scheduler.submit(job, i, use_port=True) for i in range(20)]
+
+    assert [future.result() for future in futures] == list(range(20))
+    assert max(running) <= 3
@@ -0,0 +1,81 @@
+# Copyright 2018-2024 Lausanne University Hospital and University of Lausanne,
+# Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the functions of the `pacsifier.core.sorter` module."""
+
+import os
+import shutil
+
+from pydicom import dcmread
+
+from pacsifier.core.records import new_series_record
+from pacsifier.core.sorter import get_series_dirs, sanitize_name, sort_instances
+
+
+def test_get_series_dirs():
+    assert sanitize_name("Épaule D/G") == "Epaule_D_G"
+
+    serie = new_series_record()
+    serie.update(
+        PatientID="sub 01",
+        StudyDate="20171001",
+        StudyTime="114557",
+        SeriesNumber="3",
+        SeriesDescription="T1 mprage",
+    )
+    assert get_series_dirs("out", serie) == (
+        os.path.join("out", "sub-sub_01"),
+        os.path.join("out", "sub-sub_01", "ses-20171001114557"),
+        os.path.join("out", "sub-sub_01", "ses-20171001114557", "00003-T1_mprage"),
+    )
+
+    serie.update(PatientID="", StudyTime="", SeriesDescription="")
+    assert get_series_dirs("out", serie, default_patient_id="02")[2] == os.path.join(
+        "out", "sub-02", "ses-20171001", "00003-No_series_description"
+    )
+
+
+def test_sort_instances(test_dir):
+    output_dir = os.path.join(test_dir, "tmp", "sorter")
+    shutil.rmtree(output_dir, ignore_errors=True)
+    staging_dir = os.path.join(output_dir, "staging")
+    os.makedirs(staging_dir)
+    for i in range(3):
+        shutil.copy(
+            os.path.join(test_dir, "test_data", "dicomseries", f"slice{i}.dcm"),
+            staging_dir,
+        )
+    with open(os.path.join(staging_dir, "notes.txt"), "w") as f:
+        f.write("not a DICOM file")
+    series_instance_uid = dcmread(
+        os.path.join(staging_dir, "slice0.dcm"), stop_before_pixels=True
+    ).SeriesInstanceUID
+
+    # Series without known folder are sorted using their headers
+    counts = sort_instances(staging_dir, output_dir, {})
+    assert counts == {series_instance_uid: 3}
+    series_dir = os.path.join(
+        output_dir, "sub-PACSMAN1", "ses-20231016", "00000-pacsman_testing_dicom"
+    )
+    assert sorted(os.listdir(series_dir)) == ["slice0.dcm", "slice1.dcm", "slice2.dcm"]
+    assert os.listdir(staging_dir) == ["notes.txt"]
+
+    # Known series are moved to the given folders
+    for filename in os.listdir(series_dir):
+        shutil.move(os.path.join(series_dir, filename), staging_dir)
+    other_dir = os.path.join(output_dir, "sub-01", "00001-T1")
+    counts = sort_instances(staging_dir, output_dir, {series_instance_uid: other_dir})
+    assert counts == {series_instance_uid: 3}
+    assert len(os.listdir(other_dir)) == 3
@@ -0,0 +1,115 @@
+# Copyright 2018-2024 Lausanne University Hospital and University of Lausanne,
+# Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the functions of the `pacsifier.core.sources` module."""
+
+import threading
+import time
+
+import pytest
+
+from pacsifier.core.backend import DicomBackend
+from pacsifier.core.sources import MultiSourceBackend, Source
+
+
+class DummyBackend(DicomBackend):
+    """Backend recording its retrievals, which succeed unless ``fails`` is set."""
+
+    def __init__(self, port, fails=False, delay=0.0):
+        super().__init__("localhost", port, "DUMMY", "PACSIFIER_SCU")
+        self.fails = fails
+        self.delay = delay
+        self.moves = []
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+
+    def echo(self):
+        return not self.fails
+
+    def find(self, query_retrieval_level="SERIES", **query_attributes):
+        # Like the DCMTK and pynetdicom backends, a failed query returns no series
+        if self.fails:
+            self.request_failed("C-FIND")
+            return []
+        return [{"PatientID": query_attributes.get("patient_id", ""), "port": self.port}]
+
+    def move_remote(self, study_date, patient_id, study_instance_uid, series_instance_uid, move_aet, retrieve_level="SERIES"):
+        with self._lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(self.delay)
+        with self._lock:
+            self.active -= 1
+        self.moves.append(series_instance_uid)
+        return not self.fails
+
+
+def move(backend, series_instance_uid):
+    return backend.move_remote("", "01", "1.2", series_instance_uid, move_aet="DEST")
+
+
+def test_balancing():
+    first, second = DummyBackend(4444, delay=0.05), DummyBackend(4445, delay=0.05)
+    backend = MultiSourceBackend([Source(first, 2), Source(second, 1)])
+    assert backend.max_concurrent_moves == 3
+
+    threads = [threading.Thread(target=move, args=(backend, str(i))) for i in range(9)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # The retrievals are spread within the concurrency cap of each source
+    assert len(first.moves) + len(second.moves) == 9
+    assert first.max_active <= 2 and second.max_active <= 1
+    assert len(first.moves) > len(second.moves) > 0
+
+
+def test_failover():
+    broken, replica = DummyBackend(4444, fails=True), DummyBackend(4445)
+    backend = MultiSourceBackend([Source(broken), Source(replica)], backoff=60)
+
+    assert backend.echo()
+    assert not backend.sources[0].is_up()
+
+    # The broken source is only used as a last resort
+    assert move(backend, "1")
+    assert broken.moves == [] and replica.moves == ["1"]
+    assert backend.find(patient_id="01")[0]["port"] == 4445
+
+    # A retrieval failing on every source fails
+    replica.fails = True
+    assert not move(backend, "2")
+    assert broken.moves == ["2"]
+
+    with pytest.raises(ValueError):
+        MultiSourceBackend([])
+
+
+def test_query_failover():
+    primary, replica = DummyBackend(4444, fails=True), DummyBackend(4445)
+    assert primary.find(patient_id="01") == []
+
+    # The queries failing on the primary are sent to the replica
+    backend = MultiSourceBackend([Source(primary), Source(replica)], backoff=60)
+    assert backend.find(patient_id="01")[0]["port"] == 4445
+    assert not backend.sources[0].is_up()
+    assert backend.count_instances("01", "1.2", "1.2.3") == 1
+
+    # A query failing on every source returns no series
+    replica.fails = True
+    assert backend.find(patient_id="01") == []
+    assert backend.count_instances("01", "1.2", "1.2.3") == 0
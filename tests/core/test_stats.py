@@ -0,0 +1,101 @@
+# Copyright 2018-2024 Lausanne University Hospital and University of Lausanne,
+# Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the functions of the `pacsifier.core.stats` module."""
+
+import pytest
+
+from pacsifier.core.stats import (
+    RetrievalTiming,
+    current_timing,
+    describe,
+    format_summary,
+    percentile,
+    record_retry,
+    summarize_log,
+    timed,
+)
+
+
+def test_timed():
+    timing = RetrievalTiming("SERVER@localhost:4444")
+
+    def retrieve(result):
+        assert current_timing() is timing
+        record_retry()
+        record_retry("REPLICA@localhost:4445")
+        return result
+
+    assert timed(retrieve, timing, instances=lambda: 10)(True)
+    assert current_timing() is None
+    assert timing.success and timing.retries == 2
+    assert timing.server == "REPLICA@localhost:4445"
+    assert timing.instances == 10 and timing.instances_per_second == 10 / timing.seconds
+
+    # Retries outside a measured retrieval are ignored
+    record_retry()
+
+    timing = RetrievalTiming()
+    assert not timed(retrieve, timing)(False)
+    assert timing.success is False and timing.instances_per_second is None
+
+    def fail():
+        raise RuntimeError("association lost")
+
+    timing = RetrievalTiming()
+    with pytest.raises(RuntimeError):
+        timed(fail, timing)()
+    assert timing.success is False and timing.seconds is not None
+    assert current_timing() is None
+
+
+def test_percentile():
+    values = [4.0, 1.0, 3.0, 2.0, 5.0]
+    assert percentile(values, 50) == 3.0
+    assert percentile(values, 90) == pytest.approx(4.6)
+    assert percentile([7.0], 99) == 7.0
+    assert describe([1.0, None, 3.0]) == {"count": 2, "p50": 2.0, "p90": 2.8, "p99": 2.98, "max": 3.0}
+    assert describe([None]) == {"count": 0}
+    with pytest.raises(ValueError):
+        percentile([], 50)
+
+
+def test_summarize_log():
+    entry = {
+        "Status": "done",
+        "Modality": "MR",
+        "Server": "SERVER@localhost:4444",
+        "FilesFound": 100,
+        "BytesReceived": 1000,
+        "FindSeconds": 0.5,
+        "MoveSeconds": 10.0,
+        "InstancesPerSecond": 10.0,
+        "Retries": 1,
+    }
+    entries = [
+        entry,
+        {**entry, "Modality": "CT", "InstancesPerSecond": 20.0, "Retries": 0},
+        {**entry, "Status": "skipped", "FilesFound": 5, "MoveSeconds": "", "InstancesPerSecond": ""},
+        {**entry, "Status": "failed", "FilesFound": 0, "BytesReceived": "", "InstancesPerSecond": ""},
+    ]
+    summary = summarize_log(entries)
+    assert summary["series"] == {"done": 2, "skipped": 1, "failed": 1}
+    assert summary["instances"] == 200 and summary["bytes"] == 2000
+    assert summary["retries"] == 3
+    assert summary["find_seconds"]["count"] == 4
+    assert summary["instances_per_second"]["p50"] == 15.0
+    assert list(summary["instances_per_second_by_modality"]) == ["CT", "MR"]
+    assert "2 done" in format_summary(summary)
+    assert "n/a" in format_summary(summarize_log([]))
@@ -0,0 +1,84 @@
+# Copyright 2018-2024 Lausanne University Hospital and University of Lausanne,
+# Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the functions of the `pacsifier.core.throttle` module."""
+
+import time
+
+import pytest
+
+from pacsifier.core.throttle import AdaptiveThrottle
+
+
+def test_from_parameters():
+    parameters = {"batch_size": 30, "batch_wait_time": 10}
+    throttle = AdaptiveThrottle.from_parameters(parameters)
+    assert throttle.rate == 3
+    assert throttle.burst == 30
+
+    throttle = AdaptiveThrottle.from_parameters({**parameters, "max_moves_per_minute": 60})
+    assert throttle.rate == 1
+    assert throttle.max_rate == 1
+
+    # The limits apply to each PACS server
+    throttle = AdaptiveThrottle.from_parameters({**parameters, "sources": [{}]})
+    assert throttle.rate == 6
+    assert throttle.burst == 60
+
+    throttle = AdaptiveThrottle.from_parameters({**parameters, "batch_wait_time": 0})
+    assert throttle.rate is None
+
+    with pytest.raises(ValueError):
+        AdaptiveThrottle(0)
+
+
+def test_acquire():
+    throttle = AdaptiveThrottle(20, burst=2)
+    start = time.monotonic()
+    for _ in range(4):
+        throttle.acquire()
+    # The first two requests are started at once, the next ones at 20 per second
+    assert 0.08 <= time.monotonic() - start < 0.5
+
+
+def test_record():
+    throttle = AdaptiveThrottle(10, max_rate=12, min_rate=2)
+
+    # Fast successful requests increase the rate up to max_rate
+    for _ in range(5):
+        throttle.record(1.0, True, instances=100)
+    assert throttle.rate == 12
+
+    # Failures halve the rate
+    throttle.record(0.1, False)
+    assert throttle.rate == 6
+
+    # Slower requests (per instance) decrease the rate down to min_rate
+    for _ in range(5):
+        throttle.record(10.0, True, instances=100)
+    assert throttle.rate == 2
+
+    # Unthrottled requests are not adapted
+    throttle = AdaptiveThrottle(None)
+    throttle.record(1.0, False)
+    assert throttle.rate is None
+
+
+def test_wrap():
+    throttle = AdaptiveThrottle(10, min_rate=1)
+    assert not throttle.wrap(lambda x: x)(False)
+    assert throttle.rate == 5
+    assert throttle.wrap(lambda x: x, instances=lambda: 3)(True)
+    assert throttle.rate == 6
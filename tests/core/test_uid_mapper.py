@@ -0,0 +1,74 @@
+# Copyright 2018-2024 Lausanne University Hospital and University of Lausanne,
+# Switzerland & Contributors
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the functions of the `pacsifier.core.uid_mapper` module."""
+
+import os
+import pickle
+
+import pydicom
+import pytest
+
+from pacsifier.core.uid_mapper import MAX_UID_LENGTH, UID_SECRET_ENV, UIDMapper, derive_uid
+
+
+def test_derive_uid():
+    uid = derive_uid("1.2.3", b"secret")
+    assert uid == derive_uid("1.2.3", b"secret")
+    assert uid != derive_uid("1.2.3", b"other secret")
+    assert uid != derive_uid("1.2.4", b"secret")
+    assert uid.startswith(pydicom.uid.PYDICOM_ROOT_UID)
+    assert len(uid) == MAX_UID_LENGTH
+    assert pydicom.uid.UID(uid).is_valid
+
+
+def test_uid_mapper(monkeypatch):
+    monkeypatch.delenv(UID_SECRET_ENV, raising=False)
+    mapper = UIDMapper("secret")
+    assert mapper("1.2.3") == UIDMapper(b"secret")("1.2.3") == derive_uid("1.2.3", b"secret")
+    # Workers of a process pool get the same UIDs
+    assert pickle.loads(pickle.dumps(mapper))("1.2.3") == mapper("1.2.3")
+
+    # Random secret, unless one is given by the environment
+    assert UIDMapper()("1.2.3") != UIDMapper()("1.2.3")
+    monkeypatch.setenv(UID_SECRET_ENV, "secret")
+    assert UIDMapper()("1.2.3") == mapper("1.2.3")
+
+    with pytest.raises(ValueError):
+        UIDMapper("")
+    with pytest.raises(ValueError):
+        UIDMapper("secret", prefix="1.2.3.4.5.6.7.8.9.10.11.12.13.14.15.16.17.18.19.20.")
+
+
+def test_uid_map(test_dir):
+    map_path = os.path.join(test_dir, "tmp", "uid_mapper", "uids.csv")
+    if os.path.exists(map_path):
+        os.remove(map_path)
+
+    mapper = UIDMapper("secret", map_path)
+    assert mapper("1.2.3") == mapper("1.2.3") == derive_uid("1.2.3", b"secret")
+    mapper("1.2.4")
+    with open(map_path) as f:
+        assert f.read().splitlines() == [
+            f"1.2.3,{derive_uid('1.2.3', b'secret')}",
+            f"1.2.4,{derive_uid('1.2.4', b'secret')}",
+        ]
+
+    # The UIDs of the map keep their new UID with another secret
+    other_mapper = UIDMapper("other secret", map_path)
+    assert other_mapper("1.2.3") == mapper("1.2.3")
+    assert other_mapper("1.2.5") == derive_uid("1.2.5", b"other secret")
+    with open(map_path) as f:
+        assert len(f.read().splitlines()) == 3